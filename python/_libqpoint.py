@@ -28,13 +28,57 @@ wvec3_t = NDP(np.double, ndim=1, shape=(3,), flags=['A','C','W'])
 wvec3_t_p = NDP(np.double, ndim=2, flags=['A','C','W'])
 
 arr = NDP(np.double, ndim=1, flags=['A','C'])
+arrs = NDP(np.float32, ndim=1, flags=['A','C'])
 arrf = NDP(np.uint8, ndim=1, flags=['A','C'])
+warrf = NDP(np.uint8, ndim=1, flags=['A','C','W'])
 warr = NDP(np.double, ndim=1, flags=['A','C','W'])
 warri = NDP(np.int, ndim=1, flags=['A','C','W'])
 
 arr2 = NDP(np.uintp, ndim=1, flags=['A','C'])
 larr = NDP(np.long, ndim=1, flags=['A','C'])
 
+arr_2d = NDP(np.double, ndim=2, flags=['A','C'])
+warr_2d = NDP(np.double, ndim=2, flags=['A','C','W'])
+warri_2d = NDP(np.int, ndim=2, flags=['A','C','W'])
+warrs_2d = NDP(np.float32, ndim=2, flags=['A','C','W'])
+warri32_3d = NDP(np.int32, ndim=3, flags=['A','C','W'])
+warrs_3d = NDP(np.float32, ndim=3, flags=['A','C','W'])
+
+def check_frame(name):
+    """
+    Return a coordinate frame name as a single byte, for passing to the
+    C library.
+    """
+    if not isinstance(name, bytes):
+        name = str(name).encode()
+    if len(name) != 1:
+        raise ValueError('invalid coordinate frame {}'.format(name))
+    return name
+
+def check_coord(coord):
+    """
+    Return the input and output frames of a 2-element coord list.
+    """
+    try:
+        coord_in, coord_out = coord
+    except (TypeError, ValueError):
+        raise ValueError('unable to parse coord')
+    return check_frame(coord_in), check_frame(coord_out)
+
+def nullable(ndp):
+    """
+    Extend an ndpointer type to also accept None, which is passed to the
+    C library as a NULL pointer.
+    """
+    def from_param(cls, obj):
+        if obj is None:
+            return obj
+        return ndp.from_param(obj)
+    return type(ndp)(ndp.__name__ + '_or_null', (ndp,),
+                {'from_param': classmethod(from_param)})
+
+nquat_t_p = nullable(quat_t_p)
+
 QP_DO_ALWAYS = ct.c_int.in_dll(libqp, "QP_DO_ALWAYS").value
 QP_DO_ONCE = ct.c_int.in_dll(libqp, "QP_DO_ONCE").value
 QP_DO_NEVER = ct.c_int.in_dll(libqp, "QP_DO_NEVER").value
@@ -45,6 +89,13 @@ class qp_state_t(ct.Structure):
         ('ctime_last', ct.c_double)
         ]
 
+class qp_interp_t(ct.Structure):
+    _fields_ = [
+        ('ctime', ct.c_double * 2),
+        ('dut1', ct.c_double),
+        ('q', (ct.c_double * 4) * 2),
+        ]
+
 class qp_weather_t(ct.Structure):
     _fields_ = [
         ('temperature', ct.c_double),
@@ -67,6 +118,23 @@ class qp_bulletina_t(ct.Structure):
         ('mjd_max', ct.c_int),
         ]
 
+class qp_ephem_t(ct.Structure):
+    _fields_ = [
+        ('data', ct.POINTER(ct.c_double)),
+        ('ctime0', ct.c_double),
+        ('step', ct.c_double),
+        ('n', ct.c_int),
+        ('accuracy', ct.c_int),
+        ]
+
+QP_MAX_FRAMES = 16
+
+class qp_frame_t(ct.Structure):
+    _fields_ = [
+        ('name', ct.c_char),
+        ('q', ct.c_double * 4),
+        ]
+
 class qp_memory_t(ct.Structure):
     _fields_ = [
         ('init', ct.c_int),
@@ -105,11 +173,20 @@ class qp_memory_t(ct.Structure):
         ('q_gal', ct.c_double * 4),
         ('q_gal_inv', ct.c_double * 4),
         ('gal_init', ct.c_int),
+        ('num_frames', ct.c_int),
+        ('frames', qp_frame_t * QP_MAX_FRAMES),
         ('v_dipole', ct.c_double * 3),
         ('dipole_init', ct.c_int),
         ('beta_earth', ct.c_double * 3),
         ('beta_rot', ct.c_double * 3),
         ('bulletinA', qp_bulletina_t),
+        ('ephem', qp_ephem_t),
+        ('interp_wobble', qp_interp_t),
+        ('interp_wobble_inv', qp_interp_t),
+        ('interp_erot', qp_interp_t),
+        ('interp_erot_inv', qp_interp_t),
+        ('interp_npb', qp_interp_t),
+        ('interp_npb_inv', qp_interp_t),
 
         ('accuracy', ct.c_int),
         ('mean_aber', ct.c_int),
@@ -123,10 +200,17 @@ class qp_memory_t(ct.Structure):
         ('interp_missing', ct.c_int),
         ('num_threads', ct.c_int),
         ('thread_num', ct.c_int),
+        ('reduce_mode', ct.c_int),
+        ('parallel_mode', ct.c_int),
+        ('interp_corr', ct.c_int),
+        ('sort_pix', ct.c_int),
         ]
 
 qp_memory_t_p = ct.POINTER(qp_memory_t)
 
+# number of values per correction table entry
+QP_EPHEM_NCOL = 11
+
 QP_STRUCT_INIT = 1
 QP_STRUCT_MALLOC = 2
 QP_ARR_INIT_PTR = 4
@@ -143,10 +227,19 @@ class qp_det_t(ct.Structure):
         ('n', ct.c_size_t),
         ('tod_init', ct.c_int),
         ('tod', ct.POINTER(ct.c_double)),
+        ('todf', ct.POINTER(ct.c_float)),
         ('flag_init', ct.c_int),
         ('flag', ct.POINTER(ct.c_uint8)),
         ('weights_init', ct.c_int),
         ('weights', ct.POINTER(ct.c_double)),
+        ('weightsf', ct.POINTER(ct.c_float)),
+        ('pnt_init', ct.c_int),
+        ('pix', ct.POINTER(ct.c_long)),
+        ('sin2psi', ct.POINTER(ct.c_float)),
+        ('cos2psi', ct.POINTER(ct.c_float)),
+        ('interp_init', ct.c_int),
+        ('interp_pix', ct.POINTER(ct.c_int32)),
+        ('interp_weight', ct.POINTER(ct.c_float)),
         ]
 qp_det_t_p = ct.POINTER(qp_det_t)
 
@@ -169,7 +262,15 @@ class qp_point_t(ct.Structure):
         ('ctime_init', ct.c_int),
         ('ctime', ct.POINTER(ct.c_double)),
         ('q_hwp_init', ct.c_int),
-        ('q_hwp', ct.POINTER(ct.c_double * 4))
+        ('q_hwp', ct.POINTER(ct.c_double * 4)),
+        ('beta_init', ct.c_int),
+        ('beta', ct.POINTER(ct.c_double * 3)),
+        ('beta_n', ct.c_size_t),
+        ('beta_ctime', ct.POINTER(ct.c_double)),
+        ('beta_q_bore', ct.POINTER(ct.c_double * 4)),
+        ('beta_rate', ct.c_double),
+        ('beta_accuracy', ct.c_int),
+        ('beta_ephem', qp_ephem_t),
         ]
 qp_point_t_p = ct.POINTER(qp_point_t)
 
@@ -199,6 +300,27 @@ proj_modes = {1  : QP_PROJ_TEMP,
               6  : QP_PROJ_POL,
               10 : QP_PROJ_VPOL}
 
+qp_grid_type = ct.c_uint
+QP_GRID_HEALPIX = 0
+QP_GRID_CAR = 1
+QP_GRID_TAN = 2
+grid_types = {'car' : QP_GRID_CAR,
+              'tan' : QP_GRID_TAN}
+
+class qp_grid_t(ct.Structure):
+    _fields_ = [
+        ('type', qp_grid_type),
+        ('ra0', ct.c_double),
+        ('dec0', ct.c_double),
+        ('x0', ct.c_double),
+        ('y0', ct.c_double),
+        ('dx', ct.c_double),
+        ('dy', ct.c_double),
+        ('nx', ct.c_long),
+        ('ny', ct.c_long),
+        ('q_center', ct.c_double * 4),
+        ]
+
 class qp_map_t(ct.Structure):
     _fields_ = [
         ('init', ct.c_int),
@@ -209,6 +331,7 @@ class qp_map_t(ct.Structure):
         ('pixinfo', ct.c_void_p),
         ('pixhash_init', ct.c_int),
         ('pixhash', ct.c_void_p),
+        ('grid', qp_grid_t),
         ('num_vec', ct.c_size_t),
         ('vec_mode', qp_vec_mode),
         ('vec1d_init', ct.c_int),
@@ -220,10 +343,34 @@ class qp_map_t(ct.Structure):
         ('proj1d_init', ct.c_int),
         ('proj1d', ct.POINTER(ct.c_double)),
         ('proj_init', ct.c_int),
-        ('proj', ct.POINTER(ct.POINTER(ct.c_double)))
+        ('proj', ct.POINTER(ct.POINTER(ct.c_double))),
+        ('interleave', ct.c_size_t),
+        ('single', ct.c_int),
+        ('vec1df', ct.POINTER(ct.c_float)),
+        ('vecf', ct.POINTER(ct.POINTER(ct.c_float))),
+        ('proj1df', ct.POINTER(ct.c_float)),
+        ('projf', ct.POINTER(ct.POINTER(ct.c_float))),
         ]
 qp_map_t_p = ct.POINTER(qp_map_t)
 
+class qp_rotate_plan_t(ct.Structure):
+    _fields_ = [
+        ('init', ct.c_int),
+        ('nside', ct.c_int),
+        ('pix_order', ct.c_int),
+        ('coord_in', ct.c_char),
+        ('coord_out', ct.c_char),
+        ('polconv', ct.c_int),
+        ('nstencil', ct.c_int),
+        ('npix_in', ct.c_size_t),
+        ('npix_out', ct.c_size_t),
+        ('pix', ct.POINTER(ct.c_int32)),
+        ('weight', ct.POINTER(ct.c_float)),
+        ('cos2psi', ct.POINTER(ct.c_float)),
+        ('sin2psi', ct.POINTER(ct.c_float)),
+        ]
+qp_rotate_plan_t_p = ct.POINTER(qp_rotate_plan_t)
+
 def pointer_2d(d):
     return (d.__array_interface__['data'][0] +
             np.arange(d.shape[0]) * d.strides[0]).astype(np.uintp)
@@ -290,6 +437,10 @@ setargs('qp_azel2bore',
         arg=(qp_memory_t_p, # params
              arr, arr, arr, arr, arr, arr, arr, # a/e/p/r/l/l/t
              wquat_t_p, ct.c_int))
+setargs('qp_azel2bore_batch',
+        arg=(qp_memory_t_p, # params
+             arr, arr, arr, arr, arr, arr, arr, # a/e/p/r/l/l/t
+             wquat_t_p, ct.c_int))
 
 setargs('qp_det_offsetn', arg=(arr, arr, arr, wquat_t_p, ct.c_int))
 setargs('qp_bore_offset', arg=(qp_memory_t_p, wquat_t_p, arr, arr, arr,
@@ -320,6 +471,16 @@ setargs('qp_bore2radecpa_hwp',
         arg=(qp_memory_t_p, quat_t, arr, quat_t_p, quat_t_p,
              warr, warr, warr, ct.c_int))
 
+setargs('qp_bore2radec_ndet',
+        arg=(qp_memory_t_p, quat_t_p, ct.c_int, arr, quat_t_p, nquat_t_p,
+             warr_2d, warr_2d, warr_2d, warr_2d, ct.c_int))
+setargs('qp_bore2rasindec_ndet',
+        arg=(qp_memory_t_p, quat_t_p, ct.c_int, arr, quat_t_p, nquat_t_p,
+             warr_2d, warr_2d, warr_2d, warr_2d, ct.c_int))
+setargs('qp_bore2radecpa_ndet',
+        arg=(qp_memory_t_p, quat_t_p, ct.c_int, arr, quat_t_p, nquat_t_p,
+             warr_2d, warr_2d, warr_2d, ct.c_int))
+
 setargs('qp_radecpa2quatn',
         arg=(qp_memory_t_p, arr, arr, arr, wquat_t_p, ct.c_int))
 setargs('qp_quat2radecpan',
@@ -331,6 +492,26 @@ setargs('qp_radec2pixn',
 setargs('qp_radec2gal_quatn', arg=(qp_memory_t_p, wquat_t_p, ct.c_int))
 setargs('qp_gal2radec_quatn', arg=(qp_memory_t_p, wquat_t_p, ct.c_int))
 
+setargs('qp_set_frame', arg=(qp_memory_t_p, ct.c_char, quat_t),
+        res=ct.c_int)
+setargs('qp_set_frame_center',
+        arg=(qp_memory_t_p, ct.c_char, ct.c_double, ct.c_double,
+             ct.c_double),
+        res=ct.c_int)
+setargs('qp_get_frame', arg=(qp_memory_t_p, ct.c_char, wquat_t),
+        res=ct.c_int)
+setargs('qp_rotate_quatn',
+        arg=(qp_memory_t_p, ct.c_char, ct.c_char, wquat_t_p, ct.c_int),
+        res=ct.c_int)
+setargs('qp_rotate_coordn',
+        arg=(qp_memory_t_p, ct.c_char, ct.c_char, warr, warr, warr, warr,
+             ct.c_int),
+        res=ct.c_int)
+setargs('qp_rotate_coordpan',
+        arg=(qp_memory_t_p, ct.c_char, ct.c_char, warr, warr, warr,
+             ct.c_int),
+        res=ct.c_int)
+
 setargs('qp_radec2galn',
         arg=(qp_memory_t_p, warr, warr, warr, warr, ct.c_int))
 setargs('qp_gal2radecn',
@@ -342,6 +523,22 @@ setargs('qp_gal2radecpan',
 setargs('qp_rotate_map',
         arg=(qp_memory_t_p, ct.c_int, arr2, ct.c_char,
              arr2, ct.c_char))
+setargs('qp_init_rotate_plan',
+        arg=(qp_memory_t_p, ct.c_int, ct.c_char, ct.c_char,
+             nullable(larr), ct.c_size_t, nullable(larr), ct.c_size_t),
+        res=qp_rotate_plan_t_p)
+setargs('qp_free_rotate_plan', arg=qp_rotate_plan_t_p)
+setargs('qp_apply_rotate_plan',
+        arg=(qp_memory_t_p, qp_rotate_plan_t_p, arr2, arr2, ct.c_int,
+             ct.c_int),
+        res=ct.c_int)
+setargs('qp_reorder_map',
+        arg=(qp_memory_t_p, ct.c_int, arr2, ct.c_int, ct.c_int),
+        res=ct.c_int)
+setargs('qp_ud_grade_map',
+        arg=(qp_memory_t_p, ct.c_int, arr2, ct.c_int, arr2, ct.c_int,
+             nullable(arr), ct.c_int),
+        res=ct.c_int)
 
 setargs('qp_quat2pixn',
         arg=(qp_memory_t_p, quat_t_p, ct.c_int, warri, warr, warr, ct.c_int))
@@ -360,8 +557,18 @@ setargs('qp_bore2pixpa_hwp',
         arg=(qp_memory_t_p, quat_t, arr, quat_t_p, quat_t_p, ct.c_int,
              warri, warr, ct.c_int))
 
+setargs('qp_bore2pix_ndet',
+        arg=(qp_memory_t_p, quat_t_p, ct.c_int, arr, quat_t_p, nquat_t_p,
+             ct.c_int, warri_2d, warr_2d, warr_2d, ct.c_int))
+setargs('qp_bore2pixpa_ndet',
+        arg=(qp_memory_t_p, quat_t_p, ct.c_int, arr, quat_t_p, nquat_t_p,
+             ct.c_int, warri_2d, warr_2d, ct.c_int))
+
 setargs('qp_get_interp_valn',
         arg=(qp_memory_t_p, ct.c_int, arr, arr, arr, warr, ct.c_int))
+setargs('qp_get_interp_valn_nmap',
+        arg=(qp_memory_t_p, ct.c_int, arr_2d, ct.c_int, arr, arr, warr_2d,
+             ct.c_int))
 
 setargs('qp_set_iers_bulletin_a',
         arg=(qp_memory_t_p, ct.c_int, ct.c_int, arr, arr, arr),
@@ -371,6 +578,12 @@ setargs('qp_get_iers_bulletin_a',
              ct.POINTER(ct.c_double), ct.POINTER(ct.c_double)),
         res=ct.c_int)
 
+setargs('qp_fill_ephem',
+        arg=(qp_memory_t_p, ct.c_double, ct.c_double, ct.c_int, warr_2d))
+setargs('qp_set_ephem',
+        arg=(qp_memory_t_p, ct.c_double, ct.c_double, ct.c_int, ct.c_int,
+             nullable(arr_2d)))
+
 def qp_get_bulletin_a(mem, mjd):
     dut1 = ct.c_double()
     x = ct.c_double()
@@ -425,6 +638,8 @@ setargs('qp_default_det', res=qp_det_t_p)
 setargs('qp_init_det_tod', arg=(qp_det_t_p, ct.c_size_t))
 setargs('qp_init_det_tod_from_array',
         arg=(qp_det_t_p, arr, ct.c_size_t, ct.c_int))
+setargs('qp_init_det_todf_from_array',
+        arg=(qp_det_t_p, arrs, ct.c_size_t, ct.c_int))
 setargs('qp_init_det_flag', arg=(qp_det_t_p, ct.c_size_t))
 setargs('qp_init_det_flag_from_array',
         arg=(qp_det_t_p, arrf, ct.c_size_t, ct.c_int))
@@ -446,10 +661,14 @@ setargs('qp_init_point_from_arrays',
         arg=(quat_t_p, arr, quat_t_p, ct.c_size_t, ct.c_int),
         res=qp_point_t_p)
 setargs('qp_free_point', arg=qp_point_t_p)
+setargs('qp_reset_point_beta', arg=qp_point_t_p)
 
 # initialize maps
 setargs('qp_init_map', arg=(ct.c_size_t, ct.c_size_t, qp_vec_mode, qp_proj_mode),
         res=qp_map_t_p)
+setargs('qp_init_map_single',
+        arg=(ct.c_size_t, ct.c_size_t, qp_vec_mode, qp_proj_mode),
+        res=qp_map_t_p)
 setargs('qp_init_map_from_arrays_1d',
         arg=(arr, arr, ct.c_size_t, ct.c_size_t,
              qp_vec_mode, qp_proj_mode, ct.c_int),
@@ -460,9 +679,27 @@ setargs('qp_free_map', arg=qp_map_t_p)
 setargs('qp_reshape_map', arg=qp_map_t_p, res=ct.c_int)
 setargs('qp_init_map_pixhash',
         arg=(qp_map_t_p, larr, ct.c_size_t), res=ct.c_int)
+setargs('qp_init_map_grid',
+        arg=(qp_map_t_p, qp_grid_type, ct.c_double, ct.c_double, ct.c_double,
+             ct.c_double, ct.c_double, ct.c_double, ct.c_long, ct.c_long),
+        res=ct.c_int)
+setargs('qp_quat2gridn',
+        arg=(qp_memory_t_p, ct.POINTER(qp_grid_t), quat_t_p, warri, warr,
+             warr, ct.c_int))
+
+# pointing cache
+setargs('qp_detarr_pnt',
+        arg=(qp_memory_t_p, qp_detarr_t_p, qp_point_t_p, qp_map_t_p,
+             warri_2d, warrs_2d, warrs_2d),
+        res=ct.c_int)
+setargs('qp_detarr_interp',
+        arg=(qp_memory_t_p, qp_detarr_t_p, qp_point_t_p, qp_map_t_p,
+             warri_2d, warrs_2d, warrs_2d, warri32_3d, warrs_3d),
+        res=ct.c_int)
 
 # tod -> map
-setargs('qp_add_map', arg=(qp_map_t_p, qp_map_t_p), res=ct.c_int)
+setargs('qp_add_map', arg=(qp_memory_t_p, qp_map_t_p, qp_map_t_p),
+        res=ct.c_int)
 setargs('qp_tod2map1',
         arg=(qp_memory_t_p, qp_det_t_p, qp_point_t_p, qp_map_t_p),
         res=ct.c_int)
@@ -477,6 +714,32 @@ setargs('qp_map2tod1',
 setargs('qp_map2tod',
         arg=(qp_memory_t_p, qp_detarr_t_p, qp_point_t_p, qp_map_t_p),
         res=ct.c_int)
+setargs('qp_proj_cond',
+        arg=(qp_memory_t_p, arr2, ct.c_int, ct.c_size_t, warr),
+        res=ct.c_int)
+setargs('qp_solve_map',
+        arg=(qp_memory_t_p, arr2, arr2, ct.c_int, ct.c_size_t,
+             nullable(warrf), nullable(warr), ct.c_double, ct.c_double,
+             ct.c_int),
+        res=ct.c_int)
+setargs('qp_unsolve_map',
+        arg=(qp_memory_t_p, arr2, arr2, ct.c_int, ct.c_size_t,
+             nullable(warrf), ct.c_double),
+        res=ct.c_int)
+setargs('qp_proj_inv',
+        arg=(qp_memory_t_p, arr2, arr2, ct.c_int, ct.c_size_t, ct.c_double),
+        res=ct.c_int)
+setargs('qp_tod2map_solve',
+        arg=(qp_memory_t_p, qp_detarr_t_p, qp_point_t_p, qp_map_t_p,
+             nullable(warr), nullable(warr), ct.c_double, ct.c_double),
+        res=ct.c_int)
+qp_tod_filter_t = ct.CFUNCTYPE(ct.c_int, ct.POINTER(ct.c_double),
+                               ct.c_size_t, ct.c_size_t, ct.c_void_p)
+setargs('qp_tod2map_cg',
+        arg=(qp_memory_t_p, qp_detarr_t_p, qp_point_t_p, qp_map_t_p,
+             qp_tod_filter_t, ct.c_void_p, ct.c_double, ct.c_int, ct.c_double,
+             nullable(warr), ct.POINTER(ct.c_int)),
+        res=ct.c_int)
 
 # **********************************************************************
 # Parameters
@@ -571,10 +834,18 @@ opts = {'accuracy': {0: 'high',
         'polconv': {0: ['healpix', 'cosmo'],
                     1: 'iau'},
         'pix_order': {0: 'ring',
-                      1: ['nest', 'nested']}}
+                      1: ['nest', 'nested']},
+        'reduce_mode': {0: 'copy',
+                        1: 'owner',
+                        2: 'sparse'},
+        'parallel_mode': {0: ['det', 'detector'],
+                          1: 'sample',
+                          2: 'auto'}}
 defaults = {'accuracy': 0,
             'polconv': 0,
-            'pix_order': 0}
+            'pix_order': 0,
+            'reduce_mode': 0,
+            'parallel_mode': 0}
 
 def check_set_dict(opt):
     def func(val):
@@ -616,6 +887,12 @@ check_get_polconv = check_get_dict('polconv')
 check_set_pix_order = check_set_dict('pix_order')
 check_get_pix_order = check_get_dict('pix_order')
 
+check_set_reduce_mode = check_set_dict('reduce_mode')
+check_get_reduce_mode = check_get_dict('reduce_mode')
+
+check_set_parallel_mode = check_set_dict('parallel_mode')
+check_get_parallel_mode = check_get_dict('parallel_mode')
+
 def check_get_bool(val):
     return bool(val)
 
@@ -643,6 +920,12 @@ check_get_interp_missing = check_get_bool
 check_set_interp_pix = check_set_bool
 check_get_interp_pix = check_get_bool
 
+check_set_interp_corr = check_set_bool
+check_get_interp_corr = check_get_bool
+
+check_set_sort_pix = check_set_bool
+check_get_sort_pix = check_get_bool
+
 def check_set_num_threads(nt):
     if nt is None:
         return 0
@@ -661,7 +944,8 @@ def check_get_thread_num(tn):
 
 options = ['accuracy', 'mean_aber', 'fast_math', 'polconv', 'pix_order',
            'interp_pix', 'fast_pix', 'error_missing', 'nan_missing',
-           'interp_missing', 'num_threads', 'thread_num']
+           'interp_missing', 'num_threads', 'thread_num', 'reduce_mode',
+           'parallel_mode', 'interp_corr', 'sort_pix']
 option_funcs = dict()
 for p in options:
     option_funcs[p] = dict()
@@ -45,6 +45,8 @@ def check_map(map_in, copy=False, partial=False, dtype=np.double):
     partial : bool, optional
         If True, the map is not checked to ensure a proper healpix nside,
         and the number of pixels is returned instead.
+    dtype : numpy.dtype, optional
+        Ensure the output map is of this dtype.  Default: numpy.double.
 
     Returns
     -------
@@ -66,7 +68,7 @@ def check_map(map_in, copy=False, partial=False, dtype=np.double):
         map_out = map_out.copy()
     return map_out, dim2
 
-def check_proj(proj_in, copy=False, partial=False):
+def check_proj(proj_in, copy=False, partial=False, dtype=np.double):
     """
     Return a properly transposed and memory-aligned projection map,
     its nside, and the map dimension.
@@ -82,6 +84,8 @@ def check_proj(proj_in, copy=False, partial=False):
     partial : bool, optional
         If True, the map is not checked to ensure a proper healpix nside,
         and the number of pixels is returned instead.
+    dtype : numpy.dtype, optional
+        Ensure the output map is of this dtype.  Default: numpy.double.
 
     Returns
     -------
@@ -95,12 +99,65 @@ def check_proj(proj_in, copy=False, partial=False):
         the solution to `len(proj) = nmap * (nmap + 1) / 2`.  Raises an
         error if an integer solution is not found.
     """
-    proj_out, dim2 = check_map(proj_in, copy=copy, partial=partial)
+    proj_out, dim2 = check_map(proj_in, copy=copy, partial=partial,
+                               dtype=dtype)
     nmap = int((np.sqrt(8 * len(proj_out) + 1) - 1)) // 2
     if (nmap * (nmap + 1) // 2 != len(proj_out)):
         raise ValueError('proj has incompatible shape')
     return proj_out, dim2, nmap
 
+def _check_dtype(arr, dtype=None):
+    """
+    Return the storage dtype of a map or timestream array: `dtype` if
+    supplied, otherwise single precision for single-precision input arrays,
+    and double precision for everything else.
+    """
+    if dtype is None:
+        if isinstance(arr, np.ndarray) and arr.dtype == np.float32:
+            dtype = np.float32
+        else:
+            dtype = np.double
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.double):
+        raise ValueError('dtype must be float32 or float64')
+    return dtype
+
+def _map_pointer(data, interleave=False):
+    """
+    Return the name of the 1d map array field of a ``qp_map_t`` structure
+    for the given data array, and a pointer to the array.  For interleaved
+    maps, the pointer is to the first element of the (strided) array.
+    """
+    if data.dtype == np.float32:
+        name, ctype = '1df', ct.c_float
+    else:
+        name, ctype = '1d', ct.c_double
+    if interleave:
+        return name, ct.cast(data.ctypes.data, ct.POINTER(ctype))
+    return name, lib.as_ctypes(data.ravel())
+
+def _check_grid(grid):
+    """
+    Return the arguments to ``qp_init_map_grid`` for a flat-sky grid
+    definition, as described in :meth:`QMap.init_dest`, and the number of
+    pixels in the grid.
+    """
+    try:
+        gtype = lib.grid_types[grid['proj'].lower()]
+    except KeyError:
+        raise ValueError('grid proj must be one of {}'.format(
+            list(lib.grid_types)))
+    ny, nx = [int(x) for x in grid['shape']]
+    res = np.broadcast_to(np.asarray(grid['res'], dtype=np.double), (2,))
+    dx, dy = res
+    ra0, dec0 = grid.get('center', (0, 0))
+    if nx <= 0 or ny <= 0 or dx == 0 or dy == 0:
+        raise ValueError('invalid grid shape or resolution')
+    # the center is halfway across the grid
+    x0 = -(nx - 1) / 2. * dx
+    y0 = -(ny - 1) / 2. * dy
+    return (gtype, ra0, dec0, x0, y0, dx, dy, nx, ny), nx * ny
+
 class QMap(QPoint):
     """
     Quaternion-based mapmaker that generates per-channel pointing
@@ -109,7 +166,8 @@ class QMap(QPoint):
 
     def __init__(self, nside=None, pol=True, vpol=False,
                  source_map=None, source_pol=True, source_vpol=False,
-                 q_bore=None, ctime=None, q_hwp=None, **kwargs):
+                 q_bore=None, ctime=None, q_hwp=None, cache_pointing=False,
+                 **kwargs):
         """
         Initialize the internal structures and data depo for
         mapmaking and/or timestream generation.
@@ -135,6 +193,17 @@ class QMap(QPoint):
             Boresight pointing data.  See `init_point()` for details.
             If not supplied, the pointing structure is left
             uninitialized.
+        cache_pointing : bool, optional
+            If True, the pixel index and polarization angle timestreams
+            computed for each set of detector offsets are cached and reused
+            by subsequent calls to `from_tod()` and `to_tod()` with the
+            same pointing, map geometry and pointing options.
+            The cache is stored in single precision, and requires
+            16 bytes per sample per detector for each of the source and
+            destination maps.  If the `interp_pix` option is enabled, the
+            bilinear interpolation stencil for the source map is cached
+            as well, for an additional 32 bytes per sample per detector.
+            Default: False.
 
         Notes
         -----
@@ -146,9 +215,21 @@ class QMap(QPoint):
         Only pointers to these arrays in memory are passed to the C
         library.  To ensure that extraneous copies of data are not made,
         supply these methods with C-contiguous arrays of the correct shape.
+
+        The pointing cache is invalidated whenever the pointing or map
+        structures are reinitialized, when an option that affects the
+        pointing is changed with `set()`, and when IERS Bulletin A or a
+        correction table is loaded.  If the pointing arrays in the
+        depo are modified in place, call `reset_pnt_cache()` explicitly.
+        Replacing the source map with `init_source(..., update=True)`
+        keeps the cache, so that several maps with the same geometry can
+        be scanned with a single pointing computation.
         """
         super(QMap, self).__init__(**kwargs)
 
+        self.cache_pointing = cache_pointing
+        self._pnt_cache = dict()
+
         self.depo = dict()
         """
         Dictionary of source and output maps, timetreams and pointing data.
@@ -177,7 +258,7 @@ class QMap(QPoint):
         return True
 
     def init_source(self, source_map, pol=True, pixels=None, nside=None,
-                    vpol=False, reset=False, update=False):
+                    vpol=False, grid=None, reset=False, update=False):
         """
         Initialize the source map structure.  Timestreams are
         produced by scanning this map.
@@ -186,19 +267,24 @@ class QMap(QPoint):
         ---------
         source_map : array_like
             Input map.  Must be of shape `(N, npix)`, where `N` can be
-            1, 3, 6, 9, or 18.
+            1, 3, 6, 9, or 18.  Single-precision (float32) maps are stored
+            as is, and all other maps are stored in double precision.
         pol : bool, optional
             If `True`, and the map shape is `(3, npix)`, then input is a
             polarized map (and not T + first derivatives).
         pixels : 1D array_like, optional
             Array of pixel numbers for each map index, if `source_map` is
-            a partial map.
+            a partial map.  Pixel lookups are fastest if the pixels are
+            sorted into a few contiguous ranges, e.g. a NEST-ordered patch.
         nside : int, optional
             map dimension.  If `pixels` is supplied, this argument is required.
             Otherwise, the nside is determined from the input map.
         vpol : bool, optional
             If `True`, and the input map shape is `(4, npix)`, then input is
             a polarized map that includes V polarization.
+        grid : dict, optional
+            Flat-sky pixelization of `source_map`, instead of healpix.
+            See :meth:`init_dest` for the format.
         reset : bool, optional
             If `True`, and if the structure has already been initialized,
             it is reset and re-initialized with the new map.  If `False`,
@@ -238,10 +324,13 @@ class QMap(QPoint):
                 if source_map.squeeze().shape[-1] != \
                         self.depo['source_map'].squeeze().shape[-1]:
                     raise ValueError('source_map shape mismatch')
-                source_map, _ = check_map(source_map, partial=True)
+                source_map, _ = check_map(
+                    source_map, partial=True,
+                    dtype=self.depo['source_map'].dtype)
                 source.num_vec = len(source_map)
                 source.vec_mode = lib.get_vec_mode(source_map, pol, vpol)
-                source.vec1d = lib.as_ctypes(source_map.ravel())
+                name, ptr = _map_pointer(source_map)
+                setattr(source, 'vec' + name, ptr)
                 self.depo['source_map'] = source_map
                 if qp.qp_reshape_map(self._source):
                     raise RuntimeError('Error reshaping source map')
@@ -250,7 +339,15 @@ class QMap(QPoint):
             else:
                 raise RuntimeError('source already initialized')
 
-        if pixels is None:
+        self.reset_pnt_cache('source')
+
+        if grid is not None:
+            if pixels is not None:
+                raise ValueError('pixels not supported for grid maps')
+            grid_args, npix = _check_grid(grid)
+            partial = True
+            nside = 0
+        elif pixels is None:
             partial = False
         else:
             partial = True
@@ -258,22 +355,28 @@ class QMap(QPoint):
                 raise ValueError('nside required for partial maps')
 
         # check map shape and create pointer
-        smap, snside = check_map(source_map, partial=partial)
+        smap, snside = check_map(source_map, partial=partial,
+                                 dtype=_check_dtype(source_map))
         if not partial:
             nside = snside
             npix = nside2npix(nside)
+        elif grid is not None:
+            if snside != npix:
+                raise ValueError('source_map has incompatible shape')
         else:
             npix = len(pixels)
 
         # store map
         self.depo['source_map'] = smap
         self.depo['source_nside'] = nside
-        if partial:
+        if pixels is not None:
             self.depo['source_pixels'] = pixels
+        if grid is not None:
+            self.depo['source_grid'] = grid
 
         # initialize
         source = self._source.contents
-        source.partial = partial
+        source.partial = pixels is not None
         source.nside = nside
         source.npix = npix
         source.pixinfo_init = 0
@@ -282,21 +385,29 @@ class QMap(QPoint):
         source.pixhash = None
         source.num_vec = len(source_map)
         source.vec_mode = lib.get_vec_mode(smap, pol, vpol)
-        source.vec1d = lib.as_ctypes(smap.ravel())
+        source.single = smap.dtype == np.float32
+        name, ptr = _map_pointer(smap)
+        setattr(source, 'vec' + name, ptr)
         source.vec1d_init = lib.QP_ARR_INIT_PTR
         source.vec = None
+        source.vecf = None
         source.vec_init = 0
         source.num_proj = 0
         source.proj_mode = 0
         source.proj = None
+        source.projf = None
         source.proj_init = 0
         source.proj1d = None
+        source.proj1df = None
         source.proj1d_init = 0
         source.init = lib.QP_STRUCT_INIT
 
-        if partial:
+        if pixels is not None:
             if qp.qp_init_map_pixhash(self._source, pixels, npix):
                 raise RuntimeError('Error initializing source pixhash')
+        if grid is not None:
+            if qp.qp_init_map_grid(self._source, *grid_args):
+                raise RuntimeError('Error initializing source grid')
 
         if qp.qp_reshape_map(self._source):
             raise RuntimeError('Error reshaping source map')
@@ -308,9 +419,11 @@ class QMap(QPoint):
         """
         if hasattr(self, '_source'):
             qp.qp_free_map(self._source)
+        self.reset_pnt_cache('source')
         self.depo.pop('source_map', None)
         self.depo.pop('source_nside', None)
         self.depo.pop('source_pixels', None)
+        self.depo.pop('source_grid', None)
         self._source = ct.pointer(lib.qp_map_t())
 
     def source_is_pol(self):
@@ -347,7 +460,8 @@ class QMap(QPoint):
         return True
 
     def init_dest(self, nside=None, pol=True, vec=None, proj=None, pixels=None,
-                  vpol=False, copy=False, reset=False, update=False):
+                  vpol=False, grid=None, interleave=False, dtype=np.double,
+                  copy=False, reset=False, update=False):
         """
         Initialize the destination map structure.  Timestreams are binned
         and projection matrices accumulated into this structure.
@@ -370,9 +484,47 @@ class QMap(QPoint):
             is disabled.
         pixels : 1D array_like, optional
             Array of pixel numbers for each map index, if `vec` and `proj` are
-            partial maps.
+            partial maps.  Pixel lookups are fastest if the pixels are sorted
+            into a few contiguous ranges, e.g. a NEST-ordered patch.
         vpol : bool, optional
             If True, a polarized map including V polarization will be created.
+        grid : dict, optional
+            Flat-sky pixelization of the map, instead of healpix.  A
+            dictionary with keys:
+
+            * `proj`: the projection, 'car' (plate carree) or 'tan'
+              (gnomonic).
+            * `shape`: the grid dimensions `(ny, nx)`.
+            * `res`: the pixel size in degrees, or a tuple `(dx, dy)` of
+              sizes along each axis.  Sizes may be negative, e.g. so that
+              RA increases to the left.
+            * `center`: optional `(ra, dec)` of the projection center, at
+              the center of the grid, in degrees.  Default `(0, 0)`.
+
+            For CAR, the axes are RA and Dec offsets from the center.  For
+            TAN, the axes are gnomonic coordinates along increasing RA and
+            Dec at the center.  Grid pixel `(iy, ix)` has map index
+            `iy * nx + ix`, so a map column reshapes to `(ny, nx)`.
+            Polarization angles are measured from the local meridian, as
+            for healpix maps.  Samples outside the grid are treated as
+            missing pixels.  Grid maps do not support interpolation or
+            derivative maps.
+        interleave : bool, optional
+            If True, the vec and proj entries of each pixel are stored
+            together, in a single array of shape (npix, N + N*(N+1)/2),
+            so that binning a sample touches one or two cache lines rather
+            than one per column.  This speeds up binning into high
+            resolution maps.  The returned vec and proj are views into this
+            array, and any supplied vec and proj are copied into it.
+        dtype : {numpy.double, numpy.float32}, optional
+            Storage precision of the vec and proj maps.  Supplied vec and
+            proj are converted to this type.  Timestreams binned into a
+            single-precision map are accumulated in double precision in
+            sparse per-thread buffers holding only the pixels hit in each
+            call, which are then added to the map.  The `reduce_mode`
+            option is ignored for such maps.
+            Single-precision maps are not supported by :meth:`from_tod_solve`
+            or :meth:`from_tod_cg`.
         copy : bool, optional
             If True and vec/proj are supplied, make copies of these inputs
             to avoid in-place operations.
@@ -384,7 +536,9 @@ class QMap(QPoint):
         update : bool, optional
             If True, and if the structure has already been initialized,
             the supplied vec and proj are replaced in the existing dest
-            structure rather than reinitializing from scratch.
+            structure rather than reinitializing from scratch.  For
+            interleaved maps, the supplied vec and proj are copied into the
+            existing maps.
         """
 
         if vec is False and proj is False:
@@ -406,11 +560,19 @@ class QMap(QPoint):
                     if vec.squeeze().shape[-1] != \
                             self.depo['vec'].squeeze().shape[-1]:
                         raise ValueError('vec shape mismatch')
-                    vec, _ = check_map(vec, copy=copy, partial=True)
-                    dest.num_vec = len(vec)
-                    dest.vec_mode = lib.get_vec_mode(vec, pol, vpol)
-                    dest.vec1d = lib.as_ctypes(vec.ravel())
-                    self.depo['vec'] = vec
+                    vec, _ = check_map(vec, copy=copy, partial=True,
+                                       dtype=self.depo['vec'].dtype)
+                    if dest.interleave:
+                        if vec.shape != self.depo['vec'].shape:
+                            raise ValueError('vec shape mismatch')
+                        self.depo['vec'][:] = vec
+                        vec = self.depo['vec']
+                    else:
+                        dest.num_vec = len(vec)
+                        dest.vec_mode = lib.get_vec_mode(vec, pol, vpol)
+                        name, ptr = _map_pointer(vec)
+                        setattr(dest, 'vec' + name, ptr)
+                        self.depo['vec'] = vec
                     ret += (vec.squeeze(),)
 
                 if self.depo['proj'] is not False:
@@ -419,11 +581,20 @@ class QMap(QPoint):
                     if proj.squeeze().shape[-1] != \
                             self.depo['proj'].squeeze().shape[-1]:
                         raise ValueError('proj shape mismatch')
-                    proj, _ = check_map(proj, copy=copy, partial=True)
-                    dest.num_proj = len(proj)
-                    dest.proj_mode = lib.get_proj_mode(proj, pol, vpol)
-                    dest.proj1d = lib.as_ctypes(proj.ravel())
-                    self.depo['proj'] = proj
+                    proj, _ = check_map(proj, copy=copy, partial=True,
+                                        dtype=self.depo['proj'].dtype)
+                    if dest.interleave:
+                        if proj.shape != self.depo['proj'].shape:
+                            raise ValueError('proj shape mismatch')
+                        self.depo['proj'][:] = proj
+                        proj = self.depo['proj']
+                    else:
+                        dest.num_proj = len(proj)
+                        dest.proj_mode = lib.get_proj_mode(proj, pol, vpol)
+                        name, ptr = _map_pointer(proj)
+                        setattr(dest, 'proj' + name, ptr)
+                        self.depo['proj'] = proj
+                    self.depo.pop('proj_inv', None)
                     ret += (proj.squeeze(),)
 
                 if qp.qp_reshape_map(self._dest):
@@ -436,7 +607,16 @@ class QMap(QPoint):
             else:
                 raise RuntimeError('dest already initialized')
 
-        if pixels is None:
+        self.reset_pnt_cache('dest')
+        dtype = _check_dtype(None, dtype)
+
+        if grid is not None:
+            if pixels is not None:
+                raise ValueError('pixels not supported for grid maps')
+            grid_args, npix = _check_grid(grid)
+            nside = 0
+            partial = True
+        elif pixels is None:
             if nside is None:
                 nside = 256
             npix = nside2npix(nside)
@@ -449,14 +629,15 @@ class QMap(QPoint):
 
         if vec is None:
             if vpol:
-                vec = np.zeros((4, npix), dtype=np.double)
+                vec = np.zeros((4, npix), dtype=dtype)
             elif pol:
-                vec = np.zeros((3, npix), dtype=np.double)
+                vec = np.zeros((3, npix), dtype=dtype)
             else:
-                vec = np.zeros((1, npix), dtype=np.double)
+                vec = np.zeros((1, npix), dtype=dtype)
             vdim2 = npix if partial else nside
         elif vec is not False:
-            vec, vdim2 = check_map(vec, copy=copy, partial=partial)
+            vec, vdim2 = check_map(vec, copy=copy, partial=partial,
+                                   dtype=dtype)
             if not partial:
                 nside = vdim2
                 npix = nside2npix(nside)
@@ -476,14 +657,15 @@ class QMap(QPoint):
 
         if proj is None:
             if vpol:
-                proj = np.zeros((10, npix), dtype=np.double)
+                proj = np.zeros((10, npix), dtype=dtype)
             elif pol:
-                proj = np.zeros((6, npix), dtype=np.double)
+                proj = np.zeros((6, npix), dtype=dtype)
             else:
-                proj = np.zeros((1, npix), dtype=np.double)
+                proj = np.zeros((1, npix), dtype=dtype)
             pdim2 = npix if partial else nside
         elif proj is not False:
-            proj, pdim2, pnmap = check_proj(proj, copy=copy, partial=partial)
+            proj, pdim2, pnmap = check_proj(proj, copy=copy, partial=partial,
+                                            dtype=dtype)
 
             if vec is not False:
                 if pnmap != len(vec):
@@ -510,45 +692,69 @@ class QMap(QPoint):
                 elif pdim2 != npix:
                     raise ValueError('proj has incompatible shape')
 
+        if interleave:
+            # columns are views into a single (npix, ncol) array
+            nvec = 0 if vec is False else len(vec)
+            nproj = 0 if proj is False else len(proj)
+            data = np.zeros((npix, nvec + nproj), dtype=dtype)
+            if vec is not False:
+                data[:, :nvec] = vec.T
+                vec = data[:, :nvec].T
+            if proj is not False:
+                data[:, nvec:] = proj.T
+                proj = data[:, nvec:].T
+
         # store arrays for later retrieval
         self.depo['vec'] = vec
         self.depo['proj'] = proj
+        self.depo.pop('proj_inv', None)
         self.depo['dest_nside'] = nside
 
-        if partial:
+        if pixels is not None:
             self.depo['dest_pixels'] = pixels
+        if grid is not None:
+            self.depo['dest_grid'] = grid
 
         # initialize
         ret = ()
         dest = self._dest.contents
         dest.nside = nside
         dest.npix = npix
-        dest.partial = partial
+        dest.partial = pixels is not None
         dest.pixinfo_init = 0
         dest.pixinfo = None
         dest.pixhash_init = 0
         dest.pixhash = None
+        dest.interleave = data.shape[1] if interleave else 0
+        dest.single = dtype == np.float32
         if vec is not False:
             dest.num_vec = len(vec)
             dest.vec_mode = lib.get_vec_mode(vec, pol, vpol)
-            dest.vec1d = lib.as_ctypes(vec.ravel())
+            name, ptr = _map_pointer(vec, interleave)
+            setattr(dest, 'vec' + name, ptr)
             dest.vec1d_init = lib.QP_ARR_INIT_PTR
             ret += (vec.squeeze(),)
         if proj is not False:
             dest.num_proj = len(proj)
             dest.proj_mode = lib.get_proj_mode(proj, pol, vpol)
-            dest.proj1d = lib.as_ctypes(proj.ravel())
+            name, ptr = _map_pointer(proj, interleave)
+            setattr(dest, 'proj' + name, ptr)
             dest.proj1d_init = lib.QP_ARR_INIT_PTR
             ret += (proj.squeeze(),)
         dest.vec = None
+        dest.vecf = None
         dest.vec_init = 0
         dest.proj = None
+        dest.projf = None
         dest.proj_init = 0
         dest.init = lib.QP_STRUCT_INIT
 
-        if partial:
+        if pixels is not None:
             if qp.qp_init_map_pixhash(self._dest, pixels, npix):
                 raise RuntimeError('Error initializing dest pixhash')
+        if grid is not None:
+            if qp.qp_init_map_grid(self._dest, *grid_args):
+                raise RuntimeError('Error initializing dest grid')
 
         if qp.qp_reshape_map(self._dest):
             raise RuntimeError('Error reshaping dest map')
@@ -565,10 +771,13 @@ class QMap(QPoint):
         """
         if hasattr(self, '_dest'):
             qp.qp_free_map(self._dest)
+        self.reset_pnt_cache('dest')
         self.depo.pop('vec', None)
         self.depo.pop('proj', None)
+        self.depo.pop('proj_inv', None)
         self.depo.pop('dest_nside', None)
         self.depo.pop('dest_pixels', None)
+        self.depo.pop('dest_grid', None)
         self._dest = ct.pointer(lib.qp_map_t())
 
     def dest_is_pol(self):
@@ -648,6 +857,9 @@ class QMap(QPoint):
 
         n = point.n
 
+        if ctime is not None or q_hwp is not None:
+            self.reset_pnt_cache()
+
         if ctime is False:
             point.ctime_init = 0
             point.ctime = None
@@ -670,6 +882,7 @@ class QMap(QPoint):
         """
         Reset the pointing data structure.
         """
+        self.reset_pnt_cache()
         if hasattr(self, '_point'):
             qp.qp_free_point(self._point)
         self.depo.pop('q_bore', None)
@@ -678,7 +891,8 @@ class QMap(QPoint):
         self._point = ct.pointer(lib.qp_point_t())
 
     def init_detarr(self, q_off, weight=None, gain=None, mueller=None, tod=None,
-                    flag=None, weights=None, do_diff=False, write=False):
+                    flag=None, weights=None, do_diff=False, write=False,
+                    cache=None, dtype=None):
         """
         Initialize the detector listing structure.  Detector properties and
         timestreams are passed to and from the mapmaker through this structure.
@@ -714,6 +928,16 @@ class QMap(QPoint):
         write : bool, optional
             If True, the timestreams are ensured writable and created if
             necessary.
+        cache : {None, 'dest', 'source'}, optional
+            If not None, attach cached pointing for the given map structure
+            to each detector, computing it first if necessary.  Only used
+            if the `cache_pointing` option is enabled.
+        dtype : {None, numpy.double, numpy.float32}, optional
+            Storage precision of the `tod` and `weights` arrays.  If None,
+            single-precision (float32) arrays are used as is, and all other
+            arrays, including a newly created `tod`, are double precision.
+            Single-precision samples are converted to double precision as
+            they are binned or scanned.
         """
 
         self.reset_detarr()
@@ -733,17 +957,21 @@ class QMap(QPoint):
             tod = np.atleast_2d(tod)
 
         if write:
-            tod = lib.check_output('tod', tod, shape=shape, fill=0)
+            tod = lib.check_output('tod', tod, shape=shape, fill=0,
+                                   dtype=_check_dtype(tod, dtype))
             self.depo['tod'] = tod
         elif tod is not None:
-            tod = lib.check_input('tod', tod, shape=shape)
+            tod = lib.check_input('tod', tod, shape=shape,
+                                  dtype=_check_dtype(tod, dtype))
             self.depo['tod'] = tod
         if flag is not None:
             flag = lib.check_input('flag', np.atleast_2d(flag),
                                    dtype=np.uint8, shape=shape)
             self.depo['flag'] = flag
         if weights is not None:
-            weights = lib.check_input('weights', np.atleast_2d(weights), shape=shape)
+            weights = lib.check_input('weights', np.atleast_2d(weights),
+                                      shape=shape,
+                                      dtype=_check_dtype(weights, dtype))
             self.depo['weights'] = weights
 
         # populate array
@@ -757,7 +985,10 @@ class QMap(QPoint):
             if tod is not None:
                 dets[idx].n = ns
                 dets[idx].tod_init = lib.QP_ARR_INIT_PTR
-                dets[idx].tod = lib.as_ctypes(tod[idx])
+                if tod.dtype == np.float32:
+                    dets[idx].todf = lib.as_ctypes(tod[idx])
+                else:
+                    dets[idx].tod = lib.as_ctypes(tod[idx])
             else:
                 dets[idx].tod_init = 0
             if flag is not None:
@@ -769,7 +1000,10 @@ class QMap(QPoint):
             if weights is not None:
                 dets[idx].n = ns
                 dets[idx].weights_init = lib.QP_ARR_INIT_PTR
-                dets[idx].weights = lib.as_ctypes(weights[idx])
+                if weights.dtype == np.float32:
+                    dets[idx].weightsf = lib.as_ctypes(weights[idx])
+                else:
+                    dets[idx].weights = lib.as_ctypes(weights[idx])
 
         detarr = lib.qp_detarr_t()
         detarr.n = n
@@ -783,6 +1017,9 @@ class QMap(QPoint):
 
         self._detarr = ct.pointer(detarr)
 
+        if cache is not None and self.cache_pointing:
+            self._init_pnt_cache(cache, q_off)
+
     def reset_detarr(self):
         """
         Reset the detector array structure.
@@ -794,6 +1031,133 @@ class QMap(QPoint):
         self.depo.pop('flag', None)
         self.depo.pop('weights', None)
 
+    def _init_pnt_cache(self, name, q_off):
+        """
+        Attach cached pixel index and polarization angle timestreams for the
+        `name` ('dest' or 'source') map structure to the detector array.
+        For an interpolated source map, the neighbor pixels and weights
+        are cached as well.
+        The cache is recomputed if the detector offsets or any of the
+        options that affect the pointing have changed since it was built.
+        """
+        interp = False
+        if name == 'dest':
+            qmap = self._dest
+        elif name == 'source':
+            qmap = self._source
+            # derivative maps bypass the cache
+            if qmap.contents.vec_mode >= lib.QP_VEC_D1:
+                return
+            interp = bool(self.get('interp_pix'))
+        else:
+            raise ValueError('unrecognized pointing cache {}'.format(name))
+
+        state = self._pnt_state()
+        state['interp_pix'] = interp
+        cache = self._pnt_cache.get(name, None)
+        if cache is None or cache['state'] != state or \
+                not np.array_equal(cache['q_off'], q_off):
+            shape = (len(q_off), self._point.contents.n)
+            pix = np.empty(shape, dtype=np.int)
+            sin2psi = np.empty(shape, dtype=np.float32)
+            cos2psi = np.empty(shape, dtype=np.float32)
+            cache = dict(q_off=q_off.copy(), state=state, pix=pix,
+                         sin2psi=sin2psi, cos2psi=cos2psi)
+            if interp:
+                ipix = np.empty(shape + (4,), dtype=np.int32)
+                iweight = np.empty(shape + (4,), dtype=np.float32)
+                err = qp.qp_detarr_interp(self._memory, self._detarr,
+                                          self._point, qmap, pix, sin2psi,
+                                          cos2psi, ipix, iweight)
+                cache.update(interp_pix=ipix, interp_weight=iweight)
+            else:
+                err = qp.qp_detarr_pnt(self._memory, self._detarr,
+                                       self._point, qmap, pix, sin2psi,
+                                       cos2psi)
+            if err:
+                raise RuntimeError(qp.qp_get_error_string(self._memory))
+            self._pnt_cache[name] = cache
+
+        dets = self._detarr.contents.arr
+        for idx in range(len(q_off)):
+            dets[idx].pnt_init = lib.QP_ARR_INIT_PTR
+            dets[idx].pix = lib.as_ctypes(cache['pix'][idx])
+            dets[idx].sin2psi = lib.as_ctypes(cache['sin2psi'][idx])
+            dets[idx].cos2psi = lib.as_ctypes(cache['cos2psi'][idx])
+            if interp:
+                dets[idx].interp_init = lib.QP_ARR_INIT_PTR
+                dets[idx].interp_pix = lib.as_ctypes(
+                    cache['interp_pix'][idx].ravel())
+                dets[idx].interp_weight = lib.as_ctypes(
+                    cache['interp_weight'][idx].ravel())
+
+    # options that only affect how timestreams are binned or scanned,
+    # rather than the cached pointing
+    _pnt_bin_opts = ('num_threads', 'parallel_mode', 'reduce_mode',
+                     'sort_pix', 'error_missing', 'nan_missing',
+                     'interp_missing')
+
+    def _pnt_state(self):
+        """
+        Return a flat dictionary of all parameters that may affect the
+        cached pointing.
+        """
+        state = dict()
+        for v in self.get().values():
+            state.update(v)
+        for k in self._pnt_bin_opts:
+            state.pop(k, None)
+        return state
+
+    def set(self, **kwargs):
+        """
+        Set computation options.  See
+        :meth:`qpoint.qpoint_class.QPoint.set` for a list of parameter
+        names.  The pointing cache is cleared if any parameter that affects
+        the pointing is changed.
+        """
+        if not hasattr(self, '_pnt_cache'):
+            return super(QMap, self).set(**kwargs)
+        state = self._pnt_state()
+        super(QMap, self).set(**kwargs)
+        if self._pnt_state() != state:
+            self.reset_pnt_cache()
+
+    def load_bulletin_a(self, *args, **kwargs):
+        """
+        Load IERS Bulletin A from file and store in memory, and clear the
+        pointing cache.  See
+        :meth:`qpoint.qpoint_class.QPoint.load_bulletin_a` for arguments.
+        """
+        ret = super(QMap, self).load_bulletin_a(*args, **kwargs)
+        self.reset_pnt_cache()
+        return ret
+
+    def load_ephem_table(self, filename=None):
+        """
+        Load a table of corrections, or remove it if `filename` is None,
+        and clear the pointing cache.  See
+        :meth:`qpoint.qpoint_class.QPoint.load_ephem_table`.
+        """
+        super(QMap, self).load_ephem_table(filename)
+        self.reset_pnt_cache()
+
+    def reset_pnt_cache(self, name=None):
+        """
+        Clear the pointing cache for the given map structure ('dest' or
+        'source'), or for both if `name` is None.  In the latter case, the
+        boresight velocity kept with the pointing structure for the
+        annual aberration correction is also cleared.
+        """
+        if not hasattr(self, '_pnt_cache'):
+            self._pnt_cache = dict()
+        if name is None:
+            self._pnt_cache.clear()
+            if hasattr(self, '_point'):
+                qp.qp_reset_point_beta(self._point)
+        else:
+            self._pnt_cache.pop(name, None)
+
     def reset(self):
         """
         Reset the internal data structures, and clear the data depo.
@@ -854,7 +1218,8 @@ class QMap(QPoint):
 
         # initialize detectors
         self.init_detarr(q_off, weight=weight, gain=gain, mueller=mueller,
-                         tod=tod, flag=flag, weights=weights, do_diff=do_diff)
+                         tod=tod, flag=flag, weights=weights, do_diff=do_diff,
+                         cache='dest')
 
         # check modes
         return_vec = True
@@ -878,6 +1243,8 @@ class QMap(QPoint):
         # run
         if qp.qp_tod2map(self._memory, self._detarr, self._point, self._dest):
             raise RuntimeError(qp.qp_get_error_string(self._memory))
+        if return_proj:
+            self.depo.pop('proj_inv', None)
 
         # reset modes
         dest.vec_mode = vec_mode
@@ -896,7 +1263,450 @@ class QMap(QPoint):
             return ret[0]
         return ret
 
-    def to_tod(self, q_off, gain=None, mueller=None, tod=None, flag=None, **kwargs):
+    def from_tod_solve(self, q_off, tod, weight=None, gain=None, mueller=None,
+                       flag=None, weights=None, do_diff=False, cond_thresh=1e6,
+                       fill=0, keep_proj=False, **kwargs):
+        """
+        Bin timestreams for given detectors into the destination map, and
+        solve the map in the same pass.
+
+        Arguments
+        ---------
+        q_off : array_like
+            quaternion offset array, of shape (ndet, 4)
+        tod : array_like
+            timestreams, of shape (ndet, nsamp)
+        weight, gain, mueller, flag, weights, do_diff :
+            See :meth:`from_tod`.
+        cond_thresh : scalar, optional
+            Pixels whose projection matrix condition number exceeds this
+            threshold are not solved.  If 0, only unhit and singular pixels
+            are excluded.
+        fill : scalar, optional
+            Fill the solved map with this value where pixels are not solved.
+        keep_proj : bool, optional
+            If False (default), the destination map structure is reset
+            after solving, releasing the accumulated projection matrix.
+            Otherwise, the accumulated proj map is kept, and the destination
+            vec map is replaced by the solved map.
+
+        Returns
+        -------
+        map : array_like
+            Solved map, of shape (N, npix).
+        hits : array_like
+            Weighted hits map, i.e. the first proj column, of shape (npix,).
+        cond : array_like
+            Hits-normalized condition number of the projection matrix of
+            each pixel, as in :meth:`proj_cond`, of shape (npix,).
+
+        Notes
+        -----
+        The destination map must be initialized with matching vec and proj
+        maps.  Binning and solving are done in a single call to the C library,
+        and the solve runs in parallel over pixels using up to `num_threads`
+        threads.
+
+        The remaining keyword arguments are passed to the
+        :meth:`qpoint.qpoint_class.QPoint.set` method.
+        """
+
+        self.set(**kwargs)
+
+        if not self.dest_is_init():
+            raise RuntimeError('dest map not initialized')
+        if self.depo['vec'] is False or self.depo['proj'] is False:
+            raise RuntimeError('dest vec and proj maps required')
+
+        # initialize detectors
+        self.init_detarr(q_off, weight=weight, gain=gain, mueller=mueller,
+                         tod=tod, flag=flag, weights=weights, do_diff=do_diff,
+                         cache='dest')
+
+        # run
+        npix = self._dest.contents.npix
+        hits = np.empty(npix)
+        cond = np.empty(npix)
+        err = qp.qp_tod2map_solve(self._memory, self._detarr, self._point,
+                                  self._dest, hits, cond, cond_thresh, fill)
+
+        # clean up
+        self.reset_detarr()
+        if err:
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
+
+        vec = self.depo['vec']
+        if not keep_proj:
+            if self._dest.contents.interleave:
+                # release the interleaved proj columns along with the array
+                vec = vec.copy()
+            self.reset_dest()
+
+        return vec.squeeze(), hits, cond
+
+    def from_tod_cg(self, q_off, tod, weight=None, gain=None, mueller=None,
+                    flag=None, weights=None, filter=None, cond_thresh=1e6,
+                    maxiter=100, tol=1e-6, **kwargs):
+        """
+        Solve for the map that best fits the timestreams for given detectors,
+        using a preconditioned conjugate gradient solver.
+
+        Arguments
+        ---------
+        q_off : array_like
+            quaternion offset array, of shape (ndet, 4)
+        tod : array_like
+            timestreams, of shape (ndet, nsamp)
+        weight, gain, mueller, flag, weights :
+            See :meth:`from_tod`.  Detector and sample weights enter the
+            normal equations as the (diagonal) noise weighting.
+        filter : callable, optional
+            Timestream filter, called as ``filter(tod)`` with a writable
+            array of shape (ndet, nsamp), which it should modify in place.
+            The filter should be linear, and is applied to the data and
+            at every iteration of the solver.
+        cond_thresh : scalar, optional
+            Pixels whose projection matrix condition number exceeds this
+            threshold are not solved, and are left at zero.  If 0, only unhit
+            and singular pixels are excluded, which may slow convergence
+            considerably.
+        maxiter : int, optional
+            Maximum number of iterations.
+        tol : scalar, optional
+            Convergence threshold on the residual norm, relative to that of
+            the right-hand side.
+
+        Returns
+        -------
+        map : array_like
+            Solved map, of shape (N, npix).
+        info : dict
+            Solver information, with entries `niter` (number of iterations),
+            `resid` (relative residual norm at each iteration, including the
+            initial one) and `converged`.
+
+        Notes
+        -----
+        Solves the normal equations ``(P^T F P) x = P^T F d``, where ``P``
+        is the pointing operator of :meth:`to_tod`, ``P^T`` that of
+        :meth:`from_tod`, ``d`` the timestreams and ``F`` the filter.
+        Without a filter, the solution is that of :meth:`solve_map`, reached
+        in a single iteration.  The solver starts from a blank map, and uses
+        the inverse projection matrix of each pixel as a preconditioner.
+
+        The destination map must be initialized with matching vec and proj
+        maps, which are zeroed before the right-hand side and projection
+        matrix are binned into them.  The solution is also stored in the
+        destination vec map.  The input timestreams are not modified.
+        Differenced detectors and the `interp_pix` option are not supported.
+
+        The remaining keyword arguments are passed to the
+        :meth:`qpoint.qpoint_class.QPoint.set` method.
+        """
+
+        self.set(**kwargs)
+
+        if not self.dest_is_init():
+            raise RuntimeError('dest map not initialized')
+        if self.depo['vec'] is False or self.depo['proj'] is False:
+            raise RuntimeError('dest vec and proj maps required')
+        if self._dest.contents.single:
+            raise RuntimeError('dest map must be double precision')
+
+        self.depo['vec'][:] = 0
+        self.depo['proj'][:] = 0
+        self.depo.pop('proj_inv', None)
+
+        # initialize detectors
+        self.init_detarr(q_off, weight=weight, gain=gain, mueller=mueller,
+                         tod=tod, flag=flag, weights=weights, cache='dest')
+
+        # wrap the filter, holding on to any exception it raises
+        errors = []
+        if filter is None:
+            cfilter = lib.qp_tod_filter_t()
+        else:
+            def filter_func(tod_p, ndet, nsamp, data):
+                try:
+                    filter(np.ctypeslib.as_array(tod_p, shape=(ndet, nsamp)))
+                except Exception as e:
+                    errors.append(e)
+                    return 1
+                return 0
+            cfilter = lib.qp_tod_filter_t(filter_func)
+
+        # run
+        resid = np.zeros(maxiter + 1)
+        niter = ct.c_int(0)
+        err = qp.qp_tod2map_cg(self._memory, self._detarr, self._point,
+                               self._dest, cfilter, None, cond_thresh,
+                               maxiter, tol, resid, ct.byref(niter))
+
+        # clean up
+        self.reset_detarr()
+        if errors:
+            raise errors[0]
+        if err:
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
+
+        niter = niter.value
+        info = dict(niter=niter, resid=resid[:niter + 1],
+                    converged=bool(resid[niter] <= tol))
+        return self.depo['vec'].squeeze(), info
+
+    def add_map(self, vec=None, proj=None, **kwargs):
+        """
+        Add externally accumulated signal and/or projection maps to the
+        destination map in place, e.g. to combine per-observation maps
+        binned by separate worker processes.
+
+        Arguments
+        ---------
+        vec : array_like, optional
+            Signal map to add, of the same shape as the destination
+            signal map.
+        proj : array_like, optional
+            Projection matrix map to add, of the same shape as the
+            destination projection map.
+
+        Returns
+        -------
+        vec : array_like, optional
+            The updated destination signal map, if `vec` is supplied.
+        proj : array_like, optional
+            The updated destination projection map, if `proj` is supplied.
+
+        Notes
+        -----
+        The sum is computed in parallel over blocks of pixels, using up to
+        `num_threads` threads.
+
+        The remaining keyword arguments are passed to the
+        :meth:`qpoint.qpoint_class.QPoint.set` method.
+        """
+
+        self.set(**kwargs)
+
+        if not self.dest_is_init():
+            raise RuntimeError('dest map not initialized')
+        if vec is None and proj is None:
+            raise RuntimeError('Nothing to do')
+
+        dest = self._dest.contents
+        npix = dest.npix if dest.partial or dest.grid.type else 0
+        vec_mode = lib.QP_VEC_NONE
+        proj_mode = lib.QP_PROJ_NONE
+        ret = ()
+
+        if vec is not None:
+            dvec = self.depo['vec']
+            if dvec is None or dvec is False:
+                raise RuntimeError('dest vec not initialized')
+            vec, _ = check_map(vec, partial=True)
+            if vec.shape != dvec.shape:
+                raise ValueError('vec has incompatible shape')
+            vec_mode = dest.vec_mode
+            ret += (dvec.squeeze(),)
+        else:
+            vec = np.empty(0)
+
+        if proj is not None:
+            dproj = self.depo['proj']
+            if dproj is None or dproj is False:
+                raise RuntimeError('dest proj not initialized')
+            proj, _ = check_map(proj, partial=True)
+            if proj.shape != dproj.shape:
+                raise ValueError('proj has incompatible shape')
+            proj_mode = dest.proj_mode
+            ret += (dproj.squeeze(),)
+        else:
+            proj = np.empty(0)
+
+        maploc = qp.qp_init_map_from_arrays_1d(
+            vec.ravel(), proj.ravel(), dest.nside, npix, vec_mode, proj_mode, 0)
+        err = qp.qp_add_map(self._memory, self._dest, maploc)
+        qp.qp_free_map(maploc)
+        if err:
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
+        if proj_mode:
+            self.depo.pop('proj_inv', None)
+
+        if len(ret) == 1:
+            return ret[0]
+        return ret
+
+    def _full_sky_maps(self):
+        """
+        Return a list of the initialized destination and source map arrays,
+        which must be full-sky healpix maps.
+        """
+        maps = []
+        if self.dest_is_init():
+            if 'dest_pixels' in self.depo or 'dest_grid' in self.depo:
+                raise ValueError('dest map must be a full-sky healpix map')
+            if self._dest.contents.interleave:
+                raise ValueError('dest map must not be interleaved')
+            if self._dest.contents.single:
+                raise ValueError('dest map must be double precision')
+            for key in ['vec', 'proj']:
+                if self.depo[key] is not False:
+                    maps.append(self.depo[key])
+        if self.source_is_init():
+            if 'source_pixels' in self.depo or 'source_grid' in self.depo:
+                raise ValueError('source map must be a full-sky healpix map')
+            if self._source.contents.single:
+                raise ValueError('source map must be double precision')
+            maps.append(self.depo['source_map'])
+        return maps
+
+    def reorder(self, pix_order, **kwargs):
+        """
+        Reorder the destination and source maps in place to the given
+        pixel ordering, and set the `pix_order` option to match.
+
+        Arguments
+        ---------
+        pix_order : 'nest' or 'ring'
+            Pixel ordering of the output maps.  The maps are assumed to be
+            in the ordering given by the current `pix_order` option.
+
+        Notes
+        -----
+        The maps are reordered using up to `num_threads` threads, through a
+        single scratch column, so that no copies of the maps are made.
+        The destination and source maps must be full-sky healpix maps in
+        double precision, and the destination map must not be interleaved.
+        Any cached pointing is discarded.
+
+        The remaining keyword arguments are passed to the
+        :meth:`qpoint.qpoint_class.QPoint.set` method.
+        """
+
+        self.set(**kwargs)
+
+        nest = lib.check_set_pix_order(pix_order) == 1
+        if nest == (lib.check_set_pix_order(self.get('pix_order')) == 1):
+            return
+
+        for m in self._full_sky_maps():
+            nside = npix2nside(m.shape[-1])
+            if qp.qp_reorder_map(self._memory, nside, lib.pointer_2d(m),
+                                 len(m), nest):
+                raise RuntimeError(qp.qp_get_error_string(self._memory))
+
+        self.reset_pnt_cache()
+        self.set(pix_order=pix_order)
+
+    def ud_grade_map(self, map_in, nside_out, weight=None, mode='mean',
+                     **kwargs):
+        """
+        Change the resolution of a full-sky map, or set of maps, in the
+        current `pix_order`.
+
+        Arguments
+        ---------
+        map_in : array_like
+            Input map(s), of shape (N, npix).
+        nside_out : int
+            Output map dimension.
+        weight : array_like, optional
+            Weight of each input pixel, e.g. the hits map `proj[0]`, of
+            shape (npix,).  If supplied, degraded pixels are the weighted
+            mean of their subpixels.
+        mode : 'mean' or 'sum', optional
+            If 'mean', degraded pixels are the (weighted) mean of their
+            subpixels and upgraded pixels take the value of their parent.
+            If 'sum', degraded pixels are the (weighted) sum of their
+            subpixels and upgraded pixels split the value of their parent
+            evenly, so that the map total is preserved.  Use 'sum' for
+            accumulated maps, such as the destination vec and proj maps.
+
+        Returns
+        -------
+        map_out : array_like
+            Output map(s), of shape (N, 12 * nside_out ** 2).
+
+        Notes
+        -----
+        Degraded pixels with zero total weight are set to zero, or NaN if
+        the `nan_missing` option is set.
+
+        The remaining keyword arguments are passed to the
+        :meth:`qpoint.qpoint_class.QPoint.set` method.
+        """
+
+        self.set(**kwargs)
+
+        if mode not in ['mean', 'sum']:
+            raise ValueError('mode must be one of mean or sum')
+
+        map_in, nside_in = check_map(map_in)
+        if weight is not None:
+            weight = lib.check_input('weight', weight,
+                                     shape=(nside2npix(nside_in),))
+
+        map_out = np.empty((len(map_in), nside2npix(nside_out)))
+        if qp.qp_ud_grade_map(self._memory, nside_in, lib.pointer_2d(map_in),
+                              nside_out, lib.pointer_2d(map_out),
+                              len(map_in), weight, mode == 'sum'):
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
+
+        return map_out.squeeze()
+
+    def ud_grade_dest(self, nside_out, **kwargs):
+        """
+        Change the resolution of the destination map, and reinitialize the
+        destination map structure at the new resolution.
+
+        Arguments
+        ---------
+        nside_out : int
+            Output map dimension.
+
+        Returns
+        -------
+        vec : array_like, optional
+            The destination signal map at the new resolution, if
+            initialized.
+        proj : array_like, optional
+            The destination projection map at the new resolution, if
+            initialized.
+
+        Notes
+        -----
+        The signal and projection maps are accumulated sums, so degraded
+        pixels are the sum of their subpixels.  Solving the degraded maps
+        then yields the hits-weighted combination of the subpixel solutions.
+        On upgrading, the sums are split evenly among the subpixels.
+
+        The destination map must be a full-sky healpix map.
+
+        The remaining keyword arguments are passed to the
+        :meth:`qpoint.qpoint_class.QPoint.set` method.
+        """
+
+        self.set(**kwargs)
+
+        if not self.dest_is_init():
+            raise RuntimeError('dest map not initialized')
+        if 'dest_pixels' in self.depo or 'dest_grid' in self.depo:
+            raise ValueError('dest map must be a full-sky healpix map')
+
+        dtype = np.float32 if self._dest.contents.single else np.double
+        maps = {}
+        for key in ['vec', 'proj']:
+            m = self.depo[key]
+            if m is not False:
+                m = np.atleast_2d(self.ud_grade_map(m, nside_out, mode='sum'))
+            maps[key] = m
+
+        return self.init_dest(vec=maps['vec'], proj=maps['proj'],
+                              pol=self.dest_is_pol(), vpol=self.dest_is_vpol(),
+                              interleave=bool(self._dest.contents.interleave),
+                              dtype=dtype, reset=True)
+
+    def to_tod(self, q_off, gain=None, mueller=None, tod=None, flag=None,
+               dtype=None, **kwargs):
         """
         Calculate signal TOD from source map for multiple channels.
 
@@ -913,6 +1723,10 @@ class QMap(QPoint):
         tod : array_like, optional
             output array for timestreams, of shape (ndet, nsamp)
             use this keyword argument for in-place computation.
+        dtype : {None, numpy.double, numpy.float32}, optional
+            Precision of the output timestreams.  If None, the precision of
+            `tod` if supplied, otherwise double.  Map values are scanned in
+            double precision before they are stored.
 
         Returns
         -------
@@ -930,7 +1744,7 @@ class QMap(QPoint):
 
         # initialize detectors
         self.init_detarr(q_off, gain=gain, mueller=mueller, tod=tod, flag=flag,
-                         write=True)
+                         write=True, cache='source', dtype=dtype)
 
         # run
         if qp.qp_map2tod(self._memory, self._detarr, self._point, self._source):
@@ -963,6 +1777,12 @@ class QMap(QPoint):
         -------
         cond : array_like
             Condition number of each pixel.
+
+        Notes
+        -----
+        The default 2-norm condition number is computed by the C library
+        from the eigenvalues of each matrix, using up to `num_threads`
+        threads.  Other orders are computed with `numpy.linalg.cond`.
         """
 
         # check inputs
@@ -970,6 +1790,15 @@ class QMap(QPoint):
             proj = self.depo['proj']
         if proj is None or proj is False:
             raise ValueError('missing proj')
+
+        if mode is None:
+            proj, _, nmap = check_proj(proj, partial=partial)
+            cond = np.empty(proj.shape[-1])
+            if qp.qp_proj_cond(self._memory, lib.pointer_2d(proj), nmap,
+                               len(cond), cond):
+                raise RuntimeError(qp.qp_get_error_string(self._memory))
+            return cond
+
         proj, _, nmap = check_proj(proj, copy=True, partial=partial)
         nproj = len(proj)
 
@@ -1038,7 +1867,9 @@ class QMap(QPoint):
             modified.  Otherwise, a copy is created prior to solving.
             Default: False.
         return_proj : bool, optional
-            if True, return the Cholesky-decomposed projection matrix.
+            if True, return the projection matrix, with unsolved pixels
+            set to zero (if method is 'exact'), or Cholesky-decomposed (if
+            method is 'cho').
             if False, and inplace is True, the input projection matrix
             is not modified.
         return_mask : bool, optional
@@ -1050,14 +1881,16 @@ class QMap(QPoint):
             Fill the solved map where proj == 0 with this value.  Default: 0.
         cond : array_like, optional
             A map of condition number per pixel.  If not supplied, this will be
-            calculated using `proj_cond`
+            calculated as in `proj_cond`
         cond_thresh : scalar, optional
             A threshold to place on the condition number to exclude pixels
             prior to solving.  Reduce this to avoid `LinAlgError` due to
             singular matrices.
         method : string, optional
-            Map inversion method.  If "exact", invert the pointing matrix directly
-            If "cho", use Cholesky decomposition to solve.  Default: "exact".
+            Map inversion method.  If "exact", invert the pointing matrix
+            of each pixel directly, in closed form, using up to
+            `num_threads` threads.  If "cho", use Cholesky decomposition to
+            solve.  Default: "exact".
 
         Returns
         -------
@@ -1073,7 +1906,8 @@ class QMap(QPoint):
 
         # check if we're dealing with a partial map
         if partial is None:
-            if vec is None and 'dest_pixels' in self.depo:
+            if vec is None and ('dest_pixels' in self.depo or
+                                'dest_grid' in self.depo):
                 partial = True
             else:
                 partial = False
@@ -1089,7 +1923,11 @@ class QMap(QPoint):
             proj = self.depo['proj']
         if proj is None or proj is False:
             raise ValueError('missing proj')
-        pcopy = True if not return_proj else copy
+        # proj is only modified by the exact solver if it is returned
+        if return_proj:
+            pcopy = copy
+        else:
+            pcopy = method != 'exact'
         proj, pnside, nmap = check_proj(proj, copy=pcopy, partial=partial)
 
         if pnside != nside or nmap != len(vec):
@@ -1118,29 +1956,28 @@ class QMap(QPoint):
                 return ret[0]
             return ret
 
-        # projection matrix indices
-        idx = np.zeros((nmap, nmap), dtype=int)
-        rtri, ctri = np.triu_indices(nmap)
-        idx[rtri, ctri] = idx[ctri, rtri] = np.arange(nproj)
-
-        # solve
-        # faster if numpy.linalg handles broadcasting
-        npv = [int(x) for x in np.version.short_version.split('.')]
-        if method == 'exact' and npv >= [1,8,0]:
-            if cond is None:
-                cond = self.proj_cond(proj=proj, partial=partial)
-            mask &= (cond < cond_thresh)
-            vec[:, ~mask] = 0
-            proj[..., ~mask] = np.eye(nmap)[rtri, ctri][:, None]
-            vec[:] = np.linalg.solve(proj[idx].transpose(2,0,1),
-                                     vec.transpose()).transpose()
-            vec[:, ~mask] = fill
-            proj[:, ~mask] = 0
+        # solve in place, per pixel
+        if method == 'exact':
+            if cond is not None:
+                mask &= (np.asarray(cond) < cond_thresh)
+                cond_thresh = 0
+            if qp.qp_solve_map(self._memory, lib.pointer_2d(vec),
+                               lib.pointer_2d(proj), nmap, len(mask),
+                               mask.view(np.uint8), None, cond_thresh, fill,
+                               0):
+                raise RuntimeError(qp.qp_get_error_string(self._memory))
+            if return_proj:
+                proj[:, ~mask] = 0
             ret = (vec,) + return_proj * (proj,) + return_mask * (mask,)
             if len(ret) == 1:
                 return ret[0]
             return ret
 
+        # projection matrix indices
+        idx = np.zeros((nmap, nmap), dtype=int)
+        rtri, ctri = np.triu_indices(nmap)
+        idx[rtri, ctri] = idx[ctri, rtri] = np.arange(nproj)
+
         # slow method, loop over pixels
         from scipy.linalg import cho_factor, cho_solve
         for ii, (m, A, v) in enumerate(zip(mask, proj[idx].T, vec.T)):
@@ -1149,10 +1986,7 @@ class QMap(QPoint):
                 vec[:, ii] = fill
                 continue
             try:
-                if method == 'cho':
-                    vec[:, ii] = cho_solve(cho_factor(A, False, True), v, True)
-                elif method == 'exact':
-                    vec[:, ii] = np.linalg.solve(A, v)
+                vec[:, ii] = cho_solve(cho_factor(A, False, True), v, True)
             except:
                 mask[ii] = False
                 proj[:, ii] = 0
@@ -1264,7 +2098,7 @@ class QMap(QPoint):
 
         # check if we're dealing with a partial map
         if partial is None:
-            partial = 'dest_pixels' in self.depo
+            partial = 'dest_pixels' in self.depo or 'dest_grid' in self.depo
 
         # ensure properly shaped arrays
         map_in, nside = check_map(map_in, copy=copy, partial=partial)
@@ -1273,12 +2107,12 @@ class QMap(QPoint):
             proj = self.depo['proj']
         if proj is None or proj is False:
             raise ValueError('missing proj')
-        pcopy = True if not return_proj else copy
+        # proj is not modified, so is only copied if it is returned
+        pcopy = copy if return_proj else False
         proj, pnside, nmap = check_proj(proj, copy=pcopy, partial=partial)
 
         if pnside != nside or nmap != len(map_in):
             raise ValueError('map_in and proj have incompatible shapes')
-        nproj = len(proj)
 
         # deal with mask
         if mask is None:
@@ -1298,15 +2132,110 @@ class QMap(QPoint):
             map_in[mask] *= proj[mask]
             map_in[~mask] = fill
         else:
-            # projection matrix indices
-            idx = np.zeros((nmap, nmap), dtype=int)
-            rtri, ctri = np.triu_indices(nmap)
-            idx[rtri, ctri] = idx[ctri, rtri] = np.arange(nproj)
-            map_in[:] = np.einsum('ij...,j...->i...', proj[idx], map_in)
-            map_in[:, ~mask] = fill
+            # multiply in place, per pixel
+            if qp.qp_unsolve_map(self._memory, lib.pointer_2d(map_in),
+                                 lib.pointer_2d(proj), nmap, len(mask),
+                                 mask.view(np.uint8), fill):
+                raise RuntimeError(qp.qp_get_error_string(self._memory))
 
         # return
         ret = (map_in,) + (proj,) * return_proj + (mask,) * return_mask
         if len(ret) == 1:
             return ret[0]
         return ret
+
+    def proj_inv(self, proj=None, cond_thresh=1e6, partial=None):
+        """
+        Inverse of the projection matrix of each pixel, e.g. for use as a
+        preconditioner with :meth:`precondition_map`.
+
+        Arguments
+        ---------
+        proj : array_like, optional
+            An array of upper-triangular projection matrices for each pixel,
+            of shape (N*(N+1)/2, npix).  Default to `depo['proj']`, in which
+            case the inverse is also cached as `depo['proj_inv']`.
+        cond_thresh : scalar, optional
+            Pixels whose projection matrix condition number exceeds this
+            threshold have a zero inverse, as do unhit pixels.  If 0, only
+            singular pixels are excluded.
+        partial : bool, optional
+            If True, the map is not checked to ensure a proper healpix nside.
+
+        Returns
+        -------
+        proj_inv : array_like
+            The upper triangular elements of the inverse projection matrix
+            of each pixel, in shape (N*(N+1)/2, npix).
+        """
+
+        cache = proj is None
+        if partial is None:
+            partial = cache and ('dest_pixels' in self.depo or
+                                 'dest_grid' in self.depo)
+
+        if cache:
+            proj = self.depo['proj']
+        if proj is None or proj is False:
+            raise ValueError('missing proj')
+        proj, _, nmap = check_proj(proj, partial=partial)
+
+        proj_inv = np.empty_like(proj)
+        if qp.qp_proj_inv(self._memory, lib.pointer_2d(proj),
+                          lib.pointer_2d(proj_inv), nmap, proj.shape[-1],
+                          cond_thresh):
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
+
+        if cache:
+            self.depo['proj_inv'] = proj_inv
+        return proj_inv.squeeze()
+
+    def precondition_map(self, map_in, proj_inv=None, copy=True,
+                         partial=None, fill=0):
+        """
+        Apply the inverse projection matrix of each pixel to a map.  This is
+        the block-diagonal preconditioner for conjugate gradient mapmaking,
+        and, applied to the binned vec map, yields the solved map.
+
+        Arguments
+        ---------
+        map_in : array_like
+            A map or list of N maps.
+        proj_inv : array_like, optional
+            The upper triangular elements of the inverse projection matrix
+            of each pixel, of shape (N*(N+1)/2, npix), as returned by
+            :meth:`proj_inv`.  Default to `depo['proj_inv']`, which is
+            computed from `depo['proj']` if not already cached.
+        copy : bool, optional
+            if False, do the computation in-place so that the input map is
+            modified.  Otherwise, a copy is created.  Default: True.
+        partial : bool, optional
+            If True, the map is not checked to ensure a proper healpix nside.
+        fill : scalar, optional
+            Fill the output map with this value where the inverse is zero.
+
+        Returns
+        -------
+        map : array_like
+            The preconditioned map, in shape (N, npix).
+        """
+
+        if partial is None:
+            partial = 'dest_pixels' in self.depo or 'dest_grid' in self.depo
+
+        if proj_inv is None:
+            proj_inv = self.depo.get('proj_inv', None)
+            if proj_inv is None:
+                proj_inv = self.proj_inv(partial=partial)
+        proj_inv, pnside, nmap = check_proj(proj_inv, partial=partial)
+
+        map_in, nside = check_map(map_in, copy=copy, partial=partial)
+        if pnside != nside or nmap != len(map_in):
+            raise ValueError('map_in and proj_inv have incompatible shapes')
+
+        if qp.qp_unsolve_map(self._memory, lib.pointer_2d(map_in),
+                             lib.pointer_2d(proj_inv), nmap, map_in.shape[-1],
+                             None, fill):
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
+
+        return map_in.squeeze()
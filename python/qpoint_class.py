@@ -1,16 +1,13 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
-try:
-    import itertools.izip as zip
-except ImportError:
-    pass
 import numpy as np
 from . import _libqpoint as lib
 from ._libqpoint import libqp as qp
 from ._libqpoint import check_input, check_inputs, check_output
 
-__all__ = ['QPoint', 'check_input', 'check_inputs', 'check_output']
+__all__ = ['QPoint', 'RotationPlan', 'check_input', 'check_inputs',
+           'check_output']
 
 class QPoint(object):
 
@@ -101,7 +98,11 @@ class QPoint(object):
         mean_aber : bool
             If True, apply the aberration correction as an average for the
             entire field of view.  This is gives a 1-2 arcsec deviation
-            at the edges of the SPIDER field of view.
+            at the edges of the SPIDER field of view.  If False, the
+            mapmaking functions compute the earth velocity in the
+            boresight frame once per sample, and from it the correction
+            for each detector, so the cost is small compared to the
+            per-detector pointing calculation.
         fast_math : bool
             If True, use polynomial approximations for trig functions
         polconv : 'cosmo' or 'iau'
@@ -121,8 +122,48 @@ class QPoint(object):
         interp_missing : bool
             If True and `interp_pix` is True, drop missing neighbors
             and reweight remaining neighbors.  Overrides `nan_missing`.
+        interp_corr : bool
+            If True, the wobble, earth rotation and NPB corrections are
+            evaluated on a grid spaced by their update rates, and
+            interpolated between grid points rather than held fixed
+            between updates.  Update rates of 10-60 seconds then agree
+            with per-sample evaluation to better than 1e-5 arcsec.
+            Only applies to corrections with a positive update rate.
         num_threads : bool
-             Number of openMP threads to use for mapmaking.
+             Number of openMP threads to use for mapmaking.  Long
+             timestreams passed to the pointing functions are also split
+             into contiguous chunks across this many threads.  Each chunk
+             recomputes any corrections with a positive update rate at its
+             first sample, so results are identical to a serial run when
+             all rates are 0, once or never.  With interp_corr set, the
+             wobble, earth rotation and NPB terms are also independent of
+             the chunking.
+        reduce_mode : 'copy', 'owner' or 'sparse'
+            Strategy for combining the output of parallel threads when
+            binning timestreams into maps.  If 'copy' (default), each thread
+            bins into its own copy of the full map, and the copies are
+            summed.  If 'owner', each thread owns a contiguous range of map
+            pixels and bins only the samples that fall in its range, so that
+            no map copies are made.  If 'sparse', each thread bins into a
+            sparse map of the pixels it hits, and these are summed in
+            parallel.  The latter two modes use memory that scales with the
+            number of samples and pixels hit, rather than the number of
+            threads times the map size.
+        parallel_mode : 'det', 'sample' or 'auto'
+            How work is divided among threads when binning or scanning
+            maps.  If 'det' (default), each thread processes whole
+            detectors.  If 'sample', each detector timestream is also split
+            into one contiguous chunk of samples per thread, with the
+            aberration correction state primed for the start of each chunk,
+            so that a few long timestreams use all available threads.
+            If 'auto', samples are split only if there are fewer detectors
+            than threads.
+        sort_pix : bool
+            If True, timestreams are binned into maps in blocks of samples
+            sorted by pixel, rather than in time order, so that map memory
+            is accessed in order.  This speeds up binning into high
+            resolution maps that do not fit in cache.  Applies to the
+            'copy' reduce mode.
         temperature : float
             Ambient temperature, Celcius. For computing refraction corrections.
         pressure : float
@@ -503,7 +544,7 @@ class QPoint(object):
         return quat
 
     def azel2bore(self, az, el, pitch, roll, lon, lat, ctime, q=None,
-                  **kwargs):
+                  batch=False, **kwargs):
         """
         Estimate the quaternion for the boresight orientation on the sky given
         the attitude (az/el/pitch/roll), location on the earth (lon/lat) and
@@ -528,6 +569,13 @@ class QPoint(object):
         q : array_like, optional
             Output quaternion array initialized by user.  Supply this
             for in-place computation.
+        batch : bool, optional
+            If True, use the batched boresight calculation, which evaluates
+            the slowly varying corrections only when they are updated, and
+            advances the earth rotation angle linearly in time between
+            exact evaluations.  This is several times faster at typical
+            sample rates, and agrees with the default calculation to within
+            1e-5 arcsec.
 
         Returns
         -------
@@ -550,8 +598,12 @@ class QPoint(object):
         # identity quaternion
         q = check_output('q', q, shape=(n,4), fill=[1,0,0,0])
 
-        qp.qp_azel2bore(self._memory, az, el, pitch, roll, lon, lat,
-                        ctime, q, n)
+        if batch:
+            qp.qp_azel2bore_batch(self._memory, az, el, pitch, roll, lon, lat,
+                                  ctime, q, n)
+        else:
+            qp.qp_azel2bore(self._memory, az, el, pitch, roll, lon, lat,
+                            ctime, q, n)
 
         return q
 
@@ -566,9 +618,10 @@ class QPoint(object):
 
         Arguments
         ---------
-        q_off : quaternion
+        q_off : quaternion or array of quaternions
             Detector offset quaternion for a single detector, calculated using
-            `det_offset`.
+            `det_offset`, or an (ndet, 4) array of offsets for a set of
+            detectors.
         ctime : array_like
             Unix time in seconds UTC
         q_bore : quaternion or array of quaternions
@@ -603,11 +656,16 @@ class QPoint(object):
 
         Pre-allocated output arguments can also be supplied as input keywords
         for in-place operation.
+
+        If `q_off` is a 2-dimensional array, all detectors are computed in a
+        single call to the C library, parallelized over detectors, and each
+        output is an array of shape (ndet, nsample).
         """
 
         self.set(**kwargs)
 
         q_off  = check_input('q_off', q_off, quat=True)
+        ndet = q_off.shape[0] if q_off.ndim == 2 else None
         q_bore = check_input('q_bore', np.atleast_2d(q_bore), quat=True)
         shape = (q_bore.size // 4,)
         if ctime is None:
@@ -615,7 +673,8 @@ class QPoint(object):
                 raise ValueError('ctime required if mean_aber is False')
             ctime = np.zeros(shape, dtype=q_bore.dtype)
         ctime  = check_input('ctime', ctime, shape=shape)
-        pars = dict(shape=ctime.shape, dtype=np.double)
+        oshape = ctime.shape if ndet is None else (ndet,) + ctime.shape
+        pars = dict(shape=oshape, dtype=np.double)
         ra = check_output('ra', ra, **pars)
         dec = check_output('dec', dec, **pars)
         if return_pa:
@@ -627,6 +686,23 @@ class QPoint(object):
             cos2psi = check_output('cos2psi', cos2psi, **pars)
         n = ctime.size
 
+        if ndet is not None:
+            if q_hwp is not None:
+                q_hwp = check_input('q_hwp', q_hwp, shape=q_bore.shape)
+            if return_pa:
+                qp.qp_bore2radecpa_ndet(self._memory, q_off, ndet, ctime,
+                                        q_bore, q_hwp, ra, dec, pa, n)
+                return ra, dec, pa
+            elif sindec:
+                qp.qp_bore2rasindec_ndet(self._memory, q_off, ndet, ctime,
+                                         q_bore, q_hwp, ra, dec, sin2psi,
+                                         cos2psi, n)
+            else:
+                qp.qp_bore2radec_ndet(self._memory, q_off, ndet, ctime,
+                                      q_bore, q_hwp, ra, dec, sin2psi,
+                                      cos2psi, n)
+            return ra, dec, sin2psi, cos2psi
+
         if q_hwp is None:
             if return_pa:
                 qp.qp_bore2radecpa(self._memory, q_off, ctime, q_bore,
@@ -967,6 +1043,48 @@ class QPoint(object):
             return pix[0]
         return pix
 
+    def set_frame(self, name, quat=None, center=None):
+        """
+        Register a coordinate frame for use with `rotate_quat()`,
+        `rotate_coord()` and `rotate_map()`.  The celestial ('C'), galactic
+        ('G') and ecliptic ('E') frames are predefined, and cannot be
+        redefined.
+
+        Arguments
+        ---------
+        name : string
+            Single-character frame identifier.
+        quat : quaternion, optional
+            Quaternion that rotates frame coordinates to celestial
+            coordinates.
+        center : tuple, optional
+            (ra, dec, pa) of the frame origin in celestial coordinates,
+            in degrees, e.g. for field-centric coordinates.  The frame
+            origin is at longitude = latitude = 0 with zero position angle.
+            One of `quat` or `center` is required.
+        """
+        name = lib.check_frame(name)
+        if (quat is None) == (center is None):
+            raise ValueError('one of quat or center required')
+        if quat is not None:
+            quat = check_input('quat', quat, quat=True)
+            err = qp.qp_set_frame(self._memory, name, quat)
+        else:
+            ra, dec, pa = center
+            err = qp.qp_set_frame_center(self._memory, name, ra, dec, pa)
+        if err:
+            raise ValueError(qp.qp_get_error_string(self._memory))
+
+    def get_frame(self, name):
+        """
+        Return the quaternion that rotates coordinates in the given frame
+        to celestial coordinates.
+        """
+        quat = np.empty(4, dtype=np.double)
+        if qp.qp_get_frame(self._memory, lib.check_frame(name), quat):
+            raise ValueError(qp.qp_get_error_string(self._memory))
+        return quat
+
     def rotate_quat(self, quat, coord=['C', 'G'], inplace=True, **kwargs):
         """
         Rotate a quaternion from one coordinate system to another.
@@ -974,6 +1092,8 @@ class QPoint(object):
 
         C: celestial (equatorial) coordinates
         G: galactic coordinates
+        E: ecliptic coordinates
+        Any other frame registered with `set_frame()`.
 
         Arguments
         ---------
@@ -999,16 +1119,13 @@ class QPoint(object):
 
         self.set(**kwargs)
 
+        coord_in, coord_out = lib.check_coord(coord)
         quat = check_input('quat', np.atleast_2d(quat), quat=True,
                            inplace=inplace)
         n = quat.size // 4
 
-        if coord[0] == 'C' and coord[1] == 'G':
-            qp.qp_radec2gal_quatn(self._memory, quat, n)
-        elif coord[0] == 'G' and coord[1] == 'C':
-            qp.qp_gal2radec_quatn(self._memory, quat, n)
-        else:
-            raise ValueError('unsupported coord {}'.format(coord))
+        if qp.qp_rotate_quatn(self._memory, coord_in, coord_out, quat, n):
+            raise ValueError(qp.qp_get_error_string(self._memory))
 
         return quat.squeeze()
 
@@ -1020,6 +1137,8 @@ class QPoint(object):
 
         C: celestial (equatorial) coordinates
         G: galactic coordinates
+        E: ecliptic coordinates
+        Any other frame registered with `set_frame()`.
 
         Arguments
         ---------
@@ -1031,7 +1150,6 @@ class QPoint(object):
             pa = 0 is assumed.
         coord : list, optional
             2-element list of input and output coordinates.
-            Supported systems: C, G.
         inplace : bool, optional
             If True, apply the rotation in-place on the input quaternion.
             Otherwise, return a copy of the input array.  Default: True.
@@ -1064,20 +1182,19 @@ class QPoint(object):
                 raise KeyError('ambiguous pol arguments, supply either pa '
                                'or sin2psi/cos2psi only')
 
+        coord_in, coord_out = lib.check_coord(coord)
         ra, dec, pa, sin2psi, cos2psi = \
             check_inputs(ra, dec, pa, sin2psi, cos2psi, inplace=inplace)
         n = ra.size
 
-        if coord[0] == 'C' and coord[1] == 'G':
-            if do_pa:
-                qp.qp_radecpa2galn(self._memory, ra, dec, pa, n)
-            else:
-                qp.qp_radec2galn(self._memory, ra, dec, sin2psi, cos2psi, n)
-        elif coord[0] == 'G' and coord[1] == 'C':
-            if do_pa:
-                qp.qp_gal2radecpan(self._memory, ra, dec, pa, n)
-            else:
-                qp.qp_gal2radecn(self._memory, ra, dec, sin2psi, cos2psi, n)
+        if do_pa:
+            err = qp.qp_rotate_coordpan(self._memory, coord_in, coord_out,
+                                        ra, dec, pa, n)
+        else:
+            err = qp.qp_rotate_coordn(self._memory, coord_in, coord_out,
+                                      ra, dec, sin2psi, cos2psi, n)
+        if err:
+            raise ValueError(qp.qp_get_error_string(self._memory))
 
         if n == 1:
             if do_pa:
@@ -1155,31 +1272,109 @@ class QPoint(object):
         return self.rotate_coord(ra, dec, pa, sin2psi, cos2psi,
                                  coord=['G','C'], inplace=inplace, **kwargs)
 
+    def rotate_map_plan(self, nside, coord=['C','G'], pixels_in=None,
+                        pixels_out=None, interp_pix=True, **kwargs):
+        """
+        Compute a reusable plan for rotating maps from one coordinate system
+        to another.  The plan stores, for each output pixel, the input map
+        indices and weights of its interpolation stencil and the rotation of
+        the polarization angle, so that applying it to any number of maps is
+        a simple gather.
+
+        Arguments
+        ---------
+        nside : int
+            Map dimension of both the input and output maps.
+        coord : list, optional
+            2-element list of input and output coordinates.
+            Supported systems: C, G, E, or any frame registered with
+            `set_frame()`.
+        pixels_in : 1D array_like, optional
+            Pixel numbers for each index of a partial input map.
+            If not supplied, input maps are full-sky.
+        pixels_out : 1D array_like, optional
+            Pixel numbers for each index of a partial output map.
+            If not supplied, output maps are full-sky.
+        interp_pix : bool, optional
+            If True, interpolate the input map.  Otherwise, use the value
+            of the nearest input pixel.
+
+        Returns
+        -------
+        plan : RotationPlan
+            Rotation plan, to be passed to `rotate_map()`.
+
+        Notes
+        -----
+        Any keywords accepted by the :meth:`qpoint.qpoint_class.QPoint.set`
+        method can also be passed here, and will be processed prior to
+        calculation.  The `pix_order` and `polconv` options are stored in the
+        plan.
+
+        The plan requires 40 bytes per output pixel if interpolating, and
+        16 bytes per output pixel otherwise.
+        """
+
+        interp_orig = self.get('interp_pix')
+        self.set(interp_pix=interp_pix, **kwargs)
+
+        coord_in, coord_out = lib.check_coord(coord)
+
+        npix_in = npix_out = 0
+        if pixels_in is not None:
+            pixels_in = check_input('pixels_in', np.asarray(pixels_in),
+                                    dtype=np.long)
+            npix_in = pixels_in.size
+        if pixels_out is not None:
+            pixels_out = check_input('pixels_out', np.asarray(pixels_out),
+                                     dtype=np.long)
+            npix_out = pixels_out.size
+
+        plan = qp.qp_init_rotate_plan(self._memory, nside, coord_in,
+                                      coord_out, pixels_in, npix_in,
+                                      pixels_out, npix_out)
+
+        self.set(interp_pix=interp_orig)
+        if not plan:
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
+        return RotationPlan(plan)
+
     def rotate_map(self, map_in, coord=['C','G'], map_out=None,
-                   interp_pix=True, **kwargs):
+                   interp_pix=True, plan=None, pol=True, **kwargs):
         """
         Rotate a polarized 3-x-npix map from one coordinate system to another.
         Supported coordinates:
 
         C = celestial (equatorial J2000)
         G = galactic
+        E = ecliptic (J2000 mean ecliptic)
+        Any other frame registered with `set_frame()`.
 
         Arguments
         ---------
         map_in : array_like
-            Input map, of shape (3, N)
+            Input map, of shape (3, N).  If a `plan` is supplied, any number
+            of map columns may be given, of shape (ncol, N).
         coord : list, optional
             2-element list of input and output coordinates.
-            Supported systems: C, G.
         map_out : array_like, optional
-            Rotated output map, for inplace operation.  Same shape as `map_in`.
+            Rotated output map, for inplace operation.
         interp_pix : bool, optional
             If True, interpolate the rotated map.
+        plan : RotationPlan, optional
+            Precomputed rotation plan, as returned by `rotate_map_plan()`.
+            If supplied, the `coord` and `interp_pix` arguments are ignored.
+            Use a plan to rotate many maps with the same geometry, or
+            partial maps.
+        pol : bool, optional
+            If True, the map columns are consecutive (T, Q, U) triplets, and
+            the polarization angle is rotated.  Otherwise, each column
+            is treated as an independent scalar map.
 
         Returns
         -------
         map_out : array_like
-            Rotated output map.
+            Rotated output map, of shape (ncol, npix_out).
 
         Notes
         -----
@@ -1187,33 +1382,38 @@ class QPoint(object):
         method can also be passed here, and will be processed prior to
         calculation.
 
-        Only full-sky maps are currently supported.
+        Output pixels of a plan with partial input maps that have no input
+        pixels nearby are set to zero, or NaN if the `nan_missing` option
+        is set.
         """
 
-        from warnings import warn
-        warn('This code is buggy, use at your own risk', UserWarning)
+        from .qmap_class import check_map, npix2nside
+        map_in, npix_in = check_map(map_in, partial=True)
 
-        interp_orig = self.get('interp_pix')
-        self.set(interp_pix=interp_pix, **kwargs)
+        if plan is None:
+            nside = npix2nside(npix_in)
+            plan = self.rotate_map_plan(nside, coord, interp_pix=interp_pix,
+                                        **kwargs)
+        else:
+            self.set(**kwargs)
 
-        from .qmap_class import check_map
-        map_in, nside = check_map(map_in)
-        map_out = check_output(
-            'map_out', map_out, shape=map_in.shape, dtype=map_in.dtype, fill=0)
+        if npix_in != plan.npix_in:
+            raise ValueError('input map must have {} pixels'.format(
+                plan.npix_in))
+        ncol = len(map_in)
+        if pol and ncol % 3:
+            raise ValueError('polarized maps must have 3 columns per map')
 
-        try:
-            coord_in = coord[0]
-            coord_out = coord[1]
-        except:
-            raise ValueError('unable to parse coord')
+        map_out = check_output('map_out', map_out, shape=(ncol, plan.npix_out),
+                               dtype=map_in.dtype, fill=0)
 
         map_in_p = lib.pointer_2d(map_in)
         map_out_p = lib.pointer_2d(map_out)
 
-        qp.qp_rotate_map(self._memory, nside, map_in_p, coord_in,
-                         map_out_p, coord_out)
+        if qp.qp_apply_rotate_plan(self._memory, plan._plan, map_in_p,
+                                   map_out_p, ncol, pol):
+            raise RuntimeError(qp.qp_get_error_string(self._memory))
 
-        self.set(interp_pix=interp_orig)
         return map_out
 
     def quat2pix(self, quat, nside=256, pol=True, **kwargs):
@@ -1272,9 +1472,10 @@ class QPoint(object):
 
         Arguments
         ---------
-        q_off : quaternion
+        q_off : quaternion or array of quaternions
             Detector offset quaternion for a single detector,
-            calculated using `det_offset`.
+            calculated using `det_offset`, or an (ndet, 4) array of offsets
+            for a set of detectors.
         ctime : array_like
             Unix times in seconds UTC
         q_bore : quaternion or array of quaternions
@@ -1305,29 +1506,42 @@ class QPoint(object):
         Any keywords accepted by the :meth:`qpoint.qpoint_class.QPoint.set`
         method can also be passed here, and will be processed prior to
         calculation.
+
+        If `q_off` is a 2-dimensional array, all detectors are computed in a
+        single call to the C library, parallelized over detectors, and each
+        output is an array of shape (ndet, nsample).
         """
 
         self.set(**kwargs)
 
         q_off  = check_input('q_off', q_off, quat=True)
+        ndet = q_off.shape[0] if q_off.ndim == 2 else None
         q_bore = check_input('q_bore', q_bore, quat=True)
         if ctime is None:
             if not self.get('mean_aber'):
                 raise ValueError('ctime required if mean_aber is False')
             ctime = np.zeros((q_bore.size // 4,), dtype=q_bore.dtype)
         ctime  = check_input('ctime', ctime)
-        pix  = check_output('pix', shape=ctime.shape,
-                                dtype=np.int, **kwargs)
+        shape = ctime.shape if ndet is None else (ndet,) + ctime.shape
+        pix  = check_output('pix', shape=shape, dtype=np.int, **kwargs)
         if return_pa:
-            pa = check_output('pa', shape=ctime.shape, **kwargs)
+            pa = check_output('pa', shape=shape, **kwargs)
         else:
-            sin2psi = check_output('sin2psi', shape=ctime.shape,
-                                   **kwargs)
-            cos2psi = check_output('cos2psi', shape=ctime.shape,
-                                   **kwargs)
+            sin2psi = check_output('sin2psi', shape=shape, **kwargs)
+            cos2psi = check_output('cos2psi', shape=shape, **kwargs)
         n = ctime.size
 
-        if q_hwp is None:
+        if ndet is not None:
+            if q_hwp is not None:
+                q_hwp = check_input('q_hwp', q_hwp, shape=q_bore.shape)
+            if return_pa:
+                qp.qp_bore2pixpa_ndet(self._memory, q_off, ndet, ctime,
+                                      q_bore, q_hwp, nside, pix, pa, n)
+            else:
+                qp.qp_bore2pix_ndet(self._memory, q_off, ndet, ctime,
+                                    q_bore, q_hwp, nside, pix, sin2psi,
+                                    cos2psi, n)
+        elif q_hwp is None:
             if return_pa:
                 qp.qp_bore2pixpa(self._memory, q_off, ctime, q_bore,
                                  nside, pix, pa, n)
@@ -1359,7 +1573,8 @@ class QPoint(object):
         Arguments
         ---------
         map_in : array_like
-            A single healpix map or list of maps which to interpolate from.
+            A single healpix map or list of maps which to interpolate from,
+            of shape (npix,) or (nmap, npix).
         ra, dec: array_like
             Timestreams of coordinates to interpolate to, in degrees,
             of shape (nsample,)
@@ -1372,6 +1587,12 @@ class QPoint(object):
         -------
         values : array_like
             Array of interpolated map values, of shape (nmap, nsample).
+
+        Notes
+        -----
+        The interpolation stencil for each sample is computed once and
+        applied to all of the maps, and the samples are distributed over
+        threads as for the other pointing functions.
         """
 
         pix_order = self.get('pix_order')
@@ -1388,12 +1609,12 @@ class QPoint(object):
 
         val = check_output('value', shape=(len(map_in), n))
 
-        for m, v in zip(map_in, val):
-            qp.qp_get_interp_valn(self._memory, nside, m, ra, dec, v, n)
+        qp.qp_get_interp_valn_nmap(self._memory, nside, map_in, len(map_in),
+                                   ra, dec, val, n)
 
         self.set(pix_order=pix_order)
 
-        v = v.squeeze()
+        v = val.squeeze()
         if not v.shape:
             return v[()]
         return v
@@ -1456,3 +1677,102 @@ class QPoint(object):
         if out[0].shape == ():
             return tuple(x[()] for x in out)
         return out
+
+    _ephem_magic = b'QPEPHEM1'
+
+    def make_ephem_table(self, filename, start, end, step=60.):
+        """
+        Precompute the time-dependent pointing corrections on a regular time
+        grid and store them in a binary file, to be loaded with
+        :meth:`qpoint.qpoint_class.QPoint.load_ephem_table`.
+
+        The table contains the polar motion (wobble) and
+        nutation/precession/frame bias quaternions and the earth orbital
+        velocity, computed using the current accuracy option and
+        IERS Bulletin A data.
+
+        Arguments
+        ---------
+        filename : string
+            Name of the output file.
+        start, end : float
+            Range of ctimes to cover, in seconds.
+        step : float, optional
+            Spacing between table entries, in seconds.  With the default
+            of 60 seconds, interpolated corrections agree with the direct
+            calculation to better than 1e-7 arcsec.
+        """
+
+        n = int(np.ceil((end - start) / step)) + 1
+        if n < 2:
+            raise ValueError('Table must contain at least two entries')
+        data = np.empty((n, lib.QP_EPHEM_NCOL), dtype=np.double)
+        qp.qp_fill_ephem(self._memory, start, step, n, data)
+
+        accuracy = qp.qp_get_opt_accuracy(self._memory)
+        header = np.array([start, step, n, accuracy, lib.QP_EPHEM_NCOL],
+                          dtype='<f8')
+        with open(filename, 'wb') as f:
+            f.write(self._ephem_magic)
+            f.write(header.tobytes())
+            f.write(data.astype('<f8').tobytes())
+
+    def load_ephem_table(self, filename=None):
+        """
+        Use a table of corrections created with
+        :meth:`qpoint.qpoint_class.QPoint.make_ephem_table` instead of
+        computing them with SOFA.  The file is memory-mapped, so that many
+        processes on the same machine share a single copy.  Corrections
+        at times outside the table, or when the accuracy option differs from
+        that used to compute the table, are computed as usual.
+
+        Arguments
+        ---------
+        filename : string, optional
+            Name of the table file.  If None, remove any loaded table.
+        """
+
+        if filename is None:
+            qp.qp_set_ephem(self._memory, 0, 0, 0, 0, None)
+            self._ephem = None
+            return
+
+        nhead = len(self._ephem_magic) + 5 * 8
+        with open(filename, 'rb') as f:
+            head = f.read(nhead)
+        if len(head) < nhead or not head.startswith(self._ephem_magic):
+            raise ValueError('{} is not a correction table'.format(filename))
+        start, step, n, accuracy, ncol = np.frombuffer(
+            head[len(self._ephem_magic):], dtype='<f8')
+        if int(ncol) != lib.QP_EPHEM_NCOL:
+            raise ValueError('Incompatible correction table {}'.format(filename))
+
+        data = np.memmap(filename, dtype='<f8', mode='r', offset=nhead,
+                         shape=(int(n), int(ncol)))
+        qp.qp_set_ephem(self._memory, start, step, int(n), int(accuracy), data)
+        # keep a reference to the mapped data while the table is in use
+        self._ephem = data
+
+
+class RotationPlan(object):
+    """
+    Precomputed map rotation, as returned by
+    :meth:`qpoint.qpoint_class.QPoint.rotate_map_plan`.
+    """
+
+    def __init__(self, plan):
+        self._plan = plan
+        p = plan.contents
+        self.nside = p.nside
+        self.coord = [p.coord_in.decode(), p.coord_out.decode()]
+        self.interp_pix = p.nstencil > 1
+        self.npix_in = p.npix_in
+        self.npix_out = p.npix_out
+
+    def __del__(self):
+        """
+        Free memory before deleting the object
+        """
+        if getattr(self, '_plan', None):
+            qp.qp_free_rotate_plan(self._plan)
+            self._plan = None
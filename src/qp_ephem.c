@@ -0,0 +1,78 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <math.h>
+#include "qpoint.h"
+#include "quaternion.h"
+
+/*
+  Precomputed tables of the corrections that depend only on time
+  (polar motion, nutation/precession/frame bias, earth orbital velocity),
+  tabulated on a regular grid and interpolated between entries.
+ */
+
+void qp_fill_ephem(qp_memory_t *mem, double ctime0, double step, int n,
+                   double *data) {
+  double dut1, x, y;
+
+  // make sure the factory bulletin is set up before threads read it
+  qp_get_iers_bulletin_a(mem, 0, &dut1, &x, &y);
+
+#pragma omp parallel for private(dut1, x, y)
+  for (int ii = 0; ii < n; ii++) {
+    double ctime = ctime0 + ii * step;
+    double jd_utc[2], jd_tt[2];
+    double *row = data + ii * QP_EPHEM_NCOL;
+
+    ctime2jd(ctime, jd_utc);
+    ctime2jdtt(ctime, jd_tt);
+    qp_get_iers_bulletin_a(mem, jd2mjd(jd_utc[0]) + jd_utc[1], &dut1, &x, &y);
+    qp_wobble_quat(jd_tt, x, y, row);
+    qp_npb_quat(jd_tt, row + 4, mem->accuracy);
+    qp_earth_orbital_beta(jd_tt, row + 8);
+  }
+}
+
+void qp_set_ephem(qp_memory_t *mem, double ctime0, double step, int n,
+                  int accuracy, double *data) {
+  qp_ephem_t *E = &mem->ephem;
+
+  E->data = data;
+  E->ctime0 = ctime0;
+  E->step = step;
+  E->n = (data == NULL) ? 0 : n;
+  E->accuracy = accuracy;
+}
+
+int qp_get_ephem(qp_memory_t *mem, double ctime, quat_t q_wobble,
+                 quat_t q_npb, vec3_t beta) {
+  qp_ephem_t *E = &mem->ephem;
+
+  if (E->data == NULL || E->accuracy != mem->accuracy)
+    return 1;
+
+  // entries k and k+1 must bracket ctime
+  double t = (ctime - E->ctime0) / E->step;
+  if (!(t >= 0 && t < E->n - 1))
+    return 1;
+
+  double k_floor;
+  double r = modf(t, &k_floor);
+  double *a = E->data + (size_t) k_floor * QP_EPHEM_NCOL;
+  double *b = a + QP_EPHEM_NCOL;
+  QuaternionSlerp slerp;
+
+  if (q_wobble != NULL) {
+    QuaternionSlerp_init(&slerp, a, b);
+    QuaternionSlerp_interpolate(&slerp, r, q_wobble);
+  }
+  if (q_npb != NULL) {
+    QuaternionSlerp_init(&slerp, a + 4, b + 4);
+    QuaternionSlerp_interpolate(&slerp, r, q_npb);
+  }
+  if (beta != NULL) {
+    for (int ii = 0; ii < 3; ii++)
+      beta[ii] = (1 - r) * a[8 + ii] + r * b[8 + ii];
+  }
+
+  return 0;
+}
@@ -25,3 +25,21 @@ int qp_check_error(qp_memory_t *mem, int condition, int error_code,
   }
   return 0;
 }
+
+// copy an error set on a thread-local copy of mem back to mem.
+// if err is not NULL, only the first error is kept and its code is stored
+// in err, so that errors from several threads are not mixed.
+int qp_merge_error(qp_memory_t *mem, qp_memory_t *memloc, int *err) {
+  if (memloc == mem || !memloc->error_code)
+    return 0;
+#pragma omp critical(qp_merge_error)
+  {
+    if (err == NULL || !*err) {
+      mem->error_code = memloc->error_code;
+      mem->error_string = memloc->error_string;
+      if (err != NULL)
+        *err = memloc->error_code;
+    }
+  }
+  return memloc->error_code;
+}
@@ -23,12 +23,23 @@ qp_det_t * qp_init_det(quat_t q_off, double weight, double gain, mueller_t muell
 
   det->tod_init = 0;
   det->tod = NULL;
+  det->todf = NULL;
 
   det->flag_init = 0;
   det->flag = NULL;
 
   det->weights_init = 0;
   det->weights = NULL;
+  det->weightsf = NULL;
+
+  det->pnt_init = 0;
+  det->pix = NULL;
+  det->sin2psi = NULL;
+  det->cos2psi = NULL;
+
+  det->interp_init = 0;
+  det->interp_pix = NULL;
+  det->interp_weight = NULL;
 
   det->init = QP_STRUCT_INIT | QP_STRUCT_MALLOC;
   return det;
@@ -43,6 +54,7 @@ qp_det_t * qp_default_det(void) {
 void qp_init_det_tod(qp_det_t *det, size_t n) {
   det->n = n;
   det->tod = calloc(n, sizeof(double));
+  det->todf = NULL;
   det->tod_init = QP_ARR_MALLOC_1D;
 }
 
@@ -55,6 +67,22 @@ void qp_init_det_tod_from_array(qp_det_t *det, double *tod, size_t n, int copy)
 
   det->n = n;
   det->tod = tod;
+  det->todf = NULL;
+  det->tod_init = QP_ARR_INIT_PTR;
+}
+
+void qp_init_det_todf_from_array(qp_det_t *det, float *tod, size_t n,
+                                 int copy) {
+  det->n = n;
+  det->tod = NULL;
+  if (copy) {
+    det->todf = malloc(n * sizeof(float));
+    memcpy(det->todf, tod, n * sizeof(float));
+    det->tod_init = QP_ARR_MALLOC_1D;
+    return;
+  }
+
+  det->todf = tod;
   det->tod_init = QP_ARR_INIT_PTR;
 }
 
@@ -79,6 +107,7 @@ void qp_init_det_flag_from_array(qp_det_t *det, uint8_t *flag, size_t n, int cop
 void qp_init_det_weights(qp_det_t *det, size_t n) {
   det->n = n;
   det->weights = calloc(n, sizeof(double));
+  det->weightsf = NULL;
   det->weights_init = QP_ARR_MALLOC_1D;
 }
 
@@ -92,16 +121,92 @@ void qp_init_det_weights_from_array(qp_det_t *det, double *weights, size_t n,
 
   det->n = n;
   det->weights = weights;
+  det->weightsf = NULL;
+  det->weights_init = QP_ARR_INIT_PTR;
+}
+
+void qp_init_det_weightsf_from_array(qp_det_t *det, float *weights, size_t n,
+                                     int copy) {
+  det->n = n;
+  det->weights = NULL;
+  if (copy) {
+    det->weightsf = malloc(n * sizeof(float));
+    memcpy(det->weightsf, weights, n * sizeof(float));
+    det->weights_init = QP_ARR_MALLOC_1D;
+    return;
+  }
+
+  det->weightsf = weights;
   det->weights_init = QP_ARR_INIT_PTR;
 }
 
+void qp_init_det_pnt(qp_det_t *det, size_t n) {
+  det->n = n;
+  det->pix = calloc(n, sizeof(long));
+  det->sin2psi = calloc(n, sizeof(float));
+  det->cos2psi = calloc(n, sizeof(float));
+  det->pnt_init = QP_ARR_MALLOC_1D;
+}
+
+void qp_init_det_pnt_from_arrays(qp_det_t *det, long *pix, float *sin2psi,
+                                 float *cos2psi, size_t n, int copy) {
+  if (copy) {
+    qp_init_det_pnt(det, n);
+    memcpy(det->pix, pix, n * sizeof(long));
+    memcpy(det->sin2psi, sin2psi, n * sizeof(float));
+    memcpy(det->cos2psi, cos2psi, n * sizeof(float));
+    return;
+  }
+
+  det->n = n;
+  det->pix = pix;
+  det->sin2psi = sin2psi;
+  det->cos2psi = cos2psi;
+  det->pnt_init = QP_ARR_INIT_PTR;
+}
+
+void qp_init_det_interp(qp_det_t *det, size_t n) {
+  det->n = n;
+  det->interp_pix = calloc(4 * n, sizeof(int32_t));
+  det->interp_weight = calloc(4 * n, sizeof(float));
+  det->interp_init = QP_ARR_MALLOC_1D;
+}
+
+void qp_init_det_interp_from_arrays(qp_det_t *det, int32_t *pix,
+                                    float *weight, size_t n, int copy) {
+  if (copy) {
+    qp_init_det_interp(det, n);
+    memcpy(det->interp_pix, pix, 4 * n * sizeof(int32_t));
+    memcpy(det->interp_weight, weight, 4 * n * sizeof(float));
+    return;
+  }
+
+  det->n = n;
+  det->interp_pix = pix;
+  det->interp_weight = weight;
+  det->interp_init = QP_ARR_INIT_PTR;
+}
+
 void qp_free_det(qp_det_t *det) {
-  if (det->tod_init & QP_ARR_MALLOC_1D)
+  if (det->tod_init & QP_ARR_MALLOC_1D) {
     free(det->tod);
+    free(det->todf);
+  }
   if (det->flag_init & QP_ARR_MALLOC_1D)
     free(det->flag);
-  if (det->weights_init & QP_ARR_MALLOC_1D)
+  if (det->weights_init & QP_ARR_MALLOC_1D) {
     free(det->weights);
+    free(det->weightsf);
+  }
+  if (det->pnt_init & QP_ARR_MALLOC_1D) {
+    free(det->pix);
+    free(det->sin2psi);
+    free(det->cos2psi);
+  }
+  if (det->interp_init & QP_ARR_MALLOC_1D) {
+    free(det->interp_pix);
+    free(det->interp_weight);
+  }
   if (det->init & QP_STRUCT_MALLOC)
     free(det);
 }
@@ -125,10 +230,19 @@ qp_detarr_t * qp_init_detarr(quat_t *q_off, double *weight, double *gain,
     det->n = 0;
     det->tod_init = 0;
     det->tod = NULL;
+    det->todf = NULL;
     det->flag_init = 0;
     det->flag = NULL;
     det->weights_init = 0;
     det->weights = NULL;
+    det->weightsf = NULL;
+    det->pnt_init = 0;
+    det->pix = NULL;
+    det->sin2psi = NULL;
+    det->cos2psi = NULL;
+    det->interp_init = 0;
+    det->interp_pix = NULL;
+    det->interp_weight = NULL;
     det->init = QP_STRUCT_INIT;
   }
 
@@ -198,6 +312,25 @@ void qp_init_detarr_weights_from_array_1d(qp_detarr_t *dets, double *weights,
   }
 }
 
+void qp_init_detarr_pnt_from_arrays_1d(qp_detarr_t *dets, long *pix,
+                                       float *sin2psi, float *cos2psi,
+                                       size_t n_chunk, int copy) {
+  for (size_t ii = 0; ii < dets->n; ii++) {
+    qp_init_det_pnt_from_arrays(dets->arr + ii, pix + ii * n_chunk,
+                                sin2psi + ii * n_chunk,
+                                cos2psi + ii * n_chunk, n_chunk, copy);
+  }
+}
+
+void qp_init_detarr_interp_from_arrays_1d(qp_detarr_t *dets, int32_t *pix,
+                                          float *weight, size_t n_chunk,
+                                          int copy) {
+  for (size_t ii = 0; ii < dets->n; ii++) {
+    qp_init_det_interp_from_arrays(dets->arr + ii, pix + 4 * ii * n_chunk,
+                                   weight + 4 * ii * n_chunk, n_chunk, copy);
+  }
+}
+
 void qp_free_detarr(qp_detarr_t *dets) {
   for (size_t ii = 0; ii < dets->n; ii++) {
     qp_free_det(dets->arr + ii);
@@ -226,6 +359,12 @@ qp_point_t * qp_init_point(size_t n, int time, int pol) {
   pnt->q_bore_init = QP_ARR_MALLOC_1D;
   pnt->q_bore = malloc(n * sizeof(quat_t));
 
+  pnt->beta_init = 0;
+  pnt->beta = NULL;
+  pnt->beta_n = 0;
+  pnt->beta_ctime = NULL;
+  pnt->beta_q_bore = NULL;
+
   pnt->init = QP_STRUCT_INIT | QP_STRUCT_MALLOC;
   return pnt;
 }
@@ -264,6 +403,12 @@ qp_point_t *qp_init_point_from_arrays(quat_t *q_bore, double *ctime, quat_t *q_h
     pnt->q_hwp = NULL;
   }
 
+  pnt->beta_init = 0;
+  pnt->beta = NULL;
+  pnt->beta_n = 0;
+  pnt->beta_ctime = NULL;
+  pnt->beta_q_bore = NULL;
+
   pnt->init = QP_STRUCT_INIT | QP_STRUCT_MALLOC;
   return pnt;
 }
@@ -275,6 +420,7 @@ void qp_free_point(qp_point_t *pnt) {
     free(pnt->q_hwp);
   if (pnt->ctime_init & QP_ARR_MALLOC_1D)
     free(pnt->ctime);
+  qp_reset_point_beta(pnt);
   if (pnt->init & QP_STRUCT_MALLOC)
     free(pnt);
   else
@@ -326,6 +472,20 @@ void qp_num_maps(qp_vec_mode vec_mode, qp_proj_mode proj_mode,
   *num_proj = np;
 }
 
+/* Offset between consecutive pixels of a map column */
+static inline size_t qp_map_stride(qp_map_t *map) {
+  return map->interleave ? map->interleave : 1;
+}
+
+/* Map column entries, from single- or double-precision columns */
+static inline double qp_map_vec_val(qp_map_t *map, size_t col, size_t idx) {
+  return map->single ? map->vecf[col][idx] : map->vec[col][idx];
+}
+
+static inline double qp_map_proj_val(qp_map_t *map, size_t col, size_t idx) {
+  return map->single ? map->projf[col][idx] : map->proj[col][idx];
+}
+
 // if npix != 0 then partial map
 qp_map_t * qp_init_map(size_t nside, size_t npix, qp_vec_mode vec_mode,
                        qp_proj_mode proj_mode) {
@@ -338,6 +498,13 @@ qp_map_t * qp_init_map(size_t nside, size_t npix, qp_vec_mode vec_mode,
   map->pixinfo = NULL;
   map->pixhash_init = 0;
   map->pixhash = NULL;
+  memset(&map->grid, 0, sizeof(map->grid));
+  map->interleave = 0;
+  map->single = 0;
+  map->vec1df = NULL;
+  map->vecf = NULL;
+  map->proj1df = NULL;
+  map->projf = NULL;
 
   qp_num_maps(vec_mode, proj_mode, &map->num_vec, &map->num_proj);
 
@@ -394,6 +561,13 @@ qp_map_t * qp_init_map_from_arrays(double **vec, double **proj, size_t nside,
   map->pixinfo = NULL;
   map->pixhash_init = 0;
   map->pixhash = NULL;
+  memset(&map->grid, 0, sizeof(map->grid));
+  map->interleave = 0;
+  map->single = 0;
+  map->vec1df = NULL;
+  map->vecf = NULL;
+  map->proj1df = NULL;
+  map->projf = NULL;
 
   qp_num_maps(vec_mode, proj_mode, &map->num_vec, &map->num_proj);
   map->vec_mode = vec_mode;
@@ -446,6 +620,13 @@ qp_init_map_from_arrays_1d(double *vec, double *proj, size_t nside, size_t npix,
   map->pixinfo = NULL;
   map->pixhash_init = 0;
   map->pixhash = NULL;
+  memset(&map->grid, 0, sizeof(map->grid));
+  map->interleave = 0;
+  map->single = 0;
+  map->vec1df = NULL;
+  map->vecf = NULL;
+  map->proj1df = NULL;
+  map->projf = NULL;
 
   qp_num_maps(vec_mode, proj_mode, &map->num_vec, &map->num_proj);
   map->vec_mode = vec_mode;
@@ -488,6 +669,13 @@ qp_map_t * qp_init_map_1d(size_t nside, size_t npix, qp_vec_mode vec_mode,
   map->pixinfo = NULL;
   map->pixhash_init = 0;
   map->pixhash = NULL;
+  memset(&map->grid, 0, sizeof(map->grid));
+  map->interleave = 0;
+  map->single = 0;
+  map->vec1df = NULL;
+  map->vecf = NULL;
+  map->proj1df = NULL;
+  map->projf = NULL;
 
   qp_num_maps(vec_mode, proj_mode, &map->num_vec, &map->num_proj);
 
@@ -521,30 +709,79 @@ qp_map_t * qp_init_map_1d(size_t nside, size_t npix, qp_vec_mode vec_mode,
   return map;
 }
 
+/* Copy the pixel index (pixhash or grid) of map to new_map */
+static void qp_copy_map_index(qp_map_t *map, qp_map_t *new_map) {
+  if (map->pixhash_init) {
+    new_map->pixhash = qp_copy_pixhash(map->pixhash);
+    new_map->pixhash_init = new_map->pixhash ? new_map->pixhash->init : 0;
+  }
+
+  if (map->grid.type) {
+    new_map->grid = map->grid;
+    new_map->partial = 0;
+  }
+}
+
 // if blank, malloc fresh arrays
 // otherwise, if copy, copy arrays
 // otherwise, point to arrays
-// pixhash is copied if it exists
+// the column layout and pixhash are copied if they exist
 qp_map_t * qp_init_map_from_map(qp_map_t *map, int blank, int copy) {
-  size_t npix = map->partial ? map->npix : 0;
+  size_t npix = (map->partial || map->grid.type) ? map->npix : 0;
   qp_map_t *new_map;
 
-  if (blank)
+  if (map->single && !blank)
+    return NULL;
+
+  if (map->interleave && (blank || copy)) {
+    new_map = qp_init_map_interleaved(map->nside, npix, map->vec_mode,
+                                      map->proj_mode);
+    if (!blank)
+      memcpy(new_map->vec1d, map->num_vec ? map->vec[0] : map->proj[0],
+             map->npix * map->interleave * sizeof(double));
+  } else if (blank) {
     new_map = qp_init_map(map->nside, npix, map->vec_mode, map->proj_mode);
-  else
+  } else {
     new_map = qp_init_map_from_arrays(map->vec, map->proj, map->nside, npix,
                                       map->vec_mode, map->proj_mode, copy);
-
-  if (map->pixhash_init) {
-    new_map->pixhash = qp_copy_pixhash(map->pixhash);
-    new_map->pixhash_init = new_map->pixhash->init;
+    new_map->interleave = map->interleave;
   }
 
+  qp_copy_map_index(map, new_map);
   return new_map;
 }
 
+// single-precision version of qp_reshape_map
+static int qp_reshape_map_single(qp_map_t *map, size_t step) {
+  if (map->vec1d_init) {
+    if (!(map->vec_init & QP_ARR_MALLOC_1D)) {
+      map->vecf = malloc(map->num_vec * sizeof(float *));
+      map->vec_init |= QP_ARR_MALLOC_1D;
+    }
+    for (size_t ii = 0; ii < map->num_vec; ii++)
+      map->vecf[ii] = map->vec1df + ii * step;
+  }
+
+  if (map->proj1d_init) {
+    if (!(map->proj_init & QP_ARR_MALLOC_1D)) {
+      map->projf = malloc(map->num_proj * sizeof(float *));
+      map->proj_init |= QP_ARR_MALLOC_1D;
+    }
+    for (size_t ii = 0; ii < map->num_proj; ii++)
+      map->projf[ii] = map->proj1df + ii * step;
+  }
+
+  return 0;
+}
+
 // convert 1d map to 2d
 int qp_reshape_map(qp_map_t *map) {
+  // offset between columns
+  size_t step = map->interleave ? 1 : map->npix;
+
+  if (map->single)
+    return qp_reshape_map_single(map, step);
+
   if (map->vec1d_init) {
     if (map->vec_init & QP_ARR_MALLOC_2D) {
       for (size_t ii = 0; ii < map->num_vec; ii++)
@@ -556,7 +793,7 @@ int qp_reshape_map(qp_map_t *map) {
       map->vec_init |= QP_ARR_MALLOC_1D;
     }
     for (size_t ii = 0; ii < map->num_vec; ii++)
-      map->vec[ii] = map->vec1d + ii * map->npix;
+      map->vec[ii] = map->vec1d + ii * step;
   }
 
   if (map->proj1d_init) {
@@ -570,46 +807,141 @@ int qp_reshape_map(qp_map_t *map) {
       map->proj_init |= QP_ARR_MALLOC_1D;
     }
     for (size_t ii = 0; ii < map->num_proj; ii++)
-      map->proj[ii] = map->proj1d + ii * map->npix;
+      map->proj[ii] = map->proj1d + ii * step;
   }
 
   return 0;
 }
 
+qp_map_t * qp_init_map_interleaved(size_t nside, size_t npix,
+                                   qp_vec_mode vec_mode,
+                                   qp_proj_mode proj_mode) {
+  qp_map_t *map = qp_init_map_1d(nside, npix, QP_VEC_NONE, QP_PROJ_NONE);
+
+  qp_num_maps(vec_mode, proj_mode, &map->num_vec, &map->num_proj);
+  map->vec_mode = vec_mode;
+  map->proj_mode = proj_mode;
+  map->interleave = map->num_vec + map->num_proj;
+
+  // the vec columns own the array, and the proj columns follow them
+  map->vec1d = calloc(map->npix * map->interleave, sizeof(double));
+  map->vec1d_init = QP_ARR_MALLOC_1D;
+  if (map->num_proj) {
+    map->proj1d = map->vec1d + map->num_vec;
+    map->proj1d_init = QP_ARR_INIT_PTR;
+  }
+  qp_reshape_map(map);
+
+  return map;
+}
+
+qp_map_t * qp_init_map_single(size_t nside, size_t npix,
+                              qp_vec_mode vec_mode, qp_proj_mode proj_mode) {
+  qp_map_t *map = qp_init_map_1d(nside, npix, QP_VEC_NONE, QP_PROJ_NONE);
+
+  qp_num_maps(vec_mode, proj_mode, &map->num_vec, &map->num_proj);
+  map->vec_mode = vec_mode;
+  map->proj_mode = proj_mode;
+  map->single = 1;
+
+  if (map->num_vec) {
+    map->vec1df = calloc(map->num_vec * map->npix, sizeof(float));
+    map->vec1d_init = QP_ARR_MALLOC_1D;
+  }
+  if (map->num_proj) {
+    map->proj1df = calloc(map->num_proj * map->npix, sizeof(float));
+    map->proj1d_init = QP_ARR_MALLOC_1D;
+  }
+  qp_reshape_map(map);
+
+  return map;
+}
+
 int qp_init_map_pixhash(qp_map_t *map, long *pix, size_t npix) {
   if (!map->init)
     return QP_ERROR_INIT;
   if (npix != map->npix)
     return QP_ERROR_INIT;
   map->pixhash = qp_init_pixhash(pix, npix);
+  if (map->pixhash == NULL)
+    return QP_ERROR_INIT;
   map->pixhash_init = map->pixhash->init;
   return 0;
 }
 
+int qp_init_map_grid(qp_map_t *map, qp_grid_type type, double ra0,
+                     double dec0, double x0, double y0, double dx, double dy,
+                     long nx, long ny) {
+  if (!map->init)
+    return QP_ERROR_INIT;
+  if (type != QP_GRID_CAR && type != QP_GRID_TAN)
+    return QP_ERROR_INIT;
+  if (nx <= 0 || ny <= 0 || dx == 0 || dy == 0)
+    return QP_ERROR_INIT;
+  if ((size_t) (nx * ny) != map->npix || map->pixhash_init)
+    return QP_ERROR_INIT;
+
+  qp_grid_t *grid = &map->grid;
+  grid->type = type;
+  grid->ra0 = ra0;
+  grid->dec0 = dec0;
+  grid->x0 = x0;
+  grid->y0 = y0;
+  grid->dx = dx;
+  grid->dy = dy;
+  grid->nx = nx;
+  grid->ny = ny;
+
+  // rotation taking the projection center to (ra, dec) = (0, 0)
+  quat_t q0;
+  qp_radecpa2quat(NULL, 0, 0, 0, grid->q_center);
+  qp_radecpa2quat(NULL, ra0, dec0, 0, q0);
+  Quaternion_inv(q0);
+  Quaternion_mul_right(grid->q_center, q0);
+
+  // grid maps are dense, and indexed directly
+  map->partial = 0;
+
+  return 0;
+}
+
 int qp_init_map_pixinfo(qp_map_t *map) {
   if (!map->init)
     return QP_ERROR_INIT;
-  map->pixinfo = qp_init_pixinfo(map->nside, 0);
+  /* populate the ring info up front, since the pixinfo is shared by
+     threads */
+  map->pixinfo = qp_init_pixinfo(map->nside, 1);
   map->pixinfo_init = map->pixinfo->init;
   return 0;
 }
 
 void qp_free_map(qp_map_t *map) {
-  if (map->vec1d_init & QP_ARR_MALLOC_1D)
-    free(map->vec1d);
-  if (map->vec_init & QP_ARR_MALLOC_2D)
-    for (size_t ii = 0; ii < map->num_vec; ii++)
-      free(map->vec[ii]);
-  if (map->vec_init & QP_ARR_MALLOC_1D)
-    free(map->vec);
+  if (map->single) {
+    if (map->vec1d_init & QP_ARR_MALLOC_1D)
+      free(map->vec1df);
+    if (map->vec_init & QP_ARR_MALLOC_1D)
+      free(map->vecf);
+    if (map->proj1d_init & QP_ARR_MALLOC_1D)
+      free(map->proj1df);
+    if (map->proj_init & QP_ARR_MALLOC_1D)
+      free(map->projf);
+  } else {
+    if (map->vec1d_init & QP_ARR_MALLOC_1D)
+      free(map->vec1d);
+    if (map->vec_init & QP_ARR_MALLOC_2D)
+      for (size_t ii = 0; ii < map->num_vec; ii++)
+        free(map->vec[ii]);
+    if (map->vec_init & QP_ARR_MALLOC_1D)
+      free(map->vec);
 
-  if (map->proj1d_init & QP_ARR_MALLOC_1D)
-    free(map->proj1d);
-  if (map->proj_init & QP_ARR_MALLOC_2D)
-    for (size_t ii = 0; ii < map->num_proj; ii++)
-      free(map->proj[ii]);
-  if (map->proj_init & QP_ARR_MALLOC_1D)
-    free(map->proj);
+    if (map->proj1d_init & QP_ARR_MALLOC_1D)
+      free(map->proj1d);
+    if (map->proj_init & QP_ARR_MALLOC_2D)
+      for (size_t ii = 0; ii < map->num_proj; ii++)
+        free(map->proj[ii]);
+    if (map->proj_init & QP_ARR_MALLOC_1D)
+      free(map->proj);
+  }
 
   if (map->pixinfo_init)
     qp_free_pixinfo(map->pixinfo);
@@ -623,217 +955,961 @@ void qp_free_map(qp_map_t *map) {
     memset(map, 0, sizeof(*map));
 }
 
-int qp_add_map(qp_memory_t *mem, qp_map_t *map, qp_map_t *maploc) {
+void qp_reset_point_beta(qp_point_t *pnt) {
+  if (pnt->beta_init & QP_ARR_MALLOC_1D)
+    free(pnt->beta);
+  pnt->beta_init = 0;
+  pnt->beta = NULL;
+  pnt->beta_n = 0;
+  pnt->beta_ctime = NULL;
+  pnt->beta_q_bore = NULL;
+}
 
-  if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
-                     "qp_add_map: map not initialized."))
-    return mem->error_code;
-  if (qp_check_error(mem, !maploc->init, QP_ERROR_INIT,
-                     "qp_add_map: maploc not initialized."))
-    return mem->error_code;
-  if (qp_check_error(mem, map->vec_mode != maploc->vec_mode, QP_ERROR_MAP,
-                     "qp_add_map: vec_modes differ."))
-    return mem->error_code;
-  if (qp_check_error(mem, map->proj_mode != maploc->proj_mode, QP_ERROR_MAP,
-                     "qp_add_map: proj_modes differ."))
-    return mem->error_code;
-  if (qp_check_error(mem, map->nside != maploc->nside, QP_ERROR_MAP,
-                     "qp_add_map: nsides differ."))
-    return mem->error_code;
-  if (qp_check_error(mem, map->npix != maploc->npix, QP_ERROR_MAP,
-                     "qp_add_map: npixs differ."))
-    return mem->error_code;
+/* Is the boresight-frame velocity on pnt computed from its current
+   pointing arrays, with the aberration options of mem? */
+static inline int qp_point_has_beta(qp_memory_t *mem, qp_point_t *pnt) {
+  qp_ephem_t *E = &pnt->beta_ephem;
+
+  return pnt->beta_init && pnt->beta_n == pnt->n &&
+    pnt->beta_ctime == pnt->ctime && pnt->beta_q_bore == pnt->q_bore &&
+    pnt->beta_rate == mem->state_aaber.update_rate &&
+    pnt->beta_accuracy == mem->accuracy && E->data == mem->ephem.data &&
+    E->ctime0 == mem->ephem.ctime0 && E->step == mem->ephem.step &&
+    E->n == mem->ephem.n && E->accuracy == mem->ephem.accuracy;
+}
 
-  if (map->vec_init && maploc->vec_init && map->vec_mode) {
-    for (size_t ii = 0; ii < map->num_vec; ii++)
-      for (size_t ipix = 0; ipix < map->npix; ipix++)
-        if (maploc->vec[ii][ipix] != 0)
-          map->vec[ii][ipix] += maploc->vec[ii][ipix];
+/* Compute the boresight-frame earth orbital velocity for each sample, so
+   that the per-detector annual aberration (mean_aber=0) is computed once
+   per sample instead of once per detector sample.  The array is kept on
+   pnt for later calls, see qp_reset_point_beta. */
+static void qp_init_point_beta(qp_memory_t *mem, qp_point_t *pnt) {
+  if (mem->mean_aber || !pnt->ctime_init || qp_point_has_beta(mem, pnt))
+    return;
+
+  qp_reset_point_beta(pnt);
+  pnt->beta = malloc(pnt->n * sizeof(vec3_t));
+  if (pnt->beta == NULL)
+    return;
+
+  qp_bore_betan(mem, pnt->ctime, pnt->q_bore, pnt->beta, pnt->n);
+  pnt->beta_init = QP_ARR_MALLOC_1D;
+  pnt->beta_n = pnt->n;
+  pnt->beta_ctime = pnt->ctime;
+  pnt->beta_q_bore = pnt->q_bore;
+  pnt->beta_rate = mem->state_aaber.update_rate;
+  pnt->beta_accuracy = mem->accuracy;
+  pnt->beta_ephem = mem->ephem;
+}
+
+/* Do all of the first ndet detectors have cached pointing? */
+static int qp_detarr_cached(qp_detarr_t *dets, size_t ndet) {
+  for (size_t idet = 0; idet < ndet; idet++)
+    if (!dets->arr[idet].pnt_init)
+      return 0;
+  return 1;
+}
+
+/* Timestream samples, from single- or double-precision arrays */
+static inline double qp_det_tod(qp_det_t *det, size_t ii) {
+  return det->todf ? det->todf[ii] : det->tod[ii];
+}
+
+static inline void qp_det_set_tod(qp_det_t *det, size_t ii, double val) {
+  if (det->todf)
+    det->todf[ii] = val;
+  else
+    det->tod[ii] = val;
+}
+
+static inline double qp_det_weights(qp_det_t *det, size_t ii) {
+  return det->weightsf ? det->weightsf[ii] : det->weights[ii];
+}
+
+/* Detector quaternion for sample ii */
+static inline void qp_det_quat(qp_memory_t *mem, qp_det_t *det,
+                               qp_point_t *pnt, size_t ii, quat_t q) {
+  double ctime;
+
+  if (!mem->mean_aber && qp_point_has_beta(mem, pnt)) {
+    qp_bore2det_beta(det->q_off, pnt->q_bore[ii], pnt->beta[ii], q);
+    if (pnt->q_hwp_init)
+      Quaternion_mul_right(q, pnt->q_hwp[ii]);
+    return;
   }
 
-  if (map->proj_init && maploc->proj_init && map->proj_mode) {
-    for (size_t ii = 0; ii < map->num_proj; ii++)
-      for (size_t ipix = 0; ipix < map->npix; ipix++)
-        if (maploc->proj[ii][ipix] != 0)
-          map->proj[ii][ipix] += maploc->proj[ii][ipix];
+  ctime = pnt->ctime_init ? pnt->ctime[ii] : 0;
+  if (pnt->q_hwp_init)
+    qp_bore2det_hwp(mem, det->q_off, ctime, pnt->q_bore[ii],
+                    pnt->q_hwp[ii], q);
+  else
+    qp_bore2det(mem, det->q_off, ctime, pnt->q_bore[ii], q);
+}
+
+/* Map indices and pol angles for n quaternions, for healpix, partial or
+   grid maps */
+static void qp_map_quat2pixn(qp_memory_t *mem, qp_map_t *map, quat_t *q,
+                             long *pix, double *sin2psi, double *cos2psi,
+                             int n) {
+  if (map->grid.type) {
+    qp_quat2gridn(mem, &map->grid, q, pix, sin2psi, cos2psi, n);
+    return;
   }
 
-  return 0;
+  qp_quat2pixn(mem, q, map->nside, pix, sin2psi, cos2psi, n);
+
+  if (map->partial)
+    qp_repixelizen(map->pixhash, pix, pix, n);
 }
 
-int qp_tod2map1_diff(qp_memory_t *mem, qp_det_t *det, qp_det_t *det_pair,
-                     qp_point_t *pnt, qp_map_t *map) {
+static long qp_det_pix_nocache(qp_memory_t *mem, qp_det_t *det,
+                               qp_point_t *pnt, qp_map_t *map, size_t ii,
+                               double *sin2psi, double *cos2psi) {
+  long ipix;
+  quat_t q;
 
-  double spp, cpp, spp_p, cpp_p, ctime, delta;
-  double alpha = 0, beta = 0, gamma = 0;
-  double walpha = 0, wbeta = 0, wgamma = 0;
-  long ipix, ipix_p;
-  quat_t q,q_p;
-  double w0 = det->weight;
-  double g = det->gain;
-  double *m = det->mueller;
-  double w = w0;
+  qp_det_quat(mem, det, pnt, ii, q);
 
-  double w0_p = det_pair->weight;
-  double g_p = det_pair->gain;
-  double *m_p = det_pair->mueller;
-  double w_p = w0_p;
-  double wd = 0.5 * (w + w_p);
-  double mtd = 0.5 * (m[0] + m_p[0]);
+  if (map->grid.type) {
+    qp_quat2gridn(mem, &map->grid, &q, &ipix, sin2psi, cos2psi, 1);
+    return ipix;
+  }
+
+  qp_quat2pix(mem, q, map->nside, &ipix, sin2psi, cos2psi);
+
+  if (map->partial)
+    ipix = qp_repixelize(map->pixhash, ipix);
+
+  return ipix;
+}
+
+long qp_det_pix(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
+                qp_map_t *map, size_t ii, double *sin2psi, double *cos2psi) {
+  if (det->pnt_init) {
+    *sin2psi = det->sin2psi[ii];
+    *cos2psi = det->cos2psi[ii];
+    return det->pix[ii];
+  }
+
+  return qp_det_pix_nocache(mem, det, pnt, map, ii, sin2psi, cos2psi);
+}
+
+/* Pointing for a run of samples of a detector, computed QP_PIX_BLOCK
+   samples at a time so that the pixelization kernel runs batched.  If
+   use_flags is set, samples flagged in the detector or its pair are not
+   computed. */
+typedef struct {
+  qp_det_t *det;
+  qp_det_t *det_pair;
+  int use_flags;
+  size_t end;                      // end of the sample range
+  size_t start;                    // first sample in the current block
+  size_t n;                        // number of samples in the current block
+  long pix[QP_PIX_BLOCK];
+  double sin2psi[QP_PIX_BLOCK];
+  double cos2psi[QP_PIX_BLOCK];
+} qp_pix_block_t;
+
+static inline void qp_init_pix_block(qp_pix_block_t *blk, qp_det_t *det,
+                                     qp_det_t *det_pair, int use_flags,
+                                     size_t end) {
+  blk->det = det;
+  blk->det_pair = det_pair;
+  blk->use_flags = use_flags;
+  blk->end = end;
+  blk->start = 0;
+  blk->n = 0;
+}
+
+static inline int qp_det_flagged(qp_det_t *det, size_t ii) {
+  return det && det->flag_init && det->flag[ii];
+}
+
+static void qp_fill_pix_block(qp_memory_t *mem, qp_pix_block_t *blk,
+                              qp_point_t *pnt, qp_map_t *map, size_t start) {
+  quat_t q[QP_PIX_BLOCK];
+  size_t n = blk->end - start;
+
+  if (n > QP_PIX_BLOCK)
+    n = QP_PIX_BLOCK;
+
+  for (size_t jj = 0, ii = start; jj < n; jj++, ii++) {
+    if (blk->use_flags && (qp_det_flagged(blk->det, ii) ||
+                           qp_det_flagged(blk->det_pair, ii)))
+      Quaternion_identity(q[jj]);
+    else
+      qp_det_quat(mem, blk->det, pnt, ii, q[jj]);
+  }
+  qp_map_quat2pixn(mem, map, q, blk->pix, blk->sin2psi, blk->cos2psi, n);
+
+  blk->start = start;
+  blk->n = n;
+}
+
+/* As qp_det_pix, but through a block of pointing.  Samples must be
+   requested in increasing order. */
+static inline long qp_det_pix_block(qp_memory_t *mem, qp_pix_block_t *blk,
+                                    qp_point_t *pnt, qp_map_t *map,
+                                    size_t ii, double *sin2psi,
+                                    double *cos2psi) {
+  qp_det_t *det = blk->det;
+
+  if (det->pnt_init) {
+    *sin2psi = det->sin2psi[ii];
+    *cos2psi = det->cos2psi[ii];
+    return det->pix[ii];
+  }
+
+  if (ii < blk->start || ii >= blk->start + blk->n)
+    qp_fill_pix_block(mem, blk, pnt, map, ii);
+
+  ii -= blk->start;
+  *sin2psi = blk->sin2psi[ii];
+  *cos2psi = blk->cos2psi[ii];
+  return blk->pix[ii];
+}
+
+int qp_det_pnt(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
+               qp_map_t *map, long *pix, float *sin2psi, float *cos2psi) {
 
   if (qp_check_error(mem, !mem->init, QP_ERROR_INIT,
-                     "qp_tod2map1_diff: mem not initialized."))
+                     "qp_det_pnt: mem not initialized."))
     return mem->error_code;
   if (qp_check_error(mem, !det->init, QP_ERROR_INIT,
-                     "qp_tod2map1_diff: det not initialized."))
-    return mem->error_code;
-  if (qp_check_error(mem, !det_pair->init, QP_ERROR_INIT,
-                     "qp_tod2map1_diff: det not initialized."))
+                     "qp_det_pnt: det not initialized."))
     return mem->error_code;
   if (qp_check_error(mem, !pnt->init, QP_ERROR_INIT,
-                     "qp_tod2map1_diff: pnt not initialized."))
+                     "qp_det_pnt: pnt not initialized."))
     return mem->error_code;
   if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
-                     "qp_tod2map1_diff: map not initialized."))
+                     "qp_det_pnt: map not initialized."))
     return mem->error_code;
   if (qp_check_error(mem, map->partial && !map->pixhash_init, QP_ERROR_INIT,
-                     "qp_tod2map1_diff: map pixhash not initialized."))
+                     "qp_det_pnt: map pixhash not initialized."))
     return mem->error_code;
   if (qp_check_error(mem, !mem->mean_aber && !pnt->ctime_init, QP_ERROR_POINT,
-                     "qp_tod2map1_diff: ctime required if not mean_aber"))
+                     "qp_det_pnt: ctime required if not mean_aber"))
     return mem->error_code;
 
-  if (map->vec1d_init && !map->vec_init)
-    if (qp_check_error(mem, qp_reshape_map(map), QP_ERROR_INIT,
-                       "qp_tod2map1_diff: reshape error"))
-      return mem->error_code;
+  qp_pix_block_t blk;
+  qp_init_pix_block(&blk, det, NULL, 0, pnt->n);
 
-  for (size_t ii = 0; ii < pnt->n; ii++) {
-    /* if either samples are flagged then skip */
-    if (det->flag_init || det_pair->flag_init){
-      if(det->flag[ii] || det_pair->flag[ii]){
-	continue;
-      }
+  for (size_t i0 = 0; i0 < pnt->n; i0 += QP_PIX_BLOCK) {
+    qp_fill_pix_block(mem, &blk, pnt, map, i0);
+    for (size_t jj = 0; jj < blk.n; jj++) {
+      pix[i0 + jj] = blk.pix[jj];
+      sin2psi[i0 + jj] = blk.sin2psi[jj];
+      cos2psi[i0 + jj] = blk.cos2psi[jj];
     }
-    ctime = pnt->ctime_init ? pnt->ctime[ii] : 0;
-    if (pnt->q_hwp_init){
-      qp_bore2det_hwp(mem, det->q_off, ctime, pnt->q_bore[ii],
-                      pnt->q_hwp[ii], q);
-      qp_bore2det_hwp(mem, det_pair->q_off, ctime, pnt->q_bore[ii],
-                      pnt->q_hwp[ii], q_p);
-    }else{
-      qp_bore2det(mem, det->q_off, ctime, pnt->q_bore[ii], q);
-      qp_bore2det(mem, det_pair->q_off, ctime, pnt->q_bore[ii], q_p);
-    }
-    qp_quat2pix(mem, q, map->nside, &ipix, &spp, &cpp);
-    qp_quat2pix(mem, q_p, map->nside, &ipix_p, &spp_p, &cpp_p);
+  }
 
-    if (map->partial) {
-      ipix = qp_repixelize(map->pixhash, ipix);
-      if (ipix < 0) {
-        if (mem->error_missing) {
-          qp_set_error(mem, QP_ERROR_MAP,
-                       "qp_tod2map1_diff: pixel out of bounds");
-          return mem->error_code;
-        }
-        continue;
-      }
-      ipix_p = qp_repixelize(map->pixhash, ipix_p);
-      if (ipix_p < 0) {
-        if (mem->error_missing) {
-          qp_set_error(mem, QP_ERROR_MAP,
-                       "qp_tod2map1_diff: pair pixel out of bounds");
-          return mem->error_code;
-        }
-        continue;
-      }
+  return 0;
+}
+
+int qp_detarr_pnt(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                  qp_map_t *map, long *pix, float *sin2psi, float *cos2psi) {
+
+  if (qp_check_error(mem, !dets->init, QP_ERROR_INIT,
+                     "qp_detarr_pnt: dets not initialized."))
+    return mem->error_code;
+
+  int num_threads = qp_ndet_threads(mem, dets->n);
+  int err = 0;
+
+  if (dets->n > 1)
+    qp_init_point_beta(mem, pnt);
+
+#pragma omp parallel num_threads(num_threads)
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    int errloc = 0;
+    size_t off;
+
+#pragma omp for nowait
+    for (size_t idet = 0; idet < dets->n; idet++) {
+      if (!errloc && !err) {
+        off = idet * pnt->n;
+        errloc = qp_det_pnt(memloc, dets->arr + idet, pnt, map, pix + off,
+                            sin2psi + off, cos2psi + off);
+      }
     }
 
-    if (det->weights_init)
-      w = w0 * det->weights[ii];
-    if (det_pair->weights_init)
-      w_p = w0_p * det_pair->weights[ii];
-    if (det->weights_init | det_pair->weights_init)
-      wd = 0.5 * (w + w_p);
+    if (errloc)
+      qp_merge_error(mem, memloc, &err);
 
-    if ((map->vec_mode >= QP_VEC_POL) || (map->proj_mode >= QP_PROJ_POL)) {
-      alpha = m[1] * cpp - m[2] * spp - (m_p[1] * cpp_p - m_p[2] * spp_p);
-      beta = m[2] * cpp + m[1] * spp - (m_p[2] * cpp_p + m_p[1] * spp_p);
-      if (!mem->polconv)
-        beta *= -1;
-      walpha = 0.5 * wd * alpha;
-      wbeta = 0.5 * wd * beta;
+    qp_free_memory(memloc);
+  }
+
+  return err;
+}
+
+int qp_det_interp(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
+                  qp_map_t *map, long *pix, float *sin2psi, float *cos2psi,
+                  int32_t *interp_pix, float *interp_weight) {
+
+  if (qp_check_error(mem, !mem->init, QP_ERROR_INIT,
+                     "qp_det_interp: mem not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !det->init, QP_ERROR_INIT,
+                     "qp_det_interp: det not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !pnt->init, QP_ERROR_INIT,
+                     "qp_det_interp: pnt not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
+                     "qp_det_interp: map not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->partial && !map->pixhash_init, QP_ERROR_INIT,
+                     "qp_det_interp: map pixhash not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !mem->mean_aber && !pnt->ctime_init, QP_ERROR_POINT,
+                     "qp_det_interp: ctime required if not mean_aber"))
+    return mem->error_code;
+  if (qp_check_error(mem, map->npix > INT32_MAX, QP_ERROR_MAP,
+                     "qp_det_interp: map too large for stencil indices"))
+    return mem->error_code;
+  if (qp_check_error(mem, map->grid.type, QP_ERROR_MAP,
+                     "qp_det_interp: interpolation requires a healpix map"))
+    return mem->error_code;
+  if (!map->pixinfo_init)
+    if (qp_check_error(mem, qp_init_map_pixinfo(map), QP_ERROR_INIT,
+                       "qp_det_interp: pixinfo init error"))
+      return mem->error_code;
+
+  double ra, dec, spp, cpp;
+  long ipix, p4[4];
+  double w4[4];
+  quat_t q;
+
+  for (size_t ii = 0; ii < pnt->n; ii++) {
+    qp_det_quat(mem, det, pnt, ii, q);
+    qp_quat2radec(mem, q, &ra, &dec, &spp, &cpp);
+    ipix = qp_radec2pix(mem, ra, dec, map->nside);
+    qp_get_interpol(mem, map->pixinfo, ra, dec, p4, w4);
+    if (map->partial) {
+      ipix = qp_repixelize(map->pixhash, ipix);
+      qp_repixelizen(map->pixhash, p4, p4, 4);
     }
 
-    if ((map->vec_mode == QP_VEC_VPOL) || (map->proj_mode == QP_PROJ_VPOL)) {
-      gamma = m[3] * cpp - m_p[3] * cpp_p;
-      wgamma = 0.5 * wd * gamma;
+    pix[ii] = ipix;
+    sin2psi[ii] = spp;
+    cos2psi[ii] = cpp;
+    for (int jj = 0; jj < 4; jj++) {
+      interp_pix[4 * ii + jj] = p4[jj];
+      interp_weight[4 * ii + jj] = w4[jj];
     }
+  }
 
-    if (det->tod_init && det_pair->tod_init && map->vec_init) {
-      delta = g * det->tod[ii] - g_p * det_pair->tod[ii];
+  return 0;
+}
 
-      switch (map->vec_mode) {
-      case QP_VEC_VPOL:
-        map->vec[3][ipix] += wgamma * delta;
-        /* fall through */
-      case QP_VEC_POL:
-        map->vec[1][ipix] += walpha * delta;
-        map->vec[2][ipix] += wbeta * delta;
+int qp_detarr_interp(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                     qp_map_t *map, long *pix, float *sin2psi,
+                     float *cos2psi, int32_t *interp_pix,
+                     float *interp_weight) {
+
+  if (qp_check_error(mem, !dets->init, QP_ERROR_INIT,
+                     "qp_detarr_interp: dets not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
+                     "qp_detarr_interp: map not initialized."))
+    return mem->error_code;
+
+  /* shared by all threads */
+  if (!map->pixinfo_init)
+    if (qp_check_error(mem, qp_init_map_pixinfo(map), QP_ERROR_INIT,
+                       "qp_detarr_interp: pixinfo init error"))
+      return mem->error_code;
+
+  int num_threads = qp_ndet_threads(mem, dets->n);
+  int err = 0;
+
+  if (dets->n > 1)
+    qp_init_point_beta(mem, pnt);
+
+#pragma omp parallel num_threads(num_threads)
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    int errloc = 0;
+    size_t off;
+
+#pragma omp for nowait
+    for (size_t idet = 0; idet < dets->n; idet++) {
+      if (!errloc && !err) {
+        off = idet * pnt->n;
+        errloc = qp_det_interp(memloc, dets->arr + idet, pnt, map, pix + off,
+                               sin2psi + off, cos2psi + off,
+                               interp_pix + 4 * off, interp_weight + 4 * off);
+      }
+    }
+
+    if (errloc)
+      qp_merge_error(mem, memloc, &err);
+
+    qp_free_memory(memloc);
+  }
+
+  return err;
+}
+
+/* Number of map indices per block when merging maps in parallel */
+#define QP_ADD_MAP_BLOCK 4096
+
+/* Add the [start, end) index range of maploc into map */
+static void qp_add_map_range(qp_map_t *map, qp_map_t *maploc, size_t start,
+                             size_t end) {
+  size_t s = qp_map_stride(map), sloc = qp_map_stride(maploc);
+  double val;
+
+  if (map->single || maploc->single) {
+    if (map->vec_init && maploc->vec_init && map->vec_mode &&
+        maploc->vec_mode) {
+      for (size_t ii = 0; ii < map->num_vec; ii++)
+        for (size_t ipix = start; ipix < end; ipix++) {
+          if ((val = qp_map_vec_val(maploc, ii, ipix * sloc)) == 0)
+            continue;
+          if (map->single)
+            map->vecf[ii][ipix * s] += val;
+          else
+            map->vec[ii][ipix * s] += val;
+        }
+    }
+
+    if (map->proj_init && maploc->proj_init && map->proj_mode &&
+        maploc->proj_mode) {
+      for (size_t ii = 0; ii < map->num_proj; ii++)
+        for (size_t ipix = start; ipix < end; ipix++) {
+          if ((val = qp_map_proj_val(maploc, ii, ipix * sloc)) == 0)
+            continue;
+          if (map->single)
+            map->projf[ii][ipix * s] += val;
+          else
+            map->proj[ii][ipix * s] += val;
+        }
+    }
+    return;
+  }
+
+  if (map->vec_init && maploc->vec_init && map->vec_mode &&
+      maploc->vec_mode) {
+    for (size_t ii = 0; ii < map->num_vec; ii++)
+      for (size_t ipix = start; ipix < end; ipix++)
+        if (maploc->vec[ii][ipix * sloc] != 0)
+          map->vec[ii][ipix * s] += maploc->vec[ii][ipix * sloc];
+  }
+
+  if (map->proj_init && maploc->proj_init && map->proj_mode &&
+      maploc->proj_mode) {
+    for (size_t ii = 0; ii < map->num_proj; ii++)
+      for (size_t ipix = start; ipix < end; ipix++)
+        if (maploc->proj[ii][ipix * sloc] != 0)
+          map->proj[ii][ipix * s] += maploc->proj[ii][ipix * sloc];
+  }
+}
+
+/* Do two pixhashes map the same pixels to the same indices?  Copies of a
+   pixhash have identical index structures, so these are compared
+   directly. */
+static int qp_pixhash_equal(qp_pixhash_t *a, qp_pixhash_t *b) {
+  if (a == b)
+    return 1;
+  if (a->mode != b->mode || a->count != b->count)
+    return 0;
+
+  switch (a->mode) {
+  case QP_PIXHASH_HASH:
+    return a->mask == b->mask &&
+      !memcmp(a->slots, b->slots, (a->mask + 1) * sizeof(*a->slots));
+  case QP_PIXHASH_RUNS:
+    return a->nrun == b->nrun &&
+      !memcmp(a->runs, b->runs, a->nrun * sizeof(*a->runs));
+  case QP_PIXHASH_DIRECT:
+    return a->pix0 == b->pix0 && a->span == b->span &&
+      !memcmp(a->offset, b->offset, a->span * sizeof(*a->offset));
+  }
+  return 0;
+}
+
+/* Check that maploc can be added into map, and reshape both if needed */
+static int qp_check_add_map(qp_memory_t *mem, qp_map_t *map,
+                            qp_map_t *maploc) {
+
+  if (qp_check_error(mem, !maploc->init, QP_ERROR_INIT,
+                     "qp_add_map: maploc not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, maploc->vec_mode &&
+                     map->vec_mode != maploc->vec_mode, QP_ERROR_MAP,
+                     "qp_add_map: vec_modes differ."))
+    return mem->error_code;
+  if (qp_check_error(mem, maploc->proj_mode &&
+                     map->proj_mode != maploc->proj_mode, QP_ERROR_MAP,
+                     "qp_add_map: proj_modes differ."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->nside != maploc->nside, QP_ERROR_MAP,
+                     "qp_add_map: nsides differ."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->npix != maploc->npix, QP_ERROR_MAP,
+                     "qp_add_map: npixs differ."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->partial != maploc->partial ||
+                     map->pixhash_init != maploc->pixhash_init ||
+                     (map->pixhash_init &&
+                      !qp_pixhash_equal(map->pixhash, maploc->pixhash)),
+                     QP_ERROR_MAP, "qp_add_map: partial map pixels differ."))
+    return mem->error_code;
+
+  if (maploc->vec1d_init && !maploc->vec_init)
+    if (qp_check_error(mem, qp_reshape_map(maploc), QP_ERROR_INIT,
+                       "qp_add_map: maploc reshape error"))
+      return mem->error_code;
+
+  return 0;
+}
+
+int qp_add_map(qp_memory_t *mem, qp_map_t *map, qp_map_t *maploc) {
+  return qp_add_maps(mem, map, &maploc, 1);
+}
+
+/* Sum several maps into map, splitting the index range across threads.
+   Each block of indices is written by one thread only, so no locking is
+   required.  The input maps must be compatible with map, as checked by
+   qp_add_map. */
+static void qp_add_maps_for(qp_map_t *map, qp_map_t **maplocs, int nmaps) {
+
+  size_t nblock = (map->npix + QP_ADD_MAP_BLOCK - 1) / QP_ADD_MAP_BLOCK;
+
+  /* orphaned worksharing loop, binds to the calling parallel region */
+#pragma omp for schedule(static)
+  for (size_t ib = 0; ib < nblock; ib++) {
+    size_t start = ib * QP_ADD_MAP_BLOCK;
+    size_t end = start + QP_ADD_MAP_BLOCK;
+    if (end > map->npix)
+      end = map->npix;
+    for (int im = 0; im < nmaps; im++)
+      if (maplocs[im] && maplocs[im] != map)
+        qp_add_map_range(map, maplocs[im], start, end);
+  }
+}
+
+int qp_add_maps(qp_memory_t *mem, qp_map_t *map, qp_map_t **maplocs,
+                int nmaps) {
+
+  if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
+                     "qp_add_map: map not initialized."))
+    return mem->error_code;
+  if (map->vec1d_init && !map->vec_init)
+    if (qp_check_error(mem, qp_reshape_map(map), QP_ERROR_INIT,
+                       "qp_add_map: map reshape error"))
+      return mem->error_code;
+  for (int im = 0; im < nmaps; im++)
+    if (maplocs[im] && maplocs[im] != map &&
+        qp_check_add_map(mem, map, maplocs[im]))
+      return mem->error_code;
+
+  size_t nblock = (map->npix + QP_ADD_MAP_BLOCK - 1) / QP_ADD_MAP_BLOCK;
+  int num_threads = mem->num_threads;
+  if ((size_t) num_threads > nblock)
+    num_threads = nblock > 0 ? nblock : 1;
+
+#pragma omp parallel num_threads(num_threads)
+  qp_add_maps_for(map, maplocs, nmaps);
+
+  return 0;
+}
+
+/* Pair-differenced version of qp_tod2map1_sample */
+static inline void qp_tod2map1_diff_sample(qp_memory_t *mem, qp_det_t *det,
+                                           qp_det_t *det_pair, qp_map_t *map,
+                                           size_t ii, long ipix, double spp,
+                                           double cpp, double spp_p,
+                                           double cpp_p, double **vec,
+                                           double **proj) {
+  double d, d_p, delta;
+  double alpha = 0, beta = 0, gamma = 0;
+  double walpha = 0, wbeta = 0, wgamma = 0;
+  double w0 = det->weight;
+  double g = det->gain;
+  double *m = det->mueller;
+  double w = w0;
+
+  double w0_p = det_pair->weight;
+  double g_p = det_pair->gain;
+  double *m_p = det_pair->mueller;
+  double w_p = w0_p;
+  double wd = 0.5 * (w + w_p);
+  double mtd = 0.5 * (m[0] + m_p[0]);
+
+  if (det->weights_init)
+    w = w0 * qp_det_weights(det, ii);
+  if (det_pair->weights_init)
+    w_p = w0_p * qp_det_weights(det_pair, ii);
+  if (det->weights_init | det_pair->weights_init)
+    wd = 0.5 * (w + w_p);
+
+  if ((map->vec_mode >= QP_VEC_POL) || (map->proj_mode >= QP_PROJ_POL)) {
+    alpha = m[1] * cpp - m[2] * spp - (m_p[1] * cpp_p - m_p[2] * spp_p);
+    beta = m[2] * cpp + m[1] * spp - (m_p[2] * cpp_p + m_p[1] * spp_p);
+    if (!mem->polconv)
+      beta *= -1;
+    walpha = 0.5 * wd * alpha;
+    wbeta = 0.5 * wd * beta;
+  }
+
+  if ((map->vec_mode == QP_VEC_VPOL) || (map->proj_mode == QP_PROJ_VPOL)) {
+    gamma = m[3] * cpp - m_p[3] * cpp_p;
+    wgamma = 0.5 * wd * gamma;
+  }
+
+  if (det->tod_init && det_pair->tod_init && vec) {
+    d = qp_det_tod(det, ii);
+    d_p = qp_det_tod(det_pair, ii);
+    delta = g * d - g_p * d_p;
+
+    switch (map->vec_mode) {
+    case QP_VEC_VPOL:
+      vec[3][ipix] += wgamma * delta;
+      /* fall through */
+    case QP_VEC_POL:
+      vec[1][ipix] += walpha * delta;
+      vec[2][ipix] += wbeta * delta;
 	/* fall through */
-      case QP_VEC_TEMP:
-        map->vec[0][ipix] += 0.5 * wd *
-          (g * m[0] * det->tod[ii] + g_p * m_p[0] * det_pair->tod[ii]);
+    case QP_VEC_TEMP:
+      vec[0][ipix] += 0.5 * wd *
+        (g * m[0] * d + g_p * m_p[0] * d_p);
 	break;
-      default:
+    default:
 	break;
-      }
     }
+  }
 
-    if (map->proj_init) {
-      switch(map->proj_mode) {
-        case QP_PROJ_VPOL:
-          map->proj[0][ipix] += wd * mtd;
-          map->proj[1][ipix] += 0.;
-          map->proj[2][ipix] += 0.;
-          map->proj[3][ipix] += 0.;
-          map->proj[4][ipix] += walpha * alpha;
-          map->proj[5][ipix] += walpha * beta;
-          map->proj[6][ipix] += walpha * gamma;
-          map->proj[7][ipix] += wbeta * beta;
-          map->proj[8][ipix] += wbeta * gamma;
-          map->proj[9][ipix] += wgamma * gamma;
-          break;
-        case QP_PROJ_POL:
-          map->proj[1][ipix] += 0.;
-          map->proj[2][ipix] += 0.;
-          map->proj[3][ipix] += walpha * alpha;
-          map->proj[4][ipix] += walpha * beta;
-          map->proj[5][ipix] += wbeta * beta;
+  if (proj) {
+    switch(map->proj_mode) {
+      case QP_PROJ_VPOL:
+        proj[0][ipix] += wd * mtd;
+        proj[1][ipix] += 0.;
+        proj[2][ipix] += 0.;
+        proj[3][ipix] += 0.;
+        proj[4][ipix] += walpha * alpha;
+        proj[5][ipix] += walpha * beta;
+        proj[6][ipix] += walpha * gamma;
+        proj[7][ipix] += wbeta * beta;
+        proj[8][ipix] += wbeta * gamma;
+        proj[9][ipix] += wgamma * gamma;
+        break;
+      case QP_PROJ_POL:
+        proj[1][ipix] += 0.;
+        proj[2][ipix] += 0.;
+        proj[3][ipix] += walpha * alpha;
+        proj[4][ipix] += walpha * beta;
+        proj[5][ipix] += wbeta * beta;
 	  /* fall through */
-        case QP_PROJ_TEMP:
-          map->proj[0][ipix] += wd * mtd;
-          break;
-        default:
-          break;
-      }
+      case QP_PROJ_TEMP:
+        proj[0][ipix] += wd * mtd;
+        break;
+      default:
+        break;
     }
   }
+}
 
-  return 0;
+static inline void qp_tod2map1_sample(qp_memory_t *mem, qp_det_t *det,
+                                      qp_map_t *map, size_t ii, long ipix,
+                                      double spp, double cpp, double **vec,
+                                      double **proj);
+
+/* Samples queued for binning in map index order, if the sort_pix option
+   is set.  Map indices are offsets into the map columns, i.e. pixel
+   indices scaled by the column stride of an interleaved map.  Binning
+   scatters each sample into every map column, so at high resolution
+   almost every accumulation misses the cache.  Binning a block of samples
+   sorted by map index instead visits the map in increasing order, and
+   samples that fall in the same pixel or cache line are binned
+   together. */
+typedef struct {
+  size_t n;                          // number of queued samples
+  size_t ii[QP_SORT_BLOCK];          // sample index
+  long pix[QP_SORT_BLOCK];           // map index
+  double spp[QP_SORT_BLOCK];
+  double cpp[QP_SORT_BLOCK];
+  double spp_p[QP_SORT_BLOCK];       // pair pol angle, if differencing
+  double cpp_p[QP_SORT_BLOCK];
+  uint32_t order[QP_SORT_BLOCK];     // queue order sorted by map index
+  uint32_t tmp[QP_SORT_BLOCK];
+} qp_sort_queue_t;
+
+/* Map indices within a cache line of each other are not sorted further */
+#define QP_SORT_SHIFT 3
+
+static qp_sort_queue_t * qp_init_sort_queue(qp_memory_t *mem) {
+  qp_sort_queue_t *sq;
+
+  if (!mem->sort_pix)
+    return NULL;
+  sq = malloc(sizeof(*sq));
+  if (sq)
+    sq->n = 0;
+  return sq;
 }
 
-int qp_tod2map1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt, qp_map_t *map) {
+/* Stable LSD radix sort of the queue by map index, on 8-bit digits */
+static void qp_sort_queue_order(qp_sort_queue_t *sq) {
+  size_t n = sq->n, count[256], off, cnt;
+  uint32_t *src = sq->order, *dst = sq->tmp, *swap;
+  long pmax = 0;
 
-  double spp, cpp, ctime;
-  long ipix;
-  quat_t q;
+  for (size_t jj = 0; jj < n; jj++) {
+    src[jj] = jj;
+    if (sq->pix[jj] > pmax)
+      pmax = sq->pix[jj];
+  }
+
+  for (int shift = QP_SORT_SHIFT; (pmax >> shift) > 0; shift += 8) {
+    memset(count, 0, sizeof(count));
+    for (size_t jj = 0; jj < n; jj++)
+      count[(sq->pix[src[jj]] >> shift) & 0xff]++;
+    off = 0;
+    for (int dd = 0; dd < 256; dd++) {
+      cnt = count[dd];
+      count[dd] = off;
+      off += cnt;
+    }
+    for (size_t jj = 0; jj < n; jj++)
+      dst[count[(sq->pix[src[jj]] >> shift) & 0xff]++] = src[jj];
+    swap = src;
+    src = dst;
+    dst = swap;
+  }
+
+  if (src != sq->order)
+    memcpy(sq->order, src, n * sizeof(*src));
+}
+
+/* Bin the queued samples of a detector (or detector pair) in map index
+   order, and empty the queue */
+static void qp_flush_sort_queue(qp_memory_t *mem, qp_sort_queue_t *sq,
+                                qp_det_t *det, qp_det_t *det_pair,
+                                qp_map_t *map, double **vec, double **proj) {
+  size_t jj;
+
+  qp_sort_queue_order(sq);
+
+  for (size_t kk = 0; kk < sq->n; kk++) {
+    jj = sq->order[kk];
+    if (det_pair)
+      qp_tod2map1_diff_sample(mem, det, det_pair, map, sq->ii[jj],
+                              sq->pix[jj], sq->spp[jj], sq->cpp[jj],
+                              sq->spp_p[jj], sq->cpp_p[jj], vec, proj);
+    else
+      qp_tod2map1_sample(mem, det, map, sq->ii[jj], sq->pix[jj],
+                         sq->spp[jj], sq->cpp[jj], vec, proj);
+  }
+
+  sq->n = 0;
+}
+
+/* Add a sample to the queue, binning the queue if it is full */
+static inline void qp_push_sort_queue(qp_memory_t *mem, qp_sort_queue_t *sq,
+                                      qp_det_t *det, qp_det_t *det_pair,
+                                      qp_map_t *map, size_t ii, long ipix,
+                                      double spp, double cpp, double spp_p,
+                                      double cpp_p, double **vec,
+                                      double **proj) {
+  size_t jj = sq->n++;
+
+  sq->ii[jj] = ii;
+  sq->pix[jj] = ipix;
+  sq->spp[jj] = spp;
+  sq->cpp[jj] = cpp;
+  sq->spp_p[jj] = spp_p;
+  sq->cpp_p[jj] = cpp_p;
+
+  if (sq->n == QP_SORT_BLOCK)
+    qp_flush_sort_queue(mem, sq, det, det_pair, map, vec, proj);
+}
+
+static int qp_tod2map1_diff_range(qp_memory_t *mem, qp_det_t *det,
+                                  qp_det_t *det_pair, qp_point_t *pnt,
+                                  qp_map_t *map, size_t start, size_t end) {
+
+  double spp, cpp, spp_p, cpp_p;
+  long ipix, ipix_p;
+  long stride = qp_map_stride(map);
+  double **vec, **proj;
+  qp_pix_block_t blk, blk_p;
+  qp_sort_queue_t *sq;
+  int err = 0;
+
+  if (qp_check_error(mem, !mem->init, QP_ERROR_INIT,
+                     "qp_tod2map1_diff: mem not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !det->init, QP_ERROR_INIT,
+                     "qp_tod2map1_diff: det not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !det_pair->init, QP_ERROR_INIT,
+                     "qp_tod2map1_diff: det not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !pnt->init, QP_ERROR_INIT,
+                     "qp_tod2map1_diff: pnt not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
+                     "qp_tod2map1_diff: map not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->partial && !map->pixhash_init, QP_ERROR_INIT,
+                     "qp_tod2map1_diff: map pixhash not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !mem->mean_aber && !pnt->ctime_init, QP_ERROR_POINT,
+                     "qp_tod2map1_diff: ctime required if not mean_aber"))
+    return mem->error_code;
+
+  if (map->vec1d_init && !map->vec_init)
+    if (qp_check_error(mem, qp_reshape_map(map), QP_ERROR_INIT,
+                       "qp_tod2map1_diff: reshape error"))
+      return mem->error_code;
+
+  vec = map->vec_init ? map->vec : NULL;
+  proj = map->proj_init ? map->proj : NULL;
+  qp_init_pix_block(&blk, det, det_pair, 1, end);
+  qp_init_pix_block(&blk_p, det_pair, det, 1, end);
+  sq = qp_init_sort_queue(mem);
+
+  for (size_t ii = start; ii < end; ii++) {
+    /* if either samples are flagged then skip */
+    if (det->flag_init || det_pair->flag_init){
+      if(det->flag[ii] || det_pair->flag[ii]){
+	continue;
+      }
+    }
+    ipix = qp_det_pix_block(mem, &blk, pnt, map, ii, &spp, &cpp);
+    if (ipix < 0) {
+      if (mem->error_missing) {
+        qp_set_error(mem, QP_ERROR_MAP,
+                     "qp_tod2map1_diff: pixel out of bounds");
+        err = mem->error_code;
+        break;
+      }
+      continue;
+    }
+    ipix_p = qp_det_pix_block(mem, &blk_p, pnt, map, ii, &spp_p, &cpp_p);
+    if (ipix_p < 0) {
+      if (mem->error_missing) {
+        qp_set_error(mem, QP_ERROR_MAP,
+                     "qp_tod2map1_diff: pair pixel out of bounds");
+        err = mem->error_code;
+        break;
+      }
+      continue;
+    }
+
+    ipix *= stride;
+    if (sq)
+      qp_push_sort_queue(mem, sq, det, det_pair, map, ii, ipix, spp, cpp,
+                         spp_p, cpp_p, vec, proj);
+    else
+      qp_tod2map1_diff_sample(mem, det, det_pair, map, ii, ipix, spp, cpp,
+                              spp_p, cpp_p, vec, proj);
+  }
+
+  if (sq) {
+    if (!err)
+      qp_flush_sort_queue(mem, sq, det, det_pair, map, vec, proj);
+    free(sq);
+  }
+
+  return err;
+}
+
+/* Accumulate a single sample into the given vec/proj columns at index ipix.
+   vec and proj may point to the map arrays or to a thread-local accumulator
+   with the same column layout.  Either may be NULL to skip. */
+static inline void qp_tod2map1_sample(qp_memory_t *mem, qp_det_t *det,
+                                      qp_map_t *map, size_t ii, long ipix,
+                                      double spp, double cpp, double **vec,
+                                      double **proj) {
   double w0 = det->weight;
   double g = det->gain, gd;
   double *m = det->mueller;
   double w1, mt = m[0], mq = 0, mu = 0, mv = m[3];
   double wmt = w0 * m[0], wmq = 0, wmu = 0, wmv = w0 * m[3];
 
+  if (det->weights_init) {
+    w1 = w0 * qp_det_weights(det, ii);
+    wmt = w1 * m[0];
+    if ((map->vec_mode == QP_VEC_VPOL) || (map->proj_mode == QP_PROJ_VPOL)) {
+      wmv = w1 * m[3];
+    }
+  } else {
+    w1 = w0;
+  }
+
+  if ((map->vec_mode >= QP_VEC_POL) || (map->proj_mode >= QP_PROJ_POL)) {
+    mq = m[1] * cpp - m[2] * spp;
+    mu = m[2] * cpp + m[1] * spp;
+    if (!mem->polconv)
+      mu *= -1;
+    wmq = w1 * mq;
+    wmu = w1 * mu;
+  }
+
+  if (det->tod_init && vec) {
+    gd = g * qp_det_tod(det, ii);
+
+    switch (map->vec_mode) {
+      case QP_VEC_VPOL:
+        vec[3][ipix] += wmv * gd;
+        /* fall through */
+      case QP_VEC_POL:
+        vec[1][ipix] += wmq * gd;
+        vec[2][ipix] += wmu * gd;
+        /* fall through */
+      case QP_VEC_TEMP:
+        vec[0][ipix] += wmt * gd;
+        break;
+      default:
+        break;
+    }
+  }
+
+  if (proj) {
+    switch(map->proj_mode) {
+      case QP_PROJ_VPOL:
+        proj[0][ipix] += wmt * mt;
+        proj[1][ipix] += wmt * mq;
+        proj[2][ipix] += wmt * mu;
+        proj[3][ipix] += wmt * mv;
+        proj[4][ipix] += wmq * mq;
+        proj[5][ipix] += wmq * mu;
+        proj[6][ipix] += wmq * mv;
+        proj[7][ipix] += wmu * mu;
+        proj[8][ipix] += wmu * mv;
+        proj[9][ipix] += wmv * mv;
+        break;
+      case QP_PROJ_POL:
+        proj[1][ipix] += wmt * mq;
+        proj[2][ipix] += wmt * mu;
+        proj[3][ipix] += wmq * mq;
+        proj[4][ipix] += wmq * mu;
+        proj[5][ipix] += wmu * mu;
+        /* fall through */
+      case QP_PROJ_TEMP:
+        proj[0][ipix] += wmt * mt;
+        break;
+      default:
+        break;
+    }
+  }
+}
+
+static int qp_tod2map1_range(qp_memory_t *mem, qp_det_t *det,
+                             qp_point_t *pnt, qp_map_t *map, size_t start,
+                             size_t end) {
+
+  double spp, cpp;
+  long ipix;
+  long stride = qp_map_stride(map);
+  double **vec, **proj;
+  qp_pix_block_t blk;
+  qp_sort_queue_t *sq;
+  int err = 0;
+
   if (qp_check_error(mem, !mem->init, QP_ERROR_INIT,
                      "qp_tod2map1: mem not initialized."))
     return mem->error_code;
@@ -858,102 +1934,636 @@ int qp_tod2map1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt, qp_map_t *map)
                        "qp_tod2map1: reshape error"))
       return mem->error_code;
 
-  for (size_t ii = 0; ii < pnt->n; ii++) {
+  vec = map->vec_init ? map->vec : NULL;
+  proj = map->proj_init ? map->proj : NULL;
+  qp_init_pix_block(&blk, det, NULL, 1, end);
+  sq = qp_init_sort_queue(mem);
+
+  for (size_t ii = start; ii < end; ii++) {
     if (det->flag_init && det->flag[ii])
       continue;
-    ctime = pnt->ctime_init ? pnt->ctime[ii] : 0;
-    
-    if (pnt->q_hwp_init)
-      qp_bore2det_hwp(mem, det->q_off, ctime, pnt->q_bore[ii],
-                      pnt->q_hwp[ii], q);
+
+    ipix = qp_det_pix_block(mem, &blk, pnt, map, ii, &spp, &cpp);
+    if (ipix < 0) {
+      if (mem->error_missing) {
+        qp_set_error(mem, QP_ERROR_MAP,
+                     "qp_tod2map1: pixel out of bounds");
+        err = mem->error_code;
+        break;
+      }
+      continue;
+    }
+
+    ipix *= stride;
+    if (sq)
+      qp_push_sort_queue(mem, sq, det, NULL, map, ii, ipix, spp, cpp, 0, 0,
+                         vec, proj);
     else
-      qp_bore2det(mem, det->q_off, ctime, pnt->q_bore[ii], q);
+      qp_tod2map1_sample(mem, det, map, ii, ipix, spp, cpp, vec, proj);
+  }
 
-    qp_quat2pix(mem, q, map->nside, &ipix, &spp, &cpp);
+  if (sq) {
+    if (!err)
+      qp_flush_sort_queue(mem, sq, det, NULL, map, vec, proj);
+    free(sq);
+  }
 
-    if (map->partial) {
-      ipix = qp_repixelize(map->pixhash, ipix);
-      if (ipix < 0) {
-        if (mem->error_missing) {
-          qp_set_error(mem, QP_ERROR_MAP,
-                       "qp_tod2map1: pixel out of bounds");
-          return mem->error_code;
+  return err;
+}
+
+/* Work decomposition for the threaded binners and scanners.  Each
+   detector (or detector pair) is split into nchunk contiguous chunks of
+   samples.  The only time-dependent correction applied per detector, the
+   annual aberration, is precomputed per sample by qp_init_point_beta, so
+   chunks can be processed independently. */
+typedef struct {
+  size_t nchunk;        // number of sample chunks per detector
+  size_t chunk;         // number of samples per chunk
+} qp_chunks_t;
+
+static void qp_init_chunks(qp_memory_t *mem, size_t ndet, qp_point_t *pnt,
+                           qp_chunks_t *chunks) {
+  int mode = mem->parallel_mode;
+  size_t nthreads = mem->num_threads > 1 ? mem->num_threads : 1;
+  size_t nchunk = 1;
+
+  if (mode == QP_PARALLEL_AUTO)
+    mode = (ndet < nthreads) ? QP_PARALLEL_SAMPLE : QP_PARALLEL_DET;
+  if (mode == QP_PARALLEL_SAMPLE && nthreads > 1)
+    nchunk = nthreads;
+  if (nchunk > pnt->n)
+    nchunk = pnt->n > 0 ? pnt->n : 1;
+
+  chunks->nchunk = nchunk;
+  chunks->chunk = (pnt->n + nchunk - 1) / nchunk;
+}
+
+/* Sample range for the given chunk */
+static void qp_chunk_range(qp_chunks_t *chunks, qp_point_t *pnt, size_t ic,
+                           size_t *start, size_t *end) {
+  *start = ic * chunks->chunk;
+  *end = *start + chunks->chunk;
+  if (*end > pnt->n)
+    *end = pnt->n;
+  if (*start > pnt->n)
+    *start = pnt->n;
+}
+
+/* Owner of a map index when the index range is split across threads */
+#define QP_PIX_OWNER(ipix, nthreads, npix) \
+  ((int)(((size_t)(ipix) * (size_t)(nthreads)) / (size_t)(npix)))
+
+/* Bin a detector (or detector pair) sample into the given columns */
+static inline void qp_tod2map_sample(qp_memory_t *mem, qp_detarr_t *dets,
+                                     size_t idet, qp_map_t *map, size_t ii,
+                                     long ipix, double spp, double cpp,
+                                     double spp_p, double cpp_p, double **vec,
+                                     double **proj) {
+  if (dets->diff)
+    qp_tod2map1_diff_sample(mem, dets->arr + idet, dets->arr + idet + dets->n,
+                            map, ii, ipix, spp, cpp, spp_p, cpp_p, vec, proj);
+  else
+    qp_tod2map1_sample(mem, dets->arr + idet, map, ii, ipix, spp, cpp, vec,
+                       proj);
+}
+
+/* Pointing blocks for a detector (or detector pair) for samples up to
+   end */
+static inline void qp_init_tod2map_blocks(qp_detarr_t *dets, size_t idet,
+                                          size_t end, qp_pix_block_t blk[2]) {
+  qp_det_t *det = dets->arr + idet;
+  qp_det_t *det_pair = dets->diff ? dets->arr + idet + dets->n : NULL;
+
+  qp_init_pix_block(blk, det, det_pair, 1, end);
+  if (det_pair)
+    qp_init_pix_block(blk + 1, det_pair, det, 1, end);
+}
+
+/* Pointing for a detector (or detector pair) sample to be binned.
+   Returns -1 if the sample is flagged or missing, or -2 if the sample is
+   missing and mem->error_missing is set, in which case an error is set. */
+static inline long qp_tod2map_pix(qp_memory_t *mem, qp_pix_block_t blk[2],
+                                  qp_point_t *pnt, qp_map_t *map, size_t ii,
+                                  double *spp, double *cpp, double *spp_p,
+                                  double *cpp_p) {
+  qp_det_t *det = blk[0].det;
+  qp_det_t *det_pair = blk[0].det_pair;
+  long ipix;
+
+  if (det->flag_init && det->flag[ii])
+    return -1;
+  if (det_pair && det_pair->flag_init && det_pair->flag[ii])
+    return -1;
+
+  ipix = qp_det_pix_block(mem, blk, pnt, map, ii, spp, cpp);
+  if (ipix < 0) {
+    if (!mem->error_missing)
+      return -1;
+    qp_set_error(mem, QP_ERROR_MAP, "qp_tod2map: pixel out of bounds");
+    return -2;
+  }
+
+  if (det_pair) {
+    if (qp_det_pix_block(mem, blk + 1, pnt, map, ii, spp_p, cpp_p) < 0) {
+      if (!mem->error_missing)
+        return -1;
+      qp_set_error(mem, QP_ERROR_MAP, "qp_tod2map: pair pixel out of bounds");
+      return -2;
+    }
+  }
+
+  return ipix;
+}
+
+/* Pixel-range ownership reduction.  Each thread owns a contiguous range of
+   map indices.  The pointing is computed for a block of detectors at a
+   time, and the samples are sorted into per-owner buckets, which are then
+   binned directly into the output map without locking.  Extra memory
+   scales with the number of samples in a block, not with the map size. */
+static int qp_tod2map_owner(qp_memory_t *mem, qp_detarr_t *dets,
+                            qp_point_t *pnt, qp_map_t *map, int nthreads,
+                            qp_chunks_t *chunks) {
+
+  size_t n = pnt->n;
+  size_t ndet = dets->n;
+  size_t nchunk = chunks->nchunk;
+  size_t nblock = (size_t) nthreads < ndet ? (size_t) nthreads : ndet;
+  int npnt = dets->diff ? 4 : 2;
+  double **vec = map->vec_init ? map->vec : NULL;
+  double **proj = map->proj_init ? map->proj : NULL;
+  int err = 0;
+
+  /* chunked detectors already provide a work item per thread */
+  if (nchunk > 1)
+    nblock = 1;
+
+  long *pix = malloc(nblock * n * sizeof(long));
+  double *ang = malloc(npnt * nblock * n * sizeof(double));
+  size_t *idx = malloc(nblock * n * sizeof(size_t));
+  size_t *count = malloc((nblock * nchunk * nthreads + 1) * sizeof(size_t));
+
+  if (qp_check_error(mem, !pix || !ang || !idx || !count, QP_ERROR_MAP,
+                     "qp_tod2map: error allocating sample buckets")) {
+    free(pix);
+    free(ang);
+    free(idx);
+    free(count);
+    return mem->error_code;
+  }
+
+#pragma omp parallel num_threads(nthreads)
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    int errloc = 0;
+
+    for (size_t d0 = 0; d0 < ndet; d0 += nblock) {
+      size_t nb = ndet - d0 < nblock ? ndet - d0 : nblock;
+      size_t nitem = nb * nchunk;
+
+#pragma omp single
+      memset(count, 0, (nitem * nthreads + 1) * sizeof(size_t));
+
+      /* compute pointing and bucket sizes for each detector chunk */
+#pragma omp for
+      for (size_t kk = 0; kk < nitem; kk++) {
+        size_t jj = kk / nchunk, start, end;
+        long *p = pix + jj * n;
+        double *a;
+        size_t *c = count + kk * nthreads;
+        qp_pix_block_t blk[2];
+        qp_chunk_range(chunks, pnt, kk % nchunk, &start, &end);
+        qp_init_tod2map_blocks(dets, d0 + jj, end, blk);
+        for (size_t ii = start; ii < end && !errloc; ii++) {
+          a = ang + npnt * (jj * n + ii);
+          p[ii] = qp_tod2map_pix(memloc, blk, pnt, map, ii,
+                                 a, a + 1, a + npnt - 2, a + npnt - 1);
+          if (p[ii] >= 0)
+            c[QP_PIX_OWNER(p[ii], nthreads, map->npix)]++;
+          else if (p[ii] == -2)
+            errloc = memloc->error_code;
         }
-        continue;
       }
-    }
 
-    if (det->weights_init) {
-      w1 = w0 * det->weights[ii];
-      wmt = w1 * m[0];
-      if ((map->vec_mode == QP_VEC_VPOL) || (map->proj_mode == QP_PROJ_VPOL)) {
-        wmv = w1 * m[3];
+      if (errloc)
+        qp_merge_error(mem, memloc, &err);
+#pragma omp barrier
+      if (err)
+        break;
+
+      /* bucket offsets, ordered by owner then by detector chunk */
+#pragma omp single
+      {
+        size_t off = 0, cnt;
+        for (int tt = 0; tt < nthreads; tt++) {
+          for (size_t kk = 0; kk < nitem; kk++) {
+            cnt = count[kk * nthreads + tt];
+            count[kk * nthreads + tt] = off;
+            off += cnt;
+          }
+        }
+        count[nitem * nthreads] = off;
+      }
+
+      /* sort samples into buckets */
+#pragma omp for
+      for (size_t kk = 0; kk < nitem; kk++) {
+        size_t start, end;
+        long *p = pix + (kk / nchunk) * n;
+        size_t *c = count + kk * nthreads;
+        qp_chunk_range(chunks, pnt, kk % nchunk, &start, &end);
+        for (size_t ii = start; ii < end; ii++) {
+          if (p[ii] < 0)
+            continue;
+          idx[c[QP_PIX_OWNER(p[ii], nthreads, map->npix)]++] = ii;
+        }
+      }
+
+      /* bin each bucket; after the sort above, count[kk, tt] is the end
+         of the (tt, kk) bucket, and the start is the previous end */
+#pragma omp for
+      for (int tt = 0; tt < nthreads; tt++) {
+        size_t start = 0, ii, jj;
+        double *a;
+        if (tt > 0)
+          start = count[(nitem - 1) * nthreads + tt - 1];
+        for (size_t kk = 0; kk < nitem; kk++) {
+          size_t end = count[kk * nthreads + tt];
+          jj = kk / nchunk;
+          for (size_t ll = start; ll < end; ll++) {
+            ii = idx[ll];
+            a = ang + npnt * (jj * n + ii);
+            qp_tod2map_sample(memloc, dets, d0 + jj, map, ii,
+                              pix[jj * n + ii] * qp_map_stride(map),
+                              a[0], a[1], dets->diff ? a[2] : 0,
+                              dets->diff ? a[3] : 0, vec, proj);
+          }
+          start = end;
+        }
       }
-    } else {
-      w1 = w0;
     }
 
-    if ((map->vec_mode >= QP_VEC_POL) || (map->proj_mode >= QP_PROJ_POL)) {
-      mq = m[1] * cpp - m[2] * spp;
-      mu = m[2] * cpp + m[1] * spp;
-      if (!mem->polconv)
-        mu *= -1;
-      wmq = w1 * mq;
-      wmu = w1 * mu;
+    qp_free_memory(memloc);
+  }
+
+  free(pix);
+  free(ang);
+  free(idx);
+  free(count);
+
+  return err;
+}
+
+/* Sparse map accumulator.  Stores only the pixels that are hit, in the
+   same column layout as the output map, with an open-addressing hash
+   table from map index to storage slot. */
+typedef struct {
+  size_t count;        // number of pixels stored
+  size_t size;         // number of allocated slots
+  size_t mask;         // hash table size - 1
+  long *table;         // hash table of slots (-1 if empty)
+  long *pix;           // map index of each slot
+  size_t num_vec;      // number of vec columns
+  double **vec;        // vec columns
+  size_t num_proj;     // number of proj columns
+  double **proj;       // proj columns
+  long last_pix;       // most recent lookup
+  long last_slot;
+} qp_sparse_map_t;
+
+typedef struct {
+  long pix;
+  long slot;
+} qp_sparse_pair_t;
+
+static inline size_t qp_sparse_hash(long pix, size_t mask) {
+  return (size_t)(((uint64_t) pix * 11400714819323198485ull) >> 17) & mask;
+}
+
+/* Rebuild the hash table with tsize entries.  Returns nonzero, leaving
+   the table unchanged, if it cannot be allocated. */
+static int qp_sparse_rehash(qp_sparse_map_t *smap, size_t tsize) {
+  size_t hh;
+  long *table = malloc(tsize * sizeof(long));
+
+  if (!table)
+    return 1;
+  free(smap->table);
+  smap->table = table;
+  memset(smap->table, -1, tsize * sizeof(long));
+  smap->mask = tsize - 1;
+  for (size_t ss = 0; ss < smap->count; ss++) {
+    hh = qp_sparse_hash(smap->pix[ss], smap->mask);
+    while (smap->table[hh] >= 0)
+      hh = (hh + 1) & smap->mask;
+    smap->table[hh] = ss;
+  }
+  return 0;
+}
+
+/* Grow the storage to size slots.  Returns nonzero, leaving the stored
+   pixels unchanged, if it cannot be allocated. */
+static int qp_sparse_resize(qp_sparse_map_t *smap, size_t size) {
+  long *pix;
+  double *col;
+
+  if (!(pix = realloc(smap->pix, size * sizeof(long))))
+    return 1;
+  smap->pix = pix;
+  for (size_t ii = 0; ii < smap->num_vec; ii++) {
+    if (!(col = realloc(smap->vec[ii], size * sizeof(double))))
+      return 1;
+    smap->vec[ii] = col;
+    memset(col + smap->size, 0, (size - smap->size) * sizeof(double));
+  }
+  for (size_t ii = 0; ii < smap->num_proj; ii++) {
+    if (!(col = realloc(smap->proj[ii], size * sizeof(double))))
+      return 1;
+    smap->proj[ii] = col;
+    memset(col + smap->size, 0, (size - smap->size) * sizeof(double));
+  }
+  smap->size = size;
+  return 0;
+}
+
+static void qp_free_sparse_map(qp_sparse_map_t *smap) {
+  if (!smap)
+    return;
+  for (size_t ii = 0; smap->vec && ii < smap->num_vec; ii++)
+    free(smap->vec[ii]);
+  for (size_t ii = 0; smap->proj && ii < smap->num_proj; ii++)
+    free(smap->proj[ii]);
+  free(smap->vec);
+  free(smap->proj);
+  free(smap->pix);
+  free(smap->table);
+  free(smap);
+}
+
+/* Returns NULL if the accumulator cannot be allocated */
+static qp_sparse_map_t * qp_init_sparse_map(qp_map_t *map) {
+  qp_sparse_map_t *smap = calloc(1, sizeof(*smap));
+
+  if (!smap)
+    return NULL;
+  smap->num_vec = map->vec_init ? map->num_vec : 0;
+  smap->num_proj = map->proj_init ? map->num_proj : 0;
+  smap->vec = calloc(smap->num_vec ? smap->num_vec : 1, sizeof(double *));
+  smap->proj = calloc(smap->num_proj ? smap->num_proj : 1, sizeof(double *));
+  smap->last_pix = -1;
+  if (!smap->vec || !smap->proj || qp_sparse_resize(smap, 1024) ||
+      qp_sparse_rehash(smap, 2048)) {
+    qp_free_sparse_map(smap);
+    return NULL;
+  }
+  return smap;
+}
+
+/* Return the storage slot for the given map index, adding it if necessary.
+   Returns -1 if the storage cannot be grown. */
+static inline long qp_sparse_slot(qp_sparse_map_t *smap, long pix) {
+  size_t hh;
+  long slot;
+
+  if (pix == smap->last_pix)
+    return smap->last_slot;
+
+  hh = qp_sparse_hash(pix, smap->mask);
+  while ((slot = smap->table[hh]) >= 0) {
+    if (smap->pix[slot] == pix)
+      break;
+    hh = (hh + 1) & smap->mask;
+  }
+
+  if (slot < 0) {
+    if (smap->count == smap->size && qp_sparse_resize(smap, 2 * smap->size))
+      return -1;
+    if (2 * (smap->count + 1) > smap->mask) {
+      if (qp_sparse_rehash(smap, 2 * (smap->mask + 1)))
+        return -1;
+      hh = qp_sparse_hash(pix, smap->mask);
+      while (smap->table[hh] >= 0)
+        hh = (hh + 1) & smap->mask;
     }
+    slot = smap->count++;
+    smap->pix[slot] = pix;
+    smap->table[hh] = slot;
+  }
 
-    if (det->tod_init && map->vec_init) {
-      gd = g * det->tod[ii];
-
-      switch (map->vec_mode) {
-        case QP_VEC_VPOL:
-          map->vec[3][ipix] += wmv * gd;
-          /* fall through */
-        case QP_VEC_POL:
-          map->vec[1][ipix] += wmq * gd;
-          map->vec[2][ipix] += wmu * gd;
-          /* fall through */
-        case QP_VEC_TEMP:
-          map->vec[0][ipix] += wmt * gd;
-          break;
-        default:
+  smap->last_pix = pix;
+  smap->last_slot = slot;
+  return slot;
+}
+
+/* Add a stored pixel into the map at map index pix */
+static inline void qp_sparse_add(qp_map_t *map, qp_sparse_map_t *smap,
+                                 long pix, long slot) {
+  size_t ipix = pix * qp_map_stride(map);
+
+  if (map->single) {
+    for (size_t ii = 0; ii < smap->num_vec; ii++)
+      map->vecf[ii][ipix] += smap->vec[ii][slot];
+    for (size_t ii = 0; ii < smap->num_proj; ii++)
+      map->projf[ii][ipix] += smap->proj[ii][slot];
+    return;
+  }
+
+  for (size_t ii = 0; ii < smap->num_vec; ii++)
+    map->vec[ii][ipix] += smap->vec[ii][slot];
+  for (size_t ii = 0; ii < smap->num_proj; ii++)
+    map->proj[ii][ipix] += smap->proj[ii][slot];
+}
+
+static int qp_sparse_pair_cmp(const void *a, const void *b) {
+  long pa = ((const qp_sparse_pair_t *) a)->pix;
+  long pb = ((const qp_sparse_pair_t *) b)->pix;
+  return (pa > pb) - (pa < pb);
+}
+
+/* Sparse per-thread accumulator reduction.  Each thread bins its
+   detectors into a sparse accumulator holding only the pixels it hits.
+   The accumulators are then merged into the output map in parallel, with
+   each thread owning a contiguous range of map indices.  This is also how
+   single-precision maps are binned, since the accumulators are in double
+   precision. */
+static int qp_tod2map_sparse(qp_memory_t *mem, qp_detarr_t *dets,
+                             qp_point_t *pnt, qp_map_t *map, int nthreads,
+                             qp_chunks_t *chunks) {
+
+  qp_sparse_map_t **smaps = calloc(nthreads, sizeof(qp_sparse_map_t *));
+  qp_sparse_pair_t **pairs = calloc(nthreads, sizeof(qp_sparse_pair_t *));
+  int err = 0;
+
+  if (qp_check_error(mem, !smaps || !pairs, QP_ERROR_MAP,
+                     "qp_tod2map: error allocating sparse accumulators")) {
+    free(smaps);
+    free(pairs);
+    return mem->error_code;
+  }
+
+#pragma omp parallel num_threads(nthreads)
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    const int ithread = qp_get_opt_thread_num(memloc);
+    qp_sparse_map_t *smap = qp_init_sparse_map(map);
+    qp_sparse_pair_t *spairs = NULL;
+    int errloc = 0;
+    double spp, cpp, spp_p = 0, cpp_p = 0;
+    long ipix, slot;
+    qp_pix_block_t blk[2];
+
+    smaps[ithread] = smap;
+    if (!smap) {
+      qp_set_error(memloc, QP_ERROR_MAP,
+                   "qp_tod2map: error allocating sparse accumulator");
+      errloc = memloc->error_code;
+    }
+
+#pragma omp for
+    for (size_t item = 0; item < dets->n * chunks->nchunk; item++) {
+      size_t idet = item / chunks->nchunk, start, end;
+      qp_chunk_range(chunks, pnt, item % chunks->nchunk, &start, &end);
+      qp_init_tod2map_blocks(dets, idet, end, blk);
+      for (size_t ii = start; ii < end && !errloc && !err; ii++) {
+        ipix = qp_tod2map_pix(memloc, blk, pnt, map, ii, &spp, &cpp,
+                              &spp_p, &cpp_p);
+        if (ipix < 0) {
+          if (ipix == -2)
+            errloc = memloc->error_code;
+          continue;
+        }
+        if ((slot = qp_sparse_slot(smap, ipix)) < 0) {
+          qp_set_error(memloc, QP_ERROR_MAP,
+                       "qp_tod2map: error allocating sparse accumulator");
+          errloc = memloc->error_code;
           break;
+        }
+        qp_tod2map_sample(memloc, dets, idet, map, ii, slot, spp, cpp,
+                          spp_p, cpp_p, smap->num_vec ? smap->vec : NULL,
+                          smap->num_proj ? smap->proj : NULL);
+      }
+      if (errloc)
+        qp_merge_error(mem, memloc, &err);
+    }
+
+    /* sort stored pixels for merging */
+    if (!errloc && smap->count) {
+      spairs = malloc(smap->count * sizeof(*spairs));
+      if (!spairs) {
+        qp_set_error(memloc, QP_ERROR_MAP,
+                     "qp_tod2map: error allocating sparse accumulator");
+        errloc = memloc->error_code;
+      }
+    }
+    if (spairs) {
+      for (size_t ss = 0; ss < smap->count; ss++) {
+        spairs[ss].pix = smap->pix[ss];
+        spairs[ss].slot = ss;
       }
+      qsort(spairs, smap->count, sizeof(*spairs), qp_sparse_pair_cmp);
     }
+    pairs[ithread] = spairs;
+
+    if (errloc)
+      qp_merge_error(mem, memloc, &err);
+
+#pragma omp barrier
+
+    /* merge the index range owned by this thread from all accumulators */
+    if (!err) {
+#pragma omp for
+      for (int tt = 0; tt < nthreads; tt++) {
+        size_t lo = (map->npix * tt + nthreads - 1) / nthreads;
+        for (int aa = 0; aa < nthreads; aa++) {
+          qp_sparse_map_t *sm = smaps[aa];
+          qp_sparse_pair_t *sp = pairs[aa];
+          size_t kmin = 0, kmax, kk;
+          if (!sm || !sp)
+            continue;
+          kmax = sm->count;
+          while (kmin < kmax) {
+            kk = (kmin + kmax) / 2;
+            if ((size_t) sp[kk].pix < lo)
+              kmin = kk + 1;
+            else
+              kmax = kk;
+          }
+          for (kk = kmin; kk < sm->count; kk++) {
+            if (QP_PIX_OWNER(sp[kk].pix, nthreads, map->npix) != tt)
+              break;
+            qp_sparse_add(map, sm, sp[kk].pix, sp[kk].slot);
+          }
+        }
+      }
+    }
+
+#pragma omp barrier
+    free(spairs);
+    qp_free_sparse_map(smap);
+    qp_free_memory(memloc);
+  }
+
+  free(smaps);
+  free(pairs);
+
+  return err;
+}
+
+/* Bin a detector (or detector pair) serially into a single-precision map,
+   through a sparse double-precision accumulator */
+static int qp_tod2map1_single(qp_memory_t *mem, qp_det_t *det,
+                              qp_det_t *det_pair, qp_point_t *pnt,
+                              qp_map_t *map) {
+  qp_det_t arr[2];
+  qp_detarr_t dets;
+  qp_chunks_t chunks;
+
+  if (qp_check_error(mem, !mem->init, QP_ERROR_INIT,
+                     "qp_tod2map1: mem not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !det->init || (det_pair && !det_pair->init),
+                     QP_ERROR_INIT, "qp_tod2map1: det not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !pnt->init, QP_ERROR_INIT,
+                     "qp_tod2map1: pnt not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->partial && !map->pixhash_init, QP_ERROR_INIT,
+                     "qp_tod2map1: map pixhash not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !mem->mean_aber && !pnt->ctime_init, QP_ERROR_POINT,
+                     "qp_tod2map1: ctime required if not mean_aber"))
+    return mem->error_code;
+
+  if (map->vec1d_init && !map->vec_init)
+    if (qp_check_error(mem, qp_reshape_map(map), QP_ERROR_INIT,
+                       "qp_tod2map1: reshape error"))
+      return mem->error_code;
 
-    if (map->proj_init) {
-      switch(map->proj_mode) {
-        case QP_PROJ_VPOL:
-          map->proj[0][ipix] += wmt * mt;
-          map->proj[1][ipix] += wmt * mq;
-          map->proj[2][ipix] += wmt * mu;
-          map->proj[3][ipix] += wmt * mv;
-          map->proj[4][ipix] += wmq * mq;
-          map->proj[5][ipix] += wmq * mu;
-          map->proj[6][ipix] += wmq * mv;
-          map->proj[7][ipix] += wmu * mu;
-          map->proj[8][ipix] += wmu * mv;
-          map->proj[9][ipix] += wmv * mv;
-          break;
-        case QP_PROJ_POL:
-          map->proj[1][ipix] += wmt * mq;
-          map->proj[2][ipix] += wmt * mu;
-          map->proj[3][ipix] += wmq * mq;
-          map->proj[4][ipix] += wmq * mu;
-          map->proj[5][ipix] += wmu * mu;
-          /* fall through */
-        case QP_PROJ_TEMP:
-          map->proj[0][ipix] += wmt * mt;
-          break;
-        default:
-          break;
-      }
-    }
-  }
+  arr[0] = *det;
+  if (det_pair)
+    arr[1] = *det_pair;
+  dets.init = QP_STRUCT_INIT;
+  dets.n = 1;
+  dets.arr_init = 0;
+  dets.diff = det_pair != NULL;
+  dets.arr = arr;
+  chunks.nchunk = 1;
+  chunks.chunk = pnt->n;
+
+  return qp_tod2map_sparse(mem, &dets, pnt, map, 1, &chunks);
+}
 
-  return 0;
+int qp_tod2map1_diff(qp_memory_t *mem, qp_det_t *det, qp_det_t *det_pair,
+                     qp_point_t *pnt, qp_map_t *map) {
+  if (map->init && map->single)
+    return qp_tod2map1_single(mem, det, det_pair, pnt, map);
+  return qp_tod2map1_diff_range(mem, det, det_pair, pnt, map, 0, pnt->n);
 }
 
+int qp_tod2map1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt, qp_map_t *map) {
+  if (map->init && map->single)
+    return qp_tod2map1_single(mem, det, NULL, pnt, map);
+  return qp_tod2map1_range(mem, det, pnt, map, 0, pnt->n);
+}
 
 int qp_tod2map(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
                qp_map_t *map) {
@@ -982,9 +2592,6 @@ int qp_tod2map(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
     dets->n = dets->n/2;
   }
 
-  int num_threads = (int) dets->n < mem->num_threads ? (int) dets->n : mem->num_threads;
-  omp_set_num_threads(num_threads);
-
   int err = 0;
 
   if (map->vec1d_init && !map->vec_init)
@@ -992,14 +2599,45 @@ int qp_tod2map(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
                        "qp_tod2map: reshape error"))
       return mem->error_code;
 
+  qp_chunks_t chunks;
+  qp_init_chunks(mem, dets->n, pnt, &chunks);
+  size_t nchunk = chunks.nchunk;
+  size_t nitem = dets->n * nchunk;
+
+  /* the boresight velocity is only needed if it is shared by several
+     detectors, or to process chunks of samples independently */
+  if ((nitem > 1 || dets->diff) &&
+      !qp_detarr_cached(dets, dets->diff ? 2 * dets->n : dets->n))
+    qp_init_point_beta(mem, pnt);
+
+  int num_threads = (int) nitem < mem->num_threads ? (int) nitem : mem->num_threads;
+  if (num_threads < 1)
+    num_threads = 1;
+  omp_set_num_threads(num_threads);
+
 #ifdef DEBUG
   qp_print_memory(mem);
 #endif
 
-#pragma omp parallel
+  if (map->single)
+    return qp_tod2map_sparse(mem, dets, pnt, map, num_threads, &chunks);
+  if (mem->num_threads > 1 && mem->reduce_mode == QP_REDUCE_OWNER) {
+    return qp_tod2map_owner(mem, dets, pnt, map, mem->num_threads, &chunks);
+  }
+  if (num_threads > 1 && mem->reduce_mode == QP_REDUCE_SPARSE) {
+    return qp_tod2map_sparse(mem, dets, pnt, map, num_threads, &chunks);
+  }
+
+  qp_map_t **maplocs = calloc(num_threads, sizeof(qp_map_t *));
+  if (qp_check_error(mem, !maplocs, QP_ERROR_MAP,
+                     "qp_tod2map: error allocating thread maps"))
+    return mem->error_code;
+
+#pragma omp parallel num_threads(num_threads)
   {
     qp_memory_t *memloc = qp_copy_memory(mem);
-    const int nthreads = qp_get_opt_num_threads(memloc);
+    /* the team size, which may be smaller than mem->num_threads */
+    const int nthreads = omp_get_num_threads();
 
 #ifdef DEBUG
     qp_print_memory(memloc);
@@ -1007,68 +2645,75 @@ int qp_tod2map(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
 
     qp_map_t *maploc;
     int errloc = 0;
-    if (nthreads > 1)
+    if (nthreads > 1) {
       maploc = qp_init_map_from_map(map, 1, 0);
-    else
+      maplocs[qp_get_opt_thread_num(memloc)] = maploc;
+      if (maploc == NULL) {
+        qp_set_error(memloc, QP_ERROR_MAP,
+                     "qp_tod2map: error allocating thread map");
+        errloc = memloc->error_code;
+      }
+    } else {
       maploc = map;
+    }
 
-#pragma omp for
-    for (size_t idet = 0; idet < dets->n; idet++) {
+#pragma omp for nowait
+    for (size_t item = 0; item < nitem; item++) {
+      size_t idet = item / nchunk, start, end;
       if (!errloc && !err){
+        qp_chunk_range(&chunks, pnt, item % nchunk, &start, &end);
         if(dets->diff == 0){
-	  errloc = qp_tod2map1(memloc, dets->arr + idet, pnt, maploc);
+	  errloc = qp_tod2map1_range(memloc, dets->arr + idet, pnt, maploc,
+                                     start, end);
 	}else{
-	  errloc = qp_tod2map1_diff(memloc, dets->arr + idet, dets->arr + idet + dets->n, pnt, maploc);
+	  errloc = qp_tod2map1_diff_range(memloc, dets->arr + idet,
+                                          dets->arr + idet + dets->n, pnt,
+                                          maploc, start, end);
 	}
       }
     }
 
-    if (nthreads > 1) {
-      if (!errloc && !err) {
-#pragma omp critical
-        errloc = qp_add_map(memloc, map, maploc);
-        if (errloc)
-#pragma omp atomic
-          err += errloc;
-      }
-      qp_free_map(maploc);
-    }
+    if (errloc)
+      qp_merge_error(mem, memloc, &err);
 
-    if (errloc) {
-#pragma omp atomic
-      err += errloc;
-#pragma omp critical
-      {
-        mem->error_code = memloc->error_code;
-        mem->error_string = memloc->error_string;
-      }
+    /* merge thread maps in parallel, each thread summing a block of
+       pixels from all of the thread maps */
+    if (nthreads > 1) {
+#pragma omp barrier
+      if (!err)
+        qp_add_maps_for(map, maplocs, nthreads);
+      if (maploc)
+        qp_free_map(maploc);
     }
 
     qp_free_memory(memloc);
   }
 
+  free(maplocs);
+
   return err;
 }
 
-#define _DATUM(n) (map->vec[n][ipix])
+#define _DATUM(n) (qp_map_vec_val(map, n, ipix))
 #define DATUM(n) (mt * _DATUM(n))
 #define POLDATUM(n) \
   (mt * _DATUM(n) + mq * _DATUM(n+1) + mu * _DATUM(n+2))
 #define VPOLDATUM(n) \
   (POLDATUM(n) + mv * _DATUM(n+3))
 #define _IDATUM(n) \
-  (map->vec[n][pix[0]] * weight[0] + \
-   map->vec[n][pix[1]] * weight[1] + \
-   map->vec[n][pix[2]] * weight[2] + \
-   map->vec[n][pix[3]] * weight[3])
+  (qp_map_vec_val(map, n, pix[0]) * weight[0] + \
+   qp_map_vec_val(map, n, pix[1]) * weight[1] + \
+   qp_map_vec_val(map, n, pix[2]) * weight[2] + \
+   qp_map_vec_val(map, n, pix[3]) * weight[3])
 #define IDATUM(n) (mt * _IDATUM(n))
 #define IPOLDATUM(n) \
   (mt * _IDATUM(n) + mq * _IDATUM(n+1) + mu * _IDATUM(n+2))
 #define IVPOLDATUM(n) \
   (IPOLDATUM(n) + mv * _IDATUM(n+3))
 
-int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
-                qp_map_t *map) {
+static int qp_map2tod1_range(qp_memory_t *mem, qp_det_t *det,
+                             qp_point_t *pnt, qp_map_t *map, size_t start,
+                             size_t end) {
 
   if (qp_check_error(mem, !mem->init, QP_ERROR_INIT,
                      "qp_map2tod1: mem not initialized."))
@@ -1088,13 +2733,19 @@ int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
   if (qp_check_error(mem, map->partial && !map->pixhash_init, QP_ERROR_INIT,
                      "qp_map2tod1: map pixhash not initialized."))
     return mem->error_code;
+  if (qp_check_error(mem, map->grid.type && (mem->interp_pix ||
+                                              map->vec_mode >= QP_VEC_D1),
+                     QP_ERROR_MAP, "qp_map2tod1: interpolation and derivative "
+                     "maps require a healpix map"))
+    return mem->error_code;
   if (qp_check_error(mem, !mem->mean_aber && !pnt->ctime_init, QP_ERROR_POINT,
                      "qp_map2tod1: ctime required if not mean_aber"))
     return mem->error_code;
 
-  double ra, dec, spp, cpp, ctime, dtheta, dphi;
+  double ra, dec, spp, cpp, dtheta, dphi, val;
   long ipix;
   quat_t q;
+  qp_pix_block_t blk;
   long pix[4];
   double weight[4];
   double g = det->gain;
@@ -1104,7 +2755,10 @@ int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
                    (map->vec_mode == QP_VEC_TEMP || \
                     map->vec_mode == QP_VEC_POL ||  \
                     map->vec_mode == QP_VEC_VPOL));
+  /* interpolated maps use the cached stencil if there is one */
+  int use_stencil = do_interp && det->interp_init && det->pnt_init;
   int jj, kk, bad_pix = 0;
+  long stride = qp_map_stride(map);
   double norm1, norm2;
 
   if (map->vec1d_init && !map->vec_init)
@@ -1117,42 +2771,53 @@ int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
                        "qp_map2tod1: pixinfo init error"))
       return mem->error_code;
 
-  for (size_t ii = 0; ii < pnt->n; ii++) {
+  qp_init_pix_block(&blk, det, NULL, 1, end);
+
+  for (size_t ii = start; ii < end; ii++) {
     if (det->flag_init && det->flag[ii])
       continue;
-    ctime = pnt->ctime_init ? pnt->ctime[ii] : 0;
-    if (pnt->q_hwp_init)
-      qp_bore2det_hwp(mem, det->q_off, ctime, pnt->q_bore[ii],
-                      pnt->q_hwp[ii], q);
-    else
-      qp_bore2det(mem, det->q_off, ctime, pnt->q_bore[ii], q);
+    if (use_stencil) {
+      ipix = det->pix[ii];
+      spp = det->sin2psi[ii];
+      cpp = det->cos2psi[ii];
+      for (jj = 0; jj < 4; jj++) {
+        pix[jj] = det->interp_pix[4 * ii + jj];
+        weight[jj] = det->interp_weight[4 * ii + jj];
+      }
+    } else if ((map->vec_mode >= QP_VEC_D1) || do_interp) {
+      /* derivative maps and interpolated maps without a stencil cache
+         need the full pointing, so the pointing cache is not used here */
+      qp_det_quat(mem, det, pnt, ii, q);
 
-    if ((map->vec_mode >= QP_VEC_D1) || do_interp) {
       qp_quat2radec(mem, q, &ra, &dec, &spp, &cpp);
       ipix = qp_radec2pix(mem, ra, dec, map->nside);
       qp_pixel_offset(mem, map->nside, ipix, ra, dec, &dtheta, &dphi);
       if (do_interp)
         qp_get_interpol(mem, map->pixinfo, ra, dec, pix, weight);
+      if (map->partial) {
+        ipix = qp_repixelize(map->pixhash, ipix);
+        if (do_interp)
+          qp_repixelizen(map->pixhash, pix, pix, 4);
+      }
     } else {
-      qp_quat2pix(mem, q, map->nside, &ipix, &spp, &cpp);
+      ipix = qp_det_pix_block(mem, &blk, pnt, map, ii, &spp, &cpp);
     }
 
-    if (map->partial) {
-      ipix = qp_repixelize(map->pixhash, ipix);
-      if (ipix < 0) {
-        if (mem->error_missing) {
-          qp_set_error(mem, QP_ERROR_MAP,
-                       "qp_map2tod1: pixel out of bounds");
-          return mem->error_code;
-        } else if (mem->nan_missing) {
-          det->tod[ii] = 0.0 / 0.0;
-        }
-        continue;
+    if (ipix < 0) {
+      if (mem->error_missing) {
+        qp_set_error(mem, QP_ERROR_MAP,
+                     "qp_map2tod1: pixel out of bounds");
+        return mem->error_code;
+      } else if (mem->nan_missing) {
+        qp_det_set_tod(det, ii, 0.0 / 0.0);
       }
+      continue;
+    }
+
+    if (map->partial) {
       if (do_interp) {
           bad_pix = 0;
           for (jj = 0; jj < 4; jj++) {
-            pix[jj] = qp_repixelize(map->pixhash, pix[jj]);
             if (pix[jj] < 0) {
               if (mem->error_missing) {
                 qp_set_error(mem, QP_ERROR_MAP,
@@ -1189,12 +2854,20 @@ int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
           /* fill bad sample with nan or just skip it */
           if (bad_pix) {
             if (mem->nan_missing)
-              det->tod[ii] = 0.0 / 0.0;
+              qp_det_set_tod(det, ii, 0.0 / 0.0);
             continue;
           }
       }
     }
 
+    /* offsets into the map columns */
+    if (stride > 1) {
+      ipix *= stride;
+      if (do_interp)
+        for (jj = 0; jj < 4; jj++)
+          pix[jj] *= stride;
+    }
+
     if ((map->vec_mode >= QP_VEC_POL) || (map->proj_mode >= QP_PROJ_POL)) {
       mq = m[1] * cpp - m[2] * spp;
       mu = m[2] * cpp + m[1] * spp;
@@ -1202,48 +2875,55 @@ int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
         mu *= -1;
     }
 
+    val = 0;
     switch (map->vec_mode) {
       case QP_VEC_VPOL:
         if (do_interp)
-          det->tod[ii] += g * IVPOLDATUM(0);
+          val += g * IVPOLDATUM(0);
         else
-          det->tod[ii] += g * VPOLDATUM(0);
+          val += g * VPOLDATUM(0);
         break;
       case QP_VEC_D2_POL:
-        det->tod[ii] += g * (dphi * dphi * POLDATUM(15)
-                             + dtheta * dphi * POLDATUM(12)
-                             + dtheta * dtheta * POLDATUM(9));
+        val += g * (dphi * dphi * POLDATUM(15)
+                    + dtheta * dphi * POLDATUM(12)
+                    + dtheta * dtheta * POLDATUM(9));
         /* fall through */
       case QP_VEC_D1_POL:
-        det->tod[ii] += g * (dphi * POLDATUM(6) + dtheta * POLDATUM(3));
+        val += g * (dphi * POLDATUM(6) + dtheta * POLDATUM(3));
         /* fall through */
       case QP_VEC_POL:
         if (do_interp)
-          det->tod[ii] += g * IPOLDATUM(0);
+          val += g * IPOLDATUM(0);
         else
-          det->tod[ii] += g * POLDATUM(0);
+          val += g * POLDATUM(0);
         break;
       case QP_VEC_D2:
-        det->tod[ii] += g * (dphi * dphi * DATUM(5) + dtheta * dphi * DATUM(4)
-                             + dtheta * dtheta * DATUM(3));
+        val += g * (dphi * dphi * DATUM(5) + dtheta * dphi * DATUM(4)
+                    + dtheta * dtheta * DATUM(3));
         /* fall through */
       case QP_VEC_D1:
-        det->tod[ii] += g * (dphi * DATUM(2) + dtheta * DATUM(1));
+        val += g * (dphi * DATUM(2) + dtheta * DATUM(1));
         /* fall through */
       case QP_VEC_TEMP:
         if (do_interp)
-          det->tod[ii] += g * IDATUM(0);
+          val += g * IDATUM(0);
         else
-          det->tod[ii] += g * DATUM(0);
+          val += g * DATUM(0);
         break;
       default:
         break;
     }
+    qp_det_set_tod(det, ii, qp_det_tod(det, ii) + val);
   }
 
   return 0;
 }
 
+int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
+                qp_map_t *map) {
+  return qp_map2tod1_range(mem, det, pnt, map, 0, pnt->n);
+}
+
 int qp_map2tod(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
                qp_map_t *map) {
 
@@ -1266,9 +2946,6 @@ int qp_map2tod(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
                      "qp_map2tod: ctime required if not mean_aber"))
     return mem->error_code;
 
-  int num_threads = (int) dets->n < mem->num_threads ? (int) dets->n : mem->num_threads;
-  omp_set_num_threads(num_threads);
-
   int err = 0;
 
   if (map->vec1d_init && !map->vec_init)
@@ -1276,6 +2953,29 @@ int qp_map2tod(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
                        "qp_map2tod: reshape error"))
       return mem->error_code;
 
+  /* shared by all threads, so initialize before the parallel region */
+  if (mem->interp_pix && !map->pixinfo_init &&
+      (map->vec_mode == QP_VEC_TEMP || map->vec_mode == QP_VEC_POL ||
+       map->vec_mode == QP_VEC_VPOL))
+    if (qp_check_error(mem, qp_init_map_pixinfo(map), QP_ERROR_INIT,
+                       "qp_map2tod: pixinfo init error"))
+      return mem->error_code;
+
+  qp_chunks_t chunks;
+  qp_init_chunks(mem, dets->n, pnt, &chunks);
+  size_t nchunk = chunks.nchunk;
+  size_t nitem = dets->n * nchunk;
+
+  /* derivative and interpolated maps bypass the pointing cache */
+  if (nitem > 1 && (map->vec_mode >= QP_VEC_D1 || mem->interp_pix ||
+                    !qp_detarr_cached(dets, dets->n)))
+    qp_init_point_beta(mem, pnt);
+
+  int num_threads = (int) nitem < mem->num_threads ? (int) nitem : mem->num_threads;
+  if (num_threads < 1)
+    num_threads = 1;
+  omp_set_num_threads(num_threads);
+
 #ifdef DEBUG
   qp_print_memory(mem);
 #endif
@@ -1290,24 +2990,657 @@ int qp_map2tod(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
 #endif
 
 #pragma omp for nowait
-    for (size_t idet = 0; idet < dets->n; idet++) {
-      if (!errloc && !err)
-        errloc = qp_map2tod1(memloc, dets->arr + idet, pnt, map);
+    for (size_t item = 0; item < nitem; item++) {
+      size_t start, end;
+      if (!errloc && !err) {
+        qp_chunk_range(&chunks, pnt, item % nchunk, &start, &end);
+        errloc = qp_map2tod1_range(memloc, dets->arr + item / nchunk, pnt,
+                                   map, start, end);
+      }
     }
 
-    if (errloc) {
-#pragma omp atomic
-      err += errloc;
-#pragma omp critical
-      {
-        mem->error_code = memloc->error_code;
-        mem->error_string = memloc->error_string;
+    if (errloc)
+      qp_merge_error(mem, memloc, &err);
+
+    qp_free_memory(memloc);
+  }
+
+  return err;
+}
+
+/* Per-pixel map solver.  The projection matrix of each pixel is stored as
+   its packed upper triangle, in row-major order, e.g. (TT, TQ, TU, QQ,
+   QU, UU) for polarized maps. */
+
+/* Unpack the hits-normalized projection matrix of pixel ii into a full
+   nmap x nmap matrix.  Returns the normalization. */
+static inline double qp_unpack_proj(double **proj, int nmap, size_t ii,
+                                    double *a) {
+  double norm = proj[0][ii];
+  int kk = 0;
+
+  for (int jj = 0; jj < nmap; jj++)
+    for (int ll = jj; ll < nmap; ll++, kk++)
+      a[jj * nmap + ll] = a[ll * nmap + jj] = proj[kk][ii] / norm;
+
+  return norm;
+}
+
+/* Eigenvalues of a symmetric 3x3 matrix, in closed form */
+static void qp_sym_eig3(const double *a, double *e) {
+  double p1 = a[1] * a[1] + a[2] * a[2] + a[5] * a[5];
+  double q = (a[0] + a[4] + a[8]) / 3.0;
+  double d0 = a[0] - q, d1 = a[4] - q, d2 = a[8] - q;
+  double p = sqrt((d0 * d0 + d1 * d1 + d2 * d2 + 2 * p1) / 6.0);
+  double r, phi;
+
+  if (p == 0) {
+    e[0] = e[1] = e[2] = q;
+    return;
+  }
+
+  // half the determinant of (A - q I) / p
+  r = (d0 * (d1 * d2 - a[5] * a[5]) - a[1] * (a[1] * d2 - a[5] * a[2]) +
+       a[2] * (a[1] * a[5] - d1 * a[2])) / (2 * p * p * p);
+  if (r < -1)
+    r = -1;
+  else if (r > 1)
+    r = 1;
+  phi = acos(r) / 3.0;
+
+  e[0] = q + 2 * p * cos(phi);
+  e[2] = q + 2 * p * cos(phi + 2.0 * M_PI / 3.0);
+  e[1] = 3 * q - e[0] - e[2];
+}
+
+/* Eigenvalues of a symmetric matrix, with cyclic Jacobi rotations.  The
+   matrix is overwritten. */
+static void qp_sym_eig_jacobi(double *a, int n, double *e) {
+  double off, norm = 0, theta, t, c, s, akp, akq;
+
+  for (int ii = 0; ii < n * n; ii++)
+    norm += a[ii] * a[ii];
+
+  for (int sweep = 0; sweep < 32; sweep++) {
+    off = 0;
+    for (int p = 0; p < n; p++)
+      for (int q = p + 1; q < n; q++)
+        off += a[p * n + q] * a[p * n + q];
+    if (off <= DBL_EPSILON * DBL_EPSILON * norm)
+      break;
+
+    for (int p = 0; p < n; p++) {
+      for (int q = p + 1; q < n; q++) {
+        if (a[p * n + q] == 0)
+          continue;
+        theta = (a[q * n + q] - a[p * n + p]) / (2 * a[p * n + q]);
+        t = 1.0 / (fabs(theta) + sqrt(theta * theta + 1));
+        if (theta < 0)
+          t = -t;
+        c = 1.0 / sqrt(t * t + 1);
+        s = t * c;
+        for (int k = 0; k < n; k++) {
+          akp = a[k * n + p];
+          akq = a[k * n + q];
+          a[k * n + p] = c * akp - s * akq;
+          a[k * n + q] = s * akp + c * akq;
+        }
+        for (int k = 0; k < n; k++) {
+          akp = a[p * n + k];
+          akq = a[q * n + k];
+          a[p * n + k] = c * akp - s * akq;
+          a[q * n + k] = s * akp + c * akq;
+        }
+        a[p * n + q] = a[q * n + p] = 0;
       }
     }
+  }
 
-    qp_free_memory(memloc);
+  for (int ii = 0; ii < n; ii++)
+    e[ii] = a[ii * n + ii];
+}
+
+/* 2-norm condition number of a symmetric matrix, from its eigenvalues.
+   The matrix may be overwritten.  As with numpy.linalg.cond, condition
+   numbers above 1 / DBL_EPSILON are returned as infinity. */
+static double qp_sym_cond(double *a, int n) {
+  double emin, emax, e[4] = {0};
+
+  if (n == 3)
+    qp_sym_eig3(a, e);
+  else
+    qp_sym_eig_jacobi(a, n, e);
+
+  emin = emax = fabs(e[0]);
+  for (int ii = 1; ii < n; ii++) {
+    if (fabs(e[ii]) < emin)
+      emin = fabs(e[ii]);
+    if (fabs(e[ii]) > emax)
+      emax = fabs(e[ii]);
+  }
+
+  // threshold at machine precision
+  if (emax / emin > 1.0 / DBL_EPSILON)
+    return 1.0 / 0.0;
+  return emax / emin;
+}
+
+/* Packed upper triangle of the inverse of a symmetric 1x1, 3x3 or 4x4
+   matrix, by cofactors.  Returns 1 if the matrix is singular. */
+static int qp_sym_inv(const double *m, int n, double *inv) {
+  double det;
+
+  if (n == 1) {
+    if (m[0] == 0)
+      return 1;
+    inv[0] = 1.0 / m[0];
+    return 0;
+  }
+
+  if (n == 3) {
+    double a = m[0], b = m[1], c = m[2], d = m[4], e = m[5], f = m[8];
+    inv[0] = d * f - e * e;
+    inv[1] = c * e - b * f;
+    inv[2] = b * e - c * d;
+    inv[3] = a * f - c * c;
+    inv[4] = b * c - a * e;
+    inv[5] = a * d - b * b;
+    det = a * inv[0] + b * inv[1] + c * inv[2];
+    if (det == 0 || !isfinite(det))
+      return 1;
+    for (int ii = 0; ii < 6; ii++)
+      inv[ii] /= det;
+    return 0;
+  }
+
+  // 4x4, from the 2x2 minors of the top and bottom row pairs
+  double s0 = m[0] * m[5] - m[4] * m[1];
+  double s1 = m[0] * m[6] - m[4] * m[2];
+  double s2 = m[0] * m[7] - m[4] * m[3];
+  double s3 = m[1] * m[6] - m[5] * m[2];
+  double s4 = m[1] * m[7] - m[5] * m[3];
+  double s5 = m[2] * m[7] - m[6] * m[3];
+  double c5 = m[10] * m[15] - m[14] * m[11];
+  double c4 = m[9] * m[15] - m[13] * m[11];
+  double c3 = m[9] * m[14] - m[13] * m[10];
+  double c2 = m[8] * m[15] - m[12] * m[11];
+  double c1 = m[8] * m[14] - m[12] * m[10];
+  double c0 = m[8] * m[13] - m[12] * m[9];
+
+  det = s0 * c5 - s1 * c4 + s2 * c3 + s3 * c2 - s4 * c1 + s5 * c0;
+  if (det == 0 || !isfinite(det))
+    return 1;
+
+  inv[0] = m[5] * c5 - m[6] * c4 + m[7] * c3;
+  inv[1] = -m[1] * c5 + m[2] * c4 - m[3] * c3;
+  inv[2] = m[13] * s5 - m[14] * s4 + m[15] * s3;
+  inv[3] = -m[9] * s5 + m[10] * s4 - m[11] * s3;
+  inv[4] = m[0] * c5 - m[2] * c2 + m[3] * c1;
+  inv[5] = -m[12] * s5 + m[14] * s2 - m[15] * s1;
+  inv[6] = m[8] * s5 - m[10] * s2 + m[11] * s1;
+  inv[7] = m[12] * s4 - m[13] * s2 + m[15] * s0;
+  inv[8] = -m[8] * s4 + m[9] * s2 - m[11] * s0;
+  inv[9] = m[8] * s3 - m[9] * s1 + m[10] * s0;
+  for (int ii = 0; ii < 10; ii++)
+    inv[ii] /= det;
+  return 0;
+}
+
+static int qp_check_nmap(qp_memory_t *mem, int nmap, const char *msg) {
+  return qp_check_error(mem, nmap != 1 && nmap != 3 && nmap != 4,
+                        QP_ERROR_MAP, msg);
+}
+
+int qp_proj_cond(qp_memory_t *mem, double **proj, int nmap, size_t npix,
+                 double *cond) {
+  if (qp_check_nmap(mem, nmap, "qp_proj_cond: nmap must be 1, 3 or 4"))
+    return mem->error_code;
+
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+  for (size_t ii = 0; ii < npix; ii++) {
+    double a[16];
+    if (proj[0][ii] == 0) {
+      cond[ii] = 1.0 / 0.0;
+      continue;
+    }
+    qp_unpack_proj(proj, nmap, ii, a);
+    cond[ii] = qp_sym_cond(a, nmap);
+  }
+
+  return 0;
+}
+
+/* Solve the pixels of map columns with the given stride between pixels */
+static void qp_solve_pixels(qp_memory_t *mem, double **vec, double **proj,
+                            int nmap, size_t npix, size_t stride,
+                            uint8_t *mask, double *cond, double cond_thresh,
+                            double fill, int inv) {
+  int nproj = nmap * (nmap + 1) / 2;
+  int do_cond = (cond != NULL) || (cond_thresh > 0);
+
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+  for (size_t ii = 0; ii < npix; ii++) {
+    double a[16] = {0}, b[16], pinv[10], norm = 1, c = 1.0 / 0.0;
+    size_t ip = ii * stride;
+    int valid = (mask == NULL || mask[ii]) && proj[0][ip] != 0;
+
+    if (proj[0][ip] != 0) {
+      norm = qp_unpack_proj(proj, nmap, ip, a);
+      if (do_cond) {
+        memcpy(b, a, nmap * nmap * sizeof(double));
+        c = qp_sym_cond(b, nmap);
+      }
+      if (cond_thresh > 0 && !(c < cond_thresh))
+        valid = 0;
+      if (valid && qp_sym_inv(a, nmap, pinv))
+        valid = 0;
+    }
+    if (cond)
+      cond[ii] = c;
+
+    if (!valid) {
+      for (int jj = 0; jj < nmap; jj++)
+        vec[jj][ip] = fill;
+      if (inv)
+        for (int kk = 0; kk < nproj; kk++)
+          proj[kk][ip] = 0;
+      if (mask)
+        mask[ii] = 0;
+      continue;
+    }
+
+    // x = A^-1 v, with A^-1 = pinv / norm
+    double v[4], x;
+    for (int jj = 0; jj < nmap; jj++)
+      v[jj] = vec[jj][ip] / norm;
+    for (int jj = 0; jj < nmap; jj++) {
+      x = 0;
+      for (int ll = 0; ll < nmap; ll++) {
+        int lo = jj < ll ? jj : ll, hi = jj < ll ? ll : jj;
+        x += pinv[lo * nmap - lo * (lo - 1) / 2 + hi - lo] * v[ll];
+      }
+      vec[jj][ip] = x;
+    }
+    if (inv)
+      for (int kk = 0; kk < nproj; kk++)
+        proj[kk][ip] = pinv[kk] / norm;
+  }
+}
+
+int qp_solve_map(qp_memory_t *mem, double **vec, double **proj, int nmap,
+                 size_t npix, uint8_t *mask, double *cond, double cond_thresh,
+                 double fill, int inv) {
+  if (qp_check_nmap(mem, nmap, "qp_solve_map: nmap must be 1, 3 or 4"))
+    return mem->error_code;
+
+  qp_solve_pixels(mem, vec, proj, nmap, npix, 1, mask, cond, cond_thresh,
+                  fill, inv);
+  return 0;
+}
+
+int qp_tod2map_solve(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                     qp_map_t *map, double *hits, double *cond,
+                     double cond_thresh, double fill) {
+  int err;
+
+  if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
+                     "qp_tod2map_solve: map not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->vec_mode < QP_VEC_TEMP ||
+                     map->vec_mode > QP_VEC_VPOL ||
+                     (int) map->proj_mode != (int) map->vec_mode,
+                     QP_ERROR_MAP, "qp_tod2map_solve: map requires matching "
+                     "vec and proj modes"))
+    return mem->error_code;
+  if (qp_check_error(mem, map->single, QP_ERROR_MAP,
+                     "qp_tod2map_solve: single-precision maps not supported"))
+    return mem->error_code;
+
+  if ((err = qp_tod2map(mem, dets, pnt, map)))
+    return err;
+  if (qp_check_error(mem, !map->vec_init || !map->proj_init, QP_ERROR_INIT,
+                     "qp_tod2map_solve: map columns not initialized."))
+    return mem->error_code;
+
+  size_t stride = qp_map_stride(map);
+
+  if (hits) {
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+    for (size_t ii = 0; ii < map->npix; ii++)
+      hits[ii] = map->proj[0][ii * stride];
+  }
+
+  qp_solve_pixels(mem, map->vec, map->proj, map->num_vec, map->npix, stride,
+                  NULL, cond, cond_thresh, fill, 0);
+  return 0;
+}
+
+/* Multiply the pixels of map columns by their packed symmetric matrices,
+   in place, with the given strides between pixels */
+static void qp_apply_proj_pixels(qp_memory_t *mem, double **map,
+                                 size_t map_stride, double **proj,
+                                 size_t proj_stride, int nmap, size_t npix,
+                                 uint8_t *mask, double fill) {
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+  for (size_t ii = 0; ii < npix; ii++) {
+    size_t im = ii * map_stride, ip = ii * proj_stride;
+    double v[4], x;
+
+    if ((mask && !mask[ii]) || proj[0][ip] == 0) {
+      for (int jj = 0; jj < nmap; jj++)
+        map[jj][im] = fill;
+      if (mask)
+        mask[ii] = 0;
+      continue;
+    }
+
+    for (int jj = 0; jj < nmap; jj++)
+      v[jj] = map[jj][im];
+    for (int jj = 0; jj < nmap; jj++) {
+      x = 0;
+      for (int ll = 0; ll < nmap; ll++) {
+        int lo = jj < ll ? jj : ll, hi = jj < ll ? ll : jj;
+        x += proj[lo * nmap - lo * (lo - 1) / 2 + hi - lo][ip] * v[ll];
+      }
+      map[jj][im] = x;
+    }
+  }
+}
+
+int qp_unsolve_map(qp_memory_t *mem, double **map, double **proj, int nmap,
+                   size_t npix, uint8_t *mask, double fill) {
+  if (qp_check_nmap(mem, nmap, "qp_unsolve_map: nmap must be 1, 3 or 4"))
+    return mem->error_code;
+
+  qp_apply_proj_pixels(mem, map, 1, proj, 1, nmap, npix, mask, fill);
+  return 0;
+}
+
+/* Packed inverse of the projection matrices of map columns with the given
+   stride between pixels */
+static void qp_proj_inv_pixels(qp_memory_t *mem, double **proj,
+                               size_t stride, double **proj_inv, int nmap,
+                               size_t npix, double cond_thresh) {
+  int nproj = nmap * (nmap + 1) / 2;
+
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+  for (size_t ii = 0; ii < npix; ii++) {
+    double a[16] = {0}, b[16], pinv[10], norm = 1;
+    size_t ip = ii * stride;
+    int valid = proj[0][ip] != 0;
+
+    if (valid) {
+      norm = qp_unpack_proj(proj, nmap, ip, a);
+      if (cond_thresh > 0) {
+        memcpy(b, a, nmap * nmap * sizeof(double));
+        if (!(qp_sym_cond(b, nmap) < cond_thresh))
+          valid = 0;
+      }
+      if (valid && qp_sym_inv(a, nmap, pinv))
+        valid = 0;
+    }
+
+    for (int kk = 0; kk < nproj; kk++)
+      proj_inv[kk][ii] = valid ? pinv[kk] / norm : 0;
+  }
+}
+
+int qp_proj_inv(qp_memory_t *mem, double **proj, double **proj_inv, int nmap,
+                size_t npix, double cond_thresh) {
+  if (qp_check_nmap(mem, nmap, "qp_proj_inv: nmap must be 1, 3 or 4"))
+    return mem->error_code;
+
+  qp_proj_inv_pixels(mem, proj, 1, proj_inv, nmap, npix, cond_thresh);
+  return 0;
+}
+
+/* Preconditioned conjugate gradient mapmaker.  The map vectors of the
+   solver are vec-only maps with the index of the destination map, and the
+   projection operators run through a single timestream buffer that is
+   swapped in for the detector timestreams. */
+
+static qp_map_t * qp_init_work_map(qp_map_t *map) {
+  size_t npix = (map->partial || map->grid.type) ? map->npix : 0;
+  qp_map_t *new_map = qp_init_map(map->nside, npix, map->vec_mode,
+                                  QP_PROJ_NONE);
+
+  if (new_map)
+    qp_copy_map_index(map, new_map);
+  return new_map;
+}
+
+static void qp_zero_map_vec(qp_memory_t *mem, qp_map_t *map) {
+  size_t s = qp_map_stride(map);
+
+  for (size_t jj = 0; jj < map->num_vec; jj++) {
+    double *v = map->vec[jj];
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+    for (size_t ii = 0; ii < map->npix; ii++)
+      v[ii * s] = 0;
+  }
+}
+
+/* Dot product of the vec columns of two maps, over the pixels where the
+   preconditioner is nonzero */
+static double qp_cg_dot(qp_memory_t *mem, qp_map_t *a, qp_map_t *b,
+                        double *minv0) {
+  size_t sa = qp_map_stride(a), sb = qp_map_stride(b);
+  double sum = 0;
+
+  for (size_t jj = 0; jj < a->num_vec; jj++) {
+    double *va = a->vec[jj], *vb = b->vec[jj];
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static) \
+  reduction(+:sum)
+    for (size_t ii = 0; ii < a->npix; ii++)
+      if (minv0[ii] != 0)
+        sum += va[ii * sa] * vb[ii * sb];
+  }
+
+  return sum;
+}
+
+/* y = alpha * x + beta * y */
+static void qp_cg_axpby(qp_memory_t *mem, double alpha, qp_map_t *x,
+                        double beta, qp_map_t *y) {
+  size_t sx = qp_map_stride(x), sy = qp_map_stride(y);
+
+  for (size_t jj = 0; jj < x->num_vec; jj++) {
+    double *vx = x->vec[jj], *vy = y->vec[jj];
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+    for (size_t ii = 0; ii < x->npix; ii++)
+      vy[ii * sy] = alpha * vx[ii * sx] + beta * vy[ii * sy];
+  }
+}
+
+/* Copy the detector timestreams into the buffer and point the detectors
+   at it, saving the original detectors in orig */
+static void qp_swap_detarr_tod(qp_detarr_t *dets, double *buf, size_t n,
+                               qp_det_t *orig) {
+  for (size_t idet = 0; idet < dets->n; idet++) {
+    qp_det_t *det = dets->arr + idet;
+    double *tod = buf + idet * n;
+
+    if (det->todf)
+      for (size_t ii = 0; ii < n; ii++)
+        tod[ii] = det->todf[ii];
+    else
+      memcpy(tod, det->tod, n * sizeof(double));
+
+    orig[idet] = *det;
+    det->tod = tod;
+    det->todf = NULL;
+  }
+}
+
+static void qp_restore_detarr_tod(qp_detarr_t *dets, qp_det_t *orig) {
+  for (size_t idet = 0; idet < dets->n; idet++) {
+    dets->arr[idet].tod = orig[idet].tod;
+    dets->arr[idet].todf = orig[idet].todf;
+  }
+}
+
+/* q = P^T F P p, through the timestream buffer */
+static int qp_cg_apply(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                       qp_map_t *p, qp_map_t *q, double *buf, size_t n,
+                       qp_tod_filter_t filter, void *filter_data) {
+  int err;
+
+  memset(buf, 0, dets->n * n * sizeof(double));
+  if ((err = qp_map2tod(mem, dets, pnt, p)))
+    return err;
+  if (filter && qp_check_error(mem, filter(buf, dets->n, n, filter_data),
+                               QP_ERROR_MAP, "qp_tod2map_cg: filter error"))
+    return mem->error_code;
+  qp_zero_map_vec(mem, q);
+  return qp_tod2map(mem, dets, pnt, q);
+}
+
+/* Solve for the map by preconditioned conjugate gradients, given the
+   right-hand side binned into map, with the timestreams pointing into
+   buf */
+static int qp_cg_solve(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                       qp_map_t *map, double *buf, qp_tod_filter_t filter,
+                       void *filter_data, double cond_thresh, int maxiter,
+                       double tol, double *resid, int *niter) {
+  size_t n = pnt->n, npix = map->npix;
+  int nmap = map->num_vec, nproj = map->num_proj, err = 0;
+  double *minv1d = malloc(nproj * npix * sizeof(double));
+  double *minv[10];
+  qp_map_t *r = qp_init_work_map(map), *z = qp_init_work_map(map);
+  qp_map_t *p = qp_init_work_map(map), *q = qp_init_work_map(map);
+  double rz, rz_new, pq, alpha, bnorm, rnorm = 1;
+
+  if (qp_check_error(mem, !minv1d || !r || !z || !p || !q, QP_ERROR_MAP,
+                     "qp_tod2map_cg: error allocating work maps")) {
+    err = mem->error_code;
+    *niter = 0;
+  } else {
+    /* block-diagonal preconditioner, restricted to well-conditioned
+       pixels */
+    for (int kk = 0; kk < nproj; kk++)
+      minv[kk] = minv1d + kk * npix;
+    qp_proj_inv_pixels(mem, map->proj, qp_map_stride(map), minv, nmap, npix,
+                       cond_thresh);
+
+    // x0 = 0, r = b, z = M^-1 r, p = z
+    qp_cg_axpby(mem, 1, map, 0, r);
+    qp_zero_map_vec(mem, map);
+    qp_cg_axpby(mem, 1, r, 0, z);
+    qp_apply_proj_pixels(mem, z->vec, 1, minv, 1, nmap, npix, NULL, 0);
+    qp_cg_axpby(mem, 1, z, 0, p);
+    rz = qp_cg_dot(mem, r, z, minv[0]);
+    bnorm = sqrt(qp_cg_dot(mem, r, r, minv[0]));
+    if (resid)
+      resid[0] = bnorm > 0 ? 1 : 0;
+
+    *niter = 0;
+    while (*niter < maxiter && bnorm > 0 && rnorm > tol) {
+      if ((err = qp_cg_apply(mem, dets, pnt, p, q, buf, n, filter,
+                             filter_data)))
+        break;
+      pq = qp_cg_dot(mem, p, q, minv[0]);
+      if (!(pq > 0))
+        break;
+      alpha = rz / pq;
+      qp_cg_axpby(mem, alpha, p, 1, map);
+      qp_cg_axpby(mem, -alpha, q, 1, r);
+      (*niter)++;
+
+      rnorm = sqrt(qp_cg_dot(mem, r, r, minv[0])) / bnorm;
+      if (resid)
+        resid[*niter] = rnorm;
+
+      qp_cg_axpby(mem, 1, r, 0, z);
+      qp_apply_proj_pixels(mem, z->vec, 1, minv, 1, nmap, npix, NULL, 0);
+      rz_new = qp_cg_dot(mem, r, z, minv[0]);
+      qp_cg_axpby(mem, 1, z, rz_new / rz, p);
+      rz = rz_new;
+    }
+  }
+
+  free(minv1d);
+  if (r)
+    qp_free_map(r);
+  if (z)
+    qp_free_map(z);
+  if (p)
+    qp_free_map(p);
+  if (q)
+    qp_free_map(q);
+
+  return err;
+}
+
+int qp_tod2map_cg(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                  qp_map_t *map, qp_tod_filter_t filter, void *filter_data,
+                  double cond_thresh, int maxiter, double tol, double *resid,
+                  int *niter) {
+  if (qp_check_error(mem, !mem->init, QP_ERROR_INIT,
+                     "qp_tod2map_cg: mem not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !dets->init, QP_ERROR_INIT,
+                     "qp_tod2map_cg: dets not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, !map->init, QP_ERROR_INIT,
+                     "qp_tod2map_cg: map not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, map->vec_mode < QP_VEC_TEMP ||
+                     map->vec_mode > QP_VEC_VPOL ||
+                     (int) map->proj_mode != (int) map->vec_mode,
+                     QP_ERROR_MAP, "qp_tod2map_cg: map requires matching "
+                     "vec and proj modes"))
+    return mem->error_code;
+  if (qp_check_error(mem, map->single, QP_ERROR_MAP,
+                     "qp_tod2map_cg: single-precision maps not supported"))
+    return mem->error_code;
+  if (qp_check_error(mem, dets->diff, QP_ERROR_MAP,
+                     "qp_tod2map_cg: differenced detectors not supported"))
+    return mem->error_code;
+  if (qp_check_error(mem, mem->interp_pix, QP_ERROR_MAP,
+                     "qp_tod2map_cg: interp_pix not supported"))
+    return mem->error_code;
+  for (size_t idet = 0; idet < dets->n; idet++)
+    if (qp_check_error(mem, !dets->arr[idet].tod_init, QP_ERROR_INIT,
+                       "qp_tod2map_cg: det.tod not initialized."))
+      return mem->error_code;
+
+  size_t n = pnt->n;
+  int nan_missing, iter = 0, err = 0;
+  double *buf = malloc(dets->n * n * sizeof(double));
+  qp_det_t *orig = malloc(dets->n * sizeof(qp_det_t));
+
+  if (qp_check_error(mem, !buf || !orig, QP_ERROR_MAP,
+                     "qp_tod2map_cg: error allocating timestream buffer")) {
+    free(buf);
+    free(orig);
+    return mem->error_code;
   }
 
+  // missing samples are left at zero by the forward projection
+  nan_missing = mem->nan_missing;
+  mem->nan_missing = 0;
+
+  /* the right-hand side P^T F d is binned into the map, along with the
+     projection matrix, from a copy of the timestreams */
+  qp_swap_detarr_tod(dets, buf, n, orig);
+
+  if (filter && qp_check_error(mem, filter(buf, dets->n, n, filter_data),
+                               QP_ERROR_MAP, "qp_tod2map_cg: filter error"))
+    err = mem->error_code;
+  if (!err)
+    err = qp_tod2map(mem, dets, pnt, map);
+  if (!err)
+    err = qp_cg_solve(mem, dets, pnt, map, buf, filter, filter_data,
+                      cond_thresh, maxiter, tol, resid, &iter);
+
+  qp_restore_detarr_tod(dets, orig);
+  mem->nan_missing = nan_missing;
+  if (niter)
+    *niter = iter;
+
+  free(buf);
+  free(orig);
+
   return err;
 }
 
@@ -1350,3 +3683,27 @@ int qp_get_opt_thread_num(qp_memory_t *mem) {
 #endif
   return mem->thread_num;
 }
+
+void qp_set_opt_reduce_mode(qp_memory_t *mem, int reduce_mode) {
+  mem->reduce_mode = reduce_mode;
+}
+
+int qp_get_opt_reduce_mode(qp_memory_t *mem) {
+  return mem->reduce_mode;
+}
+
+void qp_set_opt_parallel_mode(qp_memory_t *mem, int parallel_mode) {
+  mem->parallel_mode = parallel_mode;
+}
+
+int qp_get_opt_parallel_mode(qp_memory_t *mem) {
+  return mem->parallel_mode;
+}
+
+void qp_set_opt_sort_pix(qp_memory_t *mem, int sort_pix) {
+  mem->sort_pix = sort_pix;
+}
+
+int qp_get_opt_sort_pix(qp_memory_t *mem) {
+  return mem->sort_pix;
+}
@@ -41,11 +41,18 @@ qp_memory_t * qp_init_memory(void) {
   mem->error_missing = 1;
   mem->nan_missing = 0;
   mem->interp_missing = 0;
+  mem->interp_corr = 0;
   mem->gal_init = 0;
+  mem->num_frames = 0;
   mem->dipole_init = 0;
   mem->thread_num = 0;
+  mem->reduce_mode = 0;
+  mem->parallel_mode = 0;
+  mem->sort_pix = 0;
 #ifndef ENABLE_LITE
   qp_set_opt_num_threads(mem, 0);
+#else
+  mem->num_threads = 1;
 #endif
   mem->weather.temperature = 0.;
   mem->weather.pressure = 10.;
@@ -65,10 +72,18 @@ qp_memory_t * qp_init_memory(void) {
   memset(mem->q_ref_inv,      0, sizeof(quat_t));
   memset(mem->q_gal,      0, sizeof(quat_t));
   memset(mem->q_gal_inv,  0, sizeof(quat_t));
+  memset(mem->frames,     0, sizeof(mem->frames));
   memset(mem->v_dipole,   0, sizeof(vec3_t));
   memset(mem->beta_rot,   0, sizeof(vec3_t));
   memset(mem->beta_earth, 0, sizeof(vec3_t));
   mem->bulletinA.entries = NULL;
+  qp_set_ephem(mem, 0, 0, 0, 0, NULL);
+  qp_reset_interp(&mem->interp_wobble);
+  qp_reset_interp(&mem->interp_wobble_inv);
+  qp_reset_interp(&mem->interp_erot);
+  qp_reset_interp(&mem->interp_erot_inv);
+  qp_reset_interp(&mem->interp_npb);
+  qp_reset_interp(&mem->interp_npb_inv);
   mem->error_code = 0;
   mem->error_string = NULL;
   mem->init = 1;
@@ -79,9 +94,69 @@ qp_memory_t * qp_copy_memory(qp_memory_t *memsrc) {
   qp_memory_t *memdest = malloc(sizeof(*memdest));
   *memdest = *memsrc;
   qp_copy_iers_bulletin_a(memdest, memsrc);
+  /* the copy starts without an error, so that errors raised on it can be
+     told apart from any left on memsrc by an earlier call */
+  qp_set_error(memdest, 0, NULL);
   return memdest;
 }
 
+void qp_copy_state(qp_memory_t *mem, qp_memory_t *memsrc) {
+  qp_bulletina_t bulletinA = mem->bulletinA;
+  int num_threads = mem->num_threads;
+  int thread_num = mem->thread_num;
+  int error_code = mem->error_code;
+  char *error_string = mem->error_string;
+
+  *mem = *memsrc;
+
+  mem->bulletinA = bulletinA;
+  mem->num_threads = num_threads;
+  mem->thread_num = thread_num;
+  if (!memsrc->error_code) {
+    mem->error_code = error_code;
+    mem->error_string = error_string;
+  }
+}
+
+int qp_sample_threads(qp_memory_t *mem, int n) {
+  int num_threads = mem->num_threads;
+  if (omp_in_parallel())
+    return 1;
+  if (num_threads > n / QP_SAMPLE_CHUNK)
+    num_threads = n / QP_SAMPLE_CHUNK;
+  return num_threads > 0 ? num_threads : 1;
+}
+
+#define RESETSTATE(state)                       \
+  if (memloc->state_##state.update_rate > 0)    \
+    memloc->state_##state.ctime_last = -1;
+
+qp_memory_t * qp_init_chunk_memory(qp_memory_t *mem, int chunk) {
+  qp_memory_t *memloc = qp_copy_memory(mem);
+  memloc->thread_num = chunk;
+
+  if (chunk > 0) {
+    RESETSTATE(daber)
+    RESETSTATE(lonlat)
+    RESETSTATE(wobble)
+    RESETSTATE(dut1)
+    RESETSTATE(erot)
+    RESETSTATE(npb)
+    RESETSTATE(aaber)
+    RESETSTATE(ref)
+    RESETSTATE(daber_inv)
+    RESETSTATE(lonlat_inv)
+    RESETSTATE(wobble_inv)
+    RESETSTATE(dut1_inv)
+    RESETSTATE(erot_inv)
+    RESETSTATE(npb_inv)
+    RESETSTATE(aaber_inv)
+    RESETSTATE(ref_inv)
+  }
+
+  return memloc;
+}
+
 void qp_free_memory(qp_memory_t *mem) {
   qp_set_iers_bulletin_a(mem, 0, 0, NULL, NULL, NULL);
   free(mem);
@@ -208,6 +283,11 @@ void qp_print_memory(qp_memory_t *mem) {
   printf("[%d]  gal init: %s\n", thread, mem->gal_init ? "yes" : "no");
   qp_print_quat_mp(thread, "gal", mem->q_gal);
   qp_print_quat_mp(thread, "gal inv", mem->q_gal_inv);
+  for (int ii = 0; ii < mem->num_frames; ii++) {
+    char name[] = "frame  ";
+    name[6] = mem->frames[ii].name;
+    qp_print_quat_mp(thread, name, mem->frames[ii].q);
+  }
 
   // qp_print_weather_mp(thread, &mem->weather);
 
@@ -220,10 +300,14 @@ void qp_print_memory(qp_memory_t *mem) {
   printf("[%d]  opt: error missing: %s\n", thread, mem->error_missing ? "yes" : "no");
   printf("[%d]  opt: nan missing: %s\n", thread, mem->nan_missing ? "yes" : "no");
   printf("[%d]  opt: interp missing: %s\n", thread, mem->interp_missing ? "yes" : "no");
+  printf("[%d]  opt: interp corr: %s\n", thread, mem->interp_corr ? "yes" : "no");
 
 #ifndef ENABLE_LITE
   printf("[%d]  opt: num threads: %d\n", thread, qp_get_opt_num_threads(mem));
   printf("[%d]  thread num: %d\n", thread, qp_get_opt_thread_num(mem));
+  printf("[%d]  opt: reduce mode: %d\n", thread, mem->reduce_mode);
+  printf("[%d]  opt: parallel mode: %d\n", thread, mem->parallel_mode);
+  printf("[%d]  opt: sort pix: %s\n", thread, mem->sort_pix ? "yes" : "no");
 #endif
   printf("[%d]  initialized: %s\n", thread, mem->init ? "yes" : "no");
 
@@ -321,6 +405,16 @@ int qp_check_apply(qp_state_t *state) {
   return 1;
 }
 
+// return 1 to interpolate between updates, 0 to hold
+int qp_check_interp(qp_memory_t *mem, qp_state_t *state) {
+  return mem->interp_corr && state->update_rate > 0;
+}
+
+void qp_reset_interp(qp_interp_t *interp) {
+  interp->ctime[0] = interp->ctime[1] = -1;
+  interp->dut1 = 0;
+}
+
 #define OPTIONFUNCS(opt)			     \
   void qp_set_opt_##opt(qp_memory_t *mem, int val) { \
     mem->opt = val;				     \
@@ -354,6 +448,19 @@ OPTIONFUNCD(error_missing)
 OPTIONFUNCD(nan_missing)
 OPTIONFUNCD(interp_missing)
 
+void qp_set_opt_interp_corr(qp_memory_t *mem, int val) {
+  if (val != mem->interp_corr) {
+    mem->interp_corr = val;
+    qp_reset_rate_wobble(mem);
+    qp_reset_rate_erot(mem);
+    qp_reset_rate_npb(mem);
+    qp_reset_rate_wobble_inv(mem);
+    qp_reset_rate_erot_inv(mem);
+    qp_reset_rate_npb_inv(mem);
+  }
+}
+OPTIONFUNCG(interp_corr)
+
 void qp_set_options(qp_memory_t *mem,
 		    int accuracy,
 		    int mean_aber,
@@ -7,22 +7,164 @@
 #include "vec3.h"
 #include "quaternion.h"
 #include "chealpix.h"
+#include <omp.h>
+
+/* Batched healpix pixelization.
+
+   The kernels below reproduce the arithmetic of the chealpix
+   ang2pix_{nest,ring}_z_phi functions operation for operation, so that the
+   pixel numbers are identical to those from vec2pix_* and ang2pix_*, but
+   they run over blocks of (z, phi) pairs.  Both the equatorial and polar
+   branches are evaluated for every sample and the result selected, and the
+   nested face number and bit interleaving are computed arithmetically
+   rather than through lookup tables, so the loops have no branches or table
+   lookups and can be vectorized by the compiler. */
+
+static const double hpx_twothird = 2.0 / 3.0;
+static const double hpx_twopi = 6.283185307179586476925286766559005768394;
+static const double hpx_inv_halfpi = 0.6366197723675813430755350534900574;
+
+/* phi in units of pi/2, reduced to [0, 4) as in chealpix */
+static inline double hpx_tt(double phi) {
+  // fmod is exact, and returns phi itself if |phi| < 2 pi
+  double r = (fabs(phi) < hpx_twopi) ? phi : fmod(phi, hpx_twopi);
+  double tmp = r + hpx_twopi;
+  if (!(phi >= 0))
+    r = (tmp == hpx_twopi) ? 0. : tmp;
+  return r * hpx_inv_halfpi;
+}
+
+/* Interleave the bits of v with zeros */
+static inline int64_t hpx_spread_bits(int64_t v) {
+  v = (v | (v << 16)) & 0x0000ffff0000ffffLL;
+  v = (v | (v << 8)) & 0x00ff00ff00ff00ffLL;
+  v = (v | (v << 4)) & 0x0f0f0f0f0f0f0f0fLL;
+  v = (v | (v << 2)) & 0x3333333333333333LL;
+  v = (v | (v << 1)) & 0x5555555555555555LL;
+  return v;
+}
+
+static void hpx_zphi2pix_nest(int64_t nside, const double *z,
+                              const double *tt, long *pix, int n) {
+  const double ns = nside;
+  const int64_t mask = nside - 1;
+  const int64_t npface = nside * nside;
+  int order = 0;
+
+  while ((1LL << order) < nside)
+    order++;
+
+  for (int ii = 0; ii < n; ii++) {
+    double za = fabs(z[ii]);
+    double t = tt[ii];
+    int north = z[ii] >= 0;
+
+    // equatorial region
+    double temp1 = ns * (0.5 + t);
+    double temp2 = ns * (z[ii] * 0.75);
+    int64_t jp = (int64_t) (temp1 - temp2);
+    int64_t jm = (int64_t) (temp1 + temp2);
+    int64_t ifp = jp >> order;
+    int64_t ifm = jm >> order;
+    int64_t face_e = (ifp == ifm) ? (ifp | 4) : ((ifp < ifm) ? ifp : (ifm + 8));
+    int64_t ix_e = jm & mask;
+    int64_t iy_e = nside - (jp & mask) - 1;
+
+    // polar caps
+    int64_t ntt = (int64_t) t;
+    ntt = (ntt >= 4) ? 3 : ntt;
+    double tp = t - ntt;
+    double tmp = ns * sqrt(3 * (1 - za));
+    int64_t kp = (int64_t) (tp * tmp);
+    int64_t km = (int64_t) ((1.0 - tp) * tmp);
+    kp = (kp >= nside) ? mask : kp;
+    km = (km >= nside) ? mask : km;
+    int64_t face_p = north ? ntt : (ntt + 8);
+    int64_t ix_p = north ? (nside - km - 1) : kp;
+    int64_t iy_p = north ? (nside - kp - 1) : km;
+
+    int eq = za <= hpx_twothird;
+    int64_t face = eq ? face_e : face_p;
+    int64_t ix = eq ? ix_e : ix_p;
+    int64_t iy = eq ? iy_e : iy_p;
+
+    pix[ii] = face * npface + (hpx_spread_bits(ix) | (hpx_spread_bits(iy) << 1));
+  }
+}
+
+static void hpx_zphi2pix_ring(int64_t nside, const double *z,
+                              const double *tt, long *pix, int n) {
+  const double ns = nside;
+  const int64_t nl4 = 4 * nside;
+  const int64_t ncap = nside * (nside - 1) * 2;
+  const int64_t npix = 12 * nside * nside;
+
+  for (int ii = 0; ii < n; ii++) {
+    double za = fabs(z[ii]);
+    double t = tt[ii];
+
+    // equatorial region
+    double temp1 = ns * (0.5 + t);
+    double temp2 = ns * z[ii] * 0.75;
+    int64_t jp = (int64_t) (temp1 - temp2);
+    int64_t jm = (int64_t) (temp1 + temp2);
+    int64_t ir = nside + 1 + jp - jm;
+    int64_t kshift = 1 - (ir & 1);
+    int64_t ip = (jp + jm - nside + kshift + 1) / 2;
+    // ip is in [0, 2 nl4) here, so a single subtraction is a modulo
+    ip = (ip >= nl4) ? (ip - nl4) : ip;
+    int64_t pix_e = ncap + (ir - 1) * nl4 + ip;
+
+    // polar caps
+    double tp = t - (int64_t) t;
+    double tmp = ns * sqrt(3 * (1 - za));
+    int64_t kp = (int64_t) (tp * tmp);
+    int64_t km = (int64_t) ((1.0 - tp) * tmp);
+    int64_t jr = kp + km + 1;
+    int64_t jq = (int64_t) (t * jr);
+    jq = (jq >= 4 * jr) ? (jq - 4 * jr) : jq;
+    int64_t pix_p = (z[ii] > 0) ? (2 * jr * (jr - 1) + jq) :
+      (npix - 2 * jr * (jr + 1) + jq);
+
+    pix[ii] = (za <= hpx_twothird) ? pix_e : pix_p;
+  }
+}
+
+/* Compute healpix pixel numbers for n samples given z = cos(theta) and
+   phi in radians.  phi is overwritten. */
+static void qp_zphi2pix(qp_memory_t *mem, int nside, double *z, double *phi,
+                        long *pix, int n) {
+  for (int ii = 0; ii < n; ii++)
+    phi[ii] = hpx_tt(phi[ii]);
+
+  if (mem->pix_order == QP_ORDER_NEST)
+    hpx_zphi2pix_nest(nside, z, phi, pix, n);
+  else
+    hpx_zphi2pix_ring(nside, z, phi, pix, n);
+}
 
 /* Compute healpix pixel number for given nside and ra/dec */
 long qp_radec2pix(qp_memory_t *mem, double ra, double dec, int nside) {
   long pix;
-  if (mem->pix_order == QP_ORDER_NEST)
-    ang2pix_nest(nside, M_PI_2 - deg2rad(dec), deg2rad(ra), &pix);
-  else
-    ang2pix_ring(nside, M_PI_2 - deg2rad(dec), deg2rad(ra), &pix);
+  double z = cos(M_PI_2 - deg2rad(dec));
+  double phi = deg2rad(ra);
+  qp_zphi2pix(mem, nside, &z, &phi, &pix, 1);
   return pix;
 }
 
 void qp_radec2pixn(qp_memory_t *mem, double *ra, double *dec,
                    int nside, long *pix, int n) {
-  for (int ii = 0; ii < n; ii++) {
-    pix[ii] = qp_radec2pix(mem, ra[ii], dec[ii], nside);
-  }
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    double z[QP_PIX_BLOCK], phi[QP_PIX_BLOCK];
+    for (int i0 = start; i0 < end; i0 += QP_PIX_BLOCK) {
+      int nb = (end - i0 < QP_PIX_BLOCK) ? end - i0 : QP_PIX_BLOCK;
+      for (int jj = 0; jj < nb; jj++) {
+        z[jj] = cos(M_PI_2 - deg2rad(dec[i0 + jj]));
+        phi[jj] = deg2rad(ra[i0 + jj]);
+      }
+      qp_zphi2pix(memloc, nside, z, phi, pix + i0, nb);
+    }
+  );
 }
 
 void qp_init_gal(qp_memory_t *mem) {
@@ -52,9 +194,9 @@ void qp_gal2radec_quat(qp_memory_t *mem, quat_t q) {
 }
 
 void qp_radec2gal_quatn(qp_memory_t *mem, quat_t *q, int n) {
-  for (int ii=0; ii<n; ii++) {
-    qp_radec2gal_quat(mem, q[ii]);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_radec2gal_quat(memloc, q[ii]);
+  );
 }
 
 void qp_radec2gal(qp_memory_t *mem, double *ra, double *dec,
@@ -75,22 +217,22 @@ void qp_radecpa2gal(qp_memory_t *mem, double *ra, double *dec,
 
 void qp_radec2galn(qp_memory_t *mem, double *ra, double *dec,
                    double *sin2psi, double *cos2psi, int n) {
-  for (int ii=0; ii<n; ii++) {
-    qp_radec2gal(mem, ra+ii, dec+ii, sin2psi+ii, cos2psi+ii);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_radec2gal(memloc, ra+ii, dec+ii, sin2psi+ii, cos2psi+ii);
+  );
 }
 
 void qp_radecpa2galn(qp_memory_t *mem, double *ra, double *dec,
                      double *pa, int n) {
-  for (int ii=0; ii<n; ii++) {
-    qp_radecpa2gal(mem, ra+ii, dec+ii, pa+ii);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_radecpa2gal(memloc, ra+ii, dec+ii, pa+ii);
+  );
 }
 
 void qp_gal2radec_quatn(qp_memory_t *mem, quat_t *q, int n) {
-  for (int ii=0; ii<n; ii++) {
-    qp_gal2radec_quat(mem, q[ii]);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_gal2radec_quat(memloc, q[ii]);
+  );
 }
 
 void qp_gal2radec(qp_memory_t *mem, double *ra, double *dec,
@@ -111,136 +253,537 @@ void qp_gal2radecpa(qp_memory_t *mem, double *ra, double *dec,
 
 void qp_gal2radecn(qp_memory_t *mem, double *ra, double *dec,
                    double *sin2psi, double *cos2psi, int n) {
-  for (int ii=0; ii<n; ii++) {
-    qp_gal2radec(mem, ra+ii, dec+ii, sin2psi+ii, cos2psi+ii);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_gal2radec(memloc, ra+ii, dec+ii, sin2psi+ii, cos2psi+ii);
+  );
 }
 
 void qp_gal2radecpan(qp_memory_t *mem, double *ra, double *dec,
                      double *pa, int n) {
-  for (int ii=0; ii<n; ii++) {
-    qp_gal2radecpa(mem, ra+ii, dec+ii, pa+ii);
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_gal2radecpa(memloc, ra+ii, dec+ii, pa+ii);
+  );
+}
+
+/* Coordinate frames */
+
+/* J2000 mean obliquity of the ecliptic (IAU 2006), degrees */
+#define QP_OBLIQUITY_J2000 (84381.406 / 3600.)
+
+/* Register the predefined frames */
+static void qp_init_frames(qp_memory_t *mem) {
+  if (mem->num_frames > 0)
+    return;
+
+  qp_frame_t *f = mem->frames;
+
+  f[0].name = 'C';
+  Quaternion_identity(f[0].q);
+
+  qp_init_gal(mem);
+  f[1].name = 'G';
+  Quaternion_copy(f[1].q, mem->q_gal);
+
+  /* ecliptic pole, with the celestial pole at ecliptic longitude 90 deg */
+  f[2].name = 'E';
+  qp_radecpa2quat(mem, 270, 90 - QP_OBLIQUITY_J2000, 90, f[2].q);
+
+  mem->num_frames = 3;
+}
+
+static qp_frame_t * qp_find_frame(qp_memory_t *mem, char name) {
+  qp_init_frames(mem);
+  for (int ii = 0; ii < mem->num_frames; ii++)
+    if (mem->frames[ii].name == name)
+      return mem->frames + ii;
+  return NULL;
+}
+
+int qp_set_frame(qp_memory_t *mem, char name, quat_t q) {
+  qp_frame_t *f = qp_find_frame(mem, name);
+
+  if (qp_check_error(mem, name == 'C' || name == 'G' || name == 'E',
+                     QP_ERROR_INIT,
+                     "qp_set_frame: cannot redefine a predefined frame"))
+    return mem->error_code;
+
+  if (f == NULL) {
+    if (qp_check_error(mem, mem->num_frames >= QP_MAX_FRAMES, QP_ERROR_INIT,
+                       "qp_set_frame: too many frames"))
+      return mem->error_code;
+    f = mem->frames + mem->num_frames++;
+    f->name = name;
+  }
+
+  Quaternion_copy(f->q, q);
+  Quaternion_unit(f->q);
+  return 0;
+}
+
+int qp_set_frame_center(qp_memory_t *mem, char name, double ra, double dec,
+                        double pa) {
+  quat_t q, q0;
+
+  qp_radecpa2quat(mem, ra, dec, pa, q);
+  qp_radecpa2quat(mem, 0, 0, 0, q0);
+  Quaternion_inv(q0);
+  Quaternion_mul_right(q, q0);
+  return qp_set_frame(mem, name, q);
+}
+
+int qp_get_frame(qp_memory_t *mem, char name, quat_t q) {
+  qp_frame_t *f = qp_find_frame(mem, name);
+
+  if (qp_check_error(mem, f == NULL, QP_ERROR_INIT,
+                     "qp_get_frame: unknown coordinate frame"))
+    return mem->error_code;
+
+  Quaternion_copy(q, f->q);
+  return 0;
+}
+
+int qp_frame_quat(qp_memory_t *mem, char coord_in, char coord_out,
+                  quat_t q) {
+  quat_t q_out;
+
+  if (qp_get_frame(mem, coord_in, q) || qp_get_frame(mem, coord_out, q_out))
+    return mem->error_code;
+
+  /* to celestial from the input frame, then to the output frame */
+  Quaternion_inv(q_out);
+  Quaternion_mul_left(q_out, q);
+  return 0;
+}
+
+int qp_rotate_quatn(qp_memory_t *mem, char coord_in, char coord_out,
+                    quat_t *q, int n) {
+  quat_t q_rot;
+
+  if (qp_frame_quat(mem, coord_in, coord_out, q_rot))
+    return mem->error_code;
+
+  int num_threads = qp_sample_threads(mem, n);
+#pragma omp parallel for num_threads(num_threads)
+  for (int ii = 0; ii < n; ii++)
+    Quaternion_mul_left(q_rot, q[ii]);
+  return 0;
+}
+
+int qp_rotate_coordn(qp_memory_t *mem, char coord_in, char coord_out,
+                     double *ra, double *dec, double *sin2psi,
+                     double *cos2psi, int n) {
+  quat_t q_rot;
+
+  if (qp_frame_quat(mem, coord_in, coord_out, q_rot))
+    return mem->error_code;
+
+  QP_SAMPLE_LOOP(mem, n, ii,
+    quat_t q;
+    qp_radec2quat(memloc, ra[ii], dec[ii], sin2psi[ii], cos2psi[ii], q);
+    Quaternion_mul_left(q_rot, q);
+    qp_quat2radec(memloc, q, ra + ii, dec + ii, sin2psi + ii, cos2psi + ii);
+  );
+  return 0;
+}
+
+int qp_rotate_coordpan(qp_memory_t *mem, char coord_in, char coord_out,
+                       double *ra, double *dec, double *pa, int n) {
+  quat_t q_rot;
+
+  if (qp_frame_quat(mem, coord_in, coord_out, q_rot))
+    return mem->error_code;
+
+  QP_SAMPLE_LOOP(mem, n, ii,
+    quat_t q;
+    qp_radecpa2quat(memloc, ra[ii], dec[ii], pa[ii], q);
+    Quaternion_mul_left(q_rot, q);
+    qp_quat2radecpa(memloc, q, ra + ii, dec + ii, pa + ii);
+  );
+  return 0;
+}
+
+/* Map rotation plans */
+
+/* Compute the stencil and polarization rotation for output pixel pix,
+   stored at index idx of the plan */
+static void qp_rotate_plan_pixel(qp_memory_t *mem, qp_rotate_plan_t *plan,
+                                 quat_t q_rot, qp_pixinfo_t *pixinfo,
+                                 qp_pixhash_t *pixhash, long pix,
+                                 size_t idx) {
+  int ns = plan->nstencil;
+  int32_t *p = plan->pix + idx * ns;
+  float *w = plan->weight + idx * ns;
+  double theta, phi, ra, dec, sin2psi, cos2psi;
+  double weight[4] = {1, 0, 0, 0};
+  long ipix[4];
+  quat_t q;
+  int jj;
+
+  /* input coordinates of the output pixel center */
+  if (plan->pix_order == QP_ORDER_NEST)
+    pix2ang_nest(plan->nside, pix, &theta, &phi);
+  else
+    pix2ang_ring(plan->nside, pix, &theta, &phi);
+  qp_radec2quat(mem, rad2deg(phi), rad2deg(M_PI_2 - theta), 0, 1, q);
+  Quaternion_mul_left(q_rot, q);
+  qp_quat2radec(mem, q, &ra, &dec, &sin2psi, &cos2psi);
+
+  if (ns == 4)
+    qp_get_interpol(mem, pixinfo, ra, dec, ipix, weight);
+  else
+    ipix[0] = qp_radec2pix(mem, ra, dec, plan->nside);
+
+  if (pixhash) {
+    /* drop missing neighbors and renormalize.  Missing neighbors point at
+       a good one with zero weight, so that the gather does not branch. */
+    double wtot = 0, wgood = 0;
+    int good = -1;
+    for (jj = 0; jj < ns; jj++) {
+      wtot += weight[jj];
+      ipix[jj] = qp_repixelize(pixhash, ipix[jj]);
+      if (ipix[jj] < 0) {
+        weight[jj] = 0;
+      } else {
+        wgood += weight[jj];
+        good = jj;
+      }
+    }
+    if (good < 0 || !(wgood > 0)) {
+      for (jj = 0; jj < ns; jj++) {
+        p[jj] = -1;
+        w[jj] = 0;
+      }
+      ns = 0;
+    }
+    for (jj = 0; jj < ns; jj++) {
+      if (ipix[jj] < 0)
+        ipix[jj] = ipix[good];
+      weight[jj] *= wtot / wgood;
+    }
+  }
+
+  for (jj = 0; jj < ns; jj++) {
+    p[jj] = ipix[jj];
+    w[jj] = weight[jj];
   }
+
+  /* the angle from the output to the input frame, with the sign of the
+     Stokes U rotation set by the polarization convention */
+  plan->cos2psi[idx] = cos2psi;
+  plan->sin2psi[idx] = plan->polconv ? sin2psi : -sin2psi;
+}
+
+void qp_free_rotate_plan(qp_rotate_plan_t *plan) {
+  free(plan->pix);
+  free(plan->weight);
+  free(plan->cos2psi);
+  free(plan->sin2psi);
+  if (plan->init & QP_STRUCT_MALLOC)
+    free(plan);
+  else
+    memset(plan, 0, sizeof(*plan));
+}
+
+qp_rotate_plan_t * qp_init_rotate_plan(qp_memory_t *mem, int nside,
+                                       const char coord_in,
+                                       const char coord_out,
+                                       long *pix_in, size_t npix_in,
+                                       long *pix_out, size_t npix_out) {
+  long npix = nside2npix(nside);
+  quat_t q_rot;
+
+  /* output pixel centers are rotated to the input frame */
+  if (qp_frame_quat(mem, coord_out, coord_in, q_rot))
+    return NULL;
+
+  if (pix_in == NULL)
+    npix_in = npix;
+  if (pix_out == NULL)
+    npix_out = npix;
+  if (qp_check_error(mem, npix_in > INT32_MAX, QP_ERROR_MAP,
+                     "qp_init_rotate_plan: input map too large"))
+    return NULL;
+  if (pix_out != NULL) {
+    int bad = 0;
+    for (size_t ii = 0; ii < npix_out; ii++)
+      bad |= (pix_out[ii] < 0 || pix_out[ii] >= npix);
+    if (qp_check_error(mem, bad, QP_ERROR_MAP,
+                       "qp_init_rotate_plan: output pixel out of range"))
+      return NULL;
+  }
+
+  qp_rotate_plan_t *plan = calloc(1, sizeof(*plan));
+  plan->init = QP_STRUCT_INIT | QP_STRUCT_MALLOC;
+  plan->nside = nside;
+  plan->pix_order = mem->pix_order;
+  plan->coord_in = coord_in;
+  plan->coord_out = coord_out;
+  plan->polconv = mem->polconv;
+  plan->nstencil = mem->interp_pix ? 4 : 1;
+  plan->npix_in = npix_in;
+  plan->npix_out = npix_out;
+  plan->pix = malloc(npix_out * plan->nstencil * sizeof(int32_t));
+  plan->weight = malloc(npix_out * plan->nstencil * sizeof(float));
+  plan->cos2psi = malloc(npix_out * sizeof(float));
+  plan->sin2psi = malloc(npix_out * sizeof(float));
+
+  if (!plan->pix || !plan->weight || !plan->cos2psi || !plan->sin2psi) {
+    qp_free_rotate_plan(plan);
+    qp_set_error(mem, QP_ERROR_MAP, "qp_init_rotate_plan: out of memory");
+    return NULL;
+  }
+
+  /* shared by all threads */
+  qp_pixinfo_t *pixinfo = NULL;
+  if (plan->nstencil == 4)
+    pixinfo = qp_init_pixinfo(nside, 1);
+  qp_pixhash_t *pixhash = NULL;
+  if (pix_in != NULL)
+    pixhash = qp_init_pixhash(pix_in, npix_in);
+
+#pragma omp parallel for num_threads(mem->num_threads)
+  for (size_t ii = 0; ii < npix_out; ii++)
+    qp_rotate_plan_pixel(mem, plan, q_rot, pixinfo, pixhash,
+                         (pix_out == NULL) ? (long) ii : pix_out[ii], ii);
+
+  if (pixinfo)
+    qp_free_pixinfo(pixinfo);
+  if (pixhash)
+    qp_free_pixhash(pixhash);
+
+  return plan;
+}
+
+static inline double qp_rotate_gather(qp_rotate_plan_t *plan, double *m,
+                                      size_t ii) {
+  int32_t *p = plan->pix + ii * plan->nstencil;
+  float *w = plan->weight + ii * plan->nstencil;
+
+  if (plan->nstencil == 1)
+    return m[p[0]];
+  return m[p[0]] * w[0] + m[p[1]] * w[1] + m[p[2]] * w[2] + m[p[3]] * w[3];
+}
+
+/* Rotate output pixels [start, end) of a (T, Q, U) triplet, or of a single
+   column if map_in[1] and map_in[2] are not used */
+static void qp_rotate_block(qp_rotate_plan_t *plan, double **map_in,
+                            double **map_out, int pol, size_t start,
+                            size_t end, double fill) {
+  double q, u, c, s;
+
+  for (size_t ii = start; ii < end; ii++) {
+    if (plan->pix[ii * plan->nstencil] < 0) {
+      map_out[0][ii] = fill;
+      if (pol) {
+        map_out[1][ii] = fill;
+        map_out[2][ii] = fill;
+      }
+      continue;
+    }
+
+    map_out[0][ii] = qp_rotate_gather(plan, map_in[0], ii);
+    if (!pol)
+      continue;
+
+    q = qp_rotate_gather(plan, map_in[1], ii);
+    u = qp_rotate_gather(plan, map_in[2], ii);
+    c = plan->cos2psi[ii];
+    s = plan->sin2psi[ii];
+    map_out[1][ii] = q * c + u * s;
+    map_out[2][ii] = u * c - q * s;
+  }
+}
+
+int qp_apply_rotate_plan(qp_memory_t *mem, qp_rotate_plan_t *plan,
+                         double **map_in, double **map_out, int ncol,
+                         int pol) {
+  if (qp_check_error(mem, !plan->init, QP_ERROR_INIT,
+                     "qp_apply_rotate_plan: plan not initialized."))
+    return mem->error_code;
+  if (qp_check_error(mem, pol && (ncol % 3), QP_ERROR_MAP,
+                     "qp_apply_rotate_plan: polarized maps need 3 columns "
+                     "per map"))
+    return mem->error_code;
+
+  double fill = mem->nan_missing ? 0.0 / 0.0 : 0.0;
+  int step = pol ? 3 : 1;
+  size_t nblock = (plan->npix_out + QP_PIX_BLOCK - 1) / QP_PIX_BLOCK;
+  int num_threads = mem->num_threads;
+  if ((size_t) num_threads > nblock)
+    num_threads = nblock > 0 ? nblock : 1;
+
+  /* each block of output pixels is rotated for all columns, so that its
+     part of the plan is read from memory once */
+#pragma omp parallel for num_threads(num_threads) schedule(static)
+  for (size_t ib = 0; ib < nblock; ib++) {
+    size_t start = ib * QP_PIX_BLOCK;
+    size_t end = start + QP_PIX_BLOCK;
+    if (end > plan->npix_out)
+      end = plan->npix_out;
+    for (int kk = 0; kk < ncol; kk += step)
+      qp_rotate_block(plan, map_in + kk, map_out + kk, pol, start, end,
+                      fill);
+  }
+
+  return 0;
 }
 
 void qp_rotate_map(qp_memory_t *mem, int nside,
                    double **map_in, const char coord_in,
                    double **map_out, const char coord_out) {
-  long npix = 12 * nside * nside;
-  long pix, ipix[4];
-  double ra, dec, sin2psi, cos2psi;
-  double t, q, u, weight[4];
-
   /* check inputs */
-  if (!(coord_in == 'C' || coord_in == 'G'))
-    return;
-  if (!(coord_out == 'C' || coord_out == 'G'))
-    return;
   if (coord_in == coord_out)
     return;
 
-  /* initialize */
-  qp_init_gal(mem);
-  qp_pixinfo_t *pixinfo = qp_init_pixinfo(nside, 1);
+  qp_rotate_plan_t *plan = qp_init_rotate_plan(mem, nside, coord_in,
+                                               coord_out, NULL, 0, NULL, 0);
+  if (plan == NULL)
+    return;
+  qp_apply_rotate_plan(mem, plan, map_in, map_out, 3, 1);
+  qp_free_rotate_plan(plan);
+}
 
-#pragma omp parallel for private(pix, ipix, weight, ra, dec, sin2psi, cos2psi, t, q, u)
-  for (long ii=0; ii<npix; ii++) {
-    /* ra/dec of output pixel */
-    if (mem->pix_order == QP_ORDER_NEST)
-      pix2ang_nest(nside, ii, &dec, &ra);
-    else
-      pix2ang_ring(nside, ii, &dec, &ra);
-    dec = rad2deg(M_PI_2 - dec);
-    ra = rad2deg(ra);
-    sin2psi = 0;
-    cos2psi = 1;
-
-    /* find corresponding input pixel */
-    if (coord_in == 'C' && coord_out == 'G') {
-      qp_gal2radec(mem, &ra, &dec, &sin2psi, &cos2psi);
-    } else if (coord_in == 'G' && coord_out == 'C') {
-      qp_radec2gal(mem, &ra, &dec, &sin2psi, &cos2psi);
-    }
+static int qp_check_nest_nside(qp_memory_t *mem, int nside,
+                               const char *msg) {
+  return qp_check_error(mem, nside <= 0 || (nside & (nside - 1)),
+                        QP_ERROR_MAP, msg);
+}
 
-    if (mem->interp_pix) {
-      qp_get_interpol(mem, pixinfo, ra, dec, ipix, weight);
-      /* rotate input pixel to output pixel */
-      t = q = u = 0;
-      for (int jj = 0; jj < 4; jj++) {
-        t += map_in[0][ipix[jj]] * weight[jj];
-        q += map_in[1][ipix[jj]] * weight[jj];
-        u += map_in[2][ipix[jj]] * weight[jj];
-      }
-    } else {
-      pix = qp_radec2pix(mem, ra, dec, nside);
-      t = map_in[0][pix];
-      q = map_in[1][pix];
-      u = map_in[2][pix];
+int qp_reorder_map(qp_memory_t *mem, int nside, double **map, int ncol,
+                   int nest) {
+  if (qp_check_nest_nside(mem, nside, "qp_reorder_map: nside must be a "
+                          "power of 2"))
+    return mem->error_code;
+
+  size_t npix = nside2npix(nside);
+  long *perm = malloc(npix * sizeof(*perm));
+  double *buf = malloc(npix * sizeof(*buf));
+
+  if (qp_check_error(mem, perm == NULL || buf == NULL, QP_ERROR_MAP,
+                     "qp_reorder_map: out of memory")) {
+    free(perm);
+    free(buf);
+    return mem->error_code;
+  }
+
+  /* source index of each pixel in the new ordering, so that each column
+     is reordered by a gather through a single scratch column */
+#pragma omp parallel num_threads(mem->num_threads)
+  {
+#pragma omp for schedule(static)
+    for (size_t ii = 0; ii < npix; ii++) {
+      if (nest)
+        nest2ring(nside, ii, perm + ii);
+      else
+        ring2nest(nside, ii, perm + ii);
     }
 
-    if (t == 0 && q == 0 && u == 0) continue;
-    cos2psi = 1.;
-    sin2psi = 0.;
-    if (coord_in == 'C' && coord_out == 'G') {
-      qp_radec2gal(mem, &ra, &dec, &sin2psi, &cos2psi);
-    } else if (coord_in == 'G' && coord_out == 'C') {
-      qp_gal2radec(mem, &ra, &dec, &sin2psi, &cos2psi);
+    for (int kk = 0; kk < ncol; kk++) {
+      double *m = map[kk];
+#pragma omp for schedule(static)
+      for (size_t ii = 0; ii < npix; ii++)
+        buf[ii] = m[perm[ii]];
+#pragma omp for schedule(static)
+      for (size_t ii = 0; ii < npix; ii++)
+        m[ii] = buf[ii];
     }
-    map_out[0][ii] = t;
-    map_out[1][ii] = q * cos2psi + u * sin2psi;
-    map_out[2][ii] = u * cos2psi - q * sin2psi;
   }
 
-  qp_free_pixinfo(pixinfo);
+  free(perm);
+  free(buf);
+  return 0;
 }
 
-/* Compute pixel number and pol angle given nside and quaternion */
-void qp_quat2pix(qp_memory_t *mem, quat_t q, int nside, long *pix,
-                 double *sin2psi, double *cos2psi) {
-  if (mem->fast_pix) {
-    vec3_t vec;
-    Quaternion_to_matrix_col3(q, vec);
-    if (mem->pix_order == QP_ORDER_NEST)
-      vec2pix_nest(nside, vec, pix);
-    else
-      vec2pix_ring(nside, vec, pix);
+/* Index of nest pixel ipnest in the current pixel ordering */
+static inline long qp_nest2order(qp_memory_t *mem, long nside, long ipnest) {
+  long ipix = ipnest;
+  if (mem->pix_order == QP_ORDER_RING)
+    nest2ring(nside, ipnest, &ipix);
+  return ipix;
+}
 
-    double cosb2 = (1 - vec[2] * vec[2]) / 4.;
-    double norm, cosg, sing;
-    if (cosb2 < DBL_EPSILON) {
-      if (vec[2] > 0) {
-        cosg = q[3] * q[3] - q[0] * q[0];
-        sing = 2 * q[0] * q[3];
-      } else {
-        cosg = q[1] * q[1] - q[2] * q[2];
-        sing = 2 * q[1] * q[2];
+/* Nest index of pixel ipix in the current pixel ordering */
+static inline long qp_order2nest(qp_memory_t *mem, long nside, long ipix) {
+  long ipnest = ipix;
+  if (mem->pix_order == QP_ORDER_RING)
+    ring2nest(nside, ipix, &ipnest);
+  return ipnest;
+}
+
+int qp_ud_grade_map(qp_memory_t *mem, int nside_in, double **map_in,
+                    int nside_out, double **map_out, int ncol,
+                    double *weight, int sum) {
+  if (qp_check_nest_nside(mem, nside_in, "qp_ud_grade_map: nside_in must "
+                          "be a power of 2"))
+    return mem->error_code;
+  if (qp_check_nest_nside(mem, nside_out, "qp_ud_grade_map: nside_out must "
+                          "be a power of 2"))
+    return mem->error_code;
+
+  size_t npix_out = nside2npix(nside_out);
+  double fill = mem->nan_missing ? 0.0 / 0.0 : 0.0;
+
+  if (nside_out <= nside_in) {
+    /* degrade: combine the subpixels of each output pixel, which are
+       consecutive in nest ordering */
+    long ratio = (long) (nside_in / nside_out) * (nside_in / nside_out);
+#pragma omp parallel num_threads(mem->num_threads)
+    {
+      long ipix[QP_PIX_BLOCK];
+#pragma omp for schedule(static)
+      for (size_t ii = 0; ii < npix_out; ii++) {
+        long ipnest = qp_order2nest(mem, nside_out, ii) * ratio;
+        double wsum = 0;
+        for (long j0 = 0; j0 < ratio; j0 += QP_PIX_BLOCK) {
+          long nb = (ratio - j0 < QP_PIX_BLOCK) ? ratio - j0 : QP_PIX_BLOCK;
+          for (long jj = 0; jj < nb; jj++)
+            ipix[jj] = qp_nest2order(mem, nside_in, ipnest + j0 + jj);
+          for (long jj = 0; jj < nb; jj++)
+            wsum += weight ? weight[ipix[jj]] : 1;
+          for (int kk = 0; kk < ncol; kk++) {
+            double v = (j0 == 0) ? 0 : map_out[kk][ii];
+            for (long jj = 0; jj < nb; jj++)
+              v += weight ? weight[ipix[jj]] * map_in[kk][ipix[jj]] :
+                map_in[kk][ipix[jj]];
+            map_out[kk][ii] = v;
+          }
+        }
+        if (sum)
+          continue;
+        for (int kk = 0; kk < ncol; kk++)
+          map_out[kk][ii] = (wsum != 0) ? map_out[kk][ii] / wsum : fill;
       }
-      norm = 2 * cosg;
-    } else {
-      cosg = q[1] * q[3] - q[0] * q[2];
-      sing = q[0] * q[1] + q[2] * q[3];
-      norm = 2. * cosg / cosb2;
     }
-    *sin2psi = norm * sing;
-    *cos2psi = norm * cosg - 1;
   } else {
-    double ra, dec;
-    qp_quat2radec(mem, q, &ra, &dec, sin2psi, cos2psi);
-    *pix = qp_radec2pix(mem, ra, dec, nside);
+    /* upgrade: each output pixel takes the value of its parent */
+    long ratio = (long) (nside_out / nside_in) * (nside_out / nside_in);
+    double norm = sum ? 1.0 / ratio : 1.0;
+#pragma omp parallel for num_threads(mem->num_threads) schedule(static)
+    for (size_t ii = 0; ii < npix_out; ii++) {
+      long ipnest = qp_order2nest(mem, nside_out, ii) / ratio;
+      long ipix = qp_nest2order(mem, nside_in, ipnest);
+      for (int kk = 0; kk < ncol; kk++)
+        map_out[kk][ii] = norm * map_in[kk][ipix];
+    }
   }
+
+  return 0;
 }
 
-void qp_quat2pixpa(qp_memory_t *mem, quat_t q, int nside, long *pix, double *pa) {
+/* Compute the healpix z = cos(theta) and phi for a quaternion, along with
+   either its pol angle pa (if pa is not NULL) or sin2psi and cos2psi */
+static inline void qp_quat2zphi(qp_memory_t *mem, quat_t q, double *z,
+                                double *phi, double *sin2psi,
+                                double *cos2psi, double *pa) {
   if (mem->fast_pix) {
     vec3_t vec;
     Quaternion_to_matrix_col3(q, vec);
-    if (mem->pix_order == QP_ORDER_NEST)
-      vec2pix_nest(nside, vec, pix);
-    else
-      vec2pix_ring(nside, vec, pix);
+    double vlen = sqrt(vec[0] * vec[0] + vec[1] * vec[1] + vec[2] * vec[2]);
+    *z = vec[2] / vlen;
+    *phi = atan2(vec[1], vec[0]);
 
     double cosb2 = (1 - vec[2] * vec[2]) / 4.;
-    double cosg, sing;
+    double norm, cosg, sing;
     if (cosb2 < DBL_EPSILON) {
       if (vec[2] > 0) {
         cosg = q[3] * q[3] - q[0] * q[0];
@@ -249,76 +792,235 @@ void qp_quat2pixpa(qp_memory_t *mem, quat_t q, int nside, long *pix, double *pa)
         cosg = q[1] * q[1] - q[2] * q[2];
         sing = 2 * q[1] * q[2];
       }
+      norm = 2 * cosg;
     } else {
       cosg = q[1] * q[3] - q[0] * q[2];
       sing = q[0] * q[1] + q[2] * q[3];
+      norm = 2. * cosg / cosb2;
     }
 
-    if (mem->fast_math) {
-      *pa = rad2deg(poly_atan2(sing, cosg));
+    if (pa) {
+      if (mem->fast_math) {
+        *pa = rad2deg(poly_atan2(sing, cosg));
+      } else {
+        *pa = rad2deg(atan2(sing, cosg));
+      }
     } else {
-      *pa = rad2deg(atan2(sing, cosg));
+      *sin2psi = norm * sing;
+      *cos2psi = norm * cosg - 1;
     }
   } else {
     double ra, dec;
-    qp_quat2radecpa(mem, q, &ra, &dec, pa);
-    *pix = qp_radec2pix(mem, ra, dec, nside);
+    if (pa)
+      qp_quat2radecpa(mem, q, &ra, &dec, pa);
+    else
+      qp_quat2radec(mem, q, &ra, &dec, sin2psi, cos2psi);
+    *z = cos(M_PI_2 - deg2rad(dec));
+    *phi = deg2rad(ra);
   }
 }
 
+/* Compute pixel numbers and pol angles for n quaternions, in blocks of
+   QP_PIX_BLOCK samples.  The pol angle is returned in pa if it is not
+   NULL, otherwise in sin2psi and cos2psi. */
+static void qp_quat2pix_block(qp_memory_t *mem, quat_t *q, int nside,
+                              long *pix, double *sin2psi, double *cos2psi,
+                              double *pa, int n) {
+  double z[QP_PIX_BLOCK], phi[QP_PIX_BLOCK];
+
+  for (int i0 = 0; i0 < n; i0 += QP_PIX_BLOCK) {
+    int nb = (n - i0 < QP_PIX_BLOCK) ? n - i0 : QP_PIX_BLOCK;
+    for (int jj = 0, ii = i0; jj < nb; jj++, ii++) {
+      if (pa)
+        qp_quat2zphi(mem, q[ii], z + jj, phi + jj, NULL, NULL, pa + ii);
+      else
+        qp_quat2zphi(mem, q[ii], z + jj, phi + jj, sin2psi + ii,
+                     cos2psi + ii, NULL);
+    }
+    qp_zphi2pix(mem, nside, z, phi, pix + i0, nb);
+  }
+}
+
+/* Compute pixel number and pol angle given nside and quaternion */
+void qp_quat2pix(qp_memory_t *mem, quat_t q, int nside, long *pix,
+                 double *sin2psi, double *cos2psi) {
+  double z, phi;
+  qp_quat2zphi(mem, q, &z, &phi, sin2psi, cos2psi, NULL);
+  qp_zphi2pix(mem, nside, &z, &phi, pix, 1);
+}
+
+void qp_quat2pixpa(qp_memory_t *mem, quat_t q, int nside, long *pix, double *pa) {
+  double z, phi;
+  qp_quat2zphi(mem, q, &z, &phi, NULL, NULL, pa);
+  qp_zphi2pix(mem, nside, &z, &phi, pix, 1);
+}
+
 void qp_quat2pixn(qp_memory_t *mem, quat_t *q, int nside, long *pix,
                   double *sin2psi, double *cos2psi, int n) {
-  for (int ii = 0; ii < n; ii++) {
-    qp_quat2pix(mem, q[ii], nside, pix+ii, sin2psi+ii, cos2psi+ii);
-  }
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    qp_quat2pix_block(memloc, q + start, nside, pix + start, sin2psi + start,
+                      cos2psi + start, NULL, end - start);
+  );
 }
 
 void qp_quat2pixpan(qp_memory_t *mem, quat_t *q, int nside, long *pix,
                   double *pa, int n) {
-  for (int ii = 0; ii < n; ii++) {
-    qp_quat2pixpa(mem, q[ii], nside, pix+ii, pa+ii);
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    qp_quat2pix_block(memloc, q + start, nside, pix + start, NULL, NULL,
+                      pa + start, end - start);
+  );
+}
+
+/* Map index of the grid pixel containing projected coordinates (x, y),
+   or -1 if outside the grid */
+static inline long qp_grid_index(qp_grid_t *grid, double x, double y) {
+  double fx = (x - grid->x0) / grid->dx + 0.5;
+  double fy = (y - grid->y0) / grid->dy + 0.5;
+
+  if (!(fx >= 0 && fx < grid->nx && fy >= 0 && fy < grid->ny))
+    return -1;
+  return (long) fy * grid->nx + (long) fx;
+}
+
+/* Compute the grid map index and pol angle for a quaternion */
+static inline long qp_quat2grid(qp_memory_t *mem, qp_grid_t *grid, quat_t q,
+                                double *sin2psi, double *cos2psi) {
+  double ra, dec, x, y;
+
+  qp_quat2radec(mem, q, &ra, &dec, sin2psi, cos2psi);
+
+  if (grid->type == QP_GRID_TAN) {
+    quat_t qr;
+    vec3_t v;
+    Quaternion_mul(qr, grid->q_center, q);
+    Quaternion_to_matrix_col3(qr, v);
+    // no projection for the far hemisphere
+    if (!(v[0] > 0))
+      return -1;
+    x = rad2deg(v[1] / v[0]);
+    y = rad2deg(v[2] / v[0]);
+  } else {
+    x = ra - grid->ra0;
+    x -= 360. * floor((x + 180.) / 360.);
+    y = dec - grid->dec0;
   }
+
+  return qp_grid_index(grid, x, y);
 }
 
-void qp_bore2pix(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
-                 int nside, long *pix, double *sin2psi, double *cos2psi, int n) {
-  quat_t q;
+void qp_quat2gridn(qp_memory_t *mem, qp_grid_t *grid, quat_t *q, long *pix,
+                   double *sin2psi, double *cos2psi, int n) {
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    for (int ii = start; ii < end; ii++)
+      pix[ii] = qp_quat2grid(memloc, grid, q[ii], sin2psi + ii, cos2psi + ii);
+  );
+}
 
-  for (int ii = 0; ii < n; ii++) {
-    qp_bore2det(mem, q_off, ctime[ii], q_bore[ii], q);
-    qp_quat2pix(mem, q, nside, pix+ii, sin2psi+ii, cos2psi+ii);
+/* Pointing for samples [start, end) of a detector timestream, with the
+   detector quaternions computed one block at a time and pixelized by the
+   batched kernel.  q_hwp may be NULL.  The pol angle is returned in pa if
+   it is not NULL, otherwise in sin2psi and cos2psi. */
+static void qp_bore2pix_range(qp_memory_t *mem, quat_t q_off, double *ctime,
+                              quat_t *q_bore, quat_t *q_hwp, int nside,
+                              long *pix, double *sin2psi, double *cos2psi,
+                              double *pa, int start, int end) {
+  quat_t q[QP_PIX_BLOCK];
+
+  for (int i0 = start; i0 < end; i0 += QP_PIX_BLOCK) {
+    int nb = (end - i0 < QP_PIX_BLOCK) ? end - i0 : QP_PIX_BLOCK;
+    for (int jj = 0, ii = i0; jj < nb; jj++, ii++) {
+      if (q_hwp == NULL)
+        qp_bore2det(mem, q_off, ctime[ii], q_bore[ii], q[jj]);
+      else
+        qp_bore2det_hwp(mem, q_off, ctime[ii], q_bore[ii], q_hwp[ii], q[jj]);
+    }
+    qp_quat2pix_block(mem, q, nside, pix + i0,
+                      pa ? NULL : sin2psi + i0, pa ? NULL : cos2psi + i0,
+                      pa ? pa + i0 : NULL, nb);
   }
 }
 
+void qp_bore2pix(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
+                 int nside, long *pix, double *sin2psi, double *cos2psi, int n) {
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    qp_bore2pix_range(memloc, q_off, ctime, q_bore, NULL, nside, pix,
+                      sin2psi, cos2psi, NULL, start, end);
+  );
+}
+
 void qp_bore2pixpa(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
                    int nside, long *pix, double *pa, int n) {
-  quat_t q;
-
-  for (int ii = 0; ii < n; ii++) {
-    qp_bore2det(mem, q_off, ctime[ii], q_bore[ii], q);
-    qp_quat2pixpa(mem, q, nside, pix+ii, pa+ii);
-  }
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    qp_bore2pix_range(memloc, q_off, ctime, q_bore, NULL, nside, pix,
+                      NULL, NULL, pa, start, end);
+  );
 }
 
 void qp_bore2pix_hwp(qp_memory_t *mem, quat_t q_off, double *ctime,
                      quat_t *q_bore, quat_t *q_hwp, int nside, long *pix,
                      double *sin2psi, double *cos2psi, int n) {
-  quat_t q;
-
-  for (int ii = 0; ii < n; ii++) {
-    qp_bore2det_hwp(mem, q_off, ctime[ii], q_bore[ii], q_hwp[ii], q);
-    qp_quat2pix(mem, q, nside, pix+ii, sin2psi+ii, cos2psi+ii);
-  }
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    qp_bore2pix_range(memloc, q_off, ctime, q_bore, q_hwp, nside, pix,
+                      sin2psi, cos2psi, NULL, start, end);
+  );
 }
 
 void qp_bore2pixpa_hwp(qp_memory_t *mem, quat_t q_off, double *ctime,
                        quat_t *q_bore, quat_t *q_hwp, int nside, long *pix,
                        double *pa, int n) {
-  quat_t q;
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    qp_bore2pix_range(memloc, q_off, ctime, q_bore, q_hwp, nside, pix,
+                      NULL, NULL, pa, start, end);
+  );
+}
 
-  for (int ii = 0; ii < n; ii++) {
-    qp_bore2det_hwp(mem, q_off, ctime[ii], q_bore[ii], q_hwp[ii], q);
-    qp_quat2pixpa(mem, q, nside, pix+ii, pa+ii);
+void qp_bore2pix_ndet(qp_memory_t *mem, quat_t *q_off, int ndet, double *ctime,
+                      quat_t *q_bore, quat_t *q_hwp, int nside, long *pix,
+                      double *sin2psi, double *cos2psi, int n) {
+
+#pragma omp parallel num_threads(qp_ndet_threads(mem, ndet))
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    size_t off;
+
+#pragma omp for
+    for (int idet = 0; idet < ndet; idet++) {
+      off = (size_t) idet * n;
+      if (q_hwp == NULL)
+        qp_bore2pix(memloc, q_off[idet], ctime, q_bore, nside, pix + off,
+                    sin2psi + off, cos2psi + off, n);
+      else
+        qp_bore2pix_hwp(memloc, q_off[idet], ctime, q_bore, q_hwp, nside,
+                        pix + off, sin2psi + off, cos2psi + off, n);
+    }
+
+    qp_merge_error(mem, memloc, NULL);
+    qp_free_memory(memloc);
+  }
+}
+
+void qp_bore2pixpa_ndet(qp_memory_t *mem, quat_t *q_off, int ndet, double *ctime,
+                        quat_t *q_bore, quat_t *q_hwp, int nside, long *pix,
+                        double *pa, int n) {
+
+#pragma omp parallel num_threads(qp_ndet_threads(mem, ndet))
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    size_t off;
+
+#pragma omp for
+    for (int idet = 0; idet < ndet; idet++) {
+      off = (size_t) idet * n;
+      if (q_hwp == NULL)
+        qp_bore2pixpa(memloc, q_off[idet], ctime, q_bore, nside, pix + off,
+                      pa + off, n);
+      else
+        qp_bore2pixpa_hwp(memloc, q_off[idet], ctime, q_bore, q_hwp, nside,
+                          pix + off, pa + off, n);
+    }
+
+    qp_merge_error(mem, memloc, NULL);
+    qp_free_memory(memloc);
   }
 }
 
@@ -555,13 +1257,46 @@ double qp_get_interp_val(qp_memory_t *mem, qp_pixinfo_t *pixinfo, double *map,
   }
 }
 
-void qp_get_interp_valn(qp_memory_t *mem, int nside, double *map, double *ra,
-                        double *dec, double *val, int n) {
-  qp_pixinfo_t *pixinfo = qp_init_pixinfo(nside, 0);
-
-  for (int ii = 0; ii < n; ii++) {
-    val[ii] = qp_get_interp_val(mem, pixinfo, map, ra[ii], dec[ii]);
+/* Interpolate nmap maps for a block of samples.  The stencils are computed
+   once for the block, and then gathered from each map in turn. */
+static void qp_get_interp_val_block(qp_memory_t *mem, qp_pixinfo_t *pixinfo,
+                                    double *map, size_t nmap, double *ra,
+                                    double *dec, double *val, size_t nval,
+                                    int n) {
+  long pix[QP_PIX_BLOCK][4];
+  double weight[QP_PIX_BLOCK][4];
+  double *m, *v;
+
+  for (int jj = 0; jj < n; jj++)
+    qp_get_interpol(mem, pixinfo, ra[jj], dec[jj], pix[jj], weight[jj]);
+
+  for (size_t kk = 0; kk < nmap; kk++) {
+    m = map + kk * pixinfo->npix;
+    v = val + kk * nval;
+    for (int jj = 0; jj < n; jj++)
+      v[jj] = m[pix[jj][0]] * weight[jj][0] + m[pix[jj][1]] * weight[jj][1] +
+        m[pix[jj][2]] * weight[jj][2] + m[pix[jj][3]] * weight[jj][3];
   }
+}
+
+void qp_get_interp_valn_nmap(qp_memory_t *mem, int nside, double *map,
+                             int nmap, double *ra, double *dec, double *val,
+                             int n) {
+  /* ring info is filled before the threads share it */
+  qp_pixinfo_t *pixinfo = qp_init_pixinfo(nside, 1);
+
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    for (int i0 = start; i0 < end; i0 += QP_PIX_BLOCK) {
+      int nb = (end - i0 < QP_PIX_BLOCK) ? end - i0 : QP_PIX_BLOCK;
+      qp_get_interp_val_block(memloc, pixinfo, map, nmap, ra + i0, dec + i0,
+                              val + i0, n, nb);
+    }
+  );
 
   qp_free_pixinfo(pixinfo);
 }
+
+void qp_get_interp_valn(qp_memory_t *mem, int nside, double *map, double *ra,
+                        double *dec, double *val, int n) {
+  qp_get_interp_valn_nmap(mem, nside, map, 1, ra, dec, val, n);
+}
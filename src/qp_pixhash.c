@@ -5,61 +5,204 @@
 #include "qpoint.h"
 
 /*
-  FNV-1a hash
-  Available: http://ctips.pbworks.com/w/page/7277591/FNV%20Hash
+  Pixel index for partial maps.
+
+  Partial map pixel lists are usually a few contiguous ranges of pixels, so
+  the list is scanned when the pixhash is built:
+
+  - if the pixels span a range not much larger than their number, a direct
+    offset table over the range is used, and a lookup is a subtraction and
+    a load;
+  - otherwise, if the pixels form sorted runs of consecutive pixels that are
+    long on average, a lookup is a binary search over the runs;
+  - otherwise, an open-addressing hash table is used.  Keys are mixed with a
+    multiplicative (Fibonacci) hash, whose top bits index a power-of-two
+    table kept at most half full, and collisions are resolved by linear
+    probing.
+
+  The index data are allocated with the struct in a single block.
  */
-#define FNV_PRIME_32 16777619
-#define FNV_OFFSET_32 2166136261U
-uint32_t FNV32(const char *s, size_t len) {
-  uint32_t hash = FNV_OFFSET_32;
-  for(size_t i = 0; i < len; i++) {
-    hash = hash ^ (s[i]); // xor next byte into the bottom of the hash
-    hash = hash * FNV_PRIME_32; // Multiply by prime number found to work well
+
+#define QP_PIXHASH_MULT 0x9e3779b97f4a7c15ULL
+
+/* Use a direct table if the pixel span is at most this many times the
+   number of pixels */
+#define QP_PIXHASH_MAX_SPAN 4
+
+/* Use runs if they are at least this long on average */
+#define QP_PIXHASH_MIN_RUN 16
+
+static size_t qp_pixhash_data_size(qp_pixhash_t *pixhash) {
+  switch (pixhash->mode) {
+    case QP_PIXHASH_RUNS:
+      return pixhash->nrun * sizeof(qp_pix_run_t);
+    case QP_PIXHASH_DIRECT:
+      return pixhash->span * sizeof(long);
+    default:
+      return (pixhash->mask + 1) * sizeof(qp_pix_pair_t);
+  }
+}
+
+/* Point the index arrays at the data following the struct */
+static void qp_pixhash_set_data(qp_pixhash_t *pixhash) {
+  void *data = pixhash + 1;
+
+  pixhash->slots = NULL;
+  pixhash->runs = NULL;
+  pixhash->offset = NULL;
+
+  switch (pixhash->mode) {
+    case QP_PIXHASH_RUNS:
+      pixhash->runs = data;
+      break;
+    case QP_PIXHASH_DIRECT:
+      pixhash->offset = data;
+      break;
+    default:
+      pixhash->slots = data;
+      break;
   }
-  return hash;
 }
 
-long get_hash(long key, size_t n) {
-  return FNV32((const char *) &key, sizeof(key)) % n;
-  // return SuperFastHash((const char *) &key, sizeof(key)) % n;
+static qp_pixhash_t * qp_alloc_pixhash(qp_pixhash_t *header) {
+  qp_pixhash_t *pixhash = malloc(sizeof(*pixhash) +
+                                 qp_pixhash_data_size(header));
+  if (pixhash == NULL)
+    return NULL;
+
+  memcpy(pixhash, header, sizeof(*pixhash));
+  qp_pixhash_set_data(pixhash);
+  pixhash->init = QP_STRUCT_INIT | QP_STRUCT_MALLOC;
+
+  return pixhash;
 }
 
-qp_pixhash_t * qp_init_pixhash(long *pix, size_t npix) {
-  qp_pixhash_t *pixhash = malloc(sizeof(*pixhash));
+static inline size_t qp_pixhash_slot(qp_pixhash_t *pixhash, long key) {
+  return (size_t) (((uint64_t) key * QP_PIXHASH_MULT) >> pixhash->shift);
+}
 
-  pixhash->count = npix;
-  pixhash->buckets = malloc(npix * sizeof(qp_pix_bucket_t));
-  memset(pixhash->buckets, 0, npix * sizeof(qp_pix_bucket_t));
+static void qp_fill_pixhash_hash(qp_pixhash_t *pixhash, long *pix,
+                                 size_t npix) {
+  qp_pix_pair_t *slot;
+  size_t index;
 
-  qp_pix_bucket_t *bucket;
-  qp_pix_pair_t *pair;
-  long index;
-  size_t count;
+  for (size_t ii = 0; ii <= pixhash->mask; ii++)
+    pixhash->slots[ii].key = -1;
 
   for (size_t ii = 0; ii < npix; ii++) {
-    index = get_hash(pix[ii], npix);
-    bucket = pixhash->buckets + index;
-    count = bucket->count;
-
-    if (count == 0) {
-      bucket->pairs = malloc(sizeof(qp_pix_pair_t));
-    } else {
-      bucket->pairs = realloc(bucket->pairs, (count + 1) * sizeof(qp_pix_pair_t));
+    if (pix[ii] < 0)
+      continue;
+    index = qp_pixhash_slot(pixhash, pix[ii]);
+    for (;;) {
+      slot = pixhash->slots + index;
+      if (slot->key < 0) {
+        slot->key = pix[ii];
+        slot->index = ii;
+        break;
+      }
+      // the first occurrence of a duplicate pixel wins
+      if (slot->key == pix[ii])
+        break;
+      index = (index + 1) & pixhash->mask;
     }
-    bucket->count++;
+  }
+}
 
-    pair = bucket->pairs + count;
-    pair->key = pix[ii];
-    pair->index = ii;
+static void qp_fill_pixhash_runs(qp_pixhash_t *pixhash, long *pix,
+                                 size_t npix) {
+  qp_pix_run_t *run = pixhash->runs - 1;
+
+  for (size_t ii = 0; ii < npix; ii++) {
+    if (ii > 0 && pix[ii] == pix[ii - 1] + 1) {
+      run->count++;
+      continue;
+    }
+    run++;
+    run->start = pix[ii];
+    run->count = 1;
+    run->index = ii;
   }
+}
 
-  pixhash->init = QP_STRUCT_INIT | QP_STRUCT_MALLOC;
+static void qp_fill_pixhash_direct(qp_pixhash_t *pixhash, long *pix,
+                                   size_t npix) {
+  long *offset = pixhash->offset;
+
+  for (size_t ii = 0; ii < pixhash->span; ii++)
+    offset[ii] = -1;
+
+  // the first occurrence of a duplicate pixel wins
+  for (size_t ii = npix; ii-- > 0; )
+    offset[pix[ii] - pixhash->pix0] = ii;
+}
+
+qp_pixhash_t * qp_init_pixhash(long *pix, size_t npix) {
+  qp_pixhash_t header;
+  long pmin = 0, pmax = -1;
+  size_t nrun = 0;
+  int sorted = 1, negative = 0;
+
+  memset(&header, 0, sizeof(header));
+  header.count = npix;
+
+  // scan the pixel list for its range and runs of consecutive pixels
+  for (size_t ii = 0; ii < npix; ii++) {
+    if (pix[ii] < 0) {
+      negative = 1;
+      break;
+    }
+    if (ii == 0 || pix[ii] < pmin)
+      pmin = pix[ii];
+    if (ii == 0 || pix[ii] > pmax)
+      pmax = pix[ii];
+    if (ii > 0 && pix[ii] == pix[ii - 1] + 1)
+      continue;
+    if (ii > 0 && pix[ii] <= pix[ii - 1])
+      sorted = 0;
+    nrun++;
+  }
+
+  if (!negative && npix > 0 &&
+      (size_t) (pmax - pmin) < QP_PIXHASH_MAX_SPAN * npix) {
+    header.mode = QP_PIXHASH_DIRECT;
+    header.pix0 = pmin;
+    header.span = pmax - pmin + 1;
+  } else if (!negative && sorted && nrun * QP_PIXHASH_MIN_RUN <= npix) {
+    header.mode = QP_PIXHASH_RUNS;
+    header.nrun = nrun;
+  } else {
+    size_t nslot = 2;
+    int bits = 1;
+    while (nslot < 2 * npix) {
+      nslot <<= 1;
+      bits++;
+    }
+    header.mode = QP_PIXHASH_HASH;
+    header.mask = nslot - 1;
+    header.shift = 64 - bits;
+  }
+
+  qp_pixhash_t *pixhash = qp_alloc_pixhash(&header);
+  if (pixhash == NULL)
+    return NULL;
+
+  switch (pixhash->mode) {
+    case QP_PIXHASH_RUNS:
+      qp_fill_pixhash_runs(pixhash, pix, npix);
+      break;
+    case QP_PIXHASH_DIRECT:
+      qp_fill_pixhash_direct(pixhash, pix, npix);
+      break;
+    default:
+      qp_fill_pixhash_hash(pixhash, pix, npix);
+      break;
+  }
 
 #ifdef DEBUG
+  printf("pixhash mode %d\n", pixhash->mode);
   for (size_t ii = 0; ii < npix; ii++) {
-    printf("idx %12d | pix %12ld | repix %12ld | collisions %2ld\n",
-           ii, pix[ii], qp_repixelize(pixhash, pix[ii]),
-           pixhash->buckets[ii].count);
+    printf("idx %12zu | pix %12ld | repix %12ld\n",
+           ii, pix[ii], qp_repixelize(pixhash, pix[ii]));
   }
 #endif
 
@@ -67,55 +210,91 @@ qp_pixhash_t * qp_init_pixhash(long *pix, size_t npix) {
 }
 
 qp_pixhash_t * qp_copy_pixhash(qp_pixhash_t *pixhash) {
-  qp_pixhash_t *new_hash = malloc(sizeof(new_hash));
-  qp_pix_bucket_t *bucket, *new_bucket;
+  qp_pixhash_t *new_hash = qp_alloc_pixhash(pixhash);
 
-  new_hash->count = pixhash->count;
-  new_hash->buckets = malloc(new_hash->count * sizeof(qp_pix_bucket_t));
-  memset(new_hash->buckets, 0, new_hash->count * sizeof(qp_pix_bucket_t));
+  if (new_hash == NULL)
+    return NULL;
 
-  for (size_t ii = 0; ii < new_hash->count; ii++) {
-    bucket = pixhash->buckets + ii;
-
-    if (bucket->count == 0)
-      continue;
-
-    new_bucket = new_hash->buckets + ii;
-    new_bucket->count = bucket->count;
-    new_bucket->pairs = malloc(new_bucket->count * sizeof(qp_pix_pair_t));
-    memcpy(new_bucket->pairs, bucket->pairs,
-           new_bucket->count * sizeof(qp_pix_pair_t));
-  }
-
-  new_hash->init = QP_STRUCT_INIT | QP_STRUCT_MALLOC;
+  memcpy(new_hash + 1, pixhash + 1, qp_pixhash_data_size(pixhash));
   return new_hash;
 }
 
 void qp_free_pixhash(qp_pixhash_t *pixhash) {
-  qp_pix_bucket_t * bucket;
-  if (pixhash->init & QP_STRUCT_MALLOC) {
-    for (size_t ii = 0; ii < pixhash->count; ii++) {
-      bucket = pixhash->buckets + ii;
-      if (bucket->count == 0)
-        continue;
-      free(bucket->pairs);
-    }
-    free(pixhash->buckets);
+  if (pixhash->init & QP_STRUCT_MALLOC)
     free(pixhash);
+}
+
+static inline long qp_repixelize_hash(qp_pixhash_t *pixhash, size_t index,
+                                      long pix) {
+  qp_pix_pair_t *slot;
+
+  for (;;) {
+    slot = pixhash->slots + index;
+    if (slot->key == pix)
+      return slot->index;
+    if (slot->key < 0)
+      return -1;
+    index = (index + 1) & pixhash->mask;
   }
 }
 
-long qp_repixelize(qp_pixhash_t *pixhash, long pix) {
-  long index = get_hash(pix, pixhash->count);
-  qp_pix_bucket_t *bucket = pixhash->buckets + index;
+static inline long qp_repixelize_runs(qp_pixhash_t *pixhash, long pix) {
+  qp_pix_run_t *runs = pixhash->runs;
+  size_t lo = 0, hi = pixhash->nrun, mid;
 
-  if (bucket->count == 0)
+  // last run starting at or before pix
+  while (hi - lo > 1) {
+    mid = (lo + hi) / 2;
+    if (runs[mid].start <= pix)
+      lo = mid;
+    else
+      hi = mid;
+  }
+
+  if (pix < runs[lo].start || pix >= runs[lo].start + runs[lo].count)
     return -1;
+  return runs[lo].index + (pix - runs[lo].start);
+}
 
-  for (size_t ii = 0; ii < bucket->count; ii++) {
-    if (bucket->pairs[ii].key == pix)
-      return bucket->pairs[ii].index;
+static inline long qp_repixelize_direct(qp_pixhash_t *pixhash, long pix) {
+  size_t off = (size_t) (pix - pixhash->pix0);
+  return (off < pixhash->span) ? pixhash->offset[off] : -1;
+}
+
+long qp_repixelize(qp_pixhash_t *pixhash, long pix) {
+  if (pix < 0 || pixhash->count == 0)
+    return -1;
+
+  switch (pixhash->mode) {
+    case QP_PIXHASH_RUNS:
+      return qp_repixelize_runs(pixhash, pix);
+    case QP_PIXHASH_DIRECT:
+      return qp_repixelize_direct(pixhash, pix);
+    default:
+      return qp_repixelize_hash(pixhash, qp_pixhash_slot(pixhash, pix), pix);
+  }
+}
+
+void qp_repixelizen(qp_pixhash_t *pixhash, long *pix, long *index, size_t n) {
+  size_t slot[QP_PIX_BLOCK];
+
+  if (pixhash->mode != QP_PIXHASH_HASH || pixhash->count == 0) {
+    for (size_t ii = 0; ii < n; ii++)
+      index[ii] = qp_repixelize(pixhash, pix[ii]);
+    return;
   }
 
-  return -1;
+  /* hash a block of keys and prefetch their slots before probing, so that
+     cache misses on a large table overlap */
+  for (size_t i0 = 0; i0 < n; i0 += QP_PIX_BLOCK) {
+    size_t nb = (n - i0 < QP_PIX_BLOCK) ? n - i0 : QP_PIX_BLOCK;
+    for (size_t jj = 0; jj < nb; jj++) {
+      slot[jj] = qp_pixhash_slot(pixhash, pix[i0 + jj]);
+      __builtin_prefetch(pixhash->slots + slot[jj]);
+    }
+    for (size_t jj = 0; jj < nb; jj++) {
+      long p = pix[i0 + jj];
+      index[i0 + jj] = (p < 0) ? -1 : qp_repixelize_hash(pixhash, slot[jj], p);
+    }
+  }
 }
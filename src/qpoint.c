@@ -6,6 +6,7 @@
 #include "fast_math.h"
 #include "vec3.h"
 #include "quaternion.h"
+#include <omp.h>
 
 #define _unused(x) ((void)x)
 
@@ -63,9 +64,9 @@ double qp_gmst(qp_memory_t *mem, double ctime) {
 }
 
 void qp_gmstn(qp_memory_t *mem, double *ctime, double *gmst, int n) {
-  for (int ii=0; ii<n; ii++) {
-    gmst[ii] = qp_gmst(mem, ctime[ii]);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    gmst[ii] = qp_gmst(memloc, ctime[ii]);
+  );
 }
 
 double qp_lmst(qp_memory_t *mem, double ctime, double lon) {
@@ -74,9 +75,9 @@ double qp_lmst(qp_memory_t *mem, double ctime, double lon) {
 }
 
 void qp_lmstn(qp_memory_t *mem, double *ctime, double *lon, double *lmst, int n) {
-  for (int ii=0; ii<n; ii++) {
-    lmst[ii] = qp_lmst(mem, ctime[ii], lon[ii]);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    lmst[ii] = qp_lmst(memloc, ctime[ii], lon[ii]);
+  );
 }
 
 /* Planck 2015 values (l, b) = (264.00, 48.24) */
@@ -127,14 +128,13 @@ double qp_quat2dipole(qp_memory_t *mem, double ctime, quat_t q) {
 
 void qp_bore2dipole(qp_memory_t *mem, quat_t q_off, double *ctime,
                     quat_t *q_bore, double *dipole, int n) {
-  quat_t q_det;
-
   qp_dipole_init(mem);
 
-  for (int ii = 0; ii < n; ii++) {
-    qp_bore2det(mem, q_off, ctime[ii], q_bore[ii], q_det);
-    dipole[ii] = qp_quat2dipole(mem, ctime[ii], q_det);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    quat_t q_det;
+    qp_bore2det(memloc, q_off, ctime[ii], q_bore[ii], q_det);
+    dipole[ii] = qp_quat2dipole(memloc, ctime[ii], q_det);
+  );
 }
 
 double qp_dipole(qp_memory_t *mem, double ctime, double ra, double dec) {
@@ -164,9 +164,9 @@ double qp_dipole(qp_memory_t *mem, double ctime, double ra, double dec) {
 
 void qp_dipolen(qp_memory_t *mem, double *ctime, double *ra, double *dec,
                 double *dipole, int n) {
-  for (int ii=0; ii<n; ii++) {
-    dipole[ii] = qp_dipole(mem, ctime[ii], ra[ii], dec[ii]);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    dipole[ii] = qp_dipole(memloc, ctime[ii], ra[ii], dec[ii]);
+  );
 }
 
 void qp_aberration(quat_t q, vec3_t beta, quat_t qa, int inv) {
@@ -234,6 +234,69 @@ void qp_wobble_quat(double jd_tt[2], double xp, double yp, quat_t q) {
   Quaternion_r3_mul(sprime, q);
 }
 
+/* Corrections evaluated at a single time, for interpolation.  The wobble
+   and npb corrections are taken from the correction table if loaded. */
+typedef void (*qp_corr_func_t)(qp_memory_t *mem, double ctime, quat_t q);
+
+static void qp_wobble_node(qp_memory_t *mem, double ctime, quat_t q) {
+  double jd_utc[2], jd_tt[2], dut1, x, y;
+  if (!qp_get_ephem(mem, ctime, q, NULL, NULL))
+    return;
+  ctime2jd(ctime, jd_utc);
+  qp_get_iers_bulletin_a(mem, jd2mjd(jd_utc[0]) + jd_utc[1], &dut1, &x, &y);
+  ctime2jdtt(ctime, jd_tt);
+  qp_wobble_quat(jd_tt, x, y, q);
+}
+
+static void qp_erot_node(qp_memory_t *mem, double ctime, quat_t q) {
+  double jd_utc[2], jd_ut1[2];
+  ctime2jd(ctime, jd_utc);
+  jdutc2jdut1(jd_utc, mem->dut1, jd_ut1);
+  qp_erot_quat(jd_ut1, q);
+}
+
+static void qp_npb_node(qp_memory_t *mem, double ctime, quat_t q) {
+  double jd_tt[2];
+  if (!qp_get_ephem(mem, ctime, NULL, q, NULL))
+    return;
+  ctime2jdtt(ctime, jd_tt);
+  qp_npb_quat(jd_tt, q, mem->accuracy);
+}
+
+/* Interpolate a correction between nodes spaced by the update rate of the
+   given state.  Nodes are aligned to multiples of the update rate, so that
+   the result depends only on ctime, and are recomputed only when the
+   sample leaves the current interval.  Returns the result of
+   qp_check_update for the state. */
+static int qp_interp_corr(qp_memory_t *mem, qp_state_t *state,
+                          qp_interp_t *interp, double ctime,
+                          qp_corr_func_t func, quat_t q) {
+  double rate = state->update_rate;
+  double t0 = floor(ctime / rate) * rate;
+  double t1 = t0 + rate;
+  QuaternionSlerp slerp;
+
+  // recompute nodes after a reset, or if the ut1 correction changes
+  if (state->ctime_last <= 0 || interp->dut1 != mem->dut1)
+    qp_reset_interp(interp);
+  int update = qp_check_update(state, ctime);
+
+  if (interp->ctime[0] != t0 || interp->ctime[1] != t1) {
+    if (interp->ctime[1] == t0)
+      Quaternion_copy(interp->q[0], interp->q[1]);
+    else
+      func(mem, t0, interp->q[0]);
+    func(mem, t1, interp->q[1]);
+    interp->ctime[0] = t0;
+    interp->ctime[1] = t1;
+    interp->dut1 = mem->dut1;
+  }
+
+  QuaternionSlerp_init(&slerp, interp->q[0], interp->q[1]);
+  QuaternionSlerp_interpolate(&slerp, (ctime - t0) / rate, q);
+  return update;
+}
+
 /* Calculate atmospheric refraction */
 double qp_refraction(double el, double temp, double press, double hum,
                      double freq) {
@@ -305,14 +368,20 @@ void qp_apply_diurnal_aberration(qp_memory_t *mem, double ctime, double lat,
   }
 }
 
-void qp_apply_annual_aberration(qp_memory_t *mem, double ctime, quat_t q, int inv) {
-  quat_t q_aber;
+static void qp_update_annual_aberration(qp_memory_t *mem, double ctime) {
   double jd_tt[2];
 
-  if (qp_check_update(&mem->state_aaber, ctime)) {
+  if (qp_check_update(&mem->state_aaber, ctime) &&
+      qp_get_ephem(mem, ctime, NULL, NULL, mem->beta_earth)) {
     ctime2jdtt(ctime, jd_tt);
     qp_earth_orbital_beta(jd_tt, mem->beta_earth);
   }
+}
+
+void qp_apply_annual_aberration(qp_memory_t *mem, double ctime, quat_t q, int inv) {
+  quat_t q_aber;
+
+  qp_update_annual_aberration(mem, ctime);
   if (qp_check_apply(&mem->state_aaber)) {
     qp_aberration(q, mem->beta_earth, q_aber, inv);
     Quaternion_mul_left(q_aber, q);
@@ -382,10 +451,17 @@ void qp_azel2quat(qp_memory_t *mem, double az, double el, double pitch,
   // apply wobble correction (polar motion)
   // or get dut1 from IERS bulletin
   mjd_utc = jd2mjd(jd_utc[0]) + jd_utc[1];
-  if (qp_check_update(&mem->state_wobble, ctime)) {
+  if (qp_check_interp(mem, &mem->state_wobble)) {
+    if (qp_interp_corr(mem, &mem->state_wobble, &mem->interp_wobble, ctime,
+                       qp_wobble_node, mem->q_wobble) ||
+        qp_check_update(&mem->state_dut1, ctime))
+      qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
+  } else if (qp_check_update(&mem->state_wobble, ctime)) {
     qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
-    ctime2jdtt(ctime, jd_tt);
-    qp_wobble_quat(jd_tt, x, y, mem->q_wobble);
+    if (qp_get_ephem(mem, ctime, mem->q_wobble, NULL, NULL)) {
+      ctime2jdtt(ctime, jd_tt);
+      qp_wobble_quat(jd_tt, x, y, mem->q_wobble);
+    }
 #ifdef DEBUG
     qp_print_quat("wobble", mem->q_wobble);
 #endif
@@ -399,7 +475,10 @@ void qp_azel2quat(qp_memory_t *mem, double az, double el, double pitch,
   }
 
   // apply earth rotation
-  if (qp_check_update(&mem->state_erot, ctime)) {
+  if (qp_check_interp(mem, &mem->state_erot)) {
+    qp_interp_corr(mem, &mem->state_erot, &mem->interp_erot, ctime,
+                   qp_erot_node, mem->q_erot);
+  } else if (qp_check_update(&mem->state_erot, ctime)) {
     // get ut1
     jdutc2jdut1(jd_utc, mem->dut1, jd_ut1);
     qp_erot_quat(jd_ut1, mem->q_erot);
@@ -415,9 +494,14 @@ void qp_azel2quat(qp_memory_t *mem, double az, double el, double pitch,
   }
 
   // apply nutation/precession/frame bias correction
-  if (qp_check_update(&mem->state_npb, ctime)) {
-    if (jd_tt[0] == 0) ctime2jdtt(ctime, jd_tt);
-    qp_npb_quat(jd_tt, mem->q_npb, mem->accuracy);
+  if (qp_check_interp(mem, &mem->state_npb)) {
+    qp_interp_corr(mem, &mem->state_npb, &mem->interp_npb, ctime,
+                   qp_npb_node, mem->q_npb);
+  } else if (qp_check_update(&mem->state_npb, ctime)) {
+    if (qp_get_ephem(mem, ctime, NULL, mem->q_npb, NULL)) {
+      if (jd_tt[0] == 0) ctime2jdtt(ctime, jd_tt);
+      qp_npb_quat(jd_tt, mem->q_npb, mem->accuracy);
+    }
 #ifdef DEBUG
     qp_print_quat("npb", mem->q_npb);
 #endif
@@ -442,9 +526,183 @@ void qp_azel2quat(qp_memory_t *mem, double az, double el, double pitch,
 void qp_azel2bore(qp_memory_t *mem, double *az, double *el, double *pitch,
 		  double *roll, double *lon, double *lat, double *ctime,
 		  quat_t *q, int n) {
-  for (int i=0; i<n; i++)
-    qp_azel2quat(mem, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
+  QP_SAMPLE_LOOP(mem, n, i,
+    qp_azel2quat(memloc, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
                  (roll == NULL) ? 0 : roll[i], lon[i], lat[i], ctime[i], q[i]);
+  );
+}
+
+/* Earth rotation rate, radians per second of UT1 */
+#define QP_ERA_RATE (2. * M_PI * 1.00273781191135448 / 86400.)
+/* Maximum interval between exact evaluations of the earth rotation angle */
+#define QP_ERA_NODE 3600.
+
+/* Batched version of qp_azel2bore.  The corrections are updated following
+   the same schedule as qp_azel2quat, but the rotations that vary slowly
+   (lonlat, wobble) are combined into a single quaternion that is only
+   recomputed when one of them updates, and the lonlat and diurnal
+   aberration terms are only recomputed when the observer position changes.
+   If the earth rotation is updated at every sample, the rotation angle is
+   evaluated exactly at most every QP_ERA_NODE seconds and advanced
+   linearly in between, which avoids the per-sample UTC->UT1 conversion.
+   The output agrees with qp_azel2bore to within 1e-5 arcsec, comparable
+   to the rounding error in the per-sample earth rotation angle. */
+static void qp_azel2bore_batch1(qp_memory_t *mem, double *az, double *el,
+                                double *pitch, double *roll, double *lon,
+                                double *lat, double *ctime, quat_t *q, int n) {
+
+  double jd_utc[2], jd_tt[2], jd_ut1[2], mjd_utc;
+  double x, y, clat, ct;
+  double lon_ll = NAN, lat_ll = NAN, lat_daber = NAN;
+  double era = 0, era0 = 0, ctime_era = -1, dut1_era = 0;
+  int do_era = mem->state_erot.update_rate == QP_DO_ALWAYS;
+  int do_slow = 1;
+  quat_t q_step, q_aber, q_slow;
+
+  for (int ii = 0; ii < n; ii++) {
+    ct = ctime[ii];
+    ctime2jd(ct, jd_utc);
+
+    // apply boresight rotation
+    qp_azel_quat(az[ii], el[ii], (pitch == NULL) ? 0 : pitch[ii],
+                 (roll == NULL) ? 0 : roll[ii], q_step);
+    Quaternion_mul_left(q_step, q[ii]);
+
+    // apply refraction correction
+    qp_apply_refraction(mem, ct, q[ii], 0);
+
+    // apply diurnal aberration, recomputing only if latitude changes
+    if (qp_check_update(&mem->state_daber, ct) && lat[ii] != lat_daber) {
+      if (mem->fast_math)
+        clat = poly_cos(deg2rad(lat[ii]));
+      else
+        clat = cos(deg2rad(lat[ii]));
+      mem->beta_rot[0] = mem->beta_rot[2] = 0;
+      mem->beta_rot[1] = -clat * D_ABER_RAD;
+      lat_daber = lat[ii];
+    }
+    if (qp_check_apply(&mem->state_daber)) {
+      qp_aberration(q[ii], (double *)mem->beta_rot, q_aber, 0);
+      Quaternion_mul_left(q_aber, q[ii]);
+    }
+
+    // update ITRS rotation, recomputing only if position changes
+    if (qp_check_update(&mem->state_lonlat, ct) &&
+        (lon[ii] != lon_ll || lat[ii] != lat_ll)) {
+      qp_lonlat_quat(lon[ii], lat[ii], mem->q_lonlat);
+      lon_ll = lon[ii];
+      lat_ll = lat[ii];
+      do_slow = 1;
+    }
+
+    // update wobble correction (polar motion) or dut1
+    mjd_utc = jd2mjd(jd_utc[0]) + jd_utc[1];
+    if (qp_check_interp(mem, &mem->state_wobble)) {
+      if (qp_interp_corr(mem, &mem->state_wobble, &mem->interp_wobble, ct,
+                         qp_wobble_node, mem->q_wobble) ||
+          qp_check_update(&mem->state_dut1, ct))
+        qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
+      do_slow = 1;
+    } else if (qp_check_update(&mem->state_wobble, ct)) {
+      qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
+      if (qp_get_ephem(mem, ct, mem->q_wobble, NULL, NULL)) {
+        ctime2jdtt(ct, jd_tt);
+        qp_wobble_quat(jd_tt, x, y, mem->q_wobble);
+      }
+      do_slow = 1;
+    } else if (qp_check_update(&mem->state_dut1, ct))
+      qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
+
+    // apply combined lonlat and wobble rotation
+    if (do_slow) {
+      Quaternion_identity(q_slow);
+      if (qp_check_apply(&mem->state_lonlat))
+        Quaternion_mul_left(mem->q_lonlat, q_slow);
+      if (qp_check_apply(&mem->state_wobble))
+        Quaternion_mul_left(mem->q_wobble, q_slow);
+      do_slow = 0;
+    }
+    Quaternion_mul_left(q_slow, q[ii]);
+
+    // apply earth rotation
+    if (do_era) {
+      qp_check_update(&mem->state_erot, ct);
+      if (ctime_era < 0 || ct < ctime_era || ct - ctime_era >= QP_ERA_NODE ||
+          mem->dut1 != dut1_era) {
+        jdutc2jdut1(jd_utc, mem->dut1, jd_ut1);
+        era0 = iauEra00(jd_ut1[0], jd_ut1[1]);
+        ctime_era = ct;
+        dut1_era = mem->dut1;
+      }
+      // wrap to [0, 2pi) as iauEra00 does, so the quaternion sign matches
+      era = fmod(era0 + QP_ERA_RATE * (ct - ctime_era), 2. * M_PI);
+      Quaternion_r3_mul(era, q[ii]);
+    } else {
+      if (qp_check_interp(mem, &mem->state_erot))
+        qp_interp_corr(mem, &mem->state_erot, &mem->interp_erot, ct,
+                       qp_erot_node, mem->q_erot);
+      else if (qp_check_update(&mem->state_erot, ct)) {
+        jdutc2jdut1(jd_utc, mem->dut1, jd_ut1);
+        qp_erot_quat(jd_ut1, mem->q_erot);
+      }
+      if (qp_check_apply(&mem->state_erot))
+        Quaternion_mul_left(mem->q_erot, q[ii]);
+    }
+
+    // apply nutation/precession/frame bias correction
+    if (qp_check_interp(mem, &mem->state_npb))
+      qp_interp_corr(mem, &mem->state_npb, &mem->interp_npb, ct,
+                     qp_npb_node, mem->q_npb);
+    else if (qp_check_update(&mem->state_npb, ct) &&
+             qp_get_ephem(mem, ct, NULL, mem->q_npb, NULL)) {
+      ctime2jdtt(ct, jd_tt);
+      qp_npb_quat(jd_tt, mem->q_npb, mem->accuracy);
+    }
+    if (qp_check_apply(&mem->state_npb))
+      Quaternion_mul_left(mem->q_npb, q[ii]);
+
+    // apply annual aberration
+    if (mem->mean_aber)
+      qp_apply_annual_aberration(mem, ct, q[ii], 0);
+  }
+
+  // leave the earth rotation state as qp_azel2quat would
+  if (do_era && n > 0)
+    Quaternion_r3(mem->q_erot, era);
+}
+
+void qp_azel2bore_batch(qp_memory_t *mem, double *az, double *el,
+                        double *pitch, double *roll, double *lon, double *lat,
+                        double *ctime, quat_t *q, int n) {
+  int nthreads = qp_sample_threads(mem, n);
+
+  if (nthreads == 1) {
+    qp_azel2bore_batch1(mem, az, el, pitch, roll, lon, lat, ctime, q, n);
+    return;
+  }
+
+  // first sample on the shared state, then one chunk per thread
+  qp_azel2bore_batch1(mem, az, el, pitch, roll, lon, lat, ctime, q, 1);
+
+#pragma omp parallel num_threads(nthreads)
+  {
+    int ithread = omp_get_thread_num();
+    int start = 1 + (int) ((long) (n - 1) * ithread / nthreads);
+    int end = 1 + (int) ((long) (n - 1) * (ithread + 1) / nthreads);
+    qp_memory_t *memloc = qp_init_chunk_memory(mem, ithread);
+
+    qp_azel2bore_batch1(memloc, az + start, el + start,
+                        (pitch == NULL) ? NULL : pitch + start,
+                        (roll == NULL) ? NULL : roll + start,
+                        lon + start, lat + start, ctime + start, q + start,
+                        end - start);
+    qp_merge_error(mem, memloc, NULL);
+
+#pragma omp barrier
+    if (ithread == nthreads - 1)
+      qp_copy_state(mem, memloc);
+    qp_free_memory(memloc);
+  }
 }
 
 void qp_quat2azel(qp_memory_t *mem, quat_t q_in, double lon, double lat, double ctime,
@@ -475,9 +733,15 @@ void qp_quat2azel(qp_memory_t *mem, quat_t q_in, double lon, double lat, double
   qp_apply_annual_aberration(mem, ctime, q, 1);
 
   // apply nutation/precession/frame bias correction
-  if (qp_check_update(&mem->state_npb_inv, ctime)) {
-    ctime2jdtt(ctime, jd_tt);
-    qp_npb_quat(jd_tt, mem->q_npb_inv, mem->accuracy);
+  if (qp_check_interp(mem, &mem->state_npb_inv)) {
+    qp_interp_corr(mem, &mem->state_npb_inv, &mem->interp_npb_inv, ctime,
+                   qp_npb_node, mem->q_npb_inv);
+    Quaternion_inv(mem->q_npb_inv);
+  } else if (qp_check_update(&mem->state_npb_inv, ctime)) {
+    if (qp_get_ephem(mem, ctime, NULL, mem->q_npb_inv, NULL)) {
+      ctime2jdtt(ctime, jd_tt);
+      qp_npb_quat(jd_tt, mem->q_npb_inv, mem->accuracy);
+    }
     Quaternion_inv(mem->q_npb_inv);
 #ifdef DEBUG
     qp_print_quat("npb inv", mem->q_npb_inv);
@@ -493,10 +757,18 @@ void qp_quat2azel(qp_memory_t *mem, quat_t q_in, double lon, double lat, double
   // get wobble correction (polar motion)
   // or get dut1 from IERS bulletin
   mjd_utc = jd2mjd(jd_utc[0]) + jd_utc[1];
-  if (qp_check_update(&mem->state_wobble_inv, ctime)) {
+  if (qp_check_interp(mem, &mem->state_wobble_inv)) {
+    if (qp_interp_corr(mem, &mem->state_wobble_inv, &mem->interp_wobble_inv,
+                       ctime, qp_wobble_node, mem->q_wobble_inv) ||
+        qp_check_update(&mem->state_dut1, ctime))
+      qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
+    Quaternion_inv(mem->q_wobble_inv);
+  } else if (qp_check_update(&mem->state_wobble_inv, ctime)) {
     qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
-    if (jd_tt[0] == 0) ctime2jdtt(ctime, jd_tt);
-    qp_wobble_quat(jd_tt, x, y, mem->q_wobble_inv);
+    if (qp_get_ephem(mem, ctime, mem->q_wobble_inv, NULL, NULL)) {
+      if (jd_tt[0] == 0) ctime2jdtt(ctime, jd_tt);
+      qp_wobble_quat(jd_tt, x, y, mem->q_wobble_inv);
+    }
     Quaternion_inv(mem->q_wobble_inv);
 #ifdef DEBUG
     qp_print_quat("wobble inv", mem->q_wobble_inv);
@@ -505,7 +777,11 @@ void qp_quat2azel(qp_memory_t *mem, quat_t q_in, double lon, double lat, double
     qp_get_iers_bulletin_a(mem, mjd_utc, &mem->dut1, &x, &y);
 
   // apply earth rotation
-  if (qp_check_update(&mem->state_erot_inv, ctime)) {
+  if (qp_check_interp(mem, &mem->state_erot_inv)) {
+    qp_interp_corr(mem, &mem->state_erot_inv, &mem->interp_erot_inv, ctime,
+                   qp_erot_node, mem->q_erot_inv);
+    Quaternion_inv(mem->q_erot_inv);
+  } else if (qp_check_update(&mem->state_erot_inv, ctime)) {
     // get ut1
     jdutc2jdut1(jd_utc, mem->dut1, jd_ut1);
     qp_erot_quat(jd_ut1, mem->q_erot_inv);
@@ -567,6 +843,7 @@ void qp_hwp_quat(double ang, quat_t q) {
 }
 
 void qp_hwp_quatn(double *ang, quat_t *q, int n) {
+#pragma omp parallel for if (n > QP_SAMPLE_CHUNK)
   for (int ii=0; ii<n; ii++)
     qp_hwp_quat(ang[ii], q[ii]);
 }
@@ -582,22 +859,23 @@ void qp_det_offset(double delta_az, double delta_el, double delta_psi, quat_t q)
 
 void qp_det_offsetn(double *delta_az, double *delta_el, double *delta_psi, quat_t *q,
 		    int n) {
+#pragma omp parallel for if (n > QP_SAMPLE_CHUNK)
   for (int ii=0; ii<n; ii++)
     qp_det_offset(delta_az[ii], delta_el[ii], delta_psi[ii], q[ii]);
 }
 
 void qp_bore_offset(qp_memory_t *mem, quat_t *q_bore, double *ang1, double *ang2,
                     double *ang3, int n, int post) {
-  quat_t q_off;
-  for (int ii=0; ii<n; ii++) {
+  QP_SAMPLE_LOOP(mem, n, ii,
+    quat_t q_off;
     if (!post) {
       qp_det_offset(ang1[ii], ang2[ii], ang3[ii], q_off);
       Quaternion_mul_right(q_bore[ii], q_off);
     } else {
-      qp_radecpa2quat(mem, ang1[ii], ang2[ii], ang3[ii], q_off);
+      qp_radecpa2quat(memloc, ang1[ii], ang2[ii], ang3[ii], q_off);
       Quaternion_mul_left(q_off, q_bore[ii]);
     }
-  }
+  );
 }
 
 void qp_bore2det(qp_memory_t *mem, quat_t q_off, double ctime, quat_t q_bore,
@@ -616,6 +894,53 @@ void qp_bore2det_hwp(qp_memory_t *mem, quat_t q_off, double ctime, quat_t q_bore
   Quaternion_mul_right(q_det, q_hwp);
 }
 
+/* The annual aberration rotation for a detector pointing along u is about
+   n = u x beta.  Rotated into the boresight frame, this becomes
+   n' = u_off x beta_bore, where u_off is the detector offset direction and
+   beta_bore the velocity in the boresight frame: the boresight term
+   z x beta_bore plus a differential term (u_off - z) x beta_bore that is
+   linear in the offset.  So beta_bore is computed once per sample, and each
+   detector needs only a cross product and a quaternion product. */
+void qp_bore_beta(qp_memory_t *mem, double ctime, quat_t q_bore, vec3_t beta) {
+  vec3_t col;
+
+  qp_update_annual_aberration(mem, ctime);
+  if (!qp_check_apply(&mem->state_aaber)) {
+    beta[0] = beta[1] = beta[2] = 0;
+    return;
+  }
+
+  Quaternion_to_matrix_col1(q_bore, col);
+  beta[0] = vec3_dot_product(col, mem->beta_earth);
+  Quaternion_to_matrix_col2(q_bore, col);
+  beta[1] = vec3_dot_product(col, mem->beta_earth);
+  Quaternion_to_matrix_col3(q_bore, col);
+  beta[2] = vec3_dot_product(col, mem->beta_earth);
+}
+
+void qp_bore_betan(qp_memory_t *mem, double *ctime, quat_t *q_bore,
+                   vec3_t *beta, int n) {
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_bore_beta(memloc, ctime[ii], q_bore[ii], beta[ii]);
+  );
+}
+
+void qp_bore2det_beta(quat_t q_off, quat_t q_bore, vec3_t beta, quat_t q_det) {
+  vec3_t u, n;
+  quat_t q_aber;
+
+  Quaternion_to_matrix_col3(q_off, u);
+  vec3_cross_product(n, u, beta);
+  // small angle approximation, as in qp_aberration
+  q_aber[0] = 1. - 0.125 * vec3_dot_product(n, n);
+  q_aber[1] = -0.5 * n[0];
+  q_aber[2] = -0.5 * n[1];
+  q_aber[3] = -0.5 * n[2];
+
+  Quaternion_mul(q_det, q_aber, q_off);
+  Quaternion_mul_left(q_bore, q_det);
+}
+
 void qp_quat2rasindec(qp_memory_t *mem, quat_t q, double *ra, double *sindec,
 		      double *sin2psi, double *cos2psi) {
 
@@ -716,9 +1041,9 @@ void qp_quat2radecpa(qp_memory_t *mem, quat_t q, double *ra, double *dec,
 
 void qp_quat2radecpan(qp_memory_t *mem, quat_t *q, double *ra, double *dec,
                      double *pa, int n) {
-  for (int ii = 0; ii < n; ii++) {
-    qp_quat2radecpa(mem, q[ii], ra+ii, dec+ii, pa+ii);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_quat2radecpa(memloc, q[ii], ra+ii, dec+ii, pa+ii);
+  );
 }
 
 void qp_quat2radec(qp_memory_t *mem, quat_t q, double *ra, double *dec,
@@ -792,72 +1117,156 @@ void qp_radecpa2quat(qp_memory_t *mem, double ra, double dec, double pa, quat_t
 
 void qp_radecpa2quatn(qp_memory_t *mem, double *ra, double *dec, double *pa,
                       quat_t *q, int n) {
-  for (int ii=0; ii < n; ii++) {
-    qp_radecpa2quat(mem, ra[ii], dec[ii], pa[ii], q[ii]);
-  }
+  QP_SAMPLE_LOOP(mem, n, ii,
+    qp_radecpa2quat(memloc, ra[ii], dec[ii], pa[ii], q[ii]);
+  );
 }
 
 void qp_bore2radec(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
 		   double *ra, double *dec, double *sin2psi,
 		   double *cos2psi, int n) {
-  quat_t q;
-
-  for (int i=0; i<n; i++) {
-    qp_bore2det(mem, q_off, ctime[i], q_bore[i], q);
-    qp_quat2radec(mem, q, ra+i, dec+i, sin2psi+i, cos2psi+i);
-  }
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q;
+    qp_bore2det(memloc, q_off, ctime[i], q_bore[i], q);
+    qp_quat2radec(memloc, q, ra+i, dec+i, sin2psi+i, cos2psi+i);
+  );
 }
 
 void qp_bore2radec_hwp(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
 		       quat_t *q_hwp, double *ra, double *dec, double *sin2psi,
 		       double *cos2psi, int n) {
-  quat_t q;
-
-  for (int i=0; i<n; i++) {
-    qp_bore2det_hwp(mem, q_off, ctime[i], q_bore[i], q_hwp[i], q);
-    qp_quat2radec(mem, q, ra+i, dec+i, sin2psi+i, cos2psi+i);
-  }
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q;
+    qp_bore2det_hwp(memloc, q_off, ctime[i], q_bore[i], q_hwp[i], q);
+    qp_quat2radec(memloc, q, ra+i, dec+i, sin2psi+i, cos2psi+i);
+  );
 }
 
 void qp_bore2rasindec(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
 		      double *ra, double *sindec, double *sin2psi,
 		      double *cos2psi, int n) {
-  quat_t q;
-
-  for (int i=0; i<n; i++) {
-    qp_bore2det(mem, q_off, ctime[i], q_bore[i], q);
-    qp_quat2rasindec(mem, q, ra+i, sindec+i, sin2psi+i, cos2psi+i);
-  }
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q;
+    qp_bore2det(memloc, q_off, ctime[i], q_bore[i], q);
+    qp_quat2rasindec(memloc, q, ra+i, sindec+i, sin2psi+i, cos2psi+i);
+  );
 }
 
 void qp_bore2rasindec_hwp(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
 			  quat_t *q_hwp, double *ra, double *sindec, double *sin2psi,
 			  double *cos2psi, int n) {
-  quat_t q;
-
-  for (int i=0; i<n; i++) {
-    qp_bore2det_hwp(mem, q_off, ctime[i], q_bore[i], q_hwp[i], q);
-    qp_quat2rasindec(mem, q, ra+i, sindec+i, sin2psi+i, cos2psi+i);
-  }
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q;
+    qp_bore2det_hwp(memloc, q_off, ctime[i], q_bore[i], q_hwp[i], q);
+    qp_quat2rasindec(memloc, q, ra+i, sindec+i, sin2psi+i, cos2psi+i);
+  );
 }
 
 void qp_bore2radecpa(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
                      double *ra, double *dec, double *pa, int n) {
-  quat_t q;
-
-  for (int i=0; i<n; i++) {
-    qp_bore2det(mem, q_off, ctime[i], q_bore[i], q);
-    qp_quat2radecpa(mem, q, ra+i, dec+i, pa+i);
-  }
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q;
+    qp_bore2det(memloc, q_off, ctime[i], q_bore[i], q);
+    qp_quat2radecpa(memloc, q, ra+i, dec+i, pa+i);
+  );
 }
 
 void qp_bore2radecpa_hwp(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
                          quat_t *q_hwp, double *ra, double *dec, double *pa, int n) {
-  quat_t q;
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q;
+    qp_bore2det_hwp(memloc, q_off, ctime[i], q_bore[i], q_hwp[i], q);
+    qp_quat2radecpa(memloc, q, ra+i, dec+i, pa+i);
+  );
+}
 
-  for (int i=0; i<n; i++) {
-    qp_bore2det_hwp(mem, q_off, ctime[i], q_bore[i], q_hwp[i], q);
-    qp_quat2radecpa(mem, q, ra+i, dec+i, pa+i);
+// NB: for all *_ndet functions below:
+// q_off is an array of ndet offsets, and each output array is stored
+// as a contiguous (ndet, n) block, so that the timestream for detector
+// idet begins at index idet * n.  q_hwp may be NULL.
+// detectors are distributed across threads, each with its own copy of mem,
+// and an error set on any of the copies is copied back to mem.
+
+int qp_ndet_threads(qp_memory_t *mem, int ndet) {
+  int num_threads = ndet < mem->num_threads ? ndet : mem->num_threads;
+  return num_threads > 0 ? num_threads : 1;
+}
+
+void qp_bore2radec_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                        double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                        double *ra, double *dec, double *sin2psi,
+                        double *cos2psi, int n) {
+
+#pragma omp parallel num_threads(qp_ndet_threads(mem, ndet))
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    size_t off;
+
+#pragma omp for
+    for (int idet = 0; idet < ndet; idet++) {
+      off = (size_t) idet * n;
+      if (q_hwp == NULL)
+        qp_bore2radec(memloc, q_off[idet], ctime, q_bore, ra + off,
+                      dec + off, sin2psi + off, cos2psi + off, n);
+      else
+        qp_bore2radec_hwp(memloc, q_off[idet], ctime, q_bore, q_hwp,
+                          ra + off, dec + off, sin2psi + off, cos2psi + off, n);
+    }
+
+    qp_merge_error(mem, memloc, NULL);
+    qp_free_memory(memloc);
+  }
+}
+
+void qp_bore2rasindec_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                           double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                           double *ra, double *sindec, double *sin2psi,
+                           double *cos2psi, int n) {
+
+#pragma omp parallel num_threads(qp_ndet_threads(mem, ndet))
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    size_t off;
+
+#pragma omp for
+    for (int idet = 0; idet < ndet; idet++) {
+      off = (size_t) idet * n;
+      if (q_hwp == NULL)
+        qp_bore2rasindec(memloc, q_off[idet], ctime, q_bore, ra + off,
+                         sindec + off, sin2psi + off, cos2psi + off, n);
+      else
+        qp_bore2rasindec_hwp(memloc, q_off[idet], ctime, q_bore, q_hwp,
+                             ra + off, sindec + off, sin2psi + off,
+                             cos2psi + off, n);
+    }
+
+    qp_merge_error(mem, memloc, NULL);
+    qp_free_memory(memloc);
+  }
+}
+
+void qp_bore2radecpa_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                          double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                          double *ra, double *dec, double *pa, int n) {
+
+#pragma omp parallel num_threads(qp_ndet_threads(mem, ndet))
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    size_t off;
+
+#pragma omp for
+    for (int idet = 0; idet < ndet; idet++) {
+      off = (size_t) idet * n;
+      if (q_hwp == NULL)
+        qp_bore2radecpa(memloc, q_off[idet], ctime, q_bore, ra + off,
+                        dec + off, pa + off, n);
+      else
+        qp_bore2radecpa_hwp(memloc, q_off[idet], ctime, q_bore, q_hwp,
+                            ra + off, dec + off, pa + off, n);
+    }
+
+    qp_merge_error(mem, memloc, NULL);
+    qp_free_memory(memloc);
   }
 }
 
@@ -874,19 +1283,20 @@ void qp_azel2radec(qp_memory_t *mem,
 		   double *lon, double *lat, double *ctime,
 		   double *ra, double *dec, double *sin2psi,
 		   double *cos2psi, int n) {
-  quat_t q_det, q_off;
+  quat_t q_off;
   int mean_aber = qp_get_opt_mean_aber(mem);
   qp_set_opt_mean_aber(mem, 1);
 
   qp_det_offset(delta_az, delta_el, delta_psi, q_off);
 
-  for (int i=0; i<n; i++) {
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q_det;
     Quaternion_copy(q_det, q_off);
-    qp_azel2quat(mem, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
+    qp_azel2quat(memloc, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
                  (roll == NULL) ? 0 : roll[i], lon[i], lat[i], ctime[i],
                  q_det);
-    qp_quat2radec(mem, q_det, &ra[i], &dec[i], &sin2psi[i], &cos2psi[i]);
-  }
+    qp_quat2radec(memloc, q_det, &ra[i], &dec[i], &sin2psi[i], &cos2psi[i]);
+  );
 
   qp_set_opt_mean_aber(mem, mean_aber);
 }
@@ -897,19 +1307,20 @@ void qp_azel2radecpa(qp_memory_t *mem,
 		     double *az, double *el, double *pitch, double *roll,
 		     double *lon, double *lat, double *ctime,
 		     double *ra, double *dec, double *pa, int n) {
-  quat_t q_det, q_off;
+  quat_t q_off;
   int mean_aber = qp_get_opt_mean_aber(mem);
   qp_set_opt_mean_aber(mem, 1);
 
   qp_det_offset(delta_az, delta_el, delta_psi, q_off);
 
-  for (int i=0; i<n; i++) {
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q_det;
     Quaternion_copy(q_det, q_off);
-    qp_azel2quat(mem, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
+    qp_azel2quat(memloc, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
                  (roll == NULL) ? 0 : roll[i], lon[i], lat[i], ctime[i],
                  q_det);
-    qp_quat2radecpa(mem, q_det, &ra[i], &dec[i], &pa[i]);
-  }
+    qp_quat2radecpa(memloc, q_det, &ra[i], &dec[i], &pa[i]);
+  );
 
   qp_set_opt_mean_aber(mem, mean_aber);
 }
@@ -918,13 +1329,12 @@ void qp_radec2azel(qp_memory_t *mem,
 		   double *ra, double *dec, double *pa, double *lon,
 		   double *lat, double *ctime, double *az, double *el,
 		   double *hpa, int n) {
-  quat_t q;
-
-  for (int i=0; i<n; i++) {
-    qp_radecpa2quat(mem, ra[i], dec[i], (pa == NULL) ? 0 : pa[i], q);
-    qp_quat2azel(mem, q, lon[i], lat[i], ctime[i], az + i, el + i,
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q;
+    qp_radecpa2quat(memloc, ra[i], dec[i], (pa == NULL) ? 0 : pa[i], q);
+    qp_quat2azel(memloc, q, lon[i], lat[i], ctime[i], az + i, el + i,
 		 (hpa == NULL) ? NULL : (hpa + i));
-  }
+  );
 }
 
 // all input and output angles are in degrees!
@@ -934,21 +1344,22 @@ void qp_azel2radec_hwp(qp_memory_t *mem,
 		       double *lon, double *lat, double *ctime, double *hwp,
 		       double *ra, double *dec, double *sin2psi,
 		       double *cos2psi, int n) {
-  quat_t q_det, q_off, q_hwp;
+  quat_t q_off;
   int mean_aber = qp_get_opt_mean_aber(mem);
   qp_set_opt_mean_aber(mem, 1);
 
   qp_det_offset(delta_az, delta_el, delta_psi, q_off);
 
-  for (int i=0; i<n; i++) {
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q_det, q_hwp;
     Quaternion_copy(q_det, q_off);
     qp_hwp_quat(hwp[i], q_hwp);
     Quaternion_mul_right(q_det, q_hwp);
-    qp_azel2quat(mem, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
+    qp_azel2quat(memloc, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
                  (roll == NULL) ? 0 : roll[i], lon[i], lat[i], ctime[i],
                  q_det);
-    qp_quat2radec(mem, q_det, &ra[i], &dec[i], &sin2psi[i], &cos2psi[i]);
-  }
+    qp_quat2radec(memloc, q_det, &ra[i], &dec[i], &sin2psi[i], &cos2psi[i]);
+  );
 
   qp_set_opt_mean_aber(mem, mean_aber);
 }
@@ -959,21 +1370,22 @@ void qp_azel2radecpa_hwp(qp_memory_t *mem,
 			 double *az, double *el, double *pitch, double *roll,
 			 double *lon, double *lat, double *ctime, double *hwp,
 			 double *ra, double *dec, double *pa, int n) {
-  quat_t q_det, q_off, q_hwp;
+  quat_t q_off;
   int mean_aber = qp_get_opt_mean_aber(mem);
   qp_set_opt_mean_aber(mem, 1);
 
   qp_det_offset(delta_az, delta_el, delta_psi, q_off);
 
-  for (int i=0; i<n; i++) {
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q_det, q_hwp;
     Quaternion_copy(q_det, q_off);
     qp_hwp_quat(hwp[i], q_hwp);
     Quaternion_mul_right(q_det, q_hwp);
-    qp_azel2quat(mem, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
+    qp_azel2quat(memloc, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
                  (roll == NULL) ? 0 : roll[i], lon[i], lat[i], ctime[i],
                  q_det);
-    qp_quat2radecpa(mem, q_det, &ra[i], &dec[i], &pa[i]);
-  }
+    qp_quat2radecpa(memloc, q_det, &ra[i], &dec[i], &pa[i]);
+  );
 
   qp_set_opt_mean_aber(mem, mean_aber);
 }
@@ -985,19 +1397,20 @@ void qp_azel2rasindec(qp_memory_t *mem,
 		      double *lon, double *lat, double *ctime,
 		      double *ra, double *sindec, double *sin2psi,
 		      double *cos2psi, int n) {
-  quat_t q_det, q_off;
+  quat_t q_off;
   int mean_aber = qp_get_opt_mean_aber(mem);
   qp_set_opt_mean_aber(mem, 1);
 
   qp_det_offset(delta_az, delta_el, delta_psi, q_off);
 
-  for (int i=0; i<n; i++) {
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q_det;
     Quaternion_copy(q_det, q_off);
-    qp_azel2quat(mem, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
+    qp_azel2quat(memloc, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
                  (roll == NULL) ? 0 : roll[i], lon[i], lat[i], ctime[i],
                  q_det);
-    qp_quat2rasindec(mem, q_det, &ra[i], &sindec[i], &sin2psi[i], &cos2psi[i]);
-  }
+    qp_quat2rasindec(memloc, q_det, &ra[i], &sindec[i], &sin2psi[i], &cos2psi[i]);
+  );
 
   qp_set_opt_mean_aber(mem, mean_aber);
 }
@@ -1009,21 +1422,22 @@ void qp_azel2rasindec_hwp(qp_memory_t *mem,
 			  double *lon, double *lat, double *ctime, double *hwp,
 			  double *ra, double *sindec, double *sin2psi,
 			  double *cos2psi, int n) {
-  quat_t q_det, q_off, q_hwp;
+  quat_t q_off;
   int mean_aber = qp_get_opt_mean_aber(mem);
   qp_set_opt_mean_aber(mem, 1);
 
   qp_det_offset(delta_az, delta_el, delta_psi, q_off);
 
-  for (int i=0; i<n; i++) {
+  QP_SAMPLE_LOOP(mem, n, i,
+    quat_t q_det, q_hwp;
     Quaternion_copy(q_det, q_off);
     qp_hwp_quat(hwp[i], q_hwp);
     Quaternion_mul_right(q_det, q_hwp);
-    qp_azel2quat(mem, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
+    qp_azel2quat(memloc, az[i], el[i], (pitch == NULL) ? 0 : pitch[i],
                  (roll == NULL) ? 0 : roll[i], lon[i], lat[i], ctime[i],
                  q_det);
-    qp_quat2rasindec(mem, q_det, &ra[i], &sindec[i], &sin2psi[i], &cos2psi[i]);
-  }
+    qp_quat2rasindec(memloc, q_det, &ra[i], &sindec[i], &sin2psi[i], &cos2psi[i]);
+  );
 
   qp_set_opt_mean_aber(mem, mean_aber);
 }
@@ -25,6 +25,13 @@ extern "C" {
     double ctime_last;  // time of last update
   } qp_state_t;
 
+  /* correction evaluated at grid nodes bracketing the current sample */
+  typedef struct {
+    double ctime[2];    // node times
+    double dut1;        // ut1 correction used to compute nodes
+    quat_t q[2];        // correction at each node
+  } qp_interp_t;
+
   /* structure for storing refraction data */
   typedef struct {
     double temperature; // temperature, C
@@ -46,6 +53,24 @@ extern "C" {
     int mjd_max;
   } qp_bulletina_t;
 
+  /* structure for a precomputed table of time-dependent corrections */
+  typedef struct {
+    double *data;       // table entries, QP_EPHEM_NCOL values each (not owned)
+    double ctime0;      // time of the first entry
+    double step;        // spacing between entries, seconds
+    int n;              // number of entries
+    int accuracy;       // accuracy option used to compute the entries
+  } qp_ephem_t;
+
+  /* maximum number of coordinate frames, including the predefined ones */
+#define QP_MAX_FRAMES 16
+
+  /* coordinate frame, identified by a single character */
+  typedef struct {
+    char name;          // frame identifier
+    quat_t q;           // rotation from frame to celestial coordinates
+  } qp_frame_t;
+
   /* parameter structure for storing corrections computed at variable rates */
   typedef struct qp_memory_t {
     int init;
@@ -87,11 +112,20 @@ extern "C" {
     quat_t q_gal;             // galactic coordinates
     quat_t q_gal_inv;         // inverse of q_gal
     int gal_init;             // q_gal* initialized?
+    int num_frames;           // number of coordinate frames
+    qp_frame_t frames[QP_MAX_FRAMES]; // coordinate frame registry
     vec3_t v_dipole;          // dipole direction
     int dipole_init;          // q_dipole initialized?
     vec3_t beta_earth;        // earth orbital velocity
     vec3_t beta_rot;          // earth rotational velocity
     qp_bulletina_t bulletinA; // bulletin A data
+    qp_ephem_t ephem;         // precomputed correction table
+    qp_interp_t interp_wobble;     // wobble interpolation nodes
+    qp_interp_t interp_wobble_inv; // inverse wobble interpolation nodes
+    qp_interp_t interp_erot;       // earth's rotation interpolation nodes
+    qp_interp_t interp_erot_inv;   // inverse earth's rotation interpolation nodes
+    qp_interp_t interp_npb;        // nutation etc interpolation nodes
+    qp_interp_t interp_npb_inv;    // inverse nutation etc interpolation nodes
 
     // options
     int accuracy;          // 0=full accuracy, 1=low accuracy
@@ -106,6 +140,10 @@ extern "C" {
     int interp_missing;    // drop missing neighbors when interp_pix=1
     int num_threads;       // number of parallel threads
     int thread_num;        // current thread number
+    int reduce_mode;       // thread reduction strategy in tod2map
+    int parallel_mode;     // thread work decomposition in tod2map/map2tod
+    int interp_corr;       // interpolate wobble/erot/npb between updates
+    int sort_pix;          // bin blocks of samples in pixel order in tod2map
 
     // error handling
     int error_code;
@@ -117,6 +155,66 @@ extern "C" {
   void qp_free_memory(qp_memory_t *mem);
   qp_memory_t * qp_copy_memory(qp_memory_t *memsrc);
 
+  /* Copy the correction state (update times and stored corrections) from
+     memsrc into mem, keeping the options and bulletin A data of mem.  The
+     error state of mem is kept unless an error is set on memsrc. */
+  void qp_copy_state(qp_memory_t *mem, qp_memory_t *memsrc);
+
+  /* Minimum number of samples per thread in sample loops */
+#define QP_SAMPLE_CHUNK 1024
+
+  /* Number of threads to use for a loop over n samples.  Returns 1 inside
+     an active parallel region. */
+  int qp_sample_threads(qp_memory_t *mem, int n);
+
+  /* Copy of mem for a thread processing the given chunk of a sample loop.
+     For all but the first chunk, corrections with a positive update rate
+     are recomputed at the first sample of the chunk. */
+  qp_memory_t * qp_init_chunk_memory(qp_memory_t *mem, int chunk);
+
+  /* Split n samples into contiguous chunks and execute the body once per
+     chunk, with the sample range [start, end) and a memory structure
+     memloc.  If more than one thread is available, the first sample is
+     processed serially using mem, so that any corrections that are computed
+     only once are shared by all threads.  The remaining samples are split
+     into one chunk per thread, each with its own primed copy of mem, and
+     the state at the end of the last chunk is copied back into mem, along
+     with any error set on the copy of mem for a chunk. */
+#define QP_SAMPLE_RANGE(mem, n, start, end, ...)                        \
+  do {                                                                  \
+    int nthreads_ = qp_sample_threads(mem, n);                          \
+    if (nthreads_ == 1) {                                               \
+      qp_memory_t *memloc = mem;                                        \
+      int start = 0, end = (n);                                         \
+      { __VA_ARGS__ }                                                   \
+      break;                                                            \
+    }                                                                   \
+    {                                                                   \
+      qp_memory_t *memloc = mem;                                        \
+      int start = 0, end = 1;                                           \
+      { __VA_ARGS__ }                                                   \
+    }                                                                   \
+    _Pragma("omp parallel num_threads(nthreads_)")                      \
+    {                                                                   \
+      int ithread_ = omp_get_thread_num();                              \
+      int start = 1 + (int) ((long) ((n) - 1) * ithread_ / nthreads_);  \
+      int end = 1 + (int) ((long) ((n) - 1) * (ithread_ + 1) / nthreads_); \
+      qp_memory_t *memloc = qp_init_chunk_memory(mem, ithread_);        \
+      { __VA_ARGS__ }                                                   \
+      qp_merge_error(mem, memloc, NULL);                                \
+      _Pragma("omp barrier")                                            \
+      if (ithread_ == nthreads_ - 1)                                    \
+        qp_copy_state(mem, memloc);                                     \
+      qp_free_memory(memloc);                                           \
+    }                                                                   \
+  } while (0)
+
+  /* Loop over n samples, executing the body for each sample index ii with
+     a memory structure memloc, split into chunks as in QP_SAMPLE_RANGE. */
+#define QP_SAMPLE_LOOP(mem, n, ii, ...)                                 \
+  QP_SAMPLE_RANGE(mem, n, start_, end_,                                 \
+                  for (int ii = start_; ii < end_; ii++) { __VA_ARGS__ })
+
   /* common update rates */
   extern const int QP_DO_ALWAYS;
   extern const int QP_DO_ONCE;
@@ -156,6 +254,12 @@ extern "C" {
   /* check whether a correction needs to be applied */
   int qp_check_apply(qp_state_t *state);
 
+  /* check whether a correction is interpolated between updates */
+  int qp_check_interp(qp_memory_t *mem, qp_state_t *state);
+
+  /* reset interpolation nodes */
+  void qp_reset_interp(qp_interp_t *interp);
+
   /* print stuff */
   void qp_print_vec3(const char *tag, vec3_t v);
   void qp_print_quat(const char *tag, quat_t q);
@@ -216,9 +320,13 @@ extern "C" {
   OPTIONFUNC(error_missing);
   OPTIONFUNC(nan_missing);
   OPTIONFUNC(interp_missing);
+  OPTIONFUNC(interp_corr);
 #ifndef ENABLE_LITE
   OPTIONFUNC(num_threads);
   OPTIONFUNC(thread_num);
+  OPTIONFUNC(reduce_mode);
+  OPTIONFUNC(parallel_mode);
+  OPTIONFUNC(sort_pix);
 #endif
 
   /* Set weather data */
@@ -255,6 +363,9 @@ extern "C" {
   void qp_set_error(qp_memory_t *mem, int error_code, const char *error_string);
   int qp_check_error(qp_memory_t *mem, int condition, int error_code,
                      const char *error_string);
+  /* Copy an error set on a thread-local copy of mem back to mem.  If err is
+     not NULL, only the first error is kept, and its code is stored in err. */
+  int qp_merge_error(qp_memory_t *mem, qp_memory_t *memloc, int *err);
 
   /* *************************************************************************
      Utility functions
@@ -276,6 +387,24 @@ extern "C" {
   /* Copy IERS Bulletin A */
   int qp_copy_iers_bulletin_a( qp_memory_t *memdest, qp_memory_t *memsrc );
 
+  /* Number of values per entry of a correction table:
+     wobble quaternion, npb quaternion, earth orbital velocity */
+#define QP_EPHEM_NCOL 11
+  /* Compute n correction table entries at times ctime0 + i * step, using
+     SOFA and the stored IERS Bulletin A */
+  void qp_fill_ephem( qp_memory_t *mem, double ctime0, double step, int n,
+                      double *data );
+  /* Use a precomputed correction table in place of SOFA.  The data are not
+     copied, and must remain valid while the table is in use.
+     Pass data=NULL to remove the table. */
+  void qp_set_ephem( qp_memory_t *mem, double ctime0, double step, int n,
+                     int accuracy, double *data );
+  /* Return corrections interpolated from the table.  Any output may be NULL.
+     Returns 1 if no table is loaded, ctime is outside the table, or the
+     table was computed with a different accuracy option. */
+  int qp_get_ephem( qp_memory_t *mem, double ctime, quat_t q_wobble,
+                    quat_t q_npb, vec3_t beta );
+
   /* Time conversion */
 #define CTIME_JD_EPOCH 2440587.5 /* JD for ctime = 0 */
   void ctime2jd(double ctime, double jd[2]);
@@ -392,6 +521,13 @@ extern "C" {
 		    double *roll, double *lon, double *lat, double *ctime,
 		    quat_t *q, int n);
 
+  /* Compute boresight quaternions for n gondola orientations, evaluating
+     slowly varying corrections only when they are updated. Agrees with
+     qp_azel2bore to within 1e-5 arcsec. */
+  void qp_azel2bore_batch(qp_memory_t *mem, double *az, double *el,
+                          double *pitch, double *roll, double *lon,
+                          double *lat, double *ctime, quat_t *q, int n);
+
   /* Compute horizon coordinates for a given quaternion in equatorial coordinates */
   void qp_quat2azel(qp_memory_t *mem, quat_t q, double lon, double lat,
 		    double ctime, double *az, double *el, double *hpa);
@@ -447,6 +583,18 @@ extern "C" {
   void qp_bore2det_hwp(qp_memory_t *mem, quat_t q_off, double ctime, quat_t q_bore,
 		       quat_t q_hwp, quat_t q_det);
 
+  /* Calculate the earth orbital velocity in the frame of the boresight, for
+     applying the per-detector annual aberration with qp_bore2det_beta.
+     Updates the annual aberration state as qp_bore2det would. */
+  void qp_bore_beta(qp_memory_t *mem, double ctime, quat_t q_bore, vec3_t beta);
+  void qp_bore_betan(qp_memory_t *mem, double *ctime, quat_t *q_bore,
+                     vec3_t *beta, int n);
+
+  /* Calculate the detector quaternion from the boresight and offset,
+     including the annual aberration for the detector pointing, given the
+     boresight-frame velocity from qp_bore_beta. */
+  void qp_bore2det_beta(quat_t q_off, quat_t q_bore, vec3_t beta, quat_t q_det);
+
   /* Calculate ra/dec and sin(2*psi)/cos(2*psi) for a given detector offset,
      from an array of boresight quaternions. */
   void qp_bore2radec(qp_memory_t *mem, quat_t q_off, double *ctime, quat_t *q_bore,
@@ -480,6 +628,30 @@ extern "C" {
                            quat_t *q_bore, quat_t *q_hwp, double *ra, double *dec,
                            double *pa, int n);
 
+  /* Number of threads to use for a loop over ndet detectors */
+  int qp_ndet_threads(qp_memory_t *mem, int ndet);
+
+  /* Calculate ra/dec and sin(2*psi)/cos(2*psi) for an array of ndet detector
+     offsets, from an array of boresight (and optional waveplate) quaternions.
+     Outputs are (ndet, n) arrays.  q_hwp may be NULL. */
+  void qp_bore2radec_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                          double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                          double *ra, double *dec, double *sin2psi,
+                          double *cos2psi, int n);
+
+  /* Calculate ra/sin(dec) and sin(2*psi)/cos(2*psi) for an array of ndet
+     detector offsets.  Outputs are (ndet, n) arrays.  q_hwp may be NULL. */
+  void qp_bore2rasindec_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                             double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                             double *ra, double *sindec, double *sin2psi,
+                             double *cos2psi, int n);
+
+  /* Calculate ra/dec/pa for an array of ndet detector offsets.
+     Outputs are (ndet, n) arrays.  q_hwp may be NULL. */
+  void qp_bore2radecpa_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                            double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                            double *ra, double *dec, double *pa, int n);
+
   /* Calculate ra/dec and sin(2*psi)/cos(2*psi) for a given detector offset,
      from a set of boresight orientations. */
   void qp_azel2radec(qp_memory_t *mem,
@@ -548,6 +720,14 @@ extern "C" {
 #define QP_ORDER_NEST 1
 #define QP_ORDER_RING 0
 
+  /* Number of samples processed at a time by the batched pixelization
+     kernels */
+#define QP_PIX_BLOCK 64
+
+  /* Number of samples sorted by pixel at a time by the binners, if the
+     sort_pix option is set */
+#define QP_SORT_BLOCK 65536
+
   /* Compute healpix pixel number for given nside and ra/dec */
   long qp_radec2pix(qp_memory_t *mem, double ra, double dec, int nside);
 
@@ -589,6 +769,30 @@ extern "C" {
   void qp_gal2radecpan(qp_memory_t *mem, double *ra, double *dec,
                        double *pa, int n);
 
+  /* Coordinate frames.  The celestial ('C'), galactic ('G') and ecliptic
+     ('E', J2000 mean ecliptic) frames are predefined, and other frames may
+     be registered by name.  Each frame is defined by the quaternion that
+     rotates frame coordinates to celestial coordinates.  All functions
+     return nonzero and set the error string for unknown frames. */
+  int qp_set_frame(qp_memory_t *mem, char name, quat_t q);
+  /* Register a frame whose origin (lon = lat = 0, pa = 0) is at the given
+     celestial coordinates and position angle, e.g. a field center */
+  int qp_set_frame_center(qp_memory_t *mem, char name, double ra, double dec,
+                          double pa);
+  int qp_get_frame(qp_memory_t *mem, char name, quat_t q);
+  /* Quaternion that rotates coord_in coordinates to coord_out */
+  int qp_frame_quat(qp_memory_t *mem, char coord_in, char coord_out,
+                    quat_t q);
+
+  /* Rotate quaternions or coordinates between any pair of frames */
+  int qp_rotate_quatn(qp_memory_t *mem, char coord_in, char coord_out,
+                      quat_t *q, int n);
+  int qp_rotate_coordn(qp_memory_t *mem, char coord_in, char coord_out,
+                       double *ra, double *dec, double *sin2psi,
+                       double *cos2psi, int n);
+  int qp_rotate_coordpan(qp_memory_t *mem, char coord_in, char coord_out,
+                         double *ra, double *dec, double *pa, int n);
+
   /* Rotate a TQU map from one coordinate system to another */
   void qp_rotate_map(qp_memory_t *mem, int nside,
                      double **map_in, const char coord_in,
@@ -610,6 +814,17 @@ extern "C" {
                          quat_t *q_bore, quat_t *q_hwp, int nside, long *pix,
                          double *pa, int n);
 
+  /* Compute pix/pol timestreams for an array of ndet detector offsets, given
+     boresight (and optional waveplate) timestreams.
+     Outputs are (ndet, n) arrays.  q_hwp may be NULL. */
+  void qp_bore2pix_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                        double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                        int nside, long *pix, double *sin2psi,
+                        double *cos2psi, int n);
+  void qp_bore2pixpa_ndet(qp_memory_t *mem, quat_t *q_off, int ndet,
+                          double *ctime, quat_t *q_bore, quat_t *q_hwp,
+                          int nside, long *pix, double *pa, int n);
+
   /* *************************************************************************
      Mapmaking and Projection
      ********************************************************************** */
@@ -633,12 +848,24 @@ extern "C" {
 
     int tod_init;    // tod initialized?
     double *tod;     // tod array
+    float *todf;     // single-precision tod array, used instead of tod if set
 
     int flag_init;   // flag initialized?
     uint8_t *flag;   // flag array
 
     int weights_init;   // weight tod initialized?
     double *weights;    // weight tod array
+    float *weightsf;    // single-precision weight tod array, used instead of
+                        // weights if set
+
+    int pnt_init;       // pointing cache initialized?
+    long *pix;          // cached map pixel index (<0 if missing)
+    float *sin2psi;     // cached sin(2*psi) array
+    float *cos2psi;     // cached cos(2*psi) array
+
+    int interp_init;        // interpolation stencil cache initialized?
+    int32_t *interp_pix;    // cached neighbor map indices (n x 4, <0 if missing)
+    float *interp_weight;   // cached neighbor weights (n x 4)
   } qp_det_t;
 
   typedef struct {
@@ -662,6 +889,15 @@ extern "C" {
 
     int q_hwp_init;  // q_hwp array set?
     quat_t *q_hwp;   // hwp quaternion
+
+    int beta_init;   // beta array set?
+    vec3_t *beta;    // earth orbital velocity in the boresight frame
+    size_t beta_n;        // number of samples, ctime and q_bore arrays
+    double *beta_ctime;   // from which beta was computed
+    quat_t *beta_q_bore;
+    double beta_rate;     // annual aberration update rate, accuracy and
+    int beta_accuracy;    // correction table with which beta was computed
+    qp_ephem_t beta_ephem;
   } qp_point_t;
 
   /* map type enum */
@@ -676,6 +912,20 @@ extern "C" {
     QP_VEC_D2_POL     // polarized + 2nd derivs
   } qp_vec_mode;
 
+  /* Thread reduction strategies for tod2map */
+  typedef enum {
+    QP_REDUCE_COPY = 0, // full map copy per thread, merged when done
+    QP_REDUCE_OWNER,    // each thread owns a contiguous range of map pixels
+    QP_REDUCE_SPARSE    // sparse per-thread accumulators, merged in parallel
+  } qp_reduce_mode;
+
+  /* Thread work decomposition for tod2map and map2tod */
+  typedef enum {
+    QP_PARALLEL_DET = 0, // one detector (or pair) per work item
+    QP_PARALLEL_SAMPLE,  // split each detector into chunks of samples
+    QP_PARALLEL_AUTO     // split samples only if fewer dets than threads
+  } qp_parallel_mode;
+
   /* projection type enum */
   typedef enum {
     QP_PROJ_NONE = 0, // no projection
@@ -711,16 +961,68 @@ extern "C" {
   } qp_pix_pair_t;
 
   typedef struct {
-    size_t count;
-    qp_pix_pair_t *pairs;
-  } qp_pix_bucket_t;
+    long start;   // first pixel number in the run
+    long count;   // number of consecutive pixels
+    long index;   // map index of the first pixel
+  } qp_pix_run_t;
 
+  /* Pixel index structure used by a pixhash */
+  typedef enum {
+    QP_PIXHASH_HASH = 0, // open-addressing hash table
+    QP_PIXHASH_RUNS,     // sorted runs of consecutive pixels
+    QP_PIXHASH_DIRECT    // offset table spanning the pixel range
+  } qp_pixhash_mode;
+
+  /* Map from pixel numbers to partial map indices.  The index structure is
+     chosen from the pixel list when the pixhash is built, and its data are
+     allocated with the struct. */
   typedef struct {
     int init;
-    size_t count;
-    qp_pix_bucket_t *buckets;
+    qp_pixhash_mode mode;
+    size_t count;            // number of pixels
+
+    // QP_PIXHASH_HASH: linear probing, empty slots have key < 0
+    size_t mask;             // number of slots - 1 (a power of 2)
+    int shift;               // 64 - log2(number of slots)
+    qp_pix_pair_t *slots;
+
+    // QP_PIXHASH_RUNS: runs sorted by pixel number
+    size_t nrun;
+    qp_pix_run_t *runs;
+
+    // QP_PIXHASH_DIRECT: map index of pixel pix0 + ii, or -1
+    long pix0;
+    size_t span;
+    long *offset;
   } qp_pixhash_t;
 
+  /* Map pixelization */
+  typedef enum {
+    QP_GRID_HEALPIX = 0,     // healpix, ordered by the pix_order option
+    QP_GRID_CAR,             // plate carree (equirectangular)
+    QP_GRID_TAN              // gnomonic (tangent plane)
+  } qp_grid_type;
+
+  /* Flat-sky pixelization on a rectangular grid of projected coordinates
+     (x, y), in degrees relative to the projection center.  For CAR, x is
+     the RA offset, wrapped to [-180, 180), and y the Dec offset.  For TAN,
+     (x, y) are the gnomonic coordinates along increasing RA and Dec at the
+     center.  Pixel (ix, iy) is centered at (x0 + ix * dx, y0 + iy * dy),
+     and has map index iy * nx + ix.  Polarization angles are measured
+     from the local meridian, as for healpix maps. */
+  typedef struct {
+    qp_grid_type type;       // pixelization type
+    double ra0;              // projection center, degrees
+    double dec0;
+    double x0;               // coordinates of pixel (0, 0), degrees
+    double y0;
+    double dx;               // pixel size, degrees, may be negative
+    double dy;
+    long nx;                 // grid dimensions
+    long ny;
+    quat_t q_center;         // rotation of the center to the origin (TAN)
+  } qp_grid_t;
+
   typedef struct {
     int init;                // initialized?
     int partial;             // partial map?
@@ -733,6 +1035,8 @@ extern "C" {
     int pixhash_init;        // pix hash initialized?
     qp_pixhash_t *pixhash;   // repixelization hash table
 
+    qp_grid_t grid;          // flat-sky pixelization, if not healpix
+
     size_t num_vec;          // number of map columns
     qp_vec_mode vec_mode;    // map mode
     int vec1d_init;          // vec1d initialized?
@@ -746,18 +1050,62 @@ extern "C" {
     double *proj1d;          // 1d proj array
     int proj_init;           // proj initialized?
     double **proj;           // projection array
+
+    size_t interleave;       // number of columns stored per pixel, if the
+                             // columns are interleaved, or 0
+
+    /* Single-precision storage.  If set, the map columns are the float
+       arrays below, in place of vec1d/vec/proj1d/proj, and the init flags
+       above refer to these arrays. */
+    int single;              // single-precision columns?
+    float *vec1df;           // 1d map array
+    float **vecf;            // 2d map array
+    float *proj1df;          // 1d proj array
+    float **projf;           // projection array
   } qp_map_t;
 
+  /* Precomputed rotation of a map from one coordinate system to another.
+     For each output pixel, the plan holds the input map indices and
+     weights of its interpolation stencil (a single pixel with unit weight
+     if not interpolating), and the rotation of the polarization angle. */
+  typedef struct {
+    int init;                // initialized?
+    int nside;               // map nside
+    int pix_order;           // pixel ordering of both maps
+    char coord_in;           // input coordinate system
+    char coord_out;          // output coordinate system
+    int polconv;             // polarization convention
+    int nstencil;            // stencil size (1 or 4)
+    size_t npix_in;          // number of input map pixels
+    size_t npix_out;         // number of output map pixels
+    int32_t *pix;            // input map indices (npix_out, nstencil)
+    float *weight;           // stencil weights (npix_out, nstencil)
+    float *cos2psi;          // polarization rotation (npix_out)
+    float *sin2psi;          // polarization rotation (npix_out)
+  } qp_rotate_plan_t;
+
   /* initialize detectors */
   qp_det_t * qp_init_det(quat_t q_off, double weight, double gain, mueller_t mueller);
   qp_det_t * qp_default_det(void);
   void qp_init_det_tod(qp_det_t *det, size_t n);
   void qp_init_det_tod_from_array(qp_det_t *det, double *tod, size_t n, int copy);
+  /* Single-precision timestreams.  Samples are converted to double
+     precision on the fly by the binning and scanning functions. */
+  void qp_init_det_todf_from_array(qp_det_t *det, float *tod, size_t n,
+                                   int copy);
   void qp_init_det_flag(qp_det_t *det, size_t n);
   void qp_init_det_flag_from_array(qp_det_t *det, uint8_t *flag, size_t n, int copy);
   void qp_init_det_weights(qp_det_t *det, size_t n);
   void qp_init_det_weights_from_array(qp_det_t *det, double *weights, size_t n,
                                       int copy);
+  void qp_init_det_weightsf_from_array(qp_det_t *det, float *weights, size_t n,
+                                       int copy);
+  void qp_init_det_pnt(qp_det_t *det, size_t n);
+  void qp_init_det_pnt_from_arrays(qp_det_t *det, long *pix, float *sin2psi,
+                                   float *cos2psi, size_t n, int copy);
+  void qp_init_det_interp(qp_det_t *det, size_t n);
+  void qp_init_det_interp_from_arrays(qp_det_t *det, int32_t *pix,
+                                      float *weight, size_t n, int copy);
   void qp_free_det(qp_det_t *det);
   qp_detarr_t * qp_init_detarr(quat_t *q_off, double *weight, double *gain,
                                mueller_t *mueller, size_t n);
@@ -770,6 +1118,12 @@ extern "C" {
   void qp_init_detarr_weights(qp_detarr_t *dets, size_t n);
   void qp_init_detarr_weights_from_array(qp_detarr_t *dets, double **weights,
                                          size_t n, int copy);
+  void qp_init_detarr_pnt_from_arrays_1d(qp_detarr_t *dets, long *pix,
+                                         float *sin2psi, float *cos2psi,
+                                         size_t n_chunk, int copy);
+  void qp_init_detarr_interp_from_arrays_1d(qp_detarr_t *dets, int32_t *pix,
+                                            float *weight, size_t n_chunk,
+                                            int copy);
   void qp_free_detarr(qp_detarr_t *dets);
 
   /* initialize pointing */
@@ -777,25 +1131,90 @@ extern "C" {
   qp_point_t *qp_init_point_from_arrays(quat_t *q_bore, double *ctime, quat_t *q_hwp,
                                         size_t n, int copy);
   void qp_free_point(qp_point_t *pnt);
+  /* The boresight-frame earth orbital velocity used for the per-detector
+     annual aberration is computed once by the binners and scanners, and
+     kept with the pointing.  It is recomputed if the ctime or q_bore arrays
+     are replaced, or if the annual aberration rate, the accuracy option or
+     the correction table differ from those it was computed with, and must
+     be reset with this function if the array contents change. */
+  void qp_reset_point_beta(qp_point_t *pnt);
 
   /* map repixelization */
   qp_pixhash_t * qp_init_pixhash(long *pix, size_t npix);
   qp_pixhash_t * qp_copy_pixhash(qp_pixhash_t *pixhash);
   void qp_free_pixhash(qp_pixhash_t *pixhash);
   long qp_repixelize(qp_pixhash_t *pixhash, long pix);
+  /* Repixelize n pixel numbers.  pix and index may be the same array. */
+  void qp_repixelizen(qp_pixhash_t *pixhash, long *pix, long *index, size_t n);
   int qp_init_map_pixhash(qp_map_t *map, long *pix, size_t npix);
 
+  /* Use a flat-sky pixelization for a map of npix = nx * ny pixels.
+     Grid maps are dense, so they cannot also be partial healpix maps. */
+  int qp_init_map_grid(qp_map_t *map, qp_grid_type type, double ra0,
+                       double dec0, double x0, double y0, double dx,
+                       double dy, long nx, long ny);
+
+  /* Compute flat-sky grid map indices and pol angles for n quaternions.
+     Samples outside the grid have index -1. */
+  void qp_quat2gridn(qp_memory_t *mem, qp_grid_t *grid, quat_t *q, long *pix,
+                     double *sin2psi, double *cos2psi, int n);
+
   /* initialize maps */
   qp_map_t * qp_init_map(size_t nside, size_t npix, qp_vec_mode vec_mode,
                          qp_proj_mode proj_mode);
   qp_map_t * qp_init_map_from_arrays(double **vec, double **proj, size_t nside,
                                      size_t npix, qp_vec_mode vec_mode,
                                      qp_proj_mode proj_mode, int copy);
+  /* Blank copies of a single-precision map are in double precision, for
+     accumulation.  Returns NULL for a non-blank copy of such a map. */
   qp_map_t * qp_init_map_from_map(qp_map_t *map, int blank, int copy);
+  /* Initialize a map with interleaved columns, i.e. with all of the vec
+     and proj entries of each pixel stored contiguously, in a single
+     (npix, num_vec + num_proj) array. */
+  qp_map_t * qp_init_map_interleaved(size_t nside, size_t npix,
+                                     qp_vec_mode vec_mode,
+                                     qp_proj_mode proj_mode);
+  /* Initialize a map with single-precision (float) columns.  Binning
+     into such a map accumulates each call in sparse double-precision
+     buffers of the pixels hit before adding to the map, and scanning
+     converts map values on the fly. */
+  qp_map_t * qp_init_map_single(size_t nside, size_t npix,
+                                qp_vec_mode vec_mode, qp_proj_mode proj_mode);
   void qp_free_map(qp_map_t *map);
 
+  /* Compute the map pixel index and pol angle timestreams for a detector,
+     for caching and reuse in repeated calls to the binners and scanners.
+     Pixel indices are repixelized for partial maps, and are <0 for
+     samples that fall outside the map. */
+  long qp_det_pix(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
+                  qp_map_t *map, size_t ii, double *sin2psi, double *cos2psi);
+  int qp_det_pnt(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
+                 qp_map_t *map, long *pix, float *sin2psi, float *cos2psi);
+  /* Outputs are (ndet, n) arrays */
+  int qp_detarr_pnt(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                    qp_map_t *map, long *pix, float *sin2psi, float *cos2psi);
+
+  /* Compute the bilinear interpolation stencil for a detector, for caching
+     and reuse in repeated calls to map2tod with interp_pix=1.  The pixel
+     index and pol angle timestreams are computed as in qp_det_pnt, and
+     interp_pix and interp_weight are (n, 4) arrays of the neighbor map
+     indices (repixelized, <0 if missing) and their weights. */
+  int qp_det_interp(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt,
+                    qp_map_t *map, long *pix, float *sin2psi, float *cos2psi,
+                    int32_t *interp_pix, float *interp_weight);
+  /* Outputs are (ndet, n) and (ndet, n, 4) arrays */
+  int qp_detarr_interp(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                       qp_map_t *map, long *pix, float *sin2psi,
+                       float *cos2psi, int32_t *interp_pix,
+                       float *interp_weight);
+
   /* tod -> map */
   int qp_add_map(qp_memory_t *mem, qp_map_t *map, qp_map_t *maploc);
+  /* Sum nmaps maps into map, in parallel over pixels.  NULL entries are
+     skipped.  Each map is checked for compatibility as in qp_add_map, and
+     nothing is added if any of them is incompatible. */
+  int qp_add_maps(qp_memory_t *mem, qp_map_t *map, qp_map_t **maplocs,
+                  int nmaps);
   int qp_tod2map1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt, qp_map_t *map);
   int qp_tod2map(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
                  qp_map_t *map);
@@ -814,12 +1233,118 @@ extern "C" {
                            double ra, double dec);
   void qp_get_interp_valn(qp_memory_t *mem, int nside, double *map,
                           double *ra, double *dec, double *val, int n);
+  /* Interpolate nmap maps, stored contiguously as (nmap, npix), to n
+     coordinates.  val has shape (nmap, n).  The stencil for each sample is
+     computed once and applied to all maps. */
+  void qp_get_interp_valn_nmap(qp_memory_t *mem, int nside, double *map,
+                               int nmap, double *ra, double *dec, double *val,
+                               int n);
 
   /* map -> tod */
   int qp_map2tod1(qp_memory_t *mem, qp_det_t *det, qp_point_t *pnt, qp_map_t *map);
   int qp_map2tod(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
                  qp_map_t *map);
 
+  /* Hits-normalized 2-norm condition number of the projection matrix of
+     each pixel.  proj holds the nmap*(nmap+1)/2 packed upper-triangular
+     columns, for nmap = 1, 3 or 4.  The condition number is infinite for
+     unhit pixels, and condition numbers above 1 / DBL_EPSILON are returned
+     as infinity, as in the numpy implementation. */
+  int qp_proj_cond(qp_memory_t *mem, double **proj, int nmap, size_t npix,
+                   double *cond);
+
+  /* Solve for nmap map columns in place, from the binned vec columns and
+     the packed proj columns, by inverting the projection matrix of each
+     pixel.  Pixels are solved if they are set in mask (if not NULL), are
+     hit, and have a condition number below cond_thresh (if positive).
+     Other pixels are set to fill, and cleared in mask.  The condition
+     numbers are stored in cond, if not NULL.  proj is not modified unless
+     inv is nonzero, in which case proj is replaced by the packed inverse,
+     or zero for unsolved pixels. */
+  int qp_solve_map(qp_memory_t *mem, double **vec, double **proj, int nmap,
+                   size_t npix, uint8_t *mask, double *cond,
+                   double cond_thresh, double fill, int inv);
+
+  /* Bin timestreams into map as in qp_tod2map, then solve the map in place
+     as in qp_solve_map, without inverting proj.  The map must have matching
+     vec and proj modes.  The hits map proj[0] and the condition numbers are
+     stored in hits and cond, if not NULL. */
+  int qp_tod2map_solve(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                       qp_map_t *map, double *hits, double *cond,
+                       double cond_thresh, double fill);
+
+  /* Multiply nmap map columns in place by the projection matrix of each
+     pixel, given as packed proj columns as in qp_solve_map.  Pixels that
+     are not set in mask (if not NULL) or are unhit are set to fill, and
+     cleared in mask.  Given the packed inverse from qp_proj_inv instead,
+     this applies the inverse, e.g. as a preconditioner. */
+  int qp_unsolve_map(qp_memory_t *mem, double **map, double **proj, int nmap,
+                     size_t npix, uint8_t *mask, double fill);
+
+  /* Packed inverse of the projection matrix of each pixel.  Pixels that are
+     unhit, singular, or have a condition number above cond_thresh (if
+     positive) have a zero inverse. */
+  int qp_proj_inv(qp_memory_t *mem, double **proj, double **proj_inv,
+                  int nmap, size_t npix, double cond_thresh);
+
+  /* Timestream filter for the CG mapmaker, applied in place to the (ndet,
+     nsamp) timestreams.  Returns nonzero on error. */
+  typedef int (*qp_tod_filter_t)(double *tod, size_t ndet, size_t nsamp,
+                                 void *data);
+
+  /* Solve for a map by preconditioned conjugate gradients, i.e. solve
+     (P^T F P) x = P^T F d, where P is the pointing operator of map2tod,
+     P^T that of tod2map (including detector weights), d the detector
+     timestreams and F the optional filter.  The right-hand side and the
+     projection matrix are binned into map, which should be blank, and the
+     solution is returned in its vec columns.  The preconditioner is the
+     inverse projection matrix of each pixel, and pixels with a condition
+     number above cond_thresh (if positive) are not solved.  Iterates until
+     the residual norm relative to that of the right-hand side is below tol,
+     or for maxiter iterations.  The relative residual norm of each
+     iteration is stored in resid (of length maxiter + 1), if not NULL, and
+     the number of iterations in niter.  The timestreams are not modified.
+     Differenced detectors and interp_pix are not supported. */
+  int qp_tod2map_cg(qp_memory_t *mem, qp_detarr_t *dets, qp_point_t *pnt,
+                    qp_map_t *map, qp_tod_filter_t filter, void *filter_data,
+                    double cond_thresh, int maxiter, double tol,
+                    double *resid, int *niter);
+
+  /* Compute a plan for rotating maps from coord_in to coord_out, using the
+     current pix_order, interp_pix and polconv options.  pix_in and pix_out
+     are the pixel numbers of partial input and output maps, or NULL for
+     full-sky maps.  Returns NULL on error. */
+  qp_rotate_plan_t * qp_init_rotate_plan(qp_memory_t *mem, int nside,
+                                         const char coord_in,
+                                         const char coord_out,
+                                         long *pix_in, size_t npix_in,
+                                         long *pix_out, size_t npix_out);
+  void qp_free_rotate_plan(qp_rotate_plan_t *plan);
+
+  /* Rotate ncol map columns using a precomputed plan.  If pol is nonzero,
+     the columns are consecutive (T, Q, U) triplets, and the polarization
+     angle is rotated as well.  Output pixels with no valid input pixel
+     are set to zero, or NaN if the nan_missing option is set. */
+  int qp_apply_rotate_plan(qp_memory_t *mem, qp_rotate_plan_t *plan,
+                           double **map_in, double **map_out, int ncol,
+                           int pol);
+
+  /* Reorder ncol full-sky map columns in place, from RING to NEST ordering
+     if nest is nonzero, otherwise from NEST to RING. */
+  int qp_reorder_map(qp_memory_t *mem, int nside, double **map, int ncol,
+                     int nest);
+
+  /* Change the resolution of ncol full-sky map columns in the current
+     pix_order, from nside_in to nside_out.  On degrading, each output pixel
+     is the sum of its subpixels if sum is nonzero, otherwise their mean,
+     weighted by the nside_in map weight if it is not NULL.  Pixels with
+     zero total weight are set to zero, or NaN if the nan_missing option is
+     set.  On upgrading, each output pixel takes the value of its parent
+     pixel, divided by the number of subpixels if sum is nonzero. */
+  int qp_ud_grade_map(qp_memory_t *mem, int nside_in, double **map_in,
+                      int nside_out, double **map_out, int ncol,
+                      double *weight, int sum);
+
 #endif // ENABLE_LITE
 
 #ifdef __cplusplus
@@ -181,26 +181,34 @@ void
 QuaternionSlerp_init(QuaternionSlerp *slerp, const Quaternion a, const Quaternion b)
 {
   double cos_alpha = a[0]*b[0] + a[1]*b[1] + a[2]*b[2] + a[3]*b[3];
-  slerp->sin_alpha = sqrt(1. - cos_alpha*cos_alpha);
+  double d = 0., s = 0.;
   Quaternion_copy(slerp->q0, a);
   Quaternion_copy(slerp->q1, b);
 
   if (cos_alpha < 0.) {
-    slerp->alpha = acos(-cos_alpha);
     slerp->q1[0] = -slerp->q1[0];
     slerp->q1[1] = -slerp->q1[1];
     slerp->q1[2] = -slerp->q1[2];
     slerp->q1[3] = -slerp->q1[3];
-  } else {
-    slerp->alpha = acos(cos_alpha);
   }
+
+  // angle from the chord lengths, which is accurate for small angles
+  for (int i = 0; i != 4; ++i) {
+    d += (slerp->q1[i] - slerp->q0[i])*(slerp->q1[i] - slerp->q0[i]);
+    s += (slerp->q1[i] + slerp->q0[i])*(slerp->q1[i] + slerp->q0[i]);
+  }
+  slerp->alpha = 2.*atan2(sqrt(d), sqrt(s));
+  slerp->sin_alpha = sin(slerp->alpha);
 }
 
 void
 QuaternionSlerp_interpolate(const QuaternionSlerp *slerp, double t, Quaternion q)
 {
-  double s0 = sin((1.-t)*slerp->alpha)/slerp->sin_alpha;
-  double s1 = sin(t*slerp->alpha)/slerp->sin_alpha;
+  double s0 = 1.-t, s1 = t;
+  if (slerp->sin_alpha > 0.) {
+    s0 = sin((1.-t)*slerp->alpha)/slerp->sin_alpha;
+    s1 = sin(t*slerp->alpha)/slerp->sin_alpha;
+  }
   for (int i = 0; i != 4; ++i)
     q[i] = s0*slerp->q0[i] + s1*slerp->q1[i];
 }
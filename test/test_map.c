@@ -0,0 +1,1449 @@
+/* Consistency checks for the map-making routines.  Each check compares
+   two ways of computing the same result, and the program exits with a
+   non-zero status if any check fails. */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include "qpoint.h"
+#include "quaternion.h"
+#include "chealpix.h"
+
+#define NSAMP 20000
+#define NDET 6
+#define NSIDE 64
+
+static int nfail = 0;
+
+static void check(int ok, const char *name, double diff) {
+  printf("%-48s %s (%.3g)\n", name, ok ? "ok" : "FAILED", diff);
+  if (!ok)
+    nfail++;
+}
+
+/* a constant-elevation scan observed by a small detector array */
+static qp_point_t *make_point(qp_memory_t *mem, size_t n) {
+  double *az = malloc(n * sizeof(double));
+  double *el = malloc(n * sizeof(double));
+  double *lon = malloc(n * sizeof(double));
+  double *lat = malloc(n * sizeof(double));
+  double *ctime = malloc(n * sizeof(double));
+  quat_t *q_bore = malloc(n * sizeof(quat_t));
+
+  for (size_t ii = 0; ii < n; ii++) {
+    az[ii] = 100 + 40 * sin(ii / 400.);
+    el[ii] = 40 + 5 * sin(ii / 5000.);
+    lon[ii] = -67;
+    lat[ii] = -23;
+    ctime[ii] = 1.5e9 + ii / 100.;
+    Quaternion_identity(q_bore[ii]);
+  }
+  qp_azel2bore(mem, az, el, NULL, NULL, lon, lat, ctime, q_bore, n);
+
+  free(az);
+  free(el);
+  free(lon);
+  free(lat);
+
+  return qp_init_point_from_arrays(q_bore, ctime, NULL, n, 0);
+}
+
+static void free_point(qp_point_t *pnt) {
+  free(pnt->q_bore);
+  free(pnt->ctime);
+  qp_free_point(pnt);
+}
+
+static qp_detarr_t *make_dets(size_t ndet, size_t n) {
+  quat_t *q_off = malloc(ndet * sizeof(quat_t));
+  double *weight = malloc(ndet * sizeof(double));
+  double *gain = malloc(ndet * sizeof(double));
+  mueller_t *mueller = malloc(ndet * sizeof(mueller_t));
+
+  for (size_t idet = 0; idet < ndet; idet++) {
+    qp_det_offset(idet * 0.3 - 1, 0.2 * idet, 22.5 * idet, q_off[idet]);
+    weight[idet] = 1 + 0.1 * idet;
+    gain[idet] = 1;
+    mueller[idet][0] = 1;
+    mueller[idet][1] = 1;
+    mueller[idet][2] = 0;
+    mueller[idet][3] = 0;
+  }
+
+  qp_detarr_t *dets = qp_init_detarr(q_off, weight, gain, mueller, ndet);
+  qp_init_detarr_tod(dets, n);
+  for (size_t idet = 0; idet < ndet; idet++)
+    for (size_t ii = 0; ii < n; ii++)
+      dets->arr[idet].tod[ii] = sin(ii * 0.001 * (idet + 1));
+
+  free(q_off);
+  free(weight);
+  free(gain);
+  free(mueller);
+  return dets;
+}
+
+/* map value in any storage layout */
+static double map_val(qp_map_t *map, int proj, size_t col, size_t ipix) {
+  size_t idx = ipix * (map->interleave ? map->interleave : 1);
+  if (map->single)
+    return proj ? map->projf[col][idx] : map->vecf[col][idx];
+  return proj ? map->proj[col][idx] : map->vec[col][idx];
+}
+
+/* maximum difference between two maps of the same shape, relative to the
+   largest value in each column */
+static double map_diff(qp_map_t *a, qp_map_t *b) {
+  double d, dmax = 0, amax;
+  size_t ncol = a->num_vec + a->num_proj;
+  for (size_t kk = 0; kk < ncol; kk++) {
+    int proj = kk >= a->num_vec;
+    size_t col = proj ? kk - a->num_vec : kk;
+    amax = 0;
+    for (size_t ii = 0; ii < a->npix; ii++)
+      amax = fmax(amax, fabs(map_val(a, proj, col, ii)));
+    for (size_t ii = 0; ii < a->npix; ii++) {
+      d = fabs(map_val(a, proj, col, ii) - map_val(b, proj, col, ii));
+      if (amax > 0)
+        d /= amax;
+      if (d > dmax || isnan(d))
+        dmax = d;
+    }
+  }
+  return dmax;
+}
+
+/* Bin the same data with each thread reduction mode.  The modes must agree
+   with flagged samples, with a stale error code left on mem by an earlier
+   call, and with missing pixels in a partial map. */
+static void test_reduce_modes(qp_memory_t *mem, qp_point_t *pnt) {
+  const int modes[3] = {QP_REDUCE_COPY, QP_REDUCE_OWNER, QP_REDUCE_SPARSE};
+  size_t npix = 12 * NSIDE * NSIDE;
+  qp_detarr_t *dets = make_dets(NDET, pnt->n);
+  qp_map_t *maps[3];
+  int err[3];
+  double d;
+
+  qp_init_detarr_flag(dets, pnt->n);
+  for (size_t idet = 0; idet < dets->n; idet++)
+    for (size_t ii = idet; ii < pnt->n; ii += 7)
+      dets->arr[idet].flag[ii] = 1;
+
+  for (int mm = 0; mm < 3; mm++) {
+    qp_set_opt_reduce_mode(mem, modes[mm]);
+    qp_set_error(mem, QP_ERROR_POINT, "stale error");
+    maps[mm] = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+    err[mm] = qp_tod2map(mem, dets, pnt, maps[mm]);
+  }
+  d = fmax(map_diff(maps[0], maps[1]), map_diff(maps[0], maps[2]));
+  check(!err[0] && !err[1] && !err[2] && d < 1e-12,
+        "reduce modes, flagged samples", d);
+
+  /* partial map of every other hit pixel */
+  long *pix = malloc(npix * sizeof(long));
+  size_t nhit = 0;
+  for (size_t ii = 0; ii < npix; ii++)
+    if (map_val(maps[0], 1, 0, ii) > 0 && ii % 2)
+      pix[nhit++] = ii;
+  for (int mm = 0; mm < 3; mm++)
+    qp_free_map(maps[mm]);
+
+  qp_set_opt_error_missing(mem, 0);
+  for (int mm = 0; mm < 3; mm++) {
+    qp_set_opt_reduce_mode(mem, modes[mm]);
+    qp_set_error(mem, QP_ERROR_POINT, "stale error");
+    maps[mm] = qp_init_map(NSIDE, nhit, QP_VEC_POL, QP_PROJ_POL);
+    qp_init_map_pixhash(maps[mm], pix, nhit);
+    err[mm] = qp_tod2map(mem, dets, pnt, maps[mm]);
+  }
+  d = fmax(map_diff(maps[0], maps[1]), map_diff(maps[0], maps[2]));
+  check(!err[0] && !err[1] && !err[2] && d < 1e-12,
+        "reduce modes, missing pixels", d);
+
+  qp_set_opt_error_missing(mem, 1);
+  for (int mm = 0; mm < 3; mm++) {
+    qp_set_opt_reduce_mode(mem, modes[mm]);
+    qp_set_error(mem, 0, NULL);
+    err[mm] = qp_tod2map(mem, dets, pnt, maps[mm]);
+    check(err[mm] == QP_ERROR_MAP &&
+          qp_get_error_code(mem) == QP_ERROR_MAP,
+          "reduce modes, error_missing", err[mm]);
+    qp_free_map(maps[mm]);
+  }
+
+  qp_set_opt_reduce_mode(mem, QP_REDUCE_COPY);
+  qp_set_error(mem, 0, NULL);
+  free(pix);
+  qp_free_detarr(dets);
+}
+
+/* Bin ndet detectors, or ndet / 2 differenced pairs if diff is set, into
+   map */
+static int bin_map(qp_memory_t *mem, qp_point_t *pnt, size_t ndet, int diff,
+                   qp_map_t *map) {
+  qp_detarr_t *dets = make_dets(ndet, pnt->n);
+  int err;
+
+  dets->diff = diff;
+  err = qp_tod2map(mem, dets, pnt, map);
+  /* qp_tod2map halves the number of differenced detectors in place */
+  dets->n = ndet;
+  qp_free_detarr(dets);
+  return err;
+}
+
+/* As bin_map, into a new map.  Returns NULL on error. */
+static qp_map_t *bin_dets(qp_memory_t *mem, qp_point_t *pnt, size_t ndet,
+                          int diff) {
+  qp_map_t *map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+
+  if (bin_map(mem, pnt, ndet, diff, map)) {
+    qp_free_map(map);
+    map = NULL;
+  }
+  return map;
+}
+
+/* Fewer detectors than threads, where only some of the threads have any
+   work, give the same map as a serial run. */
+static void test_few_dets(qp_memory_t *mem, qp_point_t *pnt) {
+  int nthreads = qp_get_opt_num_threads(mem);
+  int mode = qp_get_opt_parallel_mode(mem);
+  qp_map_t *map, *ref;
+  double d;
+
+  qp_set_opt_parallel_mode(mem, QP_PARALLEL_DET);
+  for (int diff = 0; diff < 2; diff++) {
+    qp_set_opt_num_threads(mem, 1);
+    ref = bin_dets(mem, pnt, 1 + diff, diff);
+    qp_set_opt_num_threads(mem, nthreads);
+    map = bin_dets(mem, pnt, 1 + diff, diff);
+    d = (map && ref) ? map_diff(ref, map) : -1;
+    check(d >= 0 && d < 1e-12, diff ? "one detector pair, threaded" :
+          "one detector, threaded", d);
+    if (map)
+      qp_free_map(map);
+    if (ref)
+      qp_free_map(ref);
+  }
+  qp_set_opt_parallel_mode(mem, mode);
+}
+
+/* Maximum difference between the timestreams of two detector arrays */
+static double tod_diff(qp_detarr_t *a, qp_detarr_t *b, size_t n) {
+  double d = 0;
+  for (size_t idet = 0; idet < a->n; idet++)
+    for (size_t ii = 0; ii < n; ii++)
+      d = fmax(d, fabs(a->arr[idet].tod[ii] - b->arr[idet].tod[ii]));
+  return d;
+}
+
+/* Splitting a single detector or pair into chunks of samples, in any
+   reduce mode and with per-detector aberration, gives the same maps and
+   timestreams as one work item per detector.  The aberration is updated
+   every sample, since with a slower rate the corrections are refreshed at
+   chunk boundaries. */
+static void test_sample_mode(qp_memory_t *mem, qp_point_t *pnt) {
+  const int modes[3] = {QP_REDUCE_COPY, QP_REDUCE_OWNER, QP_REDUCE_SPARSE};
+  const int pmodes[2] = {QP_PARALLEL_SAMPLE, QP_PARALLEL_AUTO};
+  int nthreads = qp_get_opt_num_threads(mem);
+  int nts[2] = {1, nthreads};
+  double rate = qp_get_rate_aaber(mem);
+  qp_detarr_t *dref, *dets;
+  qp_map_t *map, *ref;
+  double d[2] = {0, 0};
+  int ok[2] = {1, 1};
+
+  qp_set_opt_mean_aber(mem, 0);
+  qp_set_rate_aaber(mem, QP_DO_ALWAYS);
+  qp_reset_point_beta(pnt);
+  for (int diff = 0; diff < 2; diff++) {
+    qp_set_opt_parallel_mode(mem, QP_PARALLEL_DET);
+    qp_set_opt_num_threads(mem, 1);
+    ref = bin_dets(mem, pnt, 1 + diff, diff);
+    ok[diff] = ref != NULL;
+    for (int pp = 0; pp < 2; pp++)
+      for (int tt = 0; tt < 2; tt++)
+        for (int mm = 0; mm < 3; mm++) {
+          qp_set_opt_parallel_mode(mem, pmodes[pp]);
+          qp_set_opt_num_threads(mem, nts[tt]);
+          qp_set_opt_reduce_mode(mem, modes[mm]);
+          map = bin_dets(mem, pnt, 1 + diff, diff);
+          if (map && ref)
+            d[diff] = fmax(d[diff], map_diff(ref, map));
+          else
+            ok[diff] = 0;
+          if (map)
+            qp_free_map(map);
+          qp_set_opt_reduce_mode(mem, QP_REDUCE_COPY);
+        }
+    if (ref)
+      qp_free_map(ref);
+  }
+  check(ok[0] && d[0] < 1e-12, "sample mode, one detector", d[0]);
+  check(ok[1] && d[1] < 1e-12, "sample mode, one detector pair", d[1]);
+
+  /* scan the binned map back out */
+  qp_set_opt_parallel_mode(mem, QP_PARALLEL_DET);
+  qp_set_opt_num_threads(mem, 1);
+  ref = bin_dets(mem, pnt, 1, 0);
+  dref = make_dets(1, pnt->n);
+  memset(dref->arr[0].tod, 0, pnt->n * sizeof(double));
+  ok[0] = ref && !qp_map2tod(mem, dref, pnt, ref);
+  d[0] = 0;
+  for (int pp = 0; pp < 2; pp++)
+    for (int tt = 0; tt < 2; tt++) {
+      qp_set_opt_parallel_mode(mem, pmodes[pp]);
+      qp_set_opt_num_threads(mem, nts[tt]);
+      dets = make_dets(1, pnt->n);
+      memset(dets->arr[0].tod, 0, pnt->n * sizeof(double));
+      if (ok[0] && !qp_map2tod(mem, dets, pnt, ref))
+        d[0] = fmax(d[0], tod_diff(dref, dets, pnt->n));
+      else
+        ok[0] = 0;
+      qp_free_detarr(dets);
+    }
+  check(ok[0] && d[0] < 1e-12, "sample mode, map2tod", d[0]);
+
+  if (ref)
+    qp_free_map(ref);
+  qp_free_detarr(dref);
+  qp_set_opt_parallel_mode(mem, QP_PARALLEL_DET);
+  qp_set_opt_num_threads(mem, nthreads);
+  qp_set_opt_mean_aber(mem, 1);
+  qp_set_rate_aaber(mem, rate);
+  qp_reset_point_beta(pnt);
+  qp_set_error(mem, 0, NULL);
+}
+
+/* Binning blocks of samples in pixel order gives the same maps, bit for
+   bit, as binning in sample order, since samples in the same pixel are
+   still added in sample order.  Interleaved maps give the same maps and
+   timestreams as maps stored by column. */
+static void test_map_layout(qp_memory_t *mem, qp_point_t *pnt) {
+  const int modes[3] = {QP_REDUCE_COPY, QP_REDUCE_OWNER, QP_REDUCE_SPARSE};
+  int nthreads = qp_get_opt_num_threads(mem);
+  int nts[2] = {1, nthreads};
+  qp_map_t *map, *ref, *imap, *isum, *sum;
+  qp_detarr_t *dets, *idets;
+  double d[2] = {0, 0};
+  int err = 0;
+
+  for (int diff = 0; diff < 2; diff++)
+    for (int tt = 0; tt < 2; tt++)
+      for (int mm = 0; mm < 3; mm++) {
+        qp_set_opt_num_threads(mem, nts[tt]);
+        qp_set_opt_reduce_mode(mem, modes[mm]);
+        ref = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+        map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+        imap = qp_init_map_interleaved(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+        err |= bin_map(mem, pnt, NDET, diff, ref);
+        qp_set_opt_sort_pix(mem, 1);
+        err |= bin_map(mem, pnt, NDET, diff, map);
+        err |= bin_map(mem, pnt, NDET, diff, imap);
+        qp_set_opt_sort_pix(mem, 0);
+        d[0] = fmax(d[0], map_diff(ref, map));
+        d[0] = fmax(d[0], map_diff(ref, imap));
+        qp_free_map(map);
+        map = qp_init_map_interleaved(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+        err |= bin_map(mem, pnt, NDET, diff, map);
+        d[1] = fmax(d[1], map_diff(ref, map));
+        qp_free_map(ref);
+        qp_free_map(map);
+        qp_free_map(imap);
+      }
+  qp_set_opt_num_threads(mem, nthreads);
+  qp_set_opt_reduce_mode(mem, QP_REDUCE_COPY);
+  check(!err && d[0] == 0, "sort_pix vs unsorted binning", d[0]);
+  check(!err && d[1] == 0, "interleaved vs planar, tod2map", d[1]);
+
+  /* scan and sum */
+  ref = bin_dets(mem, pnt, NDET, 0);
+  imap = qp_init_map_interleaved(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  err = !ref || bin_map(mem, pnt, NDET, 0, imap);
+  dets = make_dets(NDET, pnt->n);
+  idets = make_dets(NDET, pnt->n);
+  if (!err) {
+    err |= qp_map2tod(mem, dets, pnt, ref);
+    err |= qp_map2tod(mem, idets, pnt, imap);
+  }
+  d[0] = err ? -1 : tod_diff(dets, idets, pnt->n);
+  check(!err && d[0] == 0, "interleaved vs planar, map2tod", d[0]);
+  qp_free_detarr(dets);
+  qp_free_detarr(idets);
+
+  sum = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  isum = qp_init_map_interleaved(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  if (!err) {
+    err |= qp_add_map(mem, sum, ref) || qp_add_map(mem, sum, ref);
+    err |= qp_add_map(mem, isum, imap) || qp_add_map(mem, isum, ref);
+  }
+  d[0] = err ? -1 : map_diff(sum, isum);
+  check(!err && d[0] == 0, "interleaved vs planar, add_map", d[0]);
+
+  qp_free_map(sum);
+  qp_free_map(isum);
+  qp_free_map(imap);
+  if (ref)
+    qp_free_map(ref);
+  qp_set_error(mem, 0, NULL);
+}
+
+/* Pointing computed once with qp_detarr_pnt and attached to the detectors
+   gives the same maps and timestreams as pointing computed on the fly, to
+   the precision of the cached pol angles, for full and partial maps. */
+static void test_pnt_cache(qp_memory_t *mem, qp_point_t *pnt) {
+  size_t npix = 12 * NSIDE * NSIDE, n = NDET * pnt->n, nhit = 0;
+  long *pix = malloc(n * sizeof(long));
+  float *sin2psi = malloc(n * sizeof(float));
+  float *cos2psi = malloc(n * sizeof(float));
+  long *mpix = malloc(npix * sizeof(long));
+  qp_map_t *ref, *map, *full;
+  qp_detarr_t *dets, *cdets;
+  double d[3] = {0, 0, 0}, amax;
+  int err;
+
+  /* partial map of every other hit pixel */
+  full = bin_dets(mem, pnt, NDET, 0);
+  err = !full;
+  for (size_t ii = 0; !err && ii < npix; ii++)
+    if (map_val(full, 1, 0, ii) > 0 && ii % 2)
+      mpix[nhit++] = ii;
+  qp_set_opt_error_missing(mem, 0);
+
+  for (int partial = 0; partial < 2 && !err; partial++)
+    for (int diff = 0; diff < 2; diff++) {
+      ref = qp_init_map(NSIDE, partial ? nhit : 0, QP_VEC_POL, QP_PROJ_POL);
+      map = qp_init_map(NSIDE, partial ? nhit : 0, QP_VEC_POL, QP_PROJ_POL);
+      if (partial) {
+        qp_init_map_pixhash(ref, mpix, nhit);
+        qp_init_map_pixhash(map, mpix, nhit);
+      }
+      dets = make_dets(NDET, pnt->n);
+      cdets = make_dets(NDET, pnt->n);
+      err |= qp_detarr_pnt(mem, cdets, pnt, map, pix, sin2psi, cos2psi);
+      qp_init_detarr_pnt_from_arrays_1d(cdets, pix, sin2psi, cos2psi,
+                                        pnt->n, 0);
+      dets->diff = cdets->diff = diff;
+      err |= qp_tod2map(mem, dets, pnt, ref);
+      err |= qp_tod2map(mem, cdets, pnt, map);
+      dets->n = cdets->n = NDET;
+      d[diff] = fmax(d[diff], map_diff(ref, map));
+      /* the hits do not depend on the pol angles */
+      for (size_t ii = 0; ii < ref->npix; ii++)
+        if (ref->proj[0][ii] != map->proj[0][ii])
+          err = 1;
+
+      if (!diff) {
+        for (size_t idet = 0; idet < NDET; idet++)
+          for (size_t ii = 0; ii < pnt->n; ii++)
+            dets->arr[idet].tod[ii] = cdets->arr[idet].tod[ii] = 0;
+        err |= qp_map2tod(mem, dets, pnt, ref);
+        err |= qp_map2tod(mem, cdets, pnt, ref);
+        amax = 0;
+        for (size_t idet = 0; idet < NDET; idet++)
+          for (size_t ii = 0; ii < pnt->n; ii++)
+            amax = fmax(amax, fabs(dets->arr[idet].tod[ii]));
+        d[2] = fmax(d[2], tod_diff(dets, cdets, pnt->n) / amax);
+      }
+
+      qp_free_detarr(dets);
+      qp_free_detarr(cdets);
+      qp_free_map(ref);
+      qp_free_map(map);
+    }
+  check(!err && d[0] < 1e-6, "pointing cache, tod2map", d[0]);
+  check(!err && d[1] < 1e-6, "pointing cache, detector pairs", d[1]);
+  check(!err && d[2] < 1e-6, "pointing cache, map2tod", d[2]);
+
+  qp_set_opt_error_missing(mem, 1);
+  qp_set_error(mem, 0, NULL);
+  if (full)
+    qp_free_map(full);
+  free(mpix);
+  free(pix);
+  free(sin2psi);
+  free(cos2psi);
+}
+
+/* Scanning a partial map with interpolation through the cached stencil of
+   qp_detarr_interp gives the same timestreams as interpolating each sample
+   on the fly, to the precision of the cached weights and pol angles, with
+   and without interp_missing.  Samples dropped for missing neighbors must
+   be the same. */
+static void test_interp_cache(qp_memory_t *mem, qp_point_t *pnt) {
+  size_t npix = 12 * NSIDE * NSIDE, n = NDET * pnt->n, nhit = 0;
+  long *pix = malloc(n * sizeof(long));
+  float *sin2psi = malloc(n * sizeof(float));
+  float *cos2psi = malloc(n * sizeof(float));
+  int32_t *ipix = malloc(4 * n * sizeof(int32_t));
+  float *iweight = malloc(4 * n * sizeof(float));
+  long *mpix = malloc(npix * sizeof(long));
+  qp_map_t *map, *full;
+  qp_detarr_t *dets, *cdets;
+  double d[2] = {0, 0}, amax, a, b;
+  size_t nbad[2] = {0, 0}, nmiss[2] = {0, 0};
+  int err;
+
+  /* partial map missing every third hit pixel */
+  full = bin_dets(mem, pnt, NDET, 0);
+  err = !full;
+  for (size_t ii = 0; !err && ii < npix; ii++)
+    if (map_val(full, 1, 0, ii) > 0 && ii % 3)
+      mpix[nhit++] = ii;
+  map = qp_init_map(NSIDE, nhit, QP_VEC_POL, QP_PROJ_NONE);
+  qp_init_map_pixhash(map, mpix, nhit);
+  for (size_t kk = 0; kk < map->num_vec; kk++)
+    for (size_t ii = 0; ii < nhit; ii++)
+      map->vec[kk][ii] = 1 + kk + sin(0.01 * mpix[ii]);
+
+  qp_set_opt_interp_pix(mem, 1);
+  qp_set_opt_error_missing(mem, 0);
+  qp_set_opt_nan_missing(mem, 1);
+  for (int miss = 0; miss < 2 && !err; miss++) {
+    qp_set_opt_interp_missing(mem, miss);
+    dets = make_dets(NDET, pnt->n);
+    cdets = make_dets(NDET, pnt->n);
+    err |= qp_detarr_interp(mem, cdets, pnt, map, pix, sin2psi, cos2psi,
+                            ipix, iweight);
+    qp_init_detarr_pnt_from_arrays_1d(cdets, pix, sin2psi, cos2psi, pnt->n,
+                                      0);
+    qp_init_detarr_interp_from_arrays_1d(cdets, ipix, iweight, pnt->n, 0);
+    for (size_t idet = 0; idet < NDET; idet++)
+      for (size_t ii = 0; ii < pnt->n; ii++)
+        dets->arr[idet].tod[ii] = cdets->arr[idet].tod[ii] = 0;
+    err |= qp_map2tod(mem, dets, pnt, map);
+    err |= qp_map2tod(mem, cdets, pnt, map);
+
+    amax = 0;
+    for (size_t idet = 0; idet < NDET; idet++)
+      for (size_t ii = 0; ii < pnt->n; ii++) {
+        a = dets->arr[idet].tod[ii];
+        b = cdets->arr[idet].tod[ii];
+        if (isnan(a) || isnan(b)) {
+          nmiss[miss]++;
+          nbad[miss] += isnan(a) != isnan(b);
+          continue;
+        }
+        amax = fmax(amax, fabs(a));
+        d[miss] = fmax(d[miss], fabs(a - b));
+      }
+    if (amax > 0)
+      d[miss] /= amax;
+
+    qp_free_detarr(dets);
+    qp_free_detarr(cdets);
+  }
+  check(!err && !nbad[0] && nmiss[0] && d[0] < 1e-6,
+        "stencil cache vs interpolation, missing pixels", d[0]);
+  check(!err && !nbad[1] && nmiss[1] < nmiss[0] && d[1] < 1e-6,
+        "stencil cache vs interpolation, interp_missing", d[1]);
+
+  qp_set_opt_interp_pix(mem, 0);
+  qp_set_opt_interp_missing(mem, 0);
+  qp_set_opt_nan_missing(mem, 0);
+  qp_set_opt_error_missing(mem, 1);
+  qp_set_error(mem, 0, NULL);
+  qp_free_map(map);
+  if (full)
+    qp_free_map(full);
+  free(mpix);
+  free(pix);
+  free(sin2psi);
+  free(cos2psi);
+  free(ipix);
+  free(iweight);
+}
+
+/* Sum maps with qp_add_maps, and reject maps that do not match. */
+static void test_add_maps(qp_memory_t *mem, qp_point_t *pnt) {
+  qp_detarr_t *dets = make_dets(NDET, pnt->n);
+  qp_map_t *map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  qp_map_t *sum = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  qp_map_t *maplocs[3];
+  long pix[4] = {10, 11, 12, 100};
+  double d;
+  int err;
+
+  qp_tod2map(mem, dets, pnt, map);
+  maplocs[0] = map;
+  maplocs[1] = NULL;
+  maplocs[2] = map;
+  err = qp_add_maps(mem, sum, maplocs, 3);
+  for (size_t kk = 0; kk < map->num_vec; kk++)
+    for (size_t ii = 0; ii < map->npix; ii++)
+      sum->vec[kk][ii] -= 2 * map->vec[kk][ii];
+  for (size_t kk = 0; kk < map->num_proj; kk++)
+    for (size_t ii = 0; ii < map->npix; ii++)
+      sum->proj[kk][ii] -= 2 * map->proj[kk][ii];
+  qp_free_map(map);
+  map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  d = map_diff(sum, map);
+  check(!err && d == 0, "add_maps, sum", d);
+  qp_free_map(map);
+
+  map = qp_init_map(NSIDE / 2, 0, QP_VEC_POL, QP_PROJ_POL);
+  err = qp_add_maps(mem, sum, &map, 1);
+  check(err == QP_ERROR_MAP, "add_maps, nside mismatch", err);
+  qp_free_map(map);
+
+  map = qp_init_map(NSIDE, 0, QP_VEC_TEMP, QP_PROJ_POL);
+  err = qp_add_maps(mem, sum, &map, 1);
+  check(err == QP_ERROR_MAP, "add_maps, vec_mode mismatch", err);
+  qp_free_map(map);
+
+  qp_free_map(sum);
+  sum = qp_init_map(NSIDE, 4, QP_VEC_POL, QP_PROJ_POL);
+  map = qp_init_map(NSIDE, 4, QP_VEC_POL, QP_PROJ_POL);
+  qp_init_map_pixhash(sum, pix, 4);
+  pix[3] = 101;
+  qp_init_map_pixhash(map, pix, 4);
+  err = qp_add_maps(mem, sum, &map, 1);
+  check(err == QP_ERROR_MAP, "add_maps, partial pixel mismatch", err);
+  qp_free_map(map);
+
+  map = qp_init_map_from_map(sum, 1, 0);
+  err = qp_add_maps(mem, sum, &map, 1);
+  check(!err, "add_maps, partial map copy", err);
+  qp_free_map(map);
+
+  qp_set_error(mem, 0, NULL);
+  qp_free_map(sum);
+  qp_free_detarr(dets);
+}
+
+/* Random symmetric matrix a = r diag(e) r^T, with r a random rotation from
+   Gram-Schmidt orthogonalization, in packed upper-triangular form. */
+static void make_sym(int n, const double *e, double *packed) {
+  double r[4][4], a, x;
+  int kk = 0;
+
+  for (int ii = 0; ii < n; ii++) {
+    for (int jj = 0; jj < n; jj++)
+      r[ii][jj] = rand() / (double) RAND_MAX - 0.5;
+    for (int ll = 0; ll < ii; ll++) {
+      a = 0;
+      for (int jj = 0; jj < n; jj++)
+        a += r[ii][jj] * r[ll][jj];
+      for (int jj = 0; jj < n; jj++)
+        r[ii][jj] -= a * r[ll][jj];
+    }
+    a = 0;
+    for (int jj = 0; jj < n; jj++)
+      a += r[ii][jj] * r[ii][jj];
+    for (int jj = 0; jj < n; jj++)
+      r[ii][jj] /= sqrt(a);
+  }
+
+  for (int ii = 0; ii < n; ii++)
+    for (int jj = ii; jj < n; jj++) {
+      x = 0;
+      for (int ll = 0; ll < n; ll++)
+        x += r[ll][ii] * e[ll] * r[ll][jj];
+      packed[kk++] = x;
+    }
+}
+
+/* product of a packed symmetric matrix and a vector */
+static void sym_mul(int n, const double *packed, const double *x, double *y) {
+  for (int ii = 0; ii < n; ii++) {
+    y[ii] = 0;
+    for (int jj = 0; jj < n; jj++) {
+      int lo = ii < jj ? ii : jj, hi = ii < jj ? jj : ii;
+      y[ii] += packed[lo * n - lo * (lo - 1) / 2 + hi - lo] * x[jj];
+    }
+  }
+}
+
+/* Per-pixel solve, unsolve, inverse and condition number, compared with
+   matrices of known eigenvalues.  Pixel 0 is unhit, and for nmap > 1,
+   pixel 1 has a condition number of order 1e3, above the threshold. */
+static void test_solve(qp_memory_t *mem, int nmap) {
+  const size_t npix = 1000;
+  const int nproj = nmap * (nmap + 1) / 2;
+  double *vec[4], *proj[10], *proj0[10], *vec0[4];
+  double *cond = malloc(npix * sizeof(double));
+  double *cref = malloc(npix * sizeof(double));
+  double *xref = malloc(nmap * npix * sizeof(double));
+  double *iref = malloc(nproj * npix * sizeof(double));
+  uint8_t *mask = malloc(npix);
+  double e[4], einv[4], a[10], x[4], v[4];
+  double dcond = 0, dvec = 0, dinv = 0, dunsolve = 0;
+  size_t nbad;
+  int err, ok = 1;
+  char name[64];
+
+  for (int jj = 0; jj < nmap; jj++) {
+    vec[jj] = malloc(npix * sizeof(double));
+    vec0[jj] = malloc(npix * sizeof(double));
+  }
+  for (int kk = 0; kk < nproj; kk++) {
+    proj[kk] = malloc(npix * sizeof(double));
+    proj0[kk] = malloc(npix * sizeof(double));
+  }
+
+  srand(nmap);
+  for (size_t ii = 0; ii < npix; ii++) {
+    double emin = 1e300, emax = 0;
+    for (int jj = 0; jj < nmap; jj++) {
+      e[jj] = (ii == 1 && jj == nmap - 1) ? 1e-3 : 1 + 2. * rand() / RAND_MAX;
+      if (jj == 0 && nmap > 1 && ii != 1)
+        e[jj] = 4;
+      emin = fmin(emin, e[jj]);
+      emax = fmax(emax, e[jj]);
+      einv[jj] = 1. / e[jj];
+      x[jj] = rand() / (double) RAND_MAX - 0.5;
+    }
+    /* same rotation for the matrix and its inverse */
+    unsigned seed = rand();
+    srand(seed);
+    make_sym(nmap, e, a);
+    srand(seed);
+    make_sym(nmap, einv, iref + nproj * ii);
+    sym_mul(nmap, a, x, v);
+    for (int kk = 0; kk < nproj; kk++)
+      proj[kk][ii] = ii ? a[kk] : 0;
+    for (int jj = 0; jj < nmap; jj++) {
+      vec[jj][ii] = ii ? v[jj] : 0;
+      xref[nmap * ii + jj] = x[jj];
+    }
+    cref[ii] = ii ? emax / emin : 1.0 / 0.0;
+  }
+  for (int kk = 0; kk < nproj; kk++)
+    memcpy(proj0[kk], proj[kk], npix * sizeof(double));
+  for (int jj = 0; jj < nmap; jj++)
+    memcpy(vec0[jj], vec[jj], npix * sizeof(double));
+
+  err = qp_proj_cond(mem, proj, nmap, npix, cond);
+  for (size_t ii = 1; ii < npix; ii++)
+    dcond = fmax(dcond, fabs(cond[ii] / cref[ii] - 1));
+  sprintf(name, "proj_cond, nmap=%d", nmap);
+  check(!err && isinf(cond[0]) && dcond < 1e-9, name, dcond);
+
+  /* solve without inverting proj */
+  memset(mask, 1, npix);
+  err = qp_solve_map(mem, vec, proj, nmap, npix, mask, cond, 100, -1, 0);
+  nbad = nmap > 1 ? 2 : 1;
+  for (size_t ii = nbad; ii < npix; ii++)
+    for (int jj = 0; jj < nmap; jj++)
+      dvec = fmax(dvec, fabs(vec[jj][ii] - xref[nmap * ii + jj]));
+  for (size_t ii = 0; ii < npix; ii++)
+    ok &= mask[ii] == (ii >= nbad) && (ii >= nbad || vec[0][ii] == -1);
+  for (int kk = 0; kk < nproj; kk++)
+    ok &= !memcmp(proj[kk], proj0[kk], npix * sizeof(double));
+  sprintf(name, "solve_map, nmap=%d", nmap);
+  check(!err && ok && dvec < 1e-9, name, dvec);
+
+  /* unsolve the reference solution */
+  for (size_t ii = 0; ii < npix; ii++)
+    for (int jj = 0; jj < nmap; jj++)
+      vec[jj][ii] = xref[nmap * ii + jj];
+  err = qp_unsolve_map(mem, vec, proj, nmap, npix, NULL, 0);
+  for (size_t ii = 1; ii < npix; ii++)
+    for (int jj = 0; jj < nmap; jj++)
+      dunsolve = fmax(dunsolve, fabs(vec[jj][ii] - vec0[jj][ii]));
+  sprintf(name, "unsolve_map, nmap=%d", nmap);
+  check(!err && dunsolve < 1e-12, name, dunsolve);
+
+  /* solve with the inverse returned in proj */
+  for (int jj = 0; jj < nmap; jj++)
+    memcpy(vec[jj], vec0[jj], npix * sizeof(double));
+  err = qp_solve_map(mem, vec, proj, nmap, npix, NULL, NULL, 0, 0, 1);
+  for (size_t ii = 1; ii < npix; ii++)
+    for (int kk = 0; kk < nproj; kk++)
+      dinv = fmax(dinv, fabs(proj[kk][ii] - iref[nproj * ii + kk]));
+  ok = 1;
+  for (int kk = 0; kk < nproj; kk++)
+    ok &= proj[kk][0] == 0;
+  sprintf(name, "solve_map inverse, nmap=%d", nmap);
+  check(!err && ok && dinv < 1e-9, name, dinv);
+
+  for (int jj = 0; jj < nmap; jj++) {
+    free(vec[jj]);
+    free(vec0[jj]);
+  }
+  for (int kk = 0; kk < nproj; kk++) {
+    free(proj[kk]);
+    free(proj0[kk]);
+  }
+  free(cond);
+  free(cref);
+  free(xref);
+  free(iref);
+  free(mask);
+}
+
+/* With per-detector annual aberration, the boresight velocity kept with the
+   pointing follows changes to the time array: it is recomputed when the
+   array is replaced, and after qp_reset_point_beta when it is modified in
+   place.  It is also recomputed when the aberration options change. */
+static void test_point_beta(qp_memory_t *mem, qp_point_t *pnt) {
+  qp_detarr_t *dets = make_dets(NDET, pnt->n);
+  double *ctime = pnt->ctime;
+  double *ctime2 = malloc(pnt->n * sizeof(double));
+  qp_map_t *map0, *map1, *map2;
+  qp_point_t *pnt2;
+  double d0, d1, rate;
+
+  qp_set_opt_mean_aber(mem, 0);
+  for (size_t ii = 0; ii < pnt->n; ii++)
+    ctime2[ii] = ctime[ii] + 100 * 86400.;
+
+  map0 = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  qp_tod2map(mem, dets, pnt, map0);
+
+  /* replaced time array */
+  map1 = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  pnt->ctime = ctime2;
+  qp_tod2map(mem, dets, pnt, map1);
+  map2 = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  pnt2 = qp_init_point_from_arrays(pnt->q_bore, ctime2, NULL, pnt->n, 0);
+  qp_tod2map(mem, dets, pnt2, map2);
+  qp_free_point(pnt2);
+  d0 = map_diff(map0, map1);
+  d1 = map_diff(map1, map2);
+  check(d0 > 0 && d1 == 0, "aberration, replaced ctime", d1);
+  qp_free_map(map1);
+
+  /* modified in place */
+  map1 = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  memcpy(ctime2, ctime, pnt->n * sizeof(double));
+  qp_reset_point_beta(pnt);
+  qp_tod2map(mem, dets, pnt, map1);
+  d1 = map_diff(map0, map1);
+  check(d1 == 0, "aberration, ctime modified in place", d1);
+  qp_free_map(map1);
+  qp_free_map(map2);
+
+  /* changed options, with the velocity kept for the current ones */
+  pnt->ctime = ctime;
+  map1 = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  qp_tod2map(mem, dets, pnt, map1);
+  qp_free_map(map1);
+  rate = qp_get_rate_aaber(mem);
+  qp_set_rate_aaber(mem, QP_DO_NEVER);
+  map1 = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  qp_tod2map(mem, dets, pnt, map1);
+  map2 = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  pnt2 = qp_init_point_from_arrays(pnt->q_bore, ctime, NULL, pnt->n, 0);
+  qp_tod2map(mem, dets, pnt2, map2);
+  qp_free_point(pnt2);
+  qp_set_rate_aaber(mem, rate);
+  d0 = map_diff(map0, map1);
+  d1 = map_diff(map1, map2);
+  check(d0 > 0 && d1 == 0, "aberration, changed rate", d1);
+
+  pnt->ctime = ctime;
+  qp_reset_point_beta(pnt);
+  qp_set_opt_mean_aber(mem, 1);
+  qp_free_map(map0);
+  qp_free_map(map1);
+  qp_free_map(map2);
+  free(ctime2);
+  qp_free_detarr(dets);
+}
+
+/* Binning into single-precision maps accumulates in double precision, so
+   the result must match a double-precision map to float precision, with
+   each reduction mode, for partial maps with missing pixels, and for
+   single detectors and detector pairs. */
+static void test_single_maps(qp_memory_t *mem, qp_point_t *pnt) {
+  const int modes[3] = {QP_REDUCE_COPY, QP_REDUCE_OWNER, QP_REDUCE_SPARSE};
+  size_t npix = 12 * NSIDE * NSIDE;
+  qp_detarr_t *dets = make_dets(NDET, pnt->n);
+  qp_map_t *map, *mapf;
+  long *pix = malloc(npix * sizeof(long));
+  size_t nhit = 0;
+  double d = 0;
+  int err = 0;
+
+  for (int mm = 0; mm < 3; mm++) {
+    qp_set_opt_reduce_mode(mem, modes[mm]);
+    map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+    mapf = qp_init_map_single(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+    for (int rep = 0; rep < 2; rep++) {
+      err |= qp_tod2map(mem, dets, pnt, map);
+      err |= qp_tod2map(mem, dets, pnt, mapf);
+    }
+    d = fmax(d, map_diff(map, mapf));
+    qp_free_map(mapf);
+    if (mm < 2)
+      qp_free_map(map);
+  }
+  qp_set_opt_reduce_mode(mem, QP_REDUCE_COPY);
+  check(!err && d < 1e-6, "single precision, reduce modes", d);
+
+  /* partial map of every other hit pixel */
+  for (size_t ii = 0; ii < npix; ii++)
+    if (map_val(map, 1, 0, ii) > 0 && ii % 2)
+      pix[nhit++] = ii;
+  qp_free_map(map);
+
+  qp_set_opt_error_missing(mem, 0);
+  map = qp_init_map(NSIDE, nhit, QP_VEC_POL, QP_PROJ_POL);
+  mapf = qp_init_map_single(NSIDE, nhit, QP_VEC_POL, QP_PROJ_POL);
+  qp_init_map_pixhash(map, pix, nhit);
+  qp_init_map_pixhash(mapf, pix, nhit);
+  err = qp_tod2map(mem, dets, pnt, map);
+  err |= qp_tod2map(mem, dets, pnt, mapf);
+  d = map_diff(map, mapf);
+  check(!err && d < 1e-6, "single precision, missing pixels", d);
+  qp_set_opt_error_missing(mem, 1);
+  qp_free_map(map);
+  qp_free_map(mapf);
+
+  map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  mapf = qp_init_map_single(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  err = 0;
+  for (size_t idet = 0; idet < dets->n; idet++) {
+    err |= qp_tod2map1(mem, dets->arr + idet, pnt, map);
+    err |= qp_tod2map1(mem, dets->arr + idet, pnt, mapf);
+  }
+  d = map_diff(map, mapf);
+  check(!err && d < 1e-6, "single precision, qp_tod2map1", d);
+  qp_free_map(map);
+  qp_free_map(mapf);
+
+  /* detector pairs; qp_tod2map halves the number of detectors in place */
+  map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  mapf = qp_init_map_single(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  qp_free_detarr(dets);
+  dets = make_dets(NDET, pnt->n);
+  dets->diff = 1;
+  err = qp_tod2map(mem, dets, pnt, map);
+  dets->n = NDET;
+  qp_free_detarr(dets);
+  dets = make_dets(NDET, pnt->n);
+  dets->diff = 1;
+  err |= qp_tod2map(mem, dets, pnt, mapf);
+  dets->n = NDET;
+  d = map_diff(map, mapf);
+  check(!err && d < 1e-6, "single precision, detector pairs", d);
+  qp_free_map(map);
+  qp_free_map(mapf);
+
+  free(pix);
+  qp_free_detarr(dets);
+}
+
+/* index of the first occurrence of pix in the list, or -1 */
+static long brute_repixelize(long *pix, size_t n, long p) {
+  for (size_t ii = 0; ii < n; ii++)
+    if (pix[ii] == p)
+      return ii;
+  return -1;
+}
+
+/* Build a pixhash from the pixel list, check that the expected index
+   structure is chosen (if mode >= 0), and compare lookups of the listed
+   pixels, their neighbors and out-of-range pixels with a brute-force
+   search. */
+static void check_pixhash(const char *name, long *pix, size_t n,
+                          int mode) {
+  qp_pixhash_t *pixhash = qp_init_pixhash(pix, n);
+  qp_pixhash_t *copy = qp_copy_pixhash(pixhash);
+  size_t nq = 3 * n + 3;
+  long *query = malloc(nq * sizeof(long));
+  long *index = malloc(nq * sizeof(long));
+  long *index_copy = malloc(nq * sizeof(long));
+  size_t nbad = 0;
+
+  for (size_t ii = 0; ii < n; ii++) {
+    query[3 * ii] = pix[ii];
+    query[3 * ii + 1] = pix[ii] - 1;
+    query[3 * ii + 2] = pix[ii] + 1;
+  }
+  query[3 * n] = -1;
+  query[3 * n + 1] = 0;
+  query[3 * n + 2] = 12 * 1024 * 1024;
+
+  qp_repixelizen(pixhash, query, index, nq);
+  qp_repixelizen(copy, query, index_copy, nq);
+  for (size_t ii = 0; ii < nq; ii++) {
+    long ref = brute_repixelize(pix, n, query[ii]);
+    if (query[ii] < 0)
+      ref = -1;
+    if (qp_repixelize(pixhash, query[ii]) != ref || index[ii] != ref ||
+        index_copy[ii] != ref)
+      nbad++;
+  }
+  check((mode < 0 || (int) pixhash->mode == mode) && nbad == 0, name, nbad);
+
+  free(query);
+  free(index);
+  free(index_copy);
+  qp_free_pixhash(copy);
+  qp_free_pixhash(pixhash);
+}
+
+static void test_pixhash(void) {
+  size_t n = 2000;
+  long *pix = malloc(n * sizeof(long));
+
+  /* scattered pixels, with a duplicate */
+  srand(1);
+  for (size_t ii = 0; ii < n; ii++)
+    pix[ii] = ((long) rand() * 7919) % (12 * 1024 * 1024);
+  pix[n - 1] = pix[n / 2];
+  check_pixhash("pixhash, hash table", pix, n, QP_PIXHASH_HASH);
+  check_pixhash("pixhash, empty", pix, 0, -1);
+
+  /* sorted runs of 40 pixels, separated by large gaps */
+  for (size_t ii = 0; ii < n; ii++)
+    pix[ii] = 1000 + (ii / 40) * 5000 + ii % 40;
+  check_pixhash("pixhash, runs", pix, n, QP_PIXHASH_RUNS);
+
+  /* unsorted runs are not searchable */
+  pix[0] = pix[n - 1] + 1;
+  check_pixhash("pixhash, unsorted runs", pix, n, QP_PIXHASH_HASH);
+
+  /* a dense range with holes, out of order, with a duplicate */
+  for (size_t ii = 0; ii < n; ii++)
+    pix[ii] = 50000 + (ii * 997) % (2 * n);
+  pix[n - 1] = pix[3];
+  check_pixhash("pixhash, direct", pix, n, QP_PIXHASH_DIRECT);
+
+  /* a single pixel */
+  check_pixhash("pixhash, single pixel", pix, 1, QP_PIXHASH_DIRECT);
+
+  free(pix);
+}
+
+/* Rotate a TQU map from C to G with a rotation plan, with and without
+   interpolation, and compare with rotating each output pixel center with
+   qp_gal2radec and the polarization angle with qp_radec2gal. */
+static void test_rotate_plan(qp_memory_t *mem) {
+  long npix = 12 * NSIDE * NSIDE;
+  double *map_in[3], *map_out[3], *ref[3];
+  double d, dmax;
+  qp_pixinfo_t *pixinfo = qp_init_pixinfo(NSIDE, 1);
+  qp_rotate_plan_t *plan;
+
+  for (int kk = 0; kk < 3; kk++) {
+    map_in[kk] = malloc(npix * sizeof(double));
+    map_out[kk] = malloc(npix * sizeof(double));
+    ref[kk] = malloc(npix * sizeof(double));
+  }
+  for (long ii = 0; ii < npix; ii++) {
+    map_in[0][ii] = ii;
+    map_in[1][ii] = 1 + sin(ii * 0.01);
+    map_in[2][ii] = 0.5 * cos(ii * 0.003);
+  }
+
+  for (int interp = 0; interp < 2; interp++) {
+    qp_set_opt_interp_pix(mem, interp);
+
+    for (long ii = 0; ii < npix; ii++) {
+      double theta, phi, ra, dec, s2p = 0, c2p = 1, w[4] = {1, 0, 0, 0};
+      double t = 0, q = 0, u = 0;
+      long ipix[4];
+      pix2ang_ring(NSIDE, ii, &theta, &phi);
+      ra = phi * r2d;
+      dec = 90 - theta * r2d;
+      qp_gal2radec(mem, &ra, &dec, &s2p, &c2p);
+      if (interp)
+        qp_get_interpol(mem, pixinfo, ra, dec, ipix, w);
+      else
+        ipix[0] = qp_radec2pix(mem, ra, dec, NSIDE);
+      for (int jj = 0; jj < 1 + 3 * interp; jj++) {
+        t += map_in[0][ipix[jj]] * w[jj];
+        q += map_in[1][ipix[jj]] * w[jj];
+        u += map_in[2][ipix[jj]] * w[jj];
+      }
+      s2p = 0;
+      c2p = 1;
+      qp_radec2gal(mem, &ra, &dec, &s2p, &c2p);
+      ref[0][ii] = t;
+      ref[1][ii] = q * c2p + u * s2p;
+      ref[2][ii] = u * c2p - q * s2p;
+    }
+
+    plan = qp_init_rotate_plan(mem, NSIDE, 'C', 'G', NULL, 0, NULL, 0);
+    qp_apply_rotate_plan(mem, plan, map_in, map_out, 3, 1);
+    qp_free_rotate_plan(plan);
+
+    dmax = 0;
+    for (int kk = 0; kk < 3; kk++)
+      for (long ii = 0; ii < npix; ii++) {
+        d = fabs(map_out[kk][ii] - ref[kk][ii]) / (kk ? 1 : npix);
+        if (d > dmax || isnan(d))
+          dmax = d;
+      }
+    check(dmax < 1e-6, interp ? "rotate plan C->G, interpolated" :
+          "rotate plan C->G", dmax);
+  }
+
+  qp_set_opt_interp_pix(mem, 0);
+  qp_free_pixinfo(pixinfo);
+  for (int kk = 0; kk < 3; kk++) {
+    free(map_in[kk]);
+    free(map_out[kk]);
+    free(ref[kk]);
+  }
+}
+
+/* Grid pixels containing positions just inside and just outside each edge
+   of the grid, and at pixel centers, for a CAR grid across the RA wrap
+   with a negative RA step and for a TAN grid.  Positions are given in
+   pixel units, where pixel ix spans [ix, ix + 1). */
+static void test_grid_edges(qp_memory_t *mem) {
+  const double f[6] = {-1e-6, 1e-6, 0.5, 7.5, 1 - 1e-6, 1 + 1e-6};
+  const long nx = 20, ny = 10;
+  const double dx = -0.5, dy = 0.5, x0 = 4.75, y0 = -2.25;
+  const double ra0 = 358, dec0 = -10;
+  qp_map_t *map;
+  quat_t q[37], qc;
+  long pix[37], ref[37];
+  double s2p[37], c2p[37];
+  size_t nbad;
+
+  for (int type = QP_GRID_CAR; type <= QP_GRID_TAN; type++) {
+    map = qp_init_map(1, nx * ny, QP_VEC_TEMP, QP_PROJ_TEMP);
+    qp_init_map_grid(map, type, ra0, dec0, x0, y0, dx, dy, nx, ny);
+    Quaternion_copy(qc, map->grid.q_center);
+    Quaternion_inv(qc);
+
+    for (int jx = 0; jx < 6; jx++) {
+      for (int jy = 0; jy < 6; jy++) {
+        /* the last two positions are relative to the far edge */
+        double fx = jx < 4 ? f[jx] : nx - 1 + f[jx];
+        double fy = jy < 4 ? f[jy] : ny - 1 + f[jy];
+        double x = x0 + (fx - 0.5) * dx, y = y0 + (fy - 0.5) * dy;
+        int kk = jx * 6 + jy;
+
+        ref[kk] = (fx >= 0 && fx < nx && fy >= 0 && fy < ny) ?
+          (long) fy * nx + (long) fx : -1;
+        if (type == QP_GRID_CAR) {
+          qp_radecpa2quat(mem, ra0 + x, dec0 + y, 0, q[kk]);
+        } else {
+          double vx = 1, vy = x * d2r, vz = y * d2r;
+          double r = sqrt(vx * vx + vy * vy + vz * vz);
+          qp_radecpa2quat(mem, atan2(vy, vx) * r2d, asin(vz / r) * r2d, 0,
+                          q[kk]);
+          Quaternion_mul_left(qc, q[kk]);
+        }
+      }
+    }
+
+    /* the antipode of the center has no gnomonic projection */
+    qp_radecpa2quat(mem, ra0 + 180, -dec0, 0, q[36]);
+    ref[36] = -1;
+
+    qp_quat2gridn(mem, &map->grid, q, pix, s2p, c2p, 37);
+    nbad = 0;
+    for (int kk = 0; kk < 37; kk++)
+      nbad += pix[kk] != ref[kk];
+    check(nbad == 0, type == QP_GRID_CAR ? "CAR grid edges" :
+          "TAN grid edges", nbad);
+    qp_free_map(map);
+  }
+}
+
+/* Reordering to NEST and back, and upgrading and degrading the
+   resolution, return the original map.  The NEST ordering and the
+   degraded pixels match chealpix and the mean of the NEST subpixels. */
+static void test_reorder_ud_grade(qp_memory_t *mem) {
+  const int nside = 16, nside_hi = 64, ncol = 3;
+  const char *names[4] = {"ud_grade RING round trip",
+                          "ud_grade RING round trip, sum",
+                          "ud_grade NEST round trip",
+                          "ud_grade NEST round trip, sum"};
+  long npix = 12 * nside * nside, npix_hi = 12 * nside_hi * nside_hi;
+  double *map[3], *orig[3], *hi[3], *lo[3];
+  double d = 0, d1 = 0;
+  long ipix;
+  int err;
+
+  srand(4);
+  for (int kk = 0; kk < ncol; kk++) {
+    map[kk] = malloc(npix * sizeof(double));
+    orig[kk] = malloc(npix * sizeof(double));
+    lo[kk] = malloc(npix * sizeof(double));
+    hi[kk] = malloc(npix_hi * sizeof(double));
+    for (long ii = 0; ii < npix; ii++)
+      map[kk][ii] = orig[kk][ii] = (double) rand() / RAND_MAX - 0.5;
+  }
+
+  err = qp_reorder_map(mem, nside, map, ncol, 1);
+  for (int kk = 0; kk < ncol; kk++)
+    for (long ii = 0; ii < npix; ii++) {
+      ring2nest(nside, ii, &ipix);
+      d = fmax(d, fabs(map[kk][ipix] - orig[kk][ii]));
+    }
+  err |= qp_reorder_map(mem, nside, map, ncol, 0);
+  for (int kk = 0; kk < ncol; kk++)
+    for (long ii = 0; ii < npix; ii++)
+      d1 = fmax(d1, fabs(map[kk][ii] - orig[kk][ii]));
+  check(!err && d == 0, "reorder RING to NEST vs chealpix", d);
+  check(!err && d1 == 0, "reorder RING to NEST to RING", d1);
+
+  for (int nest = 0; nest < 2; nest++) {
+    for (int sum = 0; sum < 2; sum++) {
+      qp_set_opt_pix_order(mem, nest ? QP_ORDER_NEST : QP_ORDER_RING);
+      err = qp_ud_grade_map(mem, nside, orig, nside_hi, hi, ncol, NULL, sum);
+      err |= qp_ud_grade_map(mem, nside_hi, hi, nside, lo, ncol, NULL, sum);
+      d = 0;
+      for (int kk = 0; kk < ncol; kk++)
+        for (long ii = 0; ii < npix; ii++)
+          d = fmax(d, fabs(lo[kk][ii] - orig[kk][ii]));
+      check(!err && d < 1e-14, names[2 * nest + sum], d);
+    }
+  }
+
+  /* degrade a NEST map of random values */
+  for (int kk = 0; kk < ncol; kk++)
+    for (long ii = 0; ii < npix_hi; ii++)
+      hi[kk][ii] = (double) rand() / RAND_MAX;
+  err = qp_ud_grade_map(mem, nside_hi, hi, nside, lo, ncol, NULL, 0);
+  d = 0;
+  for (int kk = 0; kk < ncol; kk++)
+    for (long ii = 0; ii < npix; ii++) {
+      double mean = 0;
+      for (long jj = 0; jj < 16; jj++)
+        mean += hi[kk][16 * ii + jj] / 16;
+      d = fmax(d, fabs(lo[kk][ii] - mean));
+    }
+  check(!err && d < 1e-14, "ud_grade NEST degrade vs subpixel mean", d);
+
+  qp_set_opt_pix_order(mem, QP_ORDER_RING);
+  for (int kk = 0; kk < ncol; kk++) {
+    free(map[kk]);
+    free(orig[kk]);
+    free(lo[kk]);
+    free(hi[kk]);
+  }
+}
+
+/* Binning and solving in one call gives the same map, hits and condition
+   numbers as qp_tod2map followed by qp_proj_cond and qp_solve_map, for
+   maps stored by column and interleaved maps. */
+static void test_tod2map_solve(qp_memory_t *mem, qp_point_t *pnt) {
+  const int modes[2] = {QP_VEC_TEMP, QP_VEC_POL};
+  size_t npix = 12 * NSIDE * NSIDE;
+  double *hits = malloc(npix * sizeof(double));
+  double *cond = malloc(npix * sizeof(double));
+  double *cref = malloc(npix * sizeof(double));
+  double d[2] = {0, 0}, hmax = 0;
+  qp_detarr_t *dets;
+  qp_map_t *map, *ref;
+  int err = 0, nmap;
+
+  for (int mm = 0; mm < 2; mm++)
+    for (int il = 0; il < 2; il++) {
+      nmap = modes[mm] == QP_VEC_TEMP ? 1 : 3;
+      ref = qp_init_map(NSIDE, 0, modes[mm], modes[mm]);
+      err |= bin_map(mem, pnt, NDET, 0, ref);
+      err |= qp_proj_cond(mem, ref->proj, nmap, npix, cref);
+      for (size_t ii = 0; ii < npix; ii++)
+        hmax = fmax(hmax, ref->proj[0][ii]);
+      err |= qp_solve_map(mem, ref->vec, ref->proj, nmap, npix, NULL, NULL,
+                          100, -1, 0);
+
+      if (il)
+        map = qp_init_map_interleaved(NSIDE, 0, modes[mm], modes[mm]);
+      else
+        map = qp_init_map(NSIDE, 0, modes[mm], modes[mm]);
+      dets = make_dets(NDET, pnt->n);
+      err |= qp_tod2map_solve(mem, dets, pnt, map, hits, cond, 100, -1);
+      qp_free_detarr(dets);
+
+      d[0] = fmax(d[0], map_diff(ref, map));
+      for (size_t ii = 0; ii < npix; ii++) {
+        if (hits[ii] != ref->proj[0][ii])
+          err = 1;
+        if (isinf(cref[ii]) && isinf(cond[ii]))
+          continue;
+        d[1] = fmax(d[1], fabs(cond[ii] - cref[ii]) / cref[ii]);
+      }
+      qp_free_map(ref);
+      qp_free_map(map);
+    }
+  check(!err && hmax > 0 && d[0] == 0, "tod2map_solve vs tod2map, solve_map",
+        d[0]);
+  check(!err && d[1] == 0, "tod2map_solve vs proj_cond", d[1]);
+
+  qp_set_error(mem, 0, NULL);
+  free(hits);
+  free(cond);
+  free(cref);
+}
+
+/* Linear timestream filter for the CG mapmaker, removing half of the mean
+   of each detector.  It is symmetric and positive definite. */
+static int half_mean_filter(double *tod, size_t ndet, size_t nsamp,
+                            void *data) {
+  for (size_t idet = 0; idet < ndet; idet++) {
+    double *t = tod + idet * nsamp, mean = 0;
+    for (size_t ii = 0; ii < nsamp; ii++)
+      mean += t[ii];
+    mean /= nsamp;
+    for (size_t ii = 0; ii < nsamp; ii++)
+      t[ii] -= 0.5 * mean;
+  }
+  return 0;
+}
+
+/* Solve the dense n x n system a x = b in place, by Gaussian elimination
+   with partial pivoting.  The solution is returned in b. */
+static void dense_solve(size_t n, double *a, double *b) {
+  double f, t;
+  size_t piv;
+
+  for (size_t kk = 0; kk < n; kk++) {
+    piv = kk;
+    for (size_t ii = kk + 1; ii < n; ii++)
+      if (fabs(a[ii * n + kk]) > fabs(a[piv * n + kk]))
+        piv = ii;
+    for (size_t jj = 0; jj < n; jj++) {
+      t = a[kk * n + jj];
+      a[kk * n + jj] = a[piv * n + jj];
+      a[piv * n + jj] = t;
+    }
+    t = b[kk];
+    b[kk] = b[piv];
+    b[piv] = t;
+    for (size_t ii = kk + 1; ii < n; ii++) {
+      f = a[ii * n + kk] / a[kk * n + kk];
+      for (size_t jj = kk; jj < n; jj++)
+        a[ii * n + jj] -= f * a[kk * n + jj];
+      b[ii] -= f * b[kk];
+    }
+  }
+  for (size_t kk = n; kk-- > 0;) {
+    for (size_t jj = kk + 1; jj < n; jj++)
+      b[kk] -= a[kk * n + jj] * b[jj];
+    b[kk] /= a[kk * n + kk];
+  }
+}
+
+/* Without a filter, the CG mapmaker converges in one iteration to the
+   per-pixel solution of qp_solve_map.  With a linear filter, it converges
+   to the solution of the dense system (P^T F P) x = P^T F d, with the
+   matrix built column by column from the projection operators, on a
+   partial map of well-hit pixels. */
+static void test_cg(qp_memory_t *mem, qp_point_t *pnt) {
+  const size_t nside = 4, npix = 12 * nside * nside;
+  qp_detarr_t *dets = make_dets(NDET, pnt->n);
+  qp_map_t *map, *ref, *full, *unit, *col;
+  double resid[101], d;
+  long *mpix = malloc(npix * sizeof(long));
+  size_t nhit = 0, nx;
+  int niter = 0, err;
+
+  ref = bin_dets(mem, pnt, NDET, 0);
+  err = !ref || qp_solve_map(mem, ref->vec, ref->proj, 3, ref->npix, NULL,
+                             NULL, 1e3, 0, 0);
+  map = qp_init_map(NSIDE, 0, QP_VEC_POL, QP_PROJ_POL);
+  err |= qp_tod2map_cg(mem, dets, pnt, map, NULL, NULL, 1e3, 10, 1e-10,
+                       resid, &niter);
+  d = err ? -1 : map_diff(ref, map);
+  check(!err && niter == 1 && d < 1e-10, "tod2map_cg vs solve_map", d);
+  if (ref)
+    qp_free_map(ref);
+  qp_free_map(map);
+
+  /* well-hit pixels at low resolution */
+  full = qp_init_map(nside, 0, QP_VEC_POL, QP_PROJ_POL);
+  err = bin_map(mem, pnt, NDET, 0, full);
+  for (size_t ii = 0; !err && ii < npix; ii++)
+    if (full->proj[0][ii] > 1000)
+      mpix[nhit++] = ii;
+  qp_free_map(full);
+  nx = 3 * nhit;
+
+  double *a = malloc(nx * nx * sizeof(double));
+  double *b = malloc(nx * sizeof(double));
+  qp_det_t *orig = malloc(NDET * sizeof(qp_det_t));
+  double *buf = malloc(NDET * pnt->n * sizeof(double));
+
+  qp_set_opt_error_missing(mem, 0);
+  unit = qp_init_map(nside, nhit, QP_VEC_POL, QP_PROJ_NONE);
+  col = qp_init_map(nside, nhit, QP_VEC_POL, QP_PROJ_NONE);
+  qp_init_map_pixhash(unit, mpix, nhit);
+  qp_init_map_pixhash(col, mpix, nhit);
+
+  /* right-hand side, from the filtered timestreams */
+  for (size_t idet = 0; idet < NDET; idet++) {
+    orig[idet] = dets->arr[idet];
+    memcpy(buf + idet * pnt->n, dets->arr[idet].tod,
+           pnt->n * sizeof(double));
+    dets->arr[idet].tod = buf + idet * pnt->n;
+  }
+  half_mean_filter(buf, NDET, pnt->n, NULL);
+  err |= qp_tod2map(mem, dets, pnt, col);
+  for (size_t jj = 0; jj < nx; jj++)
+    b[jj] = col->vec[jj / nhit][jj % nhit];
+
+  /* matrix columns */
+  for (size_t jj = 0; jj < nx && !err; jj++) {
+    unit->vec[jj / nhit][jj % nhit] = 1;
+    memset(buf, 0, NDET * pnt->n * sizeof(double));
+    err |= qp_map2tod(mem, dets, pnt, unit);
+    half_mean_filter(buf, NDET, pnt->n, NULL);
+    for (size_t kk = 0; kk < 3; kk++)
+      memset(col->vec[kk], 0, nhit * sizeof(double));
+    err |= qp_tod2map(mem, dets, pnt, col);
+    for (size_t ii = 0; ii < nx; ii++)
+      a[ii * nx + jj] = col->vec[ii / nhit][ii % nhit];
+    unit->vec[jj / nhit][jj % nhit] = 0;
+  }
+  for (size_t idet = 0; idet < NDET; idet++)
+    dets->arr[idet].tod = orig[idet].tod;
+  if (!err)
+    dense_solve(nx, a, b);
+
+  map = qp_init_map(nside, nhit, QP_VEC_POL, QP_PROJ_POL);
+  qp_init_map_pixhash(map, mpix, nhit);
+  err |= qp_tod2map_cg(mem, dets, pnt, map, half_mean_filter, NULL, 0, 100,
+                       1e-12, resid, &niter);
+  d = 0;
+  for (size_t jj = 0; jj < nx; jj++)
+    d = fmax(d, fabs(map->vec[jj / nhit][jj % nhit] - b[jj]));
+  check(!err && nhit > 0 && niter > 1 && d < 1e-8,
+        "tod2map_cg, filtered vs dense solve", d);
+
+  qp_set_opt_error_missing(mem, 1);
+  qp_set_error(mem, 0, NULL);
+  qp_free_map(map);
+  qp_free_map(unit);
+  qp_free_map(col);
+  free(a);
+  free(b);
+  free(buf);
+  free(orig);
+  free(mpix);
+  qp_free_detarr(dets);
+}
+
+int main(int argc, char *argv[]) {
+  qp_memory_t *mem = qp_init_memory();
+  qp_set_opt_num_threads(mem, 4);
+  qp_point_t *pnt = make_point(mem, NSAMP);
+
+  test_pixhash();
+  test_reduce_modes(mem, pnt);
+  test_few_dets(mem, pnt);
+  test_sample_mode(mem, pnt);
+  test_map_layout(mem, pnt);
+  test_pnt_cache(mem, pnt);
+  test_interp_cache(mem, pnt);
+  test_add_maps(mem, pnt);
+  test_point_beta(mem, pnt);
+  test_single_maps(mem, pnt);
+  test_rotate_plan(mem);
+  test_grid_edges(mem);
+  test_reorder_ud_grade(mem);
+  test_solve(mem, 1);
+  test_solve(mem, 3);
+  test_solve(mem, 4);
+  test_tod2map_solve(mem, pnt);
+  test_cg(mem, pnt);
+
+  free_point(pnt);
+  qp_free_memory(mem);
+
+  if (nfail)
+    printf("%d checks failed\n", nfail);
+  return nfail ? 1 : 0;
+}
@@ -0,0 +1,593 @@
+/* Consistency checks for the pointing routines.  Each check compares two
+   ways of computing the same result, and the program exits with a
+   non-zero status if any check fails. */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <omp.h>
+#include "qpoint.h"
+#include "quaternion.h"
+#include "chealpix.h"
+
+#define NSAMP 20000
+
+static int nfail = 0;
+
+static void check(int ok, const char *name, double diff) {
+  printf("%-48s %s (%.3g)\n", name, ok ? "ok" : "FAILED", diff);
+  if (!ok)
+    nfail++;
+}
+
+/* a constant-elevation scan */
+static void make_scan(qp_memory_t *mem, size_t n, double **ctime_out,
+                      quat_t **q_bore_out) {
+  double *az = malloc(n * sizeof(double));
+  double *el = malloc(n * sizeof(double));
+  double *lon = malloc(n * sizeof(double));
+  double *lat = malloc(n * sizeof(double));
+  double *ctime = malloc(n * sizeof(double));
+  quat_t *q_bore = malloc(n * sizeof(quat_t));
+
+  for (size_t ii = 0; ii < n; ii++) {
+    az[ii] = 100 + 40 * sin(ii / 400.);
+    el[ii] = 40 + 5 * sin(ii / 5000.);
+    lon[ii] = -67;
+    lat[ii] = -23;
+    ctime[ii] = 1.5e9 + ii / 100.;
+    Quaternion_identity(q_bore[ii]);
+  }
+  qp_azel2bore(mem, az, el, NULL, NULL, lon, lat, ctime, q_bore, n);
+
+  free(az);
+  free(el);
+  free(lon);
+  free(lat);
+  *ctime_out = ctime;
+  *q_bore_out = q_bore;
+}
+
+/* maximum absolute difference between two arrays */
+static double max_diff(double *a, double *b, size_t n) {
+  double d, dmax = 0;
+  for (size_t ii = 0; ii < n; ii++) {
+    d = fabs(a[ii] - b[ii]);
+    if (d > dmax || isnan(d))
+      dmax = d;
+  }
+  return dmax;
+}
+
+/* maximum angle between two arrays of quaternions, in arcsec */
+static double max_quat_diff(quat_t *a, quat_t *b, size_t n) {
+  double d, dmax = 0, s;
+  for (size_t ii = 0; ii < n; ii++) {
+    s = (a[ii][0] * b[ii][0] + a[ii][1] * b[ii][1] + a[ii][2] * b[ii][2] +
+         a[ii][3] * b[ii][3]) < 0 ? -1 : 1;
+    d = 0;
+    for (int jj = 0; jj < 4; jj++)
+      d += (a[ii][jj] - s * b[ii][jj]) * (a[ii][jj] - s * b[ii][jj]);
+    /* the chord between unit quaternions is half the rotation angle */
+    d = 2 * sqrt(d) * r2as;
+    if (d > dmax || isnan(d))
+      dmax = d;
+  }
+  return dmax;
+}
+
+/* number of samples where two arrays of quaternions have opposite signs */
+static size_t quat_sign_flips(quat_t *a, quat_t *b, size_t n) {
+  size_t nflip = 0;
+  for (size_t ii = 0; ii < n; ii++)
+    nflip += (a[ii][0] * b[ii][0] + a[ii][1] * b[ii][1] +
+              a[ii][2] * b[ii][2] + a[ii][3] * b[ii][3]) < 0;
+  return nflip;
+}
+
+/* difference between two angles in degrees, wrapped to [0, 180] */
+static double angle_diff(double a, double b) {
+  double d = fmod(fabs(a - b), 360.);
+  return d > 180 ? 360 - d : d;
+}
+
+/* Boresight quaternions for a scan, starting at the given ctime, with the
+   batched or per-sample routine. */
+static void scan_bore(qp_memory_t *mem, size_t n, double t0, int batch,
+                      quat_t *q) {
+  double *az = malloc(n * sizeof(double));
+  double *el = malloc(n * sizeof(double));
+  double *lon = malloc(n * sizeof(double));
+  double *lat = malloc(n * sizeof(double));
+  double *ctime = malloc(n * sizeof(double));
+
+  for (size_t ii = 0; ii < n; ii++) {
+    az[ii] = 100 + 40 * sin(ii / 400.);
+    el[ii] = 40 + 5 * sin(ii / 5000.);
+    lon[ii] = -67 + 1e-4 * ii;
+    lat[ii] = -23;
+    ctime[ii] = t0 + ii / 20.;
+    Quaternion_identity(q[ii]);
+  }
+  qp_reset_rates(mem);
+  if (batch)
+    qp_azel2bore_batch(mem, az, el, NULL, NULL, lon, lat, ctime, q, n);
+  else
+    qp_azel2bore(mem, az, el, NULL, NULL, lon, lat, ctime, q, n);
+
+  free(az);
+  free(el);
+  free(lon);
+  free(lat);
+  free(ctime);
+}
+
+/* The batched boresight routine agrees with the per-sample routine to
+   1e-5 arcsec, with every correction updated per sample and with the
+   default update rates.  The quaternions also have the same sign, across
+   a wrap of the earth rotation angle, about 6716 seconds after the
+   start time of the other scans. */
+static void test_batch(qp_memory_t *mem) {
+  size_t n = NSAMP;
+  quat_t *q = malloc(n * sizeof(quat_t));
+  quat_t *q_batch = malloc(n * sizeof(quat_t));
+  qp_memory_t *mem1 = qp_init_memory();
+  size_t nflip;
+  double d;
+
+  qp_set_opt_num_threads(mem1, qp_get_opt_num_threads(mem));
+
+  scan_bore(mem1, n, 1.5e9, 0, q);
+  scan_bore(mem1, n, 1.5e9, 1, q_batch);
+  d = max_quat_diff(q, q_batch, n);
+  check(d < 1e-5, "azel2bore_batch, default rates", d);
+
+  qp_set_rates(mem1, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS,
+               QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS);
+  scan_bore(mem1, n, 1.5e9, 0, q);
+  scan_bore(mem1, n, 1.5e9, 1, q_batch);
+  d = max_quat_diff(q, q_batch, n);
+  check(d < 1e-5, "azel2bore_batch, per-sample corrections", d);
+
+  scan_bore(mem1, n, 1.5e9 + 6716 - 500, 0, q);
+  scan_bore(mem1, n, 1.5e9 + 6716 - 500, 1, q_batch);
+  nflip = quat_sign_flips(q, q_batch, n);
+  d = max_quat_diff(q, q_batch, n);
+  check(nflip == 0 && d < 1e-5, "azel2bore_batch, earth rotation wrap",
+        nflip);
+
+  qp_free_memory(mem1);
+  free(q);
+  free(q_batch);
+}
+
+/* With interp_corr, the wobble, earth rotation and NPB corrections updated
+   every 10 seconds agree with per-sample evaluation to 1e-5 arcsec, in
+   both the per-sample and batched routines, and do not depend on how the
+   timestream is split across threads. */
+static void test_interp_corr(qp_memory_t *mem) {
+  size_t n = NSAMP;
+  quat_t *q = malloc(n * sizeof(quat_t));
+  quat_t *q_interp = malloc(n * sizeof(quat_t));
+  quat_t *q_serial = malloc(n * sizeof(quat_t));
+  qp_memory_t *mem1 = qp_init_memory();
+  double d, d_held;
+
+  qp_set_opt_num_threads(mem1, qp_get_opt_num_threads(mem));
+  qp_set_rates(mem1, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS,
+               QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS);
+  scan_bore(mem1, n, 1.5e9 + 3.7, 0, q);
+
+  qp_set_rates(mem1, QP_DO_ALWAYS, QP_DO_ALWAYS, 10, QP_DO_ALWAYS, 10, 10,
+               QP_DO_ALWAYS, QP_DO_ALWAYS);
+  scan_bore(mem1, n, 1.5e9 + 3.7, 0, q_interp);
+  d_held = max_quat_diff(q, q_interp, n);
+
+  qp_set_opt_interp_corr(mem1, 1);
+  scan_bore(mem1, n, 1.5e9 + 3.7, 0, q_interp);
+  d = max_quat_diff(q, q_interp, n);
+  check(d < 1e-5 && d_held > 1e-3, "interp_corr vs per-sample corrections",
+        d);
+
+  scan_bore(mem1, n, 1.5e9 + 3.7, 1, q_interp);
+  d = max_quat_diff(q, q_interp, n);
+  check(d < 1e-5, "interp_corr, batched", d);
+
+  qp_set_opt_num_threads(mem1, 1);
+  scan_bore(mem1, n, 1.5e9 + 3.7, 0, q_serial);
+  qp_set_opt_num_threads(mem1, qp_get_opt_num_threads(mem));
+  scan_bore(mem1, n, 1.5e9 + 3.7, 0, q_interp);
+  d = max_quat_diff(q_serial, q_interp, n);
+  check(d == 0, "interp_corr, threaded vs serial", d);
+
+  qp_free_memory(mem1);
+  free(q);
+  free(q_interp);
+  free(q_serial);
+}
+
+/* A correction table filled with qp_fill_ephem agrees with evaluating the
+   corrections per sample to 1e-5 arcsec, in the per-sample and batched
+   boresight routines and in azel2radec.  Samples outside the table, and
+   tables computed with another accuracy option, fall back to per-sample
+   evaluation. */
+static void test_ephem(qp_memory_t *mem) {
+  size_t n = NSAMP;
+  int nt = (int) (n / 20 / 60) + 3;
+  double *data = malloc(nt * QP_EPHEM_NCOL * sizeof(double));
+  double *bad = malloc(nt * QP_EPHEM_NCOL * sizeof(double));
+  quat_t *q = malloc(n * sizeof(quat_t));
+  quat_t *q_tab = malloc(n * sizeof(quat_t));
+  quat_t *q_batch = malloc(n * sizeof(quat_t));
+  double *az = malloc(n * sizeof(double));
+  double *el = malloc(n * sizeof(double));
+  double *lon = malloc(n * sizeof(double));
+  double *lat = malloc(n * sizeof(double));
+  double *ctime = malloc(n * sizeof(double));
+  double *ra = malloc(n * sizeof(double));
+  double *dec = malloc(n * sizeof(double));
+  double *ra_tab = malloc(n * sizeof(double));
+  double *dec_tab = malloc(n * sizeof(double));
+  double *s2p = malloc(n * sizeof(double));
+  double *c2p = malloc(n * sizeof(double));
+  qp_memory_t *mem1 = qp_init_memory();
+  double t0 = 1.5e9 + 3.7, d, d_bad;
+
+  qp_set_opt_num_threads(mem1, qp_get_opt_num_threads(mem));
+  qp_set_rates(mem1, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS,
+               QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS, QP_DO_ALWAYS);
+  qp_fill_ephem(mem1, t0 - 60, 60, nt, data);
+
+  /* a table without the NPB correction, to tell whether it is used */
+  memcpy(bad, data, nt * QP_EPHEM_NCOL * sizeof(double));
+  for (int ii = 0; ii < nt; ii++) {
+    bad[ii * QP_EPHEM_NCOL + 4] = 1;
+    for (int jj = 5; jj < 8; jj++)
+      bad[ii * QP_EPHEM_NCOL + jj] = 0;
+  }
+
+  scan_bore(mem1, n, t0, 0, q);
+  scan_bore(mem1, n, t0, 1, q_batch);
+  qp_set_ephem(mem1, t0 - 60, 60, nt, 0, data);
+  scan_bore(mem1, n, t0, 0, q_tab);
+  d = max_quat_diff(q, q_tab, n);
+  check(d < 1e-5, "ephem table vs per-sample corrections", d);
+
+  scan_bore(mem1, n, t0, 1, q_tab);
+  d = max_quat_diff(q_batch, q_tab, n);
+  check(d < 1e-5, "ephem table, batched", d);
+
+  for (size_t ii = 0; ii < n; ii++) {
+    az[ii] = 100 + 40 * sin(ii / 400.);
+    el[ii] = 40 + 5 * sin(ii / 5000.);
+    lon[ii] = -67;
+    lat[ii] = -23;
+    ctime[ii] = t0 + ii / 20.;
+  }
+  qp_set_ephem(mem1, 0, 0, 0, 0, NULL);
+  qp_reset_rates(mem1);
+  qp_azel2radec(mem1, 0, 0, 0, az, el, NULL, NULL, lon, lat, ctime, ra, dec,
+                s2p, c2p, n);
+  qp_set_ephem(mem1, t0 - 60, 60, nt, 0, data);
+  qp_reset_rates(mem1);
+  qp_azel2radec(mem1, 0, 0, 0, az, el, NULL, NULL, lon, lat, ctime, ra_tab,
+                dec_tab, s2p, c2p, n);
+  d = 0;
+  for (size_t ii = 0; ii < n; ii++) {
+    d = fmax(d, angle_diff(ra[ii], ra_tab[ii]) * cos(dec[ii] * d2r) * 3600);
+    d = fmax(d, fabs(dec[ii] - dec_tab[ii]) * 3600);
+  }
+  check(d < 1e-5, "ephem table, azel2radec", d);
+
+  /* the modified table is used when it applies */
+  qp_set_ephem(mem1, t0 - 60, 60, nt, 0, bad);
+  scan_bore(mem1, n, t0, 0, q_tab);
+  d_bad = max_quat_diff(q, q_tab, n);
+
+  /* ... but not outside its range */
+  qp_set_ephem(mem1, t0 + n / 20. + 60, 60, nt, 0, bad);
+  scan_bore(mem1, n, t0, 0, q_tab);
+  d = max_quat_diff(q, q_tab, n);
+  check(d == 0 && d_bad > 1, "ephem table, out of range", d);
+
+  /* ... or when computed with another accuracy */
+  qp_set_ephem(mem1, t0 - 60, 60, nt, 1, bad);
+  scan_bore(mem1, n, t0, 0, q_tab);
+  d = max_quat_diff(q, q_tab, n);
+  check(d == 0, "ephem table, accuracy mismatch", d);
+
+  qp_free_memory(mem1);
+  free(data);
+  free(bad);
+  free(q);
+  free(q_tab);
+  free(q_batch);
+  free(az);
+  free(el);
+  free(lon);
+  free(lat);
+  free(ctime);
+  free(ra);
+  free(dec);
+  free(ra_tab);
+  free(dec_tab);
+  free(s2p);
+  free(c2p);
+}
+
+/* The batched pixelization kernel matches chealpix exactly, for random
+   and boundary positions (poles, the polar cap edges, and ra at and
+   around multiples of 45 degrees), with each ordering, with and without
+   fast_pix. */
+static void test_pixelization(qp_memory_t *mem) {
+  const int nsides[3] = {1, 64, 8192};
+  const double decs[5] = {90, -90, 0, 41.8103148957786, -41.8103148957786};
+  size_t n = NSAMP, nbad = 0;
+  double *ra = malloc(n * sizeof(double));
+  double *dec = malloc(n * sizeof(double));
+  double *pa = malloc(n * sizeof(double));
+  double *s2p = malloc(n * sizeof(double));
+  double *c2p = malloc(n * sizeof(double));
+  long *pix = malloc(n * sizeof(long));
+  quat_t *q = malloc(n * sizeof(quat_t));
+  double vec[3];
+  long ref;
+
+  srand(2);
+  for (size_t ii = 0; ii < n; ii++) {
+    if (ii % 4) {
+      ra[ii] = 1080. * rand() / RAND_MAX - 360;
+      dec[ii] = asin(2. * rand() / RAND_MAX - 1) * r2d;
+    } else {
+      ra[ii] = 45 * (int) (ii / 4 % 16) + ((ii / 64) % 3 - 1) * 1e-12;
+      dec[ii] = decs[ii / 4 % 5];
+    }
+    pa[ii] = 360. * rand() / RAND_MAX;
+  }
+  qp_radecpa2quatn(mem, ra, dec, pa, q, n);
+
+  for (int kk = 0; kk < 3; kk++) {
+    for (int nest = 0; nest < 2; nest++) {
+      qp_set_opt_pix_order(mem, nest ? QP_ORDER_NEST : QP_ORDER_RING);
+
+      qp_radec2pixn(mem, ra, dec, nsides[kk], pix, n);
+      for (size_t ii = 0; ii < n; ii++) {
+        if (nest)
+          ang2pix_nest(nsides[kk], (90 - dec[ii]) * d2r, ra[ii] * d2r, &ref);
+        else
+          ang2pix_ring(nsides[kk], (90 - dec[ii]) * d2r, ra[ii] * d2r, &ref);
+        nbad += pix[ii] != ref;
+      }
+
+      qp_set_opt_fast_pix(mem, 1);
+      qp_quat2pixn(mem, q, nsides[kk], pix, s2p, c2p, n);
+      for (size_t ii = 0; ii < n; ii++) {
+        Quaternion_to_matrix_col3(q[ii], vec);
+        if (nest)
+          vec2pix_nest(nsides[kk], vec, &ref);
+        else
+          vec2pix_ring(nsides[kk], vec, &ref);
+        nbad += pix[ii] != ref;
+      }
+      qp_set_opt_fast_pix(mem, 0);
+    }
+  }
+  check(nbad == 0, "batched pixelization vs chealpix", nbad);
+
+  qp_set_opt_pix_order(mem, QP_ORDER_RING);
+  free(ra);
+  free(dec);
+  free(pa);
+  free(s2p);
+  free(c2p);
+  free(pix);
+  free(q);
+}
+
+/* Rotations between registered frames agree with the dedicated galactic
+   routines, a frame centered on a position puts it at the origin, and
+   rotations through the ecliptic frame and back are the identity. */
+static void test_frames(qp_memory_t *mem) {
+  size_t n = 2000;
+  double *ra = malloc(n * sizeof(double));
+  double *dec = malloc(n * sizeof(double));
+  double *s2p = malloc(n * sizeof(double));
+  double *c2p = malloc(n * sizeof(double));
+  double *ra1 = malloc(n * sizeof(double));
+  double *dec1 = malloc(n * sizeof(double));
+  double *s2p1 = malloc(n * sizeof(double));
+  double *c2p1 = malloc(n * sizeof(double));
+  double d, d1, ra0 = 83.6, dec0 = 22.0, pa0 = 30.0;
+  int err;
+
+  srand(3);
+  for (size_t ii = 0; ii < n; ii++) {
+    ra[ii] = 360. * rand() / RAND_MAX;
+    dec[ii] = asin(1.98 * rand() / RAND_MAX - 0.99) * r2d;
+    s2p[ii] = sin(ii * 0.1);
+    c2p[ii] = cos(ii * 0.1);
+  }
+
+  for (int dir = 0; dir < 2; dir++) {
+    memcpy(ra1, ra, n * sizeof(double));
+    memcpy(dec1, dec, n * sizeof(double));
+    memcpy(s2p1, s2p, n * sizeof(double));
+    memcpy(c2p1, c2p, n * sizeof(double));
+    if (dir) {
+      err = qp_rotate_coordn(mem, 'G', 'C', ra1, dec1, s2p1, c2p1, n);
+      qp_gal2radecn(mem, ra, dec, s2p, c2p, n);
+    } else {
+      err = qp_rotate_coordn(mem, 'C', 'G', ra1, dec1, s2p1, c2p1, n);
+      qp_radec2galn(mem, ra, dec, s2p, c2p, n);
+    }
+    d = 0;
+    for (size_t ii = 0; ii < n; ii++) {
+      d = fmax(d, angle_diff(ra[ii], ra1[ii]) * cos(dec[ii] * d2r));
+      d = fmax(d, fabs(dec[ii] - dec1[ii]));
+      d = fmax(d, fabs(s2p[ii] - s2p1[ii]));
+      d = fmax(d, fabs(c2p[ii] - c2p1[ii]));
+    }
+    check(!err && d < 1e-10, dir ? "rotate_coord G->C vs gal2radec" :
+          "rotate_coord C->G vs radec2gal", d);
+  }
+
+  /* a frame centered on a position */
+  err = qp_set_frame_center(mem, 'F', ra0, dec0, pa0);
+  ra1[0] = ra0;
+  dec1[0] = dec0;
+  s2p1[0] = pa0;
+  err |= qp_rotate_coordpan(mem, 'C', 'F', ra1, dec1, s2p1, 1);
+  d = fmax(fmax(angle_diff(ra1[0], 0), fabs(dec1[0])),
+           angle_diff(s2p1[0], 0));
+  check(!err && d < 1e-10, "frame center at the origin", d);
+
+  /* round trip through the ecliptic */
+  memcpy(ra1, ra, n * sizeof(double));
+  memcpy(dec1, dec, n * sizeof(double));
+  memcpy(s2p1, s2p, n * sizeof(double));
+  memcpy(c2p1, c2p, n * sizeof(double));
+  err = qp_rotate_coordn(mem, 'C', 'E', ra1, dec1, s2p1, c2p1, n);
+  d1 = angle_diff(ra[0], ra1[0]) + fabs(dec[0] - dec1[0]);
+  err |= qp_rotate_coordn(mem, 'E', 'C', ra1, dec1, s2p1, c2p1, n);
+  d = 0;
+  for (size_t ii = 0; ii < n; ii++) {
+    d = fmax(d, angle_diff(ra[ii], ra1[ii]) * cos(dec[ii] * d2r));
+    d = fmax(d, fabs(dec[ii] - dec1[ii]));
+    d = fmax(d, fabs(s2p[ii] - s2p1[ii]));
+  }
+  check(!err && d1 > 1 && d < 1e-10, "rotate_coord C->E->C", d);
+
+  err = qp_rotate_coordn(mem, 'C', 'X', ra1, dec1, s2p1, c2p1, n);
+  check(err == QP_ERROR_INIT, "unknown frame", err);
+
+  qp_set_error(mem, 0, NULL);
+  free(ra);
+  free(dec);
+  free(s2p);
+  free(c2p);
+  free(ra1);
+  free(dec1);
+  free(s2p1);
+  free(c2p1);
+}
+
+/* Errors set in any chunk of a threaded sample loop reach mem, and mem
+   keeps its error state if no chunk fails. */
+static void test_sample_loop_errors(qp_memory_t *mem) {
+  int n = NSAMP;
+
+  qp_set_error(mem, 0, NULL);
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    if (start <= n / 2 && end > n / 2)
+      qp_set_error(memloc, QP_ERROR_POINT, "chunk error");
+  );
+  check(qp_get_error_code(mem) == QP_ERROR_POINT, "sample loop, chunk error",
+        qp_get_error_code(mem));
+
+  qp_set_error(mem, QP_ERROR_MAP, "earlier error");
+  QP_SAMPLE_RANGE(mem, n, start, end,
+    (void) memloc;
+    (void) start;
+    (void) end;
+  );
+  check(qp_get_error_code(mem) == QP_ERROR_MAP, "sample loop, no error",
+        qp_get_error_code(mem));
+
+  qp_set_error(mem, 0, NULL);
+}
+
+/* Errors set on the per-thread copies of mem are merged into mem without
+   mixing the error codes of different threads. */
+static void test_merge_errors(qp_memory_t *mem) {
+  int err = 0;
+
+  qp_set_error(mem, QP_ERROR_INIT, "earlier error");
+#pragma omp parallel num_threads(4)
+  {
+    qp_memory_t *memloc = qp_copy_memory(mem);
+    if (omp_get_thread_num() % 2)
+      qp_set_error(memloc, QP_ERROR_POINT, "thread error");
+    else
+      qp_set_error(memloc, QP_ERROR_MAP, "thread error");
+    qp_merge_error(mem, memloc, &err);
+    qp_free_memory(memloc);
+  }
+  check((err == QP_ERROR_POINT || err == QP_ERROR_MAP) &&
+        qp_get_error_code(mem) == err, "merged thread errors", err);
+
+  qp_set_error(mem, 0, NULL);
+}
+
+/* Pointing for an array of detectors matches the single-detector routine,
+   computed serially. */
+static void test_ndet(qp_memory_t *mem, double *ctime, quat_t *q_bore) {
+  const int ndet = 5, n = NSAMP;
+  quat_t q_off[5];
+  double *ra = malloc(ndet * n * sizeof(double));
+  double *dec = malloc(ndet * n * sizeof(double));
+  double *s2p = malloc(ndet * n * sizeof(double));
+  double *c2p = malloc(ndet * n * sizeof(double));
+  double *ra1 = malloc(n * sizeof(double));
+  double *dec1 = malloc(n * sizeof(double));
+  double *s2p1 = malloc(n * sizeof(double));
+  double *c2p1 = malloc(n * sizeof(double));
+  qp_memory_t *mem1 = qp_init_memory();
+  double d = 0;
+
+  qp_set_opt_num_threads(mem1, 1);
+  for (int idet = 0; idet < ndet; idet++)
+    qp_det_offset(0.5 * idet - 1, 0.3 * idet, 30 * idet, q_off[idet]);
+
+  qp_set_error(mem, QP_ERROR_MAP, "stale error");
+  qp_bore2radec_ndet(mem, q_off, ndet, ctime, q_bore, NULL, ra, dec, s2p,
+                     c2p, n);
+  for (int idet = 0; idet < ndet; idet++) {
+    size_t off = (size_t) idet * n;
+    qp_bore2radec(mem1, q_off[idet], ctime, q_bore, ra1, dec1, s2p1, c2p1,
+                  n);
+    d = fmax(d, max_diff(ra + off, ra1, n));
+    d = fmax(d, max_diff(dec + off, dec1, n));
+    d = fmax(d, max_diff(s2p + off, s2p1, n));
+    d = fmax(d, max_diff(c2p + off, c2p1, n));
+  }
+  check(d < 1e-10 && qp_get_error_code(mem) == QP_ERROR_MAP,
+        "bore2radec_ndet vs serial bore2radec", d);
+
+  qp_set_error(mem, 0, NULL);
+  qp_free_memory(mem1);
+  free(ra);
+  free(dec);
+  free(s2p);
+  free(c2p);
+  free(ra1);
+  free(dec1);
+  free(s2p1);
+  free(c2p1);
+}
+
+int main(int argc, char *argv[]) {
+  qp_memory_t *mem = qp_init_memory();
+  double *ctime;
+  quat_t *q_bore;
+
+  qp_set_opt_num_threads(mem, 4);
+  make_scan(mem, NSAMP, &ctime, &q_bore);
+
+  test_sample_loop_errors(mem);
+  test_merge_errors(mem);
+  test_ndet(mem, ctime, q_bore);
+  test_batch(mem);
+  test_interp_corr(mem);
+  test_ephem(mem);
+  test_pixelization(mem);
+  test_frames(mem);
+
+  free(ctime);
+  free(q_bore);
+  qp_free_memory(mem);
+
+  if (nfail)
+    printf("%d checks failed\n", nfail);
+  return nfail ? 1 : 0;
+}